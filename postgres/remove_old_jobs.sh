@@ -1,13 +1,15 @@
 #!/bin/bash
 # Script to remove searches performed more than 7 days ago
+#
+# The producer applies the retention on its own (see sequence_search/db/retention.py), dropping whole weekly
+# partitions of the results; it can also be run once with:
+#
+#   ENVIRONMENT=PRODUCTION python3 -m sequence_search.db.retention --days 7
+#
+# This script is a fallback that deletes the old jobs with a single statement, rows of other tables are
+# deleted by cascade.
 
 dbname="producer"
 username="docker"
 
-old_jobs=(`psql -X -A -d $dbname -U $username -t -c "SELECT id FROM jobs WHERE submitted < NOW() - INTERVAL '7 days';"`)
-
-for job in ${!old_jobs[*]}
-do
-  # delete jobs
-  psql -U $username -d $dbname -c "DELETE FROM jobs WHERE id='${old_jobs[$job]}'"
-done
+psql -X -U $username -d $dbname -c "DELETE FROM jobs WHERE submitted < NOW() - INTERVAL '7 days';"
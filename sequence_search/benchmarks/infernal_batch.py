@@ -0,0 +1,112 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+
+from sequence_search.consumer.infernal_deoverlap import infernal_deoverlap
+from sequence_search.consumer.infernal_parse import infernal_results, infernal_batch_results
+from sequence_search.consumer.infernal_search import infernal_search, infernal_batch_search, batch_query_name
+from sequence_search.consumer.settings import INFERNAL_QUERY_DIR, INFERNAL_RESULTS_DIR
+
+
+"""
+Compare the throughput of infernal jobs searched with a cmscan and a deoverlap each with the same jobs
+searched as a single batch, for 1, 10 and 50 queued jobs. Needs cmscan, cmsearch-deoverlap.pl and Rfam.cm,
+see the consumer settings. Run from the parent of sequence_search directory:
+
+python3 -m sequence_search.benchmarks.infernal_batch --queued 1 10 50
+
+The hits found for each job are compared between the two ways, to make sure the batch finds the same.
+"""
+
+# lengths of the queries, most searches are short ncRNAs
+LENGTHS = [22, 45, 80, 120, 200, 350]
+
+
+def random_queries(count, seed=0):
+    generator = random.Random(seed)
+    return [
+        ''.join(generator.choice('ACGU') for _ in range(generator.choice(LENGTHS)))
+        for _ in range(count)
+    ]
+
+
+def remove_files(job_id):
+    for path in [os.path.join(INFERNAL_QUERY_DIR, job_id), os.path.join(INFERNAL_RESULTS_DIR, job_id),
+                 os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id),
+                 os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout.deoverlapped' % job_id)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def run(process):
+    await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("process returned %s" % process.returncode)
+
+
+def hits(results):
+    return sorted((result['accession_rfam'], result['seq_from'], result['seq_to']) for result in results)
+
+
+async def search_one_by_one(queries):
+    """:return: list of the hits found for each query"""
+    found = []
+    for sequence in queries:
+        job_id = str(uuid.uuid4())
+        process, output = await infernal_search(sequence=sequence, job_id=job_id)
+        await run(process)
+        process, deoverlapped = await infernal_deoverlap(job_id=job_id)
+        await run(process)
+        found.append(hits(infernal_results(deoverlapped, output)))
+        remove_files(job_id)
+    return found
+
+
+async def search_in_batch(queries):
+    """:return: list of the hits found for each query"""
+    job_id = str(uuid.uuid4())
+    process, output = await infernal_batch_search(queries, job_id)
+    await run(process)
+    process, deoverlapped = await infernal_deoverlap(job_id=job_id)
+    await run(process)
+    batch = infernal_batch_results(deoverlapped, output)
+    remove_files(job_id)
+    return [hits(batch.get(batch_query_name(index), [])) for index in range(len(queries))]
+
+
+async def main(args):
+    print('%10s %18s %18s %10s %10s' % ('queued', 'one by one, jobs/s', 'batch, jobs/s', 'speedup', 'same hits'))
+    for queued in args.queued:
+        queries = random_queries(queued)
+
+        t0 = time.perf_counter()
+        expected = await search_one_by_one(queries)
+        one_by_one = queued / (time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        found = await search_in_batch(queries)
+        batch = queued / (time.perf_counter() - t0)
+
+        print('%10d %18.2f %18.2f %9.1fx %10s' % (queued, one_by_one, batch, batch / one_by_one, found == expected))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queued', type=int, nargs='+', default=[1, 10, 50])
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,269 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+from itertools import islice
+
+from sequence_search.consumer.infernal_parse import infernal_results
+
+
+"""
+Compare infernal_results with the parser it replaced on synthetic cmscan output files, with multi-block
+alignments and alignments without an NC line, that the old parser cut at the wrong line.
+Run from the parent of sequence_search directory:
+
+python3 -m sequence_search.benchmarks.infernal_parse --hits 1000 10000
+"""
+
+OUTPUT_HEADER = """# cmscan :: search sequence(s) against a CM database
+# INFERNAL 1.1.2 (July 2016)
+# Copyright (C) 2016 Howard Hughes Medical Institute.
+# Freely distributed under a BSD open source license.
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# query sequence file:                   query
+# target CM database:                    Rfam.cm
+# prefer accessions over names in output: yes
+# use CM's GA gathering cutoffs as reporting thresholds: yes
+# Rfam pipeline mode:                    on [fast]
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+"""
+
+OUTPUT_QUERY = """
+Query:       {query_name}  [L={query_length}]
+Hit scores:
+ rank     E-value  score  bias  modelname  start    end   mdl trunc   gc  description
+ ----   --------- ------ -----  --------- ------ ------   --- ----- ----  -----------
+{table}
+
+
+Hit alignments:
+{alignments}
+
+
+Internal CM pipeline statistics summary:
+----------------------------------------
+Query sequence(s):                                               1  ({query_length} residues searched)
+Target model(s):                                              3016  (836262 nodes)
+Total CM hits reported:                                 {hits:>10}  (0.8361); includes 0 truncated hit(s)
+
+# CPU time: 0.93u 0.22s 00:00:01.15 Elapsed: 00:00:00.49
+//
+"""
+
+TBLOUT_HEADER = """#target name         accession query name           accession mdl mdl from   mdl to seq from   seq to strand trunc pass   gc  bias  score   E-value inc description of target
+#------------------- --------- -------------------- --------- --- -------- -------- -------- -------- ------ ----- ---- ---- ----- ------ --------- --- ---------------------
+"""
+
+TBLOUT_FOOTER = """#
+# Program:         cmscan
+# Version:         1.1.2 (July 2016)
+# Pipeline mode:   SCAN
+# [ok]
+"""
+
+DESCRIPTIONS = ['5S ribosomal RNA', 'LSU ribosomal RNA', 'tRNA', 'Bacterial small subunit ribosomal RNA',
+                'transfer-messenger RNA', 'U6 spliceosomal RNA']
+NUCLEOTIDES = 'ACGU'
+
+
+def synthetic_hit(generator, query_name, accession, seq_from, length, strand):
+    """:return: hit as infernal_parse returns it, with the alignment of one or more blocks"""
+    mdl_from = generator.randint(1, 300)
+    seq_to = seq_from + length - 1
+    if strand == '-':
+        seq_from, seq_to = seq_to, seq_from
+
+    hit = {
+        'target_name': 'model_%s' % accession[2:],
+        'accession_rfam': accession,
+        'query_name': query_name,
+        'accession_seq': '-',
+        'mdl': generator.choice(['cm', 'hmm']),
+        'mdl_from': mdl_from,
+        'mdl_to': mdl_from + length - 1,
+        'seq_from': seq_from,
+        'seq_to': seq_to,
+        'strand': strand,
+        'trunc': generator.choice(['no', "5'", "3'", "5'&3'"]),
+        'pipeline_pass': generator.randint(1, 4),
+        'gc': round(generator.uniform(0.2, 0.8), 2),
+        'bias': round(generator.uniform(0, 5), 1),
+        'score': round(generator.uniform(5, 150), 1),
+        'e_value': float('%.2g' % generator.uniform(1e-30, 10)),
+        'inc': generator.choice('!?'),
+        'description': generator.choice(DESCRIPTIONS),
+    }
+
+    # alignments of long hits are split in blocks, unless cmscan runs with --notextw
+    width = max(len(accession), len(query_name))
+    lines = ['']
+    position, block_length = 0, generator.choice([length, 60])
+    while position < length:
+        block = min(block_length, length - position)
+        model = ''.join(generator.choice(NUCLEOTIDES).lower() for _ in range(block))
+        query = ''.join(nt.upper() if generator.random() < 0.8 else generator.choice(NUCLEOTIDES) for nt in model)
+        prefix = '  %s %5d ' % (accession.rjust(width), hit['mdl_from'] + position)
+        if position:
+            lines.append('')
+        if generator.random() < 0.3:
+            lines.append(' ' * (len(prefix) + block) + ' NC')
+        lines.append(' ' * len(prefix) + ''.join(generator.choice('(<,-_>)') for _ in range(block)) + ' CS')
+        lines.append(prefix + model + ' %d' % (hit['mdl_from'] + position + block - 1))
+        lines.append(' ' * len(prefix) + ''.join(q if q == m.upper() else ' ' for q, m in zip(query, model)))
+        lines.append('  %s %5d ' % (query_name.rjust(width), position + 1) + query + ' %d' % (position + block))
+        lines.append(' ' * len(prefix) + ''.join(generator.choice('6789*') for _ in range(block)) + ' PP')
+        position += block
+
+    hit['alignment'] = '\n'.join(lines) + '\n'
+    return hit
+
+
+def tblout_line(hit):
+    return '%-20s %-9s %-20s %-9s %-3s %8d %8d %8d %8d %6s %5s %4d %4.2f %5.1f %6.1f %9s %-3s %s\n' % (
+        hit['target_name'], hit['accession_rfam'], hit['query_name'], hit['accession_seq'], hit['mdl'],
+        hit['mdl_from'], hit['mdl_to'], hit['seq_from'], hit['seq_to'], hit['strand'], hit['trunc'],
+        hit['pipeline_pass'], hit['gc'], hit['bias'], hit['score'], '%g' % hit['e_value'], hit['inc'],
+        hit['description']
+    )
+
+
+def output_hit(rank, hit):
+    """'>>' record of a hit in the cmscan output"""
+    return '>> %s  %s\n' % (hit['accession_rfam'], hit['description']) + \
+        ' rank     E-value  score  bias mdl mdl from   mdl to       seq from      seq to       acc trunc   gc\n' + \
+        ' ----   --------- ------ ----- --- -------- --------    -------- --------      ---- -----  ----\n' + \
+        ' %4s %s %9s %6.1f %5.1f %3s %8d %8d %s %8d %8d %s %s %7.2f %5s %5.2f\n' % (
+            '(%d)' % rank, hit['inc'], '%g' % hit['e_value'], hit['score'], hit['bias'], hit['mdl'],
+            hit['mdl_from'], hit['mdl_to'], '[]', hit['seq_from'], hit['seq_to'], hit['strand'], '[]', 0.99,
+            hit['trunc'], hit['gc']) + \
+        hit['alignment'] + '\n'
+
+
+def write_synthetic_cmscan_output(output_filename, tblout_filename, hits, queries=1, seed=0):
+    """
+    Write a cmscan output file and its tblout with `hits` hits spread over `queries` queries
+    :return: list of the hits, as infernal_results returns them
+    """
+    generator = random.Random(seed)
+    query_names = ['query'] if queries == 1 else ['query%d' % index for index in range(queries)]
+
+    written = {query_name: [] for query_name in query_names}
+    for index in range(hits):
+        query_name = generator.choice(query_names)
+        # each hit of a query has its own model, so that hits are never the same
+        accession = 'RF%05d' % (index + 1)
+        hit = synthetic_hit(generator, query_name, accession, generator.randint(1, 2000),
+                            generator.randint(20, 200), generator.choice('+-'))
+        written[query_name].append(hit)
+
+    with open(output_filename, 'w') as output, open(tblout_filename, 'w') as tblout:
+        output.write(OUTPUT_HEADER)
+        tblout.write(TBLOUT_HEADER)
+        for query_name in query_names:
+            query_hits = sorted(written[query_name], key=lambda hit: -hit['score'])
+            table = '\n'.join(
+                '  (%d) %s %9s %6.1f %5.1f  %-9s %6d %6d %s  %-3s %5s %4.2f  %s' % (
+                    rank, hit['inc'], '%g' % hit['e_value'], hit['score'], hit['bias'], hit['accession_rfam'],
+                    hit['seq_from'], hit['seq_to'], hit['strand'], hit['mdl'], hit['trunc'], hit['gc'],
+                    hit['description'])
+                for rank, hit in enumerate(query_hits, 1)
+            ) or '\n   [No hits detected that satisfy reporting thresholds]'
+            output.write(OUTPUT_QUERY.format(
+                query_name=query_name, query_length=2200, hits=len(query_hits), table=table,
+                alignments='\n'.join(output_hit(rank, hit) for rank, hit in enumerate(query_hits, 1))
+            ))
+            for hit in query_hits:
+                tblout.write(tblout_line(hit))
+        output.write('[ok]\n')
+        tblout.write(TBLOUT_FOOTER)
+
+    return [hit for query_name in query_names for hit in sorted(written[query_name], key=lambda hit: -hit['score'])]
+
+
+def legacy_infernal_results(deoverlap_filename, output_filename):
+    """
+    The parser before infernal_results, for comparison: the tblout is read with readlines() and re.sub,
+    alignments are 7 lines after the scores of a hit, joined by their 8 values
+    """
+    lines = []
+    with open(deoverlap_filename, 'r') as file:
+        for line in file.readlines():
+            if not line.startswith('#'):
+                line = re.sub(" +", " ", line).strip()
+                lines.append(line.split(" "))
+    columns = ['target_name', 'accession_rfam', 'query_name', 'accession_seq', 'mdl', 'mdl_from', 'mdl_to',
+               'seq_from', 'seq_to', 'strand', 'trunc', 'pipeline_pass', 'gc', 'bias', 'score', 'e_value', 'inc']
+    results = [dict(zip(columns, item), description=' '.join(item[17:])) for item in lines]
+
+    def key(item):
+        return (item['accession_rfam'], int(item['mdl_from']), int(item['mdl_to']), int(item['seq_from']),
+                int(item['seq_to']), float(item['gc']), float(item['score']), float(item['e_value']))
+
+    alignments = {}
+    with open(output_filename, 'r') as file:
+        for line in file:
+            if line.startswith('>>'):
+                accession = line.split(' ')[1]
+                values = list(filter(None, ''.join(islice(file, 2, 3)).split(' ')))
+                item = {'accession_rfam': accession, 'mdl_from': values[6], 'mdl_to': values[7],
+                        'seq_from': values[9], 'seq_to': values[10], 'gc': values[15], 'score': values[3],
+                        'e_value': values[2]}
+                alignments.setdefault(key(item), ''.join(islice(file, 7)))
+
+    for result in results:
+        result['alignment'] = alignments.get(key(result))
+    return results
+
+
+def measure(function, repeat):
+    """Best wall-clock time of `repeat` runs"""
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%8s %10s %12s %12s %10s %18s' % ('hits', 'size, MB', 'old', 'new', 'speedup', 'old, wrong alignments'))
+    with tempfile.TemporaryDirectory() as directory:
+        for hits in args.hits:
+            output = os.path.join(directory, 'cmscan_%s' % hits)
+            tblout = os.path.join(directory, 'cmscan_%s.tblout' % hits)
+            expected = write_synthetic_cmscan_output(output, tblout, hits)
+
+            assert infernal_results(tblout, output) == expected
+            wrong = sum(result['alignment'] != hit['alignment']
+                        for result, hit in zip(legacy_infernal_results(tblout, output), expected))
+
+            old = measure(lambda: legacy_infernal_results(tblout, output), args.repeat)
+            new = measure(lambda: infernal_results(tblout, output), args.repeat)
+
+            print('%8d %10.1f %11.3fs %11.3fs %9.1fx %18d' % (
+                hits, os.path.getsize(output) / 1024 ** 2, old, new, old / new, wrong
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import datetime
+import time
+import uuid
+
+from aiopg.sa import create_engine
+
+from sequence_search.db.models import Job, JobChunk, JobChunkResult, JobChunkResultAlignment
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+
+
+"""
+Compare the single INSERT ... VALUES statement that used to store nhmmer results
+with the batched insert_job_chunk_results. Requires the test database:
+
+ENVIRONMENT=TEST python3 -m sequence_search.db
+python3 -m sequence_search.benchmarks.job_chunk_results --results 1000 10000
+"""
+
+
+def synthetic_results(count):
+    return [{
+        'rnacentral_id': 'URS%010X_9606' % index,
+        'description': 'Homo sapiens microRNA 21 stem-loop',
+        'score': 100.0,
+        'bias': 0.1,
+        'e_value': 1.2e-20,
+        'target_length': 72,
+        'alignment': 'Query 1 GAGUUUGAGACCAGCCUGGCCA 22\n        GAGUUUGAGACCAGCCUGGCCA\nSbjct 1 GAGUUUGAGACCAGCCUGGCCA 22',
+        'alignment_length': 22,
+        'gap_count': 0,
+        'match_count': 22,
+        'nts_count1': 22,
+        'nts_count2': 0,
+        'identity': 100.0,
+        'query_coverage': 100.0,
+        'target_coverage': 30.5,
+        'gaps': 0.0,
+        'query_length': 22,
+        'result_id': index,
+        'alignment_start': 1.0,
+        'alignment_stop': 22.0,
+        'alignment_sequence': 'GAGUUUGAGACCAGCCUGGCCA',
+    } for index in range(count)]
+
+
+async def old_insert(connection, job_chunk_id, results):
+    alignments = {}
+    for result in results:
+        result['job_chunk_id'] = job_chunk_id
+        alignments[result['result_id']] = {
+            'alignment': result.pop('alignment'),
+            'alignment_sequence': result.pop('alignment_sequence')
+        }
+
+    query = JobChunkResult.insert().values(results).returning(JobChunkResult.c.result_id, JobChunkResult.c.id)
+    async for row in await connection.execute(query):
+        alignments[row.result_id]['job_chunk_result_id'] = row.id
+    await connection.execute(JobChunkResultAlignment.insert().values(list(alignments.values())))
+
+
+async def new_insert(connection, job_chunk_id, results):
+    await insert_job_chunk_results(connection, job_chunk_id, results)
+
+
+async def measure(engine, function, results, repeat):
+    """Best wall-clock time of `repeat` transactions, each one rolled back afterwards"""
+    timings = []
+    for _ in range(repeat):
+        async with engine.acquire() as connection:
+            transaction = await connection.begin()
+            job_id = str(uuid.uuid4())
+            await connection.execute(Job.insert().values(
+                id=job_id, query='AACAGCAUGAGUGCGCUGGAUGCUG', description='benchmark', submitted=datetime.datetime.now(),
+                priority='low', status='started'
+            ))
+            job_chunk_id = await connection.scalar(JobChunk.insert().values(
+                job_id=job_id, database='mirbase', submitted=datetime.datetime.now(), status='started'
+            ).returning(JobChunk.c.id))
+
+            t0 = time.perf_counter()
+            await function(connection, job_chunk_id, results)
+            timings.append(time.perf_counter() - t0)
+            await transaction.rollback()
+    return min(timings)
+
+
+async def main(args):
+    settings = get_postgres_credentials(ENVIRONMENT='TEST')
+    engine = await create_engine(
+        user=settings.POSTGRES_USER,
+        database=settings.POSTGRES_DATABASE,
+        host=settings.POSTGRES_HOST,
+        password=settings.POSTGRES_PASSWORD
+    )
+
+    print('%8s %12s %12s %12s %12s' % ('results', 'old, s', 'new, s', 'old, rows/s', 'new, rows/s'))
+    for count in args.results:
+        old = await measure(engine, old_insert, synthetic_results(count), args.repeat)
+        new = await measure(engine, new_insert, synthetic_results(count), args.repeat)
+        print('%8d %11.3fs %11.3fs %12d %12d' % (count, old, new, count / old, count / new))
+
+    engine.close()
+    await engine.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,151 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import time
+import uuid
+
+from aiopg.sa import create_engine
+
+from sequence_search.db.models import Job, JobChunk
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+from sequence_search.db.jobs import get_job_results, get_job_result_alignment, archive_job_results
+
+
+"""
+Compare the payload size and latency of job results with alignments (what job-result
+used to return) with the summaries, that are returned by default, and with fetching
+single alignments on demand, before and after the job is archived. Requires the test database:
+
+ENVIRONMENT=TEST python3 -m sequence_search.db
+python3 -m sequence_search.benchmarks.job_results --hits 1000 --query-length 200
+"""
+
+
+def synthetic_alignment(query_length):
+    """An nhmmer-like alignment: blocks of 4 lines with 60 nucleotides each"""
+    lines = []
+    for start in range(0, query_length, 60):
+        block = ''.join(random.choice('ACGU') for _ in range(min(60, query_length - start)))
+        lines.append('  query %6d %s %d' % (start + 1, block, start + len(block)))
+        lines.append('               %s' % block.lower())
+        lines.append('  URS0000000001_9606 %6d %s %d' % (start + 1, block, start + len(block)))
+        lines.append('               %s PP' % ('*' * len(block)))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def synthetic_results(count, query_length):
+    return [{
+        'rnacentral_id': 'URS%010X_9606' % index,
+        'description': 'Homo sapiens microRNA 21 stem-loop',
+        'score': 100.0 - index * 0.01,
+        'bias': 0.1,
+        'e_value': 1.2e-20,
+        'target_length': query_length,
+        'alignment': synthetic_alignment(query_length),
+        'alignment_length': query_length,
+        'gap_count': 0,
+        'match_count': query_length,
+        'nts_count1': query_length,
+        'nts_count2': 0,
+        'identity': 100.0,
+        'query_coverage': 100.0,
+        'target_coverage': 100.0,
+        'gaps': 0.0,
+        'query_length': query_length,
+        'result_id': index,
+        'alignment_start': 1,
+        'alignment_stop': query_length,
+        'alignment_sequence': ''.join(random.choice('ACGU') for _ in range(query_length)),
+    } for index in range(count)]
+
+
+async def measure(function, repeat):
+    """Best wall-clock time and the json payload size of `repeat` calls"""
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        payload = json.dumps(await function())
+        timings.append(time.perf_counter() - t0)
+    return min(timings), len(payload.encode('utf-8'))
+
+
+async def main(args):
+    settings = get_postgres_credentials(ENVIRONMENT='TEST')
+    engine = await create_engine(
+        user=settings.POSTGRES_USER,
+        database=settings.POSTGRES_DATABASE,
+        host=settings.POSTGRES_HOST,
+        password=settings.POSTGRES_PASSWORD
+    )
+
+    job_id = str(uuid.uuid4())
+    async with engine.acquire() as connection:
+        await connection.execute(Job.insert().values(
+            id=job_id, query='A' * args.query_length, description='benchmark', submitted=datetime.datetime.now(),
+            priority='low', status='success'
+        ))
+        job_chunk_id = await connection.scalar(JobChunk.insert().values(
+            job_id=job_id, database='mirbase', submitted=datetime.datetime.now(), status='success'
+        ).returning(JobChunk.c.id))
+        await insert_job_chunk_results(connection, job_chunk_id, synthetic_results(args.hits, args.query_length))
+        await connection.execute('ANALYZE job_chunk_results')
+        await connection.execute('ANALYZE job_chunk_result_alignments')
+
+    try:
+        with_alignments = lambda: get_job_results(engine, job_id, alignment=True)
+        summaries = lambda: get_job_results(engine, job_id)
+        page = lambda: get_job_results(engine, job_id, start=0, size=20)
+
+        result_id = (await summaries())[0]['id']
+        single_alignment = lambda: get_job_result_alignment(engine, job_id, result_id)
+
+        print('%-48s %12s %12s' % ('request', 'latency, ms', 'payload, kB'))
+        for storage in ['job_chunk_results', 'archive']:
+            if storage == 'archive':
+                await archive_job_results(engine, job_id)
+                async with engine.acquire() as connection:
+                    size = await connection.scalar(
+                        'SELECT octet_length(results) + octet_length(alignments) FROM job_results_archive '
+                        'WHERE job_id=%s', job_id
+                    )
+                print('archived into %.1f kB' % (size / 1024))
+
+            for name, function in [
+                ('all hits with alignments', with_alignments),
+                ('all hits, summaries', summaries),
+                ('page of 20 summaries', page),
+                ('single alignment', single_alignment),
+            ]:
+                latency, size = await measure(function, args.repeat)
+                print('%-48s %12.1f %12.1f' % ('%s, %s' % (name, storage), latency * 1000, size / 1024))
+    finally:
+        async with engine.acquire() as connection:
+            await connection.execute(Job.delete().where(Job.c.id == job_id))
+
+    engine.close()
+    await engine.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, default=1000)
+    parser.add_argument('--query-length', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,141 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import datetime
+import time
+import tracemalloc
+import uuid
+
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer
+from aiopg.sa import create_engine
+
+from sequence_search.benchmarks.job_results import synthetic_results
+from sequence_search.db.models import Job, JobChunk
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+from sequence_search.db.jobs import get_job_results, stream_job_results, archive_job_results
+from sequence_search.producer import streaming
+
+
+"""
+Compare peak memory and time to first byte of job results with alignments, sent with web.json_response
+(all results are read and serialized before the first byte is sent) and streamed as a JSON array or NDJSON
+(see producer/streaming.py), before and after the job is archived. Requires the test database:
+
+ENVIRONMENT=TEST python3 -m sequence_search.db
+python3 -m sequence_search.benchmarks.job_results_streaming --hits 1000 10000
+"""
+
+
+def make_app(engine, job_id, hits):
+    """Job results handlers without the limit of 1000 results of the job-result endpoint"""
+    async def buffered(request):
+        return web.json_response(await get_job_results(engine, job_id, alignment=True, limit=hits))
+
+    async def streamed(request):
+        rows = stream_job_results(engine, job_id, alignment=True, limit=hits)
+        return await streaming.stream_json(request, rows, streaming.STREAM_FORMATS[request.match_info['format']])
+
+    app = web.Application()
+    app.router.add_get('/buffered', buffered)
+    app.router.add_get('/stream/{format}', streamed)
+    return app
+
+
+async def fetch(session, url):
+    """Time to first byte, total time and size of the response, the body is read in chunks and dropped"""
+    start = time.perf_counter()
+    async with session.get(url) as response:
+        first_byte = None
+        size = 0
+        async for chunk in response.content.iter_any():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+    return first_byte, time.perf_counter() - start, size
+
+
+async def measure(session, url, repeat):
+    """Best time to first byte and total time of `repeat` requests, then the peak memory of one more"""
+    timings = [await fetch(session, url) for _ in range(repeat)]
+
+    tracemalloc.start()
+    await fetch(session, url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(timing[0] for timing in timings), min(timing[1] for timing in timings), timings[0][2], peak
+
+
+async def benchmark(engine, hits, args):
+    job_id = str(uuid.uuid4())
+    async with engine.acquire() as connection:
+        await connection.execute(Job.insert().values(
+            id=job_id, query='A' * args.query_length, description='benchmark', submitted=datetime.datetime.now(),
+            priority='low', status='success'
+        ))
+        job_chunk_id = await connection.scalar(JobChunk.insert().values(
+            job_id=job_id, database='mirbase', submitted=datetime.datetime.now(), status='success'
+        ).returning(JobChunk.c.id))
+        await insert_job_chunk_results(connection, job_chunk_id, synthetic_results(hits, args.query_length))
+        await connection.execute('ANALYZE job_chunk_results')
+        await connection.execute('ANALYZE job_chunk_result_alignments')
+
+    server = TestServer(make_app(engine, job_id, hits))
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            for storage in ['job_chunk_results', 'archive']:
+                if storage == 'archive':
+                    await archive_job_results(engine, job_id)
+
+                for name, path in [('json_response', '/buffered'), ('stream=json', '/stream/json'),
+                                   ('stream=ndjson', '/stream/ndjson')]:
+                    first_byte, total, size, peak = await measure(session, server.make_url(path), args.repeat)
+                    print('%-8d %-18s %-14s %10.1f %10.1f %12.1f %12.1f' % (
+                        hits, storage, name, first_byte * 1000, total * 1000, size / 1024 / 1024, peak / 1024 / 1024
+                    ))
+    finally:
+        await server.close()
+        async with engine.acquire() as connection:
+            await connection.execute(Job.delete().where(Job.c.id == job_id))
+
+
+async def main(args):
+    settings = get_postgres_credentials(ENVIRONMENT='TEST')
+    engine = await create_engine(
+        user=settings.POSTGRES_USER,
+        database=settings.POSTGRES_DATABASE,
+        host=settings.POSTGRES_HOST,
+        password=settings.POSTGRES_PASSWORD
+    )
+
+    print('rows are serialized with %s' % ('orjson' if streaming.orjson is not None else 'json'))
+    print('%-8s %-18s %-14s %10s %10s %12s %12s' % ('hits', 'storage', 'response', 'TTFB, ms', 'total, ms',
+                                                    'payload, MB', 'peak, MB'))
+    for hits in args.hits:
+        await benchmark(engine, hits, args)
+
+    engine.close()
+    await engine.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--query-length', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,113 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+
+from sequence_search.consumer import settings
+from sequence_search.consumer.nhmmer_parse import nhmmer_stream_parse
+from sequence_search.consumer.nhmmer_search import nhmmer_search
+from sequence_search.consumer.resident_databases import load_resident_databases
+from sequence_search.consumer.rnacentral_databases import database_file_path
+
+
+"""
+Compare per-chunk nhmmer latency of the 'subprocess' (fasta) and 'resident' (makehmmerdb FM-index)
+search backends for short, miRNA-length queries, and the hits they find: the FM-index seeds nhmmer
+with exact matches, so its hits can differ from those of the fasta scan.
+Needs nhmmer, makehmmerdb and the database chunks in consumer/databases.
+Run from the parent of sequence_search directory:
+
+python3 -m sequence_search.benchmarks.nhmmer_backends --databases mirbase.fasta ena1.fasta
+
+With --drop-caches (needs root) the page cache is dropped before every search,
+which is what a consumer sees for a chunk that was not searched recently.
+"""
+
+QUERIES = [
+    'UAGCUUAUCAGACUGAUGUUGA',  # hsa-miR-21-5p
+    'UGAGGUAGUAGGUUGUAUAGUU',  # hsa-let-7a-5p
+    'UAAAGUGCUUAUAGUGCAGGUAG',  # hsa-miR-20a-5p
+]
+
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+async def search(database, sequence):
+    job_id = str(uuid.uuid4())
+    process, filename = await nhmmer_search(sequence=sequence, job_id=job_id, database=database)
+    await process.communicate()
+
+    hits = set()
+    if process.returncode == 0:
+        hits = set(record['rnacentral_id'] for record in nhmmer_stream_parse(filename))
+
+    for path in [filename, os.path.join(settings.QUERY_DIR, '%s_%s' % (job_id, database))]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return process.returncode, hits
+
+
+async def measure(backend, database, repeat, cold):
+    """Median time of a search and the hits of every query"""
+    settings.SEARCH_BACKEND = backend
+    timings = []
+    hits = {}
+    for index in range(repeat):
+        if cold:
+            drop_caches()
+
+        query = QUERIES[index % len(QUERIES)]
+        t0 = time.perf_counter()
+        return_code, hits[query] = await search(database, query)
+        timings.append(time.perf_counter() - t0)
+
+        if return_code != 0:
+            raise RuntimeError("nhmmer returned %s for %s" % (return_code, database))
+    return statistics.median(timings), hits
+
+
+async def main(args):
+    indexed = load_resident_databases([database_file_path(database) for database in args.databases])
+    print('FM-indexes built for %s' % ', '.join(indexed) if indexed else 'FM-indexes are up-to-date')
+
+    print('%30s %10s %15s %15s %10s %10s %10s' % (
+        'database', 'size, MB', 'subprocess, s', 'resident, s', 'hits', 'common', 'resident'))
+    for database in args.databases:
+        size = os.path.getsize(database_file_path(database)) / 1024 / 1024
+        subprocess, fasta_hits = await measure('subprocess', database, args.repeat, args.drop_caches)
+        resident, index_hits = await measure('resident', database, args.repeat, args.drop_caches)
+
+        # hits of the fasta scan, how many of them the FM-index found too, hits of the FM-index
+        total = sum(len(hits) for hits in fasta_hits.values())
+        common = sum(len(hits & index_hits[query]) for query, hits in fasta_hits.items())
+        total_resident = sum(len(hits) for hits in index_hits.values())
+        print('%30s %10.1f %14.3fs %14.3fs %10d %10d %10d' % (
+            database, size, subprocess, resident, total, common, total_resident))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--databases', nargs='+', default=['mirbase.fasta'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--drop-caches', action='store_true')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
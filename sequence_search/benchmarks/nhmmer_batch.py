@@ -0,0 +1,119 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+
+from sequence_search.consumer import settings
+from sequence_search.consumer.nhmmer_parse import nhmmer_results, nhmmer_batch_results
+from sequence_search.consumer.nhmmer_search import nhmmer_search, nhmmer_batch_search, is_short
+
+
+"""
+Compare the throughput of job_chunks searched one nhmmer run each with job_chunks searched in batches
+of the same database, for a mix of miRNA-length and longer queries. Needs nhmmer and the database chunks
+in consumer/databases. Run from the parent of sequence_search directory:
+
+python3 -m sequence_search.benchmarks.nhmmer_batch --databases mirbase.fasta --queries 16 --batch-sizes 1 4 8
+
+Each batch is split into short and long queries, as the consumer does it, see views/submit_job.nhmmer_batch.
+The number of hits per query is compared between the two ways, to make sure the batches find the same.
+"""
+
+# lengths of the queries, most searches are short ncRNAs
+LENGTHS = [22, 22, 23, 30, 45, 80, 120, 200, 350, 1500]
+
+
+def random_queries(count, seed=0):
+    generator = random.Random(seed)
+    return [
+        ''.join(generator.choice('ACGU') for _ in range(generator.choice(LENGTHS)))
+        for _ in range(count)
+    ]
+
+
+def remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def run(process, query, output):
+    await process.communicate()
+    remove(query)
+    if process.returncode != 0:
+        raise RuntimeError("nhmmer returned %s" % process.returncode)
+
+
+async def search_one_by_one(queries, database):
+    """:return: list of the numbers of records found for each query"""
+    found = []
+    for sequence in queries:
+        job_id = str(uuid.uuid4())
+        process, output = await nhmmer_search(sequence=sequence, job_id=job_id, database=database)
+        await run(process, os.path.join(settings.QUERY_DIR, '%s_%s' % (job_id, database)), output)
+        found.append(len(nhmmer_results(output)))
+        remove(output)
+    return found
+
+
+async def search_in_batches(queries, database, batch_size):
+    """:return: list of the numbers of records found for each query, in the order of queries"""
+    found = {}
+    for start in range(0, len(queries), batch_size):
+        batch = list(enumerate(queries))[start:start + batch_size]
+        for short in [True, False]:
+            group = [(index, sequence) for index, sequence in batch if is_short(sequence) == short]
+            if not group:
+                continue
+
+            job_id = str(uuid.uuid4())
+            process, output = await nhmmer_batch_search([sequence for _, sequence in group], job_id, database)
+            await run(process, os.path.join(settings.QUERY_DIR, '%s_%s' % (job_id, database)), output)
+            sections = list(nhmmer_batch_results(output).values())
+            for (index, _), (stats, records) in zip(group, sections):
+                found[index] = len(records)
+            remove(output)
+    return [found.get(index) for index in range(len(queries))]
+
+
+async def main(args):
+    queries = random_queries(args.queries)
+    print('%d queries, lengths %s' % (len(queries), sorted(len(query) for query in queries)))
+
+    print('%30s %12s %15s %15s %10s' % ('database', 'batch size', 'time, s', 'queries/s', 'same hits'))
+    for database in args.databases:
+        t0 = time.perf_counter()
+        expected = await search_one_by_one(queries, database)
+        elapsed = time.perf_counter() - t0
+        print('%30s %12s %14.3fs %15.2f %10s' % (database, 'none', elapsed, len(queries) / elapsed, '-'))
+
+        for batch_size in args.batch_sizes:
+            t0 = time.perf_counter()
+            found = await search_in_batches(queries, database, batch_size)
+            elapsed = time.perf_counter() - t0
+            print('%30s %12d %14.3fs %15.2f %10s' % (
+                database, batch_size, elapsed, len(queries) / elapsed, found == expected
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--databases', nargs='+', default=['mirbase.fasta'])
+    parser.add_argument('--queries', type=int, default=16)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,169 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from itertools import islice
+
+from sequence_search.consumer.nhmmer_parse import nhmmer_parse, nhmmer_stream_parse
+
+
+"""
+Compare nhmmer_parse with nhmmer_stream_parse on synthetic nhmmer output files.
+Run from the parent of sequence_search directory:
+
+python3 -m sequence_search.benchmarks.nhmmer_parse --hits 1000 10000 50000
+"""
+
+HEADER = """# nhmmer :: search a DNA model, alignment, or sequence against a DNA database
+# HMMER 3.2.1 (June 2018); http://hmmer.org/
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# query file:                      queries/synthetic
+# target sequence database:        databases/all-except-rrna-1.fasta
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+Query:       query  [M={query_length}]
+Scores for complete hits:
+    E-value  score  bias  Sequence             start    end  Description
+    ------- ------ -----  --------             -----    ---  -----------
+{table}
+
+Annotation for each hit  (and alignments):
+"""
+
+FOOTER = """
+
+
+Internal pipeline statistics summary:
+-------------------------------------
+Query model(s):                            1  ({query_length} nodes)
+Target sequences:                    1562895  (1523647091 residues searched)
+Residues passing SSV filter:        25870374  (0.017); expected (0.02)
+Residues passing bias filter:       17283627  (0.0113); expected (0.02)
+Residues passing Vit filter:          918734  (0.000603); expected (0.003)
+Residues passing Fwd filter:          239418  (0.000157); expected (3e-05)
+Total number of hits:                  {hits}  (0.000238)
+Elapsed time: 00:01:03.17u 00:00:01.81s 00:00:18.45 Elapsed
+# Mc/sec: 9417.85
+//
+[ok]
+"""
+
+NUCLEOTIDES = 'ACGU'
+
+
+def synthetic_hit(rnacentral_id, description, blocks, block_length):
+    """Returns a single '>>' record with `blocks` alignment blocks of `block_length` nucleotides"""
+    query_start = random.randint(1, 5)
+    target_start = random.randint(1, 40)
+    score = round(random.uniform(5, 120), 1)
+    query_end = query_start + blocks * block_length - 1
+    target_end = target_start + blocks * block_length - 1
+
+    lines = [
+        '>> %s  %s' % (rnacentral_id, description),
+        '    score  bias    Evalue   hmmfrom    hmm to     alifrom    ali to      envfrom    env to       sq len      acc',
+        '   ------ ----- ---------   -------   -------    --------- ---------    --------- ---------    ---------    ----',
+        ' %s %6.1f %5.1f %9.2g %9d %9d %s %9d %9d %s %9d %9d .. %9d %7.2f' % (
+            random.choice('!?'), score, random.uniform(0, 5), random.uniform(1e-30, 10), query_start, query_end,
+            random.choice(['..', '.]', '[.', '[]']), target_start, target_end, random.choice(['..', '.]']),
+            max(1, target_start - 3), target_end + 3, target_end + random.randint(5, 500), random.uniform(0.5, 1)),
+        '',
+        '  Alignment:',
+        '  score: %s bits' % score,
+    ]
+
+    width = len(rnacentral_id)
+    digits = len(str(max(query_end, target_end)))
+    query_position, target_position = query_start, target_start
+    for _ in range(blocks):
+        query = ''.join(random.choice(NUCLEOTIDES).lower() for _ in range(block_length))
+        target = ''.join(nt.upper() if random.random() < 0.8 else random.choice(NUCLEOTIDES) for nt in query)
+        query = ''.join('.' if random.random() < 0.05 else nt for nt in query)
+        target = ''.join('-' if random.random() < 0.05 else nt for nt in target)
+        matches = ''.join(q if q.upper() == t else ' ' for q, t in zip(query, target))
+
+        query_prefix = '  %s %*d ' % ('query'.rjust(width), digits, query_position)
+        target_prefix = '  %s %*d ' % (rnacentral_id, digits, target_position)
+        lines.append(query_prefix + query + ' %d' % (query_position + block_length - 1))
+        lines.append(' ' * len(query_prefix) + matches)
+        lines.append(target_prefix + target + ' %d' % (target_position + block_length - 1))
+        lines.append(' ' * len(query_prefix) + ''.join(random.choice('6789*') for _ in range(block_length)) + ' PP')
+        lines.append('')
+        query_position += block_length
+        target_position += block_length
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_synthetic_nhmmer_output(filename, hits, query_length=200, seed=0):
+    """Write an nhmmer output file with `hits` records and multi-block alignments"""
+    random.seed(seed)
+    table = []
+    records = []
+    for _ in range(hits):
+        rnacentral_id = 'URS%010X_%d' % (random.randint(0, 16 ** 10 - 1), random.choice([9606, 10090, 7955, 562]))
+        description = random.choice([
+            'Homo sapiens microRNA 21 stem-loop',
+            'Mus musculus small nucleolar RNA;',
+            'Escherichia coli 16S ribosomal RNA'
+        ])
+        table.append('    1.2e-20  100.0   0.1  %s  1  100  %s' % (rnacentral_id, description))
+        records.append(synthetic_hit(rnacentral_id, description, random.randint(1, 3), random.randint(40, 100)))
+
+    with open(filename, 'w') as f:
+        f.write(HEADER.format(query_length=query_length, table='\n'.join(table)))
+        f.write('\n'.join(records))
+        f.write(FOOTER.format(query_length=query_length, hits=hits))
+
+
+def measure(function, repeat):
+    """Best wall-clock time of `repeat` runs"""
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--limit', type=int, default=1000, help='Same meaning as NHMMER_LIMIT in consumer settings')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%8s %10s %12s %12s %12s %12s' % ('hits', 'size, MB', 'old, all', 'new, all', 'old, limit', 'new, limit'))
+    with tempfile.TemporaryDirectory() as directory:
+        for hits in args.hits:
+            filename = os.path.join(directory, 'nhmmer_%s' % hits)
+            write_synthetic_nhmmer_output(filename, hits)
+
+            assert list(nhmmer_parse(filename=filename)) == list(nhmmer_stream_parse(filename=filename))
+
+            old_all = measure(lambda: list(nhmmer_parse(filename=filename)), args.repeat)
+            new_all = measure(lambda: list(nhmmer_stream_parse(filename=filename)), args.repeat)
+            old_limit = measure(lambda: list(islice(nhmmer_parse(filename=filename), args.limit)), args.repeat)
+            new_limit = measure(lambda: list(nhmmer_stream_parse(filename=filename, limit=args.limit)), args.repeat)
+
+            print('%8d %10.1f %11.3fs %11.3fs %11.3fs %11.3fs' % (
+                hits, os.path.getsize(filename) / 1024 ** 2, old_all, new_all, old_limit, new_limit
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import argparse
+import asyncio
+import time
+import types
+
+from sequence_search.db import PoolTimeoutError
+from sequence_search.db.pool import create_pool
+from sequence_search.db.settings import get_postgres_credentials
+
+
+"""
+Load test of the connection pool: clients, that each run a query of --query-time seconds in a loop,
+are added until the pool saturates, i.e. the median request waits for a connection at least half as long
+as it uses it. Throughput stops growing at that point and only the wait time does. Requires the test database:
+
+ENVIRONMENT=TEST python3 -m sequence_search.db
+python3 -m sequence_search.benchmarks.pool --maxsize 10 --clients 1 5 10 20 40 80
+"""
+
+
+async def client(engine, query_time, deadline, waits):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            async with engine.acquire() as connection:
+                waits.append(time.perf_counter() - start)
+                await connection.scalar('SELECT pg_sleep(%s)', query_time)
+        except PoolTimeoutError:
+            pass
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0.0
+
+
+async def run(settings, clients, query_time, duration):
+    engine = await create_pool(settings)
+    try:
+        waits = []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[client(engine, query_time, deadline, waits) for _ in range(clients)])
+        return waits, engine.get_metrics()
+    finally:
+        engine.close()
+        await engine.wait_closed()
+
+
+async def main(args):
+    settings = types.SimpleNamespace(
+        **get_postgres_credentials(ENVIRONMENT='TEST')._asdict(),
+        POSTGRES_POOL_MINSIZE=args.maxsize,
+        POSTGRES_POOL_MAXSIZE=args.maxsize,
+        POSTGRES_POOL_ACQUIRE_TIMEOUT=args.acquire_timeout
+    )
+
+    print('%8s %12s %12s %12s %12s' % ('clients', 'requests/s', 'p50 wait, s', 'p99 wait, s', 'timeouts'))
+    saturation = None
+    for clients in args.clients:
+        waits, metrics = await run(settings, clients, args.query_time, args.duration)
+        p50, p99 = percentile(waits, 50), percentile(waits, 99)
+        print('%8d %12.1f %12.4f %12.4f %12d' % (
+            clients, len(waits) / args.duration, p50, p99, metrics['acquire_timeouts']
+        ))
+        if saturation is None and p50 >= args.query_time / 2:
+            saturation = clients
+
+    if saturation is not None:
+        print('pool of %d connections saturates at %d clients' % (args.maxsize, saturation))
+    else:
+        print('pool of %d connections did not saturate' % args.maxsize)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--maxsize', type=int, default=10, help='POSTGRES_POOL_MAXSIZE')
+    parser.add_argument('--acquire-timeout', type=float, default=10.0, help='POSTGRES_POOL_ACQUIRE_TIMEOUT')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 5, 10, 20, 40, 80])
+    parser.add_argument('--query-time', type=float, default=0.01, help='seconds each request holds a connection')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of load at each number of clients')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
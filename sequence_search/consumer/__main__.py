@@ -19,11 +19,15 @@ import aiohttp_jinja2
 import jinja2
 from aiojobs.aiohttp import setup as setup_aiojobs
 from aiohttp import web, web_middlewares
+from prometheus_client import CollectorRegistry
 
 from . import settings
 from ..db.models import close_pg, init_pg
 from ..db.consumers import register_consumer_in_the_database
 from ..db.settings import get_postgres_credentials
+from .metrics import ConsumerCollector
+from .parser_pool import ParserPool
+from .resident_databases import load_resident_databases
 from .urls import setup_routes
 
 """
@@ -45,6 +49,18 @@ async def on_startup(app):
     # clear queries and results directories
     app['clear_directories_task'] = asyncio.create_task(clear_directories(app))
 
+    # build the FM-indexes of the database chunks in memory, searches use the fasta files until they are built
+    if settings.SEARCH_BACKEND == 'resident':
+        app['load_databases_task'] = asyncio.create_task(load_databases())
+
+
+async def load_databases():
+    try:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, load_resident_databases)
+    except OSError as e:
+        logging.error(f"Error loading resident databases: {str(e)}")
+
 
 async def clear_directories(app):
     # clear results directories
@@ -83,6 +99,18 @@ async def on_cleanup(app):
         except asyncio.CancelledError:
             logging.info("Background task clear_directories was cancelled")
 
+    # stop copying the database chunks, if still running
+    load_task = app.get('load_databases_task')
+    if load_task:
+        load_task.cancel()
+        try:
+            await load_task
+        except asyncio.CancelledError:
+            logging.info("Background task load_databases was cancelled")
+
+    # stop the result parsing processes
+    app['executor'].shutdown(wait=False)
+
     # Close the database connection
     await close_pg(app)
 
@@ -107,6 +135,10 @@ def create_app():
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
 
+    # metrics of the pool, that are served at /metrics
+    app['metrics'] = CollectorRegistry()
+    app['metrics'].register(ConsumerCollector(app))
+
     # setup views and routes
     setup_routes(app)
 
@@ -116,6 +148,9 @@ def create_app():
     # setup aiojobs scheduler
     setup_aiojobs(app)
 
+    # parsing of large nhmmer and cmscan results is CPU-bound, run it in separate processes
+    app['executor'] = ParserPool(max_workers=settings.PARSER_PROCESSES)
+
     return app
 
 
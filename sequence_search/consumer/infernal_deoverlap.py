@@ -10,6 +10,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import bisect
 import os
 import shlex
 import asyncio.subprocess
@@ -18,10 +19,18 @@ from . import settings
 from sequence_search.consumer.settings import INFERNAL_RESULTS_DIR
 
 
+def tblout_path(job_id):
+    return os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id)
+
+
+def deoverlapped_path(job_id):
+    return os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout.deoverlapped' % job_id)
+
+
 async def infernal_deoverlap(job_id):
     params = {
-        'file': os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id),
-        'output': os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout.deoverlapped' % job_id),
+        'file': tblout_path(job_id),
+        'output': deoverlapped_path(job_id),
         'cmsearch-deoverlap': settings.DEOVERLAP,
     }
 
@@ -40,3 +49,89 @@ async def infernal_deoverlap(job_id):
     )
 
     return process, params['output']
+
+
+"""
+In-process equivalent of `cmsearch-deoverlap.pl --maxkeep --cmscan`, that spares a perl interpreter per job.
+
+Hits of the same query sequence are sorted by score, the best first, and swept in that order: a hit is kept
+unless it overlaps a hit, that was kept before, on the same strand. Hits that overlap only hits that were
+removed are kept (--maxkeep). Kept hits never overlap each other, so they are held in a list sorted by start,
+where a new hit only has to be checked against its two neighbours.
+"""
+
+# columns of the cmscan tblout (--fmt 1), counting from 0
+SEQ_NAME_COLUMN = 2  # query name, hits of different sequences never overlap (--cmscan)
+SEQ_FROM_COLUMN = 7
+SEQ_TO_COLUMN = 8
+STRAND_COLUMN = 9
+SCORE_COLUMN = 14
+
+
+def parse_tblout_hit(line):
+    """:return: (sequence name, strand, start, end, score) of a tblout line, start <= end on both strands"""
+    fields = line.split()
+    seq_from, seq_to = int(fields[SEQ_FROM_COLUMN]), int(fields[SEQ_TO_COLUMN])
+    return (
+        fields[SEQ_NAME_COLUMN],
+        fields[STRAND_COLUMN],
+        min(seq_from, seq_to),
+        max(seq_from, seq_to),
+        float(fields[SCORE_COLUMN])
+    )
+
+
+def overlaps_kept(starts, ends, start, end):
+    """Whether [start, end] overlaps any of the disjoint intervals, sorted by start"""
+    index = bisect.bisect_right(starts, end)
+    # the interval that starts last at or before `end` is the only one that can reach `start`
+    return index > 0 and ends[index - 1] >= start
+
+
+def deoverlap(lines):
+    """
+    Removes overlapping hits from the lines of a cmscan tblout, comment lines are skipped.
+
+    :param lines: lines of the tblout file
+    :return: lines of the kept hits, sorted by sequence name and score (the best first)
+    """
+    hits = []
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        hits.append((parse_tblout_hit(line), line))
+
+    # like `sort -k 3,3 -k 15,15rn` of the perl script
+    hits.sort(key=lambda hit: (hit[0][0], -hit[0][4], hit[1]))
+
+    kept = []
+    intervals = {}  # (sequence name, strand) -> (starts, ends) of the kept hits
+    for (name, strand, start, end, score), line in hits:
+        starts, ends = intervals.setdefault((name, strand), ([], []))
+        if overlaps_kept(starts, ends, start, end):
+            continue
+
+        index = bisect.bisect_right(starts, start)
+        starts.insert(index, start)
+        ends.insert(index, end)
+        kept.append(line)
+
+    return kept
+
+
+def native_deoverlap(job_id):
+    """
+    Writes the deoverlapped tblout of the job, the same file as infernal_deoverlap does it,
+    suitable for running in a process pool
+    :return: path to the deoverlapped file
+    """
+    with open(tblout_path(job_id), 'r') as f:
+        kept = deoverlap(f)
+
+    output = deoverlapped_path(job_id)
+    with open(output, 'w') as f:
+        for line in kept:
+            f.write(line if line.endswith('\n') else line + '\n')
+
+    return output
+
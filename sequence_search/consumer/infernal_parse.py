@@ -11,7 +11,69 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import re
-from itertools import islice
+
+
+"""
+Single-pass parsers of the cmscan output.
+
+The tblout (and the deoverlapped tblout) is read line by line, each hit is a record with its numbers
+converted once. The cmscan output (-o) is read line by line as well, an alignment is every line after
+the scores of its hit up to the next unindented line, so alignments of any number of blocks are read
+whole. Hits are joined with their alignments by (query, model, seq_from, seq_to) while the cmscan output
+is read, which stops as soon as every hit has its alignment.
+"""
+
+# columns of the cmscan tblout (--fmt 1), the rest of the line is the description
+TBLOUT_COLUMNS = [
+    ('target_name', str),
+    ('accession_rfam', str),
+    ('query_name', str),
+    ('accession_seq', str),
+    ('mdl', str),
+    ('mdl_from', int),
+    ('mdl_to', int),
+    ('seq_from', int),
+    ('seq_to', int),
+    ('strand', str),
+    ('trunc', str),
+    ('pipeline_pass', int),
+    ('gc', float),
+    ('bias', float),
+    ('score', float),
+    ('e_value', float),
+    ('inc', str),
+]
+
+# columns of the scores line of a hit in the cmscan output, e.g.
+#   (1) !   3.2e-24  104.9   0.0  cm        1      119 []        1      119 + []    0.99    no  0.49
+HIT_COLUMNS = [
+    ('e_value', 2, float),
+    ('score', 3, float),
+    ('mdl_from', 6, int),
+    ('mdl_to', 7, int),
+    ('seq_from', 9, int),
+    ('seq_to', 10, int),
+    ('gc', 15, float),
+]
+
+QUERY_HEADER_RE = re.compile(r'^Query:\s+(\S+)')
+HIT_SCORES_RE = re.compile(r'^\s*\(\d+\)\s')
+
+
+def parse_tblout_line(line):
+    """:return: hit of a tblout line, with the numbers converted"""
+    fields = line.split()
+    result = {name: convert(value) for (name, convert), value in zip(TBLOUT_COLUMNS, fields)}
+    result['description'] = ' '.join(fields[len(TBLOUT_COLUMNS):])
+    return result
+
+
+def tblout_records(lines):
+    """Hits of the lines of a tblout, comments and blank lines are skipped"""
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        yield parse_tblout_line(line)
 
 
 def infernal_parse(filename):
@@ -20,38 +82,56 @@ def infernal_parse(filename):
     :param filename: file to parse, named with job_id
     :return: data to save in the database
     """
-    lines = []
     with open(filename, 'r') as file:
-        for line in file.readlines():
-            if not line.startswith('#'):
-                line = re.sub(" +", " ", line).strip()
-                lines.append(line.split(" "))
-
-    results = []
-    for item in lines:
-        result = {
-            "target_name": item[0],
-            "accession_rfam": item[1],
-            "query_name": item[2],
-            "accession_seq": item[3],
-            "mdl": item[4],
-            "mdl_from": item[5],
-            "mdl_to": item[6],
-            "seq_from": item[7],
-            "seq_to": item[8],
-            "strand": item[9],
-            "trunc": item[10],
-            "pipeline_pass": item[11],
-            "gc": item[12],
-            "bias": item[13],
-            "score": item[14],
-            "e_value": item[15],
-            "inc": item[16],
-            "description": ' '.join(item[17:])
-        }
-        results.append(result)
+        return list(tblout_records(file))
 
-    return results
+
+def alignment_record(query_name, accession, scores, lines):
+    """Hit of the cmscan output, the alignment starts with the blank line after the scores"""
+    fields = scores.split()
+    record = {name: convert(fields[index]) for name, index, convert in HIT_COLUMNS}
+
+    while lines and not lines[-1].strip():
+        lines.pop()
+
+    record.update({
+        'accession_rfam': accession,
+        'query_name': query_name,
+        'alignment': ''.join(lines) + ('' if not lines or lines[-1].endswith('\n') else '\n')
+    })
+    return record
+
+
+def alignment_records(lines):
+    """
+    Hits with their alignments of the lines of a cmscan output
+    :param lines: lines of the cmscan output, e.g. an open file
+    """
+    query_name = None
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        if line.startswith('>>'):
+            accession = line.split()[1]
+            scores = next((line for line in lines if HIT_SCORES_RE.match(line)), None)
+            if scores is None:
+                return
+
+            # alignment lines are indented or blank, anything else ends the hit
+            alignment = []
+            for line in lines:
+                if line[0] not in ' \n':
+                    break
+                alignment.append(line)
+            else:
+                line = None
+
+            yield alignment_record(query_name, accession, scores, alignment)
+            continue
+
+        if line.startswith('Query:'):
+            query_name = QUERY_HEADER_RE.match(line).group(1)
+        line = next(lines, None)
 
 
 def alignment(filename):
@@ -60,26 +140,79 @@ def alignment(filename):
     :param filename: file to parse, named with job_id
     :return: alignment to save in the database. Values are used to find the infernal result
     """
-    output = []
     with open(filename, 'r') as file:
-        for line in file:
-            if line.startswith('>>'):
-                get_accession = line.split(' ')
-                values = ''.join(islice(file, 2, 3))
-                values = list(filter(None, values.split(' ')))
-                alignment = ''.join(islice(file, 7))
-
-                output_result = {
-                    "accession_rfam": get_accession[1],
-                    "mdl_from": values[6],
-                    "mdl_to": values[7],
-                    "seq_from": values[9],
-                    "seq_to": values[10],
-                    "gc": values[15],
-                    "score": values[3],
-                    "e_value": values[2],
-                    "alignment": alignment
-                }
-                output.append(output_result)
-
-    return output
+        return list(alignment_records(file))
+
+
+def alignment_key(item):
+    """Values that identify a hit both in the deoverlapped file and in the cmscan output"""
+    return item['query_name'], item['accession_rfam'], item['seq_from'], item['seq_to']
+
+
+def join_alignments(results, output_filename):
+    """
+    Adds the alignment of each hit, the cmscan output is read up to the last alignment that is needed
+    :param results: hits of the deoverlapped file
+    :param output_filename: cmscan output file with the alignments
+    :return: the same results
+    """
+    missing = {}
+    for result in results:
+        result['alignment'] = None
+        missing.setdefault(alignment_key(result), []).append(result)
+
+    if missing:
+        with open(output_filename, 'r') as file:
+            for item in alignment_records(file):
+                for result in missing.pop(alignment_key(item), []):
+                    result['alignment'] = item['alignment']
+                if not missing:
+                    break
+
+    return results
+
+
+def infernal_results(deoverlap_filename, output_filename):
+    """
+    Join the deoverlapped hits with their alignments, so that each hit is saved to the database only once
+    :param deoverlap_filename: deoverlapped tblout file
+    :param output_filename: cmscan output file with the alignments
+    :return: data to save in the database
+    """
+    results = infernal_parse(deoverlap_filename)
+    if not results:
+        return results
+
+    return join_alignments(results, output_filename)
+
+
+def rename_query(alignment, query_name):
+    """
+    Show the query of a batch as 'query' in the alignment, the way it looks after a search of its own.
+    The name is right-aligned to the width of the model name column, so the width is kept as it is.
+    """
+    pattern = re.compile(r'^( *)%s(?= )' % re.escape(query_name), re.MULTILINE)
+    return pattern.sub(lambda match: 'query'.rjust(len(match.group(0))), alignment)
+
+
+def infernal_batch_results(deoverlap_filename, output_filename):
+    """
+    Same as infernal_results for a cmscan run with several queries, see infernal_batch_search.
+    Hits are split by the query name column of the deoverlapped file and alignments by the query section
+    of the cmscan output.
+    :param deoverlap_filename: deoverlapped tblout file
+    :param output_filename: cmscan output file with the alignments
+    :return: {query name in the batch: data to save in the database}, queries without hits are left out
+    """
+    batch = {}
+    for result in join_alignments(infernal_parse(deoverlap_filename), output_filename):
+        batch.setdefault(result['query_name'], []).append(result)
+
+    # results are saved the same way as the ones of a search of its own
+    for query_name, results in batch.items():
+        for result in results:
+            if result['alignment'] is not None:
+                result['alignment'] = rename_query(result['alignment'], query_name)
+            result['query_name'] = 'query'
+
+    return batch
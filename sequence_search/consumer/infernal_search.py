@@ -18,30 +18,30 @@ from . import settings
 from sequence_search.consumer.settings import INFERNAL_QUERY_DIR, INFERNAL_RESULTS_DIR
 
 
-async def infernal_search(sequence, job_id):
+def batch_query_name(index):
     """
-    Run cmscan to search the CM-format Rfam database
-    :param sequence: sequence to search
-    :param job_id: id of the job
-    :return:
+    Name of the index-th query in the fasta file of a batch.
+
+    Names up to 7 characters (query99) are not wider than the Rfam accessions, so the alignments
+    have the same layout as the ones of a single query, see infernal_parse.rename_query.
     """
-    sequence = sequence.replace('T', 'U').upper()
+    return 'query%s' % (index + 1)
 
+
+async def run_cmscan(query, output, tblout):
+    """
+    Run cmscan with the queries in the `query` fasta file against the CM-format Rfam database
+    :return: cmscan process
+    """
     params = {
-        'query': os.path.join(INFERNAL_QUERY_DIR, '%s' % job_id),
-        'output': os.path.join(INFERNAL_RESULTS_DIR, '%s' % job_id),
-        'tblout': os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id),
+        'query': query,
+        'output': output,
+        'tblout': tblout,
         'rfam_cm': settings.RFAM_CM,
         'cmscan': settings.CMSCAN_EXECUTABLE,
-        'cpu': 4,
+        'cpu': settings.CPUS_PER_SLOT,
     }
 
-    # write out query in fasta format
-    with open(params['query'], 'w') as f:
-        f.write('>query\n')
-        f.write(sequence)
-        f.write('\n')
-
     command = ('{cmscan} '
                '--notextw '          # unlimit ASCII text output line width
                '--cut_ga '           # use CM's GA gathering cutoffs as reporting thresholds
@@ -55,10 +55,51 @@ async def infernal_search(sequence, job_id):
                '{query} '            # query file
                ).format(**params)
 
-    process = await asyncio.subprocess.create_subprocess_exec(
+    return await asyncio.subprocess.create_subprocess_exec(
         *shlex.split(command),
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE
     )
 
-    return process, params['output']
+
+async def infernal_search(sequence, job_id):
+    """
+    Run cmscan to search the CM-format Rfam database
+    :param sequence: sequence to search
+    :param job_id: id of the job
+    :return:
+    """
+    sequence = sequence.replace('T', 'U').upper()
+    query = os.path.join(INFERNAL_QUERY_DIR, '%s' % job_id)
+    output = os.path.join(INFERNAL_RESULTS_DIR, '%s' % job_id)
+
+    # write out query in fasta format
+    with open(query, 'w') as f:
+        f.write('>query\n')
+        f.write(sequence)
+        f.write('\n')
+
+    process = await run_cmscan(query, output, os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id))
+    return process, output
+
+
+async def infernal_batch_search(sequences, job_id):
+    """
+    Run a single cmscan for the sequences of several infernal jobs, so that Rfam.cm is loaded once for all of them.
+    Sequences are named with batch_query_name in the order they are given, use infernal_batch_results
+    to split the results by query.
+    :param sequences: list of sequences to search
+    :param job_id: id of the first job of the batch, names the query and the result files
+    :return: (cmscan process, output file)
+    """
+    query = os.path.join(INFERNAL_QUERY_DIR, '%s' % job_id)
+    output = os.path.join(INFERNAL_RESULTS_DIR, '%s' % job_id)
+
+    with open(query, 'w') as f:
+        for index, sequence in enumerate(sequences):
+            f.write('>%s\n' % batch_query_name(index))
+            f.write(sequence.replace('T', 'U').upper())
+            f.write('\n')
+
+    process = await run_cmscan(query, output, os.path.join(INFERNAL_RESULTS_DIR, '%s.tblout' % job_id))
+    return process, output
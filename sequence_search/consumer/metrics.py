@@ -0,0 +1,74 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import functools
+
+from prometheus_client import Gauge, Histogram
+
+from .settings import SLOTS
+
+
+"""
+Prometheus metrics of the consumer, served at /metrics.
+"""
+
+SEARCH_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, float('inf'))
+
+SEARCH_SECONDS = Histogram(
+    'sequence_search_search_seconds', 'Run time of nhmmer and cmscan, by database of the job chunk',
+    ['tool', 'database', 'status'], buckets=SEARCH_BUCKETS
+)
+
+PARSE_SECONDS = Histogram(
+    'sequence_search_parse_seconds', 'Time to parse the results of nhmmer and cmscan', ['tool']
+)
+
+SAVE_RESULTS_SECONDS = Histogram(
+    'sequence_search_save_results_seconds', 'Time to save the results of a job chunk to the database', ['tool']
+)
+
+NHMMER_BATCH_SIZE = Histogram(
+    'sequence_search_nhmmer_batch_size', 'Job chunks searched with a single nhmmer run',
+    buckets=(1, 2, 4, 8, 16, 32, float('inf'))
+)
+
+INFERNAL_BATCH_SIZE = Histogram(
+    'sequence_search_infernal_batch_size', 'Infernal jobs searched with a single cmscan run',
+    buckets=(1, 2, 5, 10, 20, 50, float('inf'))
+)
+
+SLOTS_TOTAL = Gauge('sequence_search_consumer_slots', 'Job chunks and infernal jobs the consumer runs at a time')
+SLOTS_TOTAL.set(SLOTS)
+
+BUSY_SLOTS = Gauge('sequence_search_consumer_busy_slots', 'Job chunks and infernal jobs running on the consumer')
+
+
+def occupies_slot(function):
+    """Counts the job chunk or infernal job as running, until the coroutine returns"""
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with BUSY_SLOTS.track_inprogress():
+            return await function(*args, **kwargs)
+    return wrapper
+
+
+class ConsumerCollector(object):
+    """Reads the metrics of the postgres pool of the app"""
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        engine = self.app.get('engine')
+        if engine is not None:
+            yield from engine.collect()
@@ -214,10 +214,285 @@ def nhmmer_parse(filename="", stats_text='Internal pipeline statistics summary')
             yield data
 
 
-def parse_number_of_hits(filename):
-    command = "tail -n 10 %s | grep Total" % filename
-    total = os.popen(command).read()
-    return total if total else None
+# Precompiled patterns used by the streaming parser, see nhmmer_stream_parse
+URS_RE = re.compile(r'URS[0-9A-Fa-f]{10}(_\d+)?')
+SPACES_RE = re.compile(r' +')
+WORD_RE = re.compile(r'\w')
+QUERY_LINE_RE = re.compile(r'^(\s+query\s+\d+ )(.+) \d+')
+QUERY_LABEL_RE = re.compile(r'^Query\s+\d+ ')
+TARGET_NAME_RE = re.compile(r'\s+URS[0-9A-Fa-f]{10}(_\d+)?;?')
+TARGET_LINE_RE = re.compile(r'^Sbjct\s+\d+ (.+) \d+')
+QUERY_LENGTH_RE = re.compile(r'Query:       query  \[M=(\d+)\]')
+QUERY_HEADER_RE = re.compile(r'^Query:\s+(\S+)\s+\[M=(\d+)\]')
+
+# lines of the internal pipeline statistics, with the numbers that are kept of each, e.g.
+# Target sequences:                      38589  (4657073 residues searched)
+# Residues passing SSV filter:          147040  (0.0316); expected (0.02)
+# Total number of hits:                  4  (0.000168)
+# Elapsed time: 00:00:00.19u 00:00:00.01s 00:00:00.20 Elapsed
+PIPELINE_STATS_RE = [
+    (('target_sequences', 'residues_searched'), re.compile(r'^Target sequences:\s+(\d+)\s+\((\d+) residues searched')),
+    (('residues_passed_ssv',), re.compile(r'^Residues passing SSV filter:\s+(\d+)')),
+    (('residues_passed_bias',), re.compile(r'^Residues passing bias filter:\s+(\d+)')),
+    (('residues_passed_vit',), re.compile(r'^Residues passing Vit filter:\s+(\d+)')),
+    (('residues_passed_fwd',), re.compile(r'^Residues passing Fwd filter:\s+(\d+)')),
+    (('total_hits',), re.compile(r'^Total number of hits:\s+(\d+)')),
+]
+ELAPSED_RE = re.compile(r'^Elapsed time:.*\s(\d+):(\d+):(\d+(?:\.\d+)?) Elapsed')
+
+# bytes at the end of a result file, that hold the internal pipeline statistics
+PIPELINE_STATS_TAIL = 4096
+
+
+def parse_record_lines(lines, query_length, query_name='query'):
+    """
+    Line-based equivalent of parse_record that uses precompiled patterns.
+
+    Lines 0-6 hold the hit description and statistics, alignment blocks start
+    at line 7 and consist of 5 lines each: query, matches, target, posterior
+    probabilities and a blank separator.
+
+    query_name is the name of the query in the fasta file given to nhmmer, it is
+    shown as 'Query' in the alignment, whatever it was.
+    """
+    if query_name == 'query':
+        query_line_re = QUERY_LINE_RE
+    else:
+        query_line_re = re.compile(r'^(\s+%s\s+\d+ )(.+) \d+' % re.escape(query_name))
+    upper_query_name = query_name.upper()
+
+    first_line = lines[0]
+    match = URS_RE.search(first_line)
+    data = {
+        'rnacentral_id': match.group(),
+        'description': first_line.replace(match.group(), '').replace(';', '').strip(),
+    }
+
+    stats = lines[3].replace('!', '').replace('?', '').replace('[]', '').replace('[.', '').\
+        replace('.]', '').replace('..', '').strip()
+    scores = SPACES_RE.split(stats)
+    data['score'] = float(scores[0])
+    data['bias'] = float(scores[1])
+    data['e_value'] = float(scores[2])
+    data['alignment_start'] = float(scores[5])
+    data['alignment_stop'] = float(scores[6])
+    data['target_length'] = int(scores[9])
+
+    alignment = []
+    alignment_length = 0
+    matches = 0
+    nts_count1 = 0
+    nts_count2 = 0
+    gap_count = 0
+    alignment_sequence = []
+    label = None
+    whitespace = None
+
+    for i, line in enumerate(lines[7:]):
+        state = i % 5
+        if state == 3:  # skip nhmmer confidence lines
+            continue
+        elif state == 4:  # blank line
+            alignment.append(line)
+            continue
+
+        gaps = line.count('-') + line.count('.')
+        if state == 0:  # query
+            match = query_line_re.match(line)
+            if match:
+                label = match.group(1)
+                block_length = len(match.group(2))
+                alignment_length += block_length
+                line = line.upper().replace('.', '-').replace(upper_query_name, 'Query', 1).lstrip()
+                alignment.append(line)
+                whitespace = len(QUERY_LABEL_RE.match(line).group(0))
+                nts_count1 += block_length - gaps
+                gap_count += gaps
+        elif state == 1:  # matches
+            line = ' ' * whitespace + WORD_RE.sub('|', line[len(label):])
+            matches += line.count('|')
+            alignment.append(line)
+        else:  # target
+            line = TARGET_NAME_RE.sub('Sbjct', line.upper())
+            match = TARGET_LINE_RE.match(line)
+            if match:
+                nts_count2 += len(match.group(1)) - gaps
+                gap_count += gaps
+            alignment.append(line)
+            fields = line.split(' ')
+            fields = [field for field in fields if field]
+            if len(fields) > 2:
+                alignment_sequence.append(fields[2])
+
+    data['alignment'] = '\n'.join(alignment).strip()
+    data['alignment_length'] = alignment_length
+    data['gap_count'] = gap_count
+    data['match_count'] = matches
+    data['nts_count1'] = nts_count1
+    data['nts_count2'] = nts_count2
+    data['identity'] = (float(matches) / alignment_length) * 100
+    data['query_coverage'] = (float(nts_count1) / query_length) * 100
+    data['target_coverage'] = (float(nts_count2) / data['target_length']) * 100
+    data['gaps'] = (float(gap_count) / alignment_length) * 100
+    data['alignment_sequence'] = ''.join(alignment_sequence).replace('-', '')
+    data['query_length'] = query_length
+    return data
+
+
+def nhmmer_stream_parse(filename="", limit=None, stats_text='Internal pipeline statistics summary'):
+    """
+    Single-pass replacement for nhmmer_parse.
+
+    The file is read line by line exactly once: each '>>' line starts a new hit,
+    lines of the current hit are collected until the next one and parsed with
+    parse_record_lines. Parsing stops as soon as `limit` records were produced,
+    so the tail of large result files is never read. Output is identical to
+    nhmmer_parse.
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    query_length = 0
+    result_id = 0
+    lines = None  # lines of the current hit, None while reading the header
+    truncated = False  # set once the internal statistics were reached
+    line = ''
+
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('>>'):
+                if lines is not None:
+                    if not truncated:
+                        lines.append('')
+                    result_id += 1
+                    data = parse_record_lines(lines, query_length)
+                    data['result_id'] = result_id
+                    yield data
+                    if limit is not None and result_id >= limit:
+                        return
+                lines = [line[2:].rstrip('\n')]
+                truncated = False
+            elif lines is None:
+                match = QUERY_LENGTH_RE.search(line)
+                if match and not query_length:
+                    query_length = int(match.group(1))
+            elif not truncated:
+                if stats_text in line:
+                    truncated = True
+                else:
+                    lines.append(line.rstrip('\n'))
+
+        if lines is not None:
+            if not truncated and line.endswith('\n'):
+                lines.append('')
+            data = parse_record_lines(lines, query_length)
+            data['result_id'] = result_id + 1
+            yield data
+
+
+def nhmmer_results(filename, limit=None):
+    """Parse up to `limit` records into a list, suitable for running in a process pool"""
+    return list(nhmmer_stream_parse(filename=filename, limit=limit))
+
+
+def nhmmer_batch_stream_parse(filename, limit=None, stats_text='Internal pipeline statistics summary'):
+    """
+    Parses the output of nhmmer that searched several queries at once, see nhmmer_batch_search.
+
+    Every query has a section of its own, that starts with 'Query:' and ends with '//'.
+    Records of each section are parsed like nhmmer_stream_parse does it with a file of
+    a single query, up to `limit` records per query, the rest of the section is only
+    scanned for the internal pipeline statistics.
+
+    :return: generator of (query name, pipeline statistics, list of records) for every query
+    """
+    query_name = None
+    query_length = 0
+    stats_lines = []
+    records = []
+    lines = None  # lines of the current hit, None while reading the header of the section
+    truncated = False  # set once the internal statistics of the section were reached
+
+    def parse(lines):
+        data = parse_record_lines(lines, query_length, query_name)
+        data['result_id'] = len(records) + 1
+        return data
+
+    with open(filename, 'r') as f:
+        for line in f:
+            if query_name is None:
+                match = QUERY_HEADER_RE.match(line)
+                if match:
+                    query_name, query_length = match.group(1), int(match.group(2))
+                    stats_lines, records, lines, truncated = [], [], None, False
+            elif line.startswith('>>'):
+                if lines is not None and (limit is None or len(records) < limit):
+                    if not truncated:
+                        lines.append('')
+                    records.append(parse(lines))
+                lines = [line[2:].rstrip('\n')]
+                truncated = False
+            elif line.startswith('//'):
+                if lines is not None and (limit is None or len(records) < limit):
+                    if not truncated:
+                        lines.append('')
+                    records.append(parse(lines))
+                yield query_name, parse_pipeline_stats(stats_lines), records
+                query_name = None
+            elif stats_text in line:
+                truncated = True
+            elif truncated:
+                stats_lines.append(line)
+            elif lines is not None:
+                lines.append(line.rstrip('\n'))
+
+
+def nhmmer_batch_results(filename, limit=None):
+    """
+    Parse up to `limit` records of every query into a dict, suitable for running in a process pool
+
+    :return: {query name: (pipeline statistics, list of records)}
+    """
+    return {
+        query_name: (stats, records)
+        for query_name, stats, records in nhmmer_batch_stream_parse(filename=filename, limit=limit)
+    }
+
+
+def parse_pipeline_stats(lines):
+    """
+    Numbers of the internal pipeline statistics of a query, see PIPELINE_STATS_RE.
+
+    :param lines: lines of the statistics, other lines are skipped
+    :return: dict with the numbers that were found, search_seconds is the wall-clock time of nhmmer
+    """
+    stats = {}
+    for line in lines:
+        for names, pattern in PIPELINE_STATS_RE:
+            match = pattern.match(line)
+            if match:
+                stats.update(zip(names, map(int, match.groups())))
+                break
+        else:
+            match = ELAPSED_RE.match(line)
+            if match:
+                hours, minutes, seconds = match.groups()
+                stats['search_seconds'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return stats
+
+
+def nhmmer_pipeline_stats(filename):
+    """
+    Internal pipeline statistics of a result file of a single query, they are at the very end of the file,
+    so only the last PIPELINE_STATS_TAIL bytes are read.
+
+    :return: dict of parse_pipeline_stats, empty if the file has no statistics
+    """
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - PIPELINE_STATS_TAIL))
+        tail = f.read().decode('utf-8', errors='replace')
+    return parse_pipeline_stats(tail.splitlines())
 
 
 if __name__ == "__main__":
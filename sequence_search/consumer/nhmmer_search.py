@@ -15,8 +15,8 @@ import shlex
 import asyncio.subprocess
 
 from . import settings
-from sequence_search.consumer.rnacentral_databases import query_file_path, result_file_path, database_file_path, \
-    get_e_value
+from sequence_search.consumer.rnacentral_databases import query_file_path, result_file_path, get_e_value
+from sequence_search.consumer.resident_databases import search_target
 
 
 class NhmmerError(Exception):
@@ -24,9 +24,31 @@ class NhmmerError(Exception):
     pass
 
 
-async def nhmmer_search(sequence, job_id, database):
-    sequence = sequence.replace('T', 'U').upper()
+# queries shorter than this are searched with a looser stage 3 threshold, see --F3
+SHORT_QUERY_LENGTH = 50
+
+
+def is_short(sequence):
+    return len(sequence) < SHORT_QUERY_LENGTH
+
+
+def batch_query_name(index):
+    """
+    Name of the index-th query in the fasta file of a batch.
+
+    Names must not contain '-' or '.', that are counted as gaps by the parser, and must be no longer than
+    the URS ids of the targets, so that the alignments look the same as the ones of a single query.
+    """
+    return 'query%s' % (index + 1)
+
 
+async def run_nhmmer(query, output, database, short):
+    """
+    Starts nhmmer with the queries in the `query` fasta file against the database chunk.
+
+    :param short: the queries are shorter than SHORT_QUERY_LENGTH
+    :return: nhmmer process
+    """
     try:
         if database.startswith('all-except-rrna') or database.startswith('whitelist-rrna'):
             db_name = None
@@ -36,26 +58,22 @@ async def nhmmer_search(sequence, job_id, database):
         db_name = None
 
     e_value = get_e_value(db_name) if db_name else 14455.68
+    target, target_format = search_target(database)
 
     params = {
-        'query': query_file_path(job_id, database),
-        'output': result_file_path(job_id, database),
+        'query': query,
+        'output': output,
         'nhmmer': settings.NHMMER_EXECUTABLE,
-        'db': database_file_path(database),
+        'db': target,
+        'tformat': target_format,
         'e_value': e_value,
-        'cpu': 4,
-        'f3': '--F3 0.02' if len(sequence) < 50 else ''
+        'cpu': settings.CPUS_PER_SLOT,
+        'f3': '--F3 0.02' if short else ''
     }
 
-    # write out query in fasta format
-    with open(params['query'], 'w') as f:
-        f.write('>query\n')
-        f.write(sequence)
-        f.write('\n')
-
     command = ('{nhmmer} '
                '--qfasta '         # query format
-               '--tformat fasta '  # target format
+               '--tformat {tformat} '  # target format: fasta or hmmerdb (FM-index of the resident backend)
                '-o {output} '      # direct main output to a file
                '-T 0 '             # report sequences >= this score threshold in output
                '{f3} '             # stage 3 (Fwd) threshold: promote hits w/ P <= F3
@@ -66,10 +84,48 @@ async def nhmmer_search(sequence, job_id, database):
                '{query} '          # query file
                '{db}').format(**params)
 
-    process = await asyncio.subprocess.create_subprocess_exec(
+    return await asyncio.subprocess.create_subprocess_exec(
         *shlex.split(command),
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE
     )
 
-    return process, params['output']
+
+async def nhmmer_search(sequence, job_id, database):
+    sequence = sequence.replace('T', 'U').upper()
+    query, output = query_file_path(job_id, database), result_file_path(job_id, database)
+
+    # write out query in fasta format
+    with open(query, 'w') as f:
+        f.write('>query\n')
+        f.write(sequence)
+        f.write('\n')
+
+    process = await run_nhmmer(query, output, database, is_short(sequence))
+    return process, output
+
+
+async def nhmmer_batch_search(sequences, job_id, database):
+    """
+    Searches several sequences against the same database chunk with a single nhmmer process,
+    which spares every sequence but the first the start of a process and the cold read of the chunk.
+
+    Sequences are named with batch_query_name in the order they are given, use nhmmer_batch_results
+    to split the output by query. They should all be either short or not, see is_short.
+
+    :param sequences: list of query sequences
+    :param job_id: id of the first job of the batch, names the query and the result file
+    :param database: name of the database chunk
+    :return: (nhmmer process, result file)
+    """
+    sequences = [sequence.replace('T', 'U').upper() for sequence in sequences]
+    query, output = query_file_path(job_id, database), result_file_path(job_id, database)
+
+    with open(query, 'w') as f:
+        for index, sequence in enumerate(sequences):
+            f.write('>%s\n' % batch_query_name(index))
+            f.write(sequence)
+            f.write('\n')
+
+    process = await run_nhmmer(query, output, database, any(is_short(sequence) for sequence in sequences))
+    return process, output
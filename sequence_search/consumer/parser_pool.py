@@ -0,0 +1,46 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ParserPool(Executor):
+    """
+    Processes, that parse nhmmer and cmscan results off the event loop, see create_app.
+
+    Once a worker of a ProcessPoolExecutor dies (e.g. it is killed by the OOM killer), the executor is broken
+    for good: the parses it was running fail with BrokenProcessPool and so does every later submit.
+    ParserPool replaces a broken executor with a new one, so that only the parses, that were running, fail.
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            try:
+                return self.executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                logging.error("Parser processes are broken, starting new ones")
+                self.executor.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        with self.lock:
+            self.executor.shutdown(wait=wait, **kwargs)
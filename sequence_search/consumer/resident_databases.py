@@ -0,0 +1,109 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import os
+import subprocess
+
+from . import settings
+from .rnacentral_databases import get_database_files, database_file_path
+
+
+"""
+Resident search backend: an FM-index of every database chunk is built once, at consumer startup, with makehmmerdb
+in RESIDENT_DATABASES_DIR (an in-memory tmpfs like /dev/shm). nhmmer searches the index (--tformat hmmerdb),
+that seeds its filters with the matches found in the index, instead of scanning the whole fasta file of the chunk.
+"""
+
+
+def index_path(database, target_dir):
+    """Path to the FM-index of the database chunk"""
+    return os.path.join(target_dir, '%s.hmmerdb' % database)
+
+
+def is_up_to_date(source, index):
+    """True if the index was built from the current database chunk, the index gets its modification time"""
+    try:
+        return int(os.stat(source).st_mtime) == int(os.stat(index).st_mtime)
+    except FileNotFoundError:
+        return False
+
+
+def build_index(source, index):
+    """
+    Builds the FM-index of the database chunk with makehmmerdb. The index is built under a temporary name
+    and renamed afterwards, so that nhmmer never reads a partial index.
+    """
+    temporary = index + '.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)  # left by a consumer, that was stopped half way through
+
+    subprocess.run([settings.MAKEHMMERDB_EXECUTABLE, str(source), temporary],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+    source_stat = os.stat(source)
+    os.utime(temporary, (source_stat.st_atime, source_stat.st_mtime))
+    os.replace(temporary, index)
+
+
+def load_resident_databases(source_files=None, target_dir=None):
+    """
+    Build the FM-indexes of the database chunks in the resident databases folder, unless an up-to-date index
+    is already there (e.g. the consumer was restarted). A chunk, whose index can't be built, is searched
+    in the fasta file.
+
+    :param source_files: database chunks to index, all of the chunks by default
+    :param target_dir: RESIDENT_DATABASES_DIR by default
+    :return: list of database names that were indexed
+    """
+    source_files = get_database_files() if source_files is None else source_files
+    target_dir = settings.RESIDENT_DATABASES_DIR if target_dir is None else target_dir
+    os.makedirs(target_dir, exist_ok=True)
+
+    built, failed = [], []
+    for source in source_files:
+        index = index_path(source.name, target_dir)
+        if is_up_to_date(source, index):
+            continue
+
+        try:
+            build_index(source, index)
+        except subprocess.CalledProcessError as e:
+            logging.error("makehmmerdb failed for %s: %s" % (source.name, e.stderr.decode('utf-8', 'replace')))
+            failed.append(source.name)
+            continue
+        built.append(source.name)
+
+    logging.info("Resident databases in %s: %d indexed, %d up-to-date, %d failed" % (
+        target_dir, len(built), len(source_files) - len(built) - len(failed), len(failed)))
+    return built
+
+
+def resident_database_path(database, target_dir=None):
+    """Returns path to the FM-index of the database chunk, or None, if the index is not there (yet) or out of date"""
+    target_dir = settings.RESIDENT_DATABASES_DIR if target_dir is None else target_dir
+    index = index_path(database, target_dir)
+    return index if is_up_to_date(database_file_path(database), index) else None
+
+
+def search_target(database):
+    """
+    Returns path to the target nhmmer should search for the database chunk and its --tformat,
+    depending on SEARCH_BACKEND: the FM-index of the resident backend, unless it is not built (yet),
+    or the fasta file of the chunk.
+    """
+    if settings.SEARCH_BACKEND == 'resident':
+        index = resident_database_path(database)
+        if index is not None:
+            return index, 'hmmerdb'
+    return database_file_path(database), 'fasta'
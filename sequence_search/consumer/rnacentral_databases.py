@@ -11,6 +11,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import hashlib
 import os
 from collections import namedtuple
 
@@ -77,6 +78,18 @@ def get_database_files():
     return [file for file in (DATABASES_DIRECTORY).glob('*.fasta')]
 
 
+def databases_release():
+    """
+    Fingerprint of the database chunks: changes whenever a chunk is added, removed or replaced,
+    which invalidates the search cache (see db.jobs.search_key).
+    """
+    release = hashlib.sha256()
+    for file in sorted(get_database_files()):
+        stat = file.stat()
+        release.update(('%s %s %s\n' % (file.name, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return release.hexdigest()
+
+
 def producer_validator(databases):
     database_keys = [db.id for db in rnacentral_databases]
 
@@ -40,6 +40,39 @@ EXPIRATION = 60 * 60 * 24 * 7  # seconds
 # maximum time to run nhmmer
 MAX_RUN_TIME = 5 * 60  # seconds
 
+# number of worker processes used to parse nhmmer and cmscan results off the event loop
+PARSER_PROCESSES = 2
+
+# number of job_chunks/infernal_jobs that run concurrently on this consumer
+SLOTS = 1
+
+# number of cores shared by the nhmmer/cmscan processes of all slots
+CPUS = os.cpu_count() or 4
+
+# where nhmmer reads the database chunks from:
+# 'subprocess' - the fasta files in the databases folder
+# 'resident' - FM-indexes of the fasta files in RESIDENT_DATABASES_DIR, built once at startup with makehmmerdb.
+# Experimental, enable it explicitly: nhmmer only extends the exact seed matches found in the index,
+# so it can miss some of the hits of the fasta scan (never report new ones), see README.md
+SEARCH_BACKEND = 'subprocess'
+
+# how overlapping cmscan hits are removed:
+# 'native' - in the consumer process, see infernal_deoverlap.deoverlap, with cmsearch-deoverlap.pl as the fallback
+# 'perl' - cmsearch-deoverlap.pl (DEOVERLAP)
+DEOVERLAP_BACKEND = 'native'
+
+# folder for the FM-indexes of the database chunks (resident backend), should be in memory (tmpfs)
+RESIDENT_DATABASES_DIR = pathlib.Path('/dev/shm') / 'rnacentral-databases'
+
+# pool of connections to postgres, shared by the request handlers and the job_chunks running in the slots,
+# see db/pool.py and the pool metrics at /metrics
+POSTGRES_POOL_MINSIZE = 1
+POSTGRES_POOL_MAXSIZE = 10
+# seconds to wait for a free connection, before the request fails (0 - wait forever)
+POSTGRES_POOL_ACQUIRE_TIMEOUT = 10.0
+# statements that run longer than this fail with SQLError and their connection is closed (in seconds)
+POSTGRES_STATEMENT_TIMEOUT = 60.0
+
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'LOCAL')
 
 # add settings from environment-specific files
@@ -89,3 +122,6 @@ def substitute_environment_variables():
 
 
 substitute_environment_variables()
+
+# value of the --cpu option of every nhmmer/cmscan process, so that a full consumer uses all of its cores
+CPUS_PER_SLOT = max(1, CPUS // SLOTS)
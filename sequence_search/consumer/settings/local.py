@@ -28,6 +28,9 @@ PRODUCER_JOB_DONE_URL = 'api/job-done'
 # full path to nhmmer executable
 NHMMER_EXECUTABLE = 'nhmmer'
 
+# full path to makehmmerdb executable, builds the FM-indexes of the resident search backend
+MAKEHMMERDB_EXECUTABLE = 'makehmmerdb'
+
 # full path to cmscan executable
 CMSCAN_EXECUTABLE = 'cmscan'
 
@@ -15,3 +15,8 @@ from sequence_search.consumer.tests.test_submit_infernal_job import SubmitInfern
 from sequence_search.consumer.tests.test_infernal_parse import InfernalParseTestCase
 from sequence_search.consumer.tests.test_infernal_deoverlap import InfernalDeoverlapTestCase
 from sequence_search.consumer.tests.test_rnacentral_databases import TestProducerToConsumersDatabases
+from sequence_search.consumer.tests.test_nhmmer_parse import NhmmerStreamParseTestCase
+from sequence_search.consumer.tests.test_submit_job import ParseNhmmerResultsTestCase, JobChunkConnectionsTestCase
+from sequence_search.consumer.tests.test_resident_databases import ResidentDatabasesTestCase, ResidentBackendHitsTestCase
+from sequence_search.consumer.tests.test_metrics import MetricsTestCase
+from sequence_search.consumer.tests.test_parser_pool import ParserPoolTestCase
@@ -10,12 +10,24 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
+import subprocess
+import tempfile
 import unittest
 
 from shutil import copyfile
+from unittest import mock
 
-from sequence_search.consumer.infernal_deoverlap import infernal_deoverlap
-from sequence_search.consumer.settings.__init__ import PROJECT_ROOT
+from sequence_search.consumer import infernal_deoverlap as deoverlap_module
+from sequence_search.consumer.infernal_deoverlap import infernal_deoverlap, deoverlap, native_deoverlap
+from sequence_search.consumer.infernal_parse import infernal_parse
+from sequence_search.consumer.settings.__init__ import PROJECT_ROOT, DEOVERLAP
+
+
+def hits(filename):
+    """Lines of the hits in a tblout file of the tests"""
+    with open(PROJECT_ROOT / 'tests' / filename, 'r') as f:
+        return [line for line in f if not line.startswith('#') and line.strip()]
 
 
 class InfernalDeoverlapTestCase(unittest.TestCase):
@@ -27,3 +39,42 @@ class InfernalDeoverlapTestCase(unittest.TestCase):
         process_deoverlap, file_deoverlap = await infernal_deoverlap(job_id='tblout_file')
         assert process_deoverlap != 0
         assert 'tblout_file.deoverlapped' in file_deoverlap
+
+    def test_deoverlap_keeps_a_single_hit(self):
+        assert deoverlap(hits('tblout_file')) == hits('tblout_file')
+
+    def test_deoverlap(self):
+        lines = hits('tblout_overlapping_file')
+        kept = [line.split()[1] for line in deoverlap(lines)]
+
+        # RF02541 overlaps the better RF00001 and RF00027 overlaps RF00005 on the minus strand,
+        # RF00023 only overlaps RF00010, that is removed by RF00177, so it is kept (--maxkeep),
+        # RF00001 of query2 is on another sequence
+        assert kept == ['RF00001', 'RF00177', 'RF00005', 'RF00023', 'RF00001']
+
+    def test_native_deoverlap(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(deoverlap_module, 'INFERNAL_RESULTS_DIR', directory):
+            copyfile(PROJECT_ROOT / 'tests' / 'tblout_overlapping_file', os.path.join(directory, 'job.tblout'))
+
+            filename = native_deoverlap('job')
+            assert filename == os.path.join(directory, 'job.tblout.deoverlapped')
+
+            results = infernal_parse(filename)
+            assert [(item['target_name'], float(item['score'])) for item in results] == [
+                ('5S_rRNA', 104.9), ('SSU_rRNA_bacteria', 50.0), ('tRNA', 30.2), ('tmRNA', 30.0), ('5S_rRNA', 20.0)
+            ]
+
+    @unittest.skipUnless(os.path.isfile(DEOVERLAP), 'cmsearch-deoverlap.pl is not installed')
+    def test_same_hits_as_cmsearch_deoverlap(self):
+        for filename in ['tblout_file', 'tblout_overlapping_file']:
+            with tempfile.TemporaryDirectory() as directory:
+                tblout = os.path.join(directory, 'job.tblout')
+                copyfile(PROJECT_ROOT / 'tests' / filename, tblout)
+                subprocess.run(['perl', str(DEOVERLAP), '--maxkeep', '--cmscan', tblout], check=True,
+                               cwd=directory)
+
+                with open(tblout + '.deoverlapped', 'r') as f:
+                    expected = [line for line in f if not line.startswith('#') and line.strip()]
+
+            assert sorted(deoverlap(hits(filename))) == sorted(expected)
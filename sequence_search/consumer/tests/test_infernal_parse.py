@@ -10,33 +10,129 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
+import random
+import re
+import tempfile
 import unittest
 
-from sequence_search.consumer.infernal_parse import infernal_parse
+from sequence_search.benchmarks.infernal_parse import write_synthetic_cmscan_output, tblout_line
+from sequence_search.consumer.infernal_parse import infernal_parse, infernal_results, infernal_batch_results, \
+    rename_query
+from sequence_search.consumer.infernal_search import batch_query_name
 from sequence_search.consumer.settings.__init__ import PROJECT_ROOT
 
 
 class InfernalParseTestCase(unittest.TestCase):
-    async def test_infernal_parse(self):
+    def test_infernal_parse(self):
         file = PROJECT_ROOT / 'tests' / 'tblout_file'
         data = [
             {'target_name': '5S_rRNA',
              'accession_rfam': 'RF00001',
              'query_name': 'query',
              'accession_seq': '-',
-             'mdl': 'cm', 'mdl_from': '1',
-             'mdl_to': '119',
-             'seq_from': '1',
-             'seq_to': '119',
+             'mdl': 'cm', 'mdl_from': 1,
+             'mdl_to': 119,
+             'seq_from': 1,
+             'seq_to': 119,
              'strand': '+',
              'trunc': 'no',
-             'pipeline_pass': '1',
-             'gc': '0.49',
-             'bias': '0.0',
-             'score': '104.9',
-             'e_value': '3.2e-24',
+             'pipeline_pass': 1,
+             'gc': 0.49,
+             'bias': 0.0,
+             'score': 104.9,
+             'e_value': 3.2e-24,
              'inc': '!',
              'description': '5S ribosomal RNA'}
         ]
         results = infernal_parse(file)
         assert results == data
+
+    def test_infernal_results(self):
+        results = infernal_results(PROJECT_ROOT / 'tests' / 'tblout_file', PROJECT_ROOT / 'tests' / 'cmscan_file')
+
+        # RF02541 is in the cmscan output, but was removed by cmsearch-deoverlap
+        assert [result['accession_rfam'] for result in results] == ['RF00001']
+        assert results[0]['alignment'].splitlines()[3].startswith('  RF00001   1 gccuGcggcCAUAccagcgcgaAAGCACcgG')
+        assert results[0]['alignment'].splitlines()[6].endswith(' PP')
+
+    def test_infernal_results_of_several_hits(self):
+        results = infernal_results(PROJECT_ROOT / 'tests' / 'tblout_overlapping_file',
+                                   PROJECT_ROOT / 'tests' / 'cmscan_file')
+        alignments = {result['accession_rfam']: result['alignment'] for result in results
+                      if result['query_name'] == 'query'}
+
+        assert alignments['RF00001'].splitlines()[3].startswith('  RF00001   1 gccuGcggcCAUAccagcgcgaAAGCACcgG')
+        assert alignments['RF02541'].splitlines()[3].startswith('  RF02541 512 uUACGGCCAUACCuCaG')
+        assert alignments['RF02541'].endswith(' PP\n')
+
+        # hits, that are not in the cmscan output, have no alignment
+        assert alignments['RF00005'] is None
+
+    def test_synthetic_cmscan_output(self):
+        """Hits of random cmscan outputs are parsed and joined with their alignments"""
+        for seed in range(30):
+            generator = random.Random(seed)
+            queries = generator.randint(1, 3)
+
+            with tempfile.TemporaryDirectory() as directory:
+                output_filename = os.path.join(directory, 'output')
+                tblout_filename = os.path.join(directory, 'tblout')
+                deoverlap_filename = os.path.join(directory, 'tblout.deoverlapped')
+
+                hits = write_synthetic_cmscan_output(output_filename, tblout_filename, generator.randint(0, 40),
+                                                     queries=queries, seed=seed)
+                assert infernal_parse(tblout_filename) == [
+                    {key: value for key, value in hit.items() if key != 'alignment'} for hit in hits
+                ]
+                assert infernal_results(tblout_filename, output_filename) == hits
+
+                # any of the hits in any order, like in a deoverlapped file
+                kept = generator.sample(hits, generator.randint(0, len(hits)))
+                with open(deoverlap_filename, 'w') as f:
+                    f.writelines(tblout_line(hit) for hit in kept)
+
+                assert infernal_results(deoverlap_filename, output_filename) == kept
+
+                batch = infernal_batch_results(deoverlap_filename, output_filename)
+                assert sum(len(results) for results in batch.values()) == len(kept)
+                for query_name, results in batch.items():
+                    expected = [hit for hit in kept if hit['query_name'] == query_name]
+                    assert [result['alignment'] for result in results] == [
+                        rename_query(hit['alignment'], query_name) for hit in expected
+                    ]
+                    assert all(result['query_name'] == 'query' for result in results)
+
+    def test_infernal_batch_results(self):
+        """Output of cmscan with several queries has a section per query, the tblout a query name column"""
+        with open(PROJECT_ROOT / 'tests' / 'tblout_file') as f:
+            tblout = f.read().split('\n')
+        with open(PROJECT_ROOT / 'tests' / 'cmscan_file') as f:
+            header, section = f.read().split('Query:', 1)
+        section = 'Query:' + section.split('[ok]')[0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            deoverlap_filename = os.path.join(directory, 'tblout.deoverlapped')
+            output_filename = os.path.join(directory, 'output')
+
+            # the second query has no hits
+            with open(deoverlap_filename, 'w') as f:
+                f.write('\n'.join(tblout[:2]) + '\n')
+                for index in [0, 2]:
+                    f.write(re.sub(r' query {5}', ' ' + batch_query_name(index).ljust(10), tblout[2]) + '\n')
+                f.write('\n'.join(tblout[3:]))
+
+            with open(output_filename, 'w') as f:
+                f.write(header)
+                for index in range(3):
+                    # names are right-aligned to the width of the model names in the alignments
+                    f.write(re.sub(r' query(?= )', batch_query_name(index), section))
+                f.write('[ok]\n')
+
+            expected = infernal_results(PROJECT_ROOT / 'tests' / 'tblout_file', PROJECT_ROOT / 'tests' / 'cmscan_file')
+            batch = infernal_batch_results(deoverlap_filename, output_filename)
+
+            assert sorted(batch) == [batch_query_name(0), batch_query_name(2)]
+            assert batch[batch_query_name(0)] == expected
+            assert batch[batch_query_name(2)] == expected
+
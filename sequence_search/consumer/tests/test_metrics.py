@@ -0,0 +1,65 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import asyncio
+import logging
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from prometheus_client import REGISTRY
+
+from sequence_search.consumer.__main__ import create_app
+from sequence_search.consumer.metrics import occupies_slot
+from sequence_search.consumer.settings import SLOTS
+from sequence_search.db.settings import get_postgres_credentials
+
+
+class MetricsTestCase(AioHTTPTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python3 -m unittest sequence_search.consumer.tests.test_metrics
+    """
+    async def get_application(self):
+        logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
+        app = create_app()
+        app.update(name='test', settings=get_postgres_credentials(ENVIRONMENT='TEST'))
+        return app
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        async with self.client.get(path='/metrics') as response:
+            assert response.status == 200
+            text = await response.text()
+
+        assert 'sequence_search_consumer_slots %s' % float(SLOTS) in text
+        assert 'sequence_search_db_pool_connections{state="in_use"}' in text
+        assert 'sequence_search_db_pool_wait_seconds_bucket{le="+Inf"}' in text
+
+    @unittest_run_loop
+    async def test_busy_slots(self):
+        started, finish = asyncio.Event(), asyncio.Event()
+
+        @occupies_slot
+        async def search():
+            started.set()
+            await finish.wait()
+
+        busy = REGISTRY.get_sample_value('sequence_search_consumer_busy_slots')
+        task = asyncio.ensure_future(search())
+        await started.wait()
+        assert REGISTRY.get_sample_value('sequence_search_consumer_busy_slots') == busy + 1
+
+        finish.set()
+        await task
+        assert REGISTRY.get_sample_value('sequence_search_consumer_busy_slots') == busy
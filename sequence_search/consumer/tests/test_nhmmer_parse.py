@@ -0,0 +1,94 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import re
+import tempfile
+import unittest
+
+from itertools import islice
+
+from sequence_search.consumer.nhmmer_parse import nhmmer_parse, nhmmer_stream_parse, nhmmer_results, \
+    nhmmer_batch_results, nhmmer_pipeline_stats
+from sequence_search.consumer.nhmmer_search import batch_query_name
+from sequence_search.consumer.settings.__init__ import PROJECT_ROOT
+
+
+class NhmmerStreamParseTestCase(unittest.TestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python3 -m unittest sequence_search.consumer.tests.test_nhmmer_parse
+    """
+    file = PROJECT_ROOT / 'tests' / 'nhmmer_file'
+
+    def test_same_output_as_nhmmer_parse(self):
+        expected = list(nhmmer_parse(filename=self.file))
+        results = list(nhmmer_stream_parse(filename=self.file))
+        assert len(results) == 4
+        assert results == expected
+
+    def test_multi_block_alignment(self):
+        record = next(nhmmer_stream_parse(filename=self.file))
+        assert record['rnacentral_id'] == 'URSCA269E0D37_9606'
+        assert record['alignment_length'] == 78
+        assert record['alignment'].count('Query') == 3
+        assert record['result_id'] == 1
+
+    def test_limit(self):
+        expected = list(islice(nhmmer_parse(filename=self.file), 2))
+        results = list(nhmmer_stream_parse(filename=self.file, limit=2))
+        assert results == expected
+        assert list(nhmmer_stream_parse(filename=self.file, limit=0)) == []
+
+    def test_pipeline_stats(self):
+        assert nhmmer_pipeline_stats(self.file) == {
+            'target_sequences': 38589,
+            'residues_searched': 4657073,
+            'residues_passed_ssv': 147040,
+            'residues_passed_bias': 96851,
+            'residues_passed_vit': 6297,
+            'residues_passed_fwd': 1466,
+            'total_hits': 4,
+            'search_seconds': 0.2,
+        }
+
+        # the output of a search that was killed has no statistics
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'nhmmer_results')
+            with open(self.file) as f, open(filename, 'w') as truncated:
+                truncated.write(f.read().split('Internal pipeline statistics summary')[0])
+            assert nhmmer_pipeline_stats(filename) == {}
+
+    def test_batch_same_output_as_single_query(self):
+        """Output of nhmmer with several queries has a section per query, names are right-aligned in alignments"""
+        with open(self.file) as f:
+            header, section = f.read().split('Query:', 1)
+        section = 'Query:' + section.split('[ok]')[0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'nhmmer_batch_results')
+            with open(filename, 'w') as f:
+                f.write(header)
+                for index in range(3):
+                    f.write(re.sub(r' query(?= )', batch_query_name(index), section))
+                f.write('[ok]\n')
+
+            expected = nhmmer_results(self.file)
+            results = nhmmer_batch_results(filename)
+            assert list(results) == [batch_query_name(index) for index in range(3)]
+            for stats, records in results.values():
+                assert stats == nhmmer_pipeline_stats(self.file)
+                assert records == expected
+
+            results = nhmmer_batch_results(filename, limit=2)
+            assert all(records == expected[:2] for stats, records in results.values())
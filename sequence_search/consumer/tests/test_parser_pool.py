@@ -0,0 +1,44 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import os
+import unittest
+
+from concurrent.futures.process import BrokenProcessPool
+
+from sequence_search.consumer.parser_pool import ParserPool
+
+
+class ParserPoolTestCase(unittest.TestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python3 -m unittest sequence_search.consumer.tests.test_parser_pool
+    """
+    def setUp(self):
+        self.pool = ParserPool(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.loop.close()
+
+    def test_worker_died(self):
+        # the parse, that was running, fails
+        with self.assertRaises(BrokenProcessPool):
+            self.loop.run_until_complete(self.loop.run_in_executor(self.pool, os._exit, 1))
+
+        # the next parses run in new processes
+        assert self.loop.run_until_complete(self.loop.run_in_executor(self.pool, abs, -1)) == 1
+        assert self.pool.submit(abs, -2).result() == 2
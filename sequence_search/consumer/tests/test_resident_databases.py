@@ -0,0 +1,183 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+from sequence_search.consumer import settings
+from sequence_search.consumer.nhmmer_parse import nhmmer_stream_parse
+from sequence_search.consumer.nhmmer_search import nhmmer_search
+from sequence_search.consumer.resident_databases import load_resident_databases, resident_database_path, \
+    search_target
+
+
+class ResidentDatabasesTestCase(unittest.TestCase):
+    """
+    makehmmerdb is replaced with a script, that copies the fasta file to the index.
+
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.consumer.tests.test_resident_databases
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source_dir = pathlib.Path(self.directory.name) / 'databases'
+        self.target_dir = pathlib.Path(self.directory.name) / 'shm'
+        os.makedirs(self.source_dir)
+
+        self.source_files = []
+        for name in ['mirbase.fasta', 'ena1.fasta']:
+            with open(self.source_dir / name, 'w') as f:
+                f.write('>URS0000000001_9606\nGAGUUUGAGACCAGCCUGGCCA\n')
+            self.source_files.append(self.source_dir / name)
+
+        self.makehmmerdb = self.script('makehmmerdb', 'cp "$1" "$2"')
+        patcher = mock.patch.object(settings, 'MAKEHMMERDB_EXECUTABLE', self.makehmmerdb)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def script(self, name, command):
+        path = pathlib.Path(self.directory.name) / name
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n%s\n' % command)
+        os.chmod(path, 0o755)
+        return str(path)
+
+    def database_file_path(self, database):
+        return self.source_dir / database
+
+    def test_load_resident_databases(self):
+        built = load_resident_databases(self.source_files, self.target_dir)
+        assert sorted(built) == ['ena1.fasta', 'mirbase.fasta']
+        assert sorted(os.listdir(self.target_dir)) == ['ena1.fasta.hmmerdb', 'mirbase.fasta.hmmerdb']
+
+        # up-to-date indexes are kept after a restart, changed database chunks are indexed again
+        with open(self.source_dir / 'ena1.fasta', 'a') as f:
+            f.write('>URS0000000002_9606\nUGAGGUAGUAGGUUGUAUAGUU\n')
+        os.utime(self.source_dir / 'ena1.fasta', (0, os.stat(self.source_dir / 'ena1.fasta').st_mtime + 10))
+
+        assert load_resident_databases(self.source_files, self.target_dir) == ['ena1.fasta']
+        with open(self.target_dir / 'ena1.fasta.hmmerdb') as f:
+            assert 'URS0000000002_9606' in f.read()
+
+    def test_load_resident_databases_failed(self):
+        # a partial index of the failed makehmmerdb is not used
+        with mock.patch.object(settings, 'MAKEHMMERDB_EXECUTABLE', self.script('failed', 'touch "$2"; exit 1')):
+            assert load_resident_databases(self.source_files, self.target_dir) == []
+
+        with mock.patch('sequence_search.consumer.resident_databases.database_file_path', self.database_file_path):
+            assert resident_database_path('mirbase.fasta', self.target_dir) is None
+
+        # the next startup builds the index
+        assert sorted(load_resident_databases(self.source_files, self.target_dir)) == ['ena1.fasta', 'mirbase.fasta']
+
+    def test_resident_database_path(self):
+        with mock.patch('sequence_search.consumer.resident_databases.database_file_path', self.database_file_path):
+            # the index is not there yet
+            assert resident_database_path('mirbase.fasta', self.target_dir) is None
+
+            load_resident_databases(self.source_files, self.target_dir)
+            path = resident_database_path('mirbase.fasta', self.target_dir)
+            assert path == os.path.join(self.target_dir, 'mirbase.fasta.hmmerdb')
+
+    def test_search_target(self):
+        with mock.patch('sequence_search.consumer.resident_databases.database_file_path', self.database_file_path), \
+                mock.patch.object(settings, 'RESIDENT_DATABASES_DIR', self.target_dir), \
+                mock.patch.object(settings, 'SEARCH_BACKEND', 'resident'):
+            # fasta file is searched until the index is built
+            assert search_target('mirbase.fasta') == (self.source_dir / 'mirbase.fasta', 'fasta')
+
+            load_resident_databases(self.source_files, self.target_dir)
+            assert search_target('mirbase.fasta') == (os.path.join(self.target_dir, 'mirbase.fasta.hmmerdb'), 'hmmerdb')
+
+            with mock.patch.object(settings, 'SEARCH_BACKEND', 'subprocess'):
+                assert search_target('mirbase.fasta') == (self.source_dir / 'mirbase.fasta', 'fasta')
+
+
+@unittest.skipUnless(shutil.which('nhmmer') and shutil.which('makehmmerdb'), 'needs nhmmer and makehmmerdb')
+class ResidentBackendHitsTestCase(unittest.TestCase):
+    """
+    Known differences of the hits of the 'resident' (FM-index) and 'subprocess' (fasta) backends, see README.md:
+    the FM-index finds exact matches of the query, but can miss hits with no exact seed.
+
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.consumer.tests.test_resident_databases
+    """
+    query = 'UAGCUUAUCAGACUGAUGUUGA'  # hsa-miR-21-5p
+
+    targets = {
+        # hsa-mir-21 precursor and the mature miRNA, exact matches of the query
+        'URS000075A3B2_9606': 'UGUCGGGUAGCUUAUCAGACUGAUGUUGACUGUUGAAUCUCAUGGCAACACCAGUCGAUGGGCUGUC',
+        'URS000039ED8D_9606': 'UAGCUUAUCAGACUGAUGUUGA',
+        # mismatches every few nucleotides
+        'URS0000000001_10090': 'UAGCAUAUCUGACUGUUGUUCA',
+        'URS0000000002_10090': 'UACCUUAGCAGAGUGAUCUUGA',
+        # unrelated
+        'URS0000000003_9606': 'GGCUACGUAGCUCAGUUGGUUAGAGCACAUCACUCAUAAUGAUGGGGUCACAGGUUCGAAUCCCGUCGUAGCCACCA',
+        'URS0000000004_9606': 'UGAGGUAGUAGGUUGUAUAGUU',
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.source_dir = pathlib.Path(self.directory.name) / 'databases'
+        self.target_dir = pathlib.Path(self.directory.name) / 'shm'
+        os.makedirs(self.source_dir)
+
+        with open(self.source_dir / 'mirbase.fasta', 'w') as f:
+            for rnacentral_id, sequence in self.targets.items():
+                f.write('>%s\n%s\n' % (rnacentral_id, sequence))
+        load_resident_databases([self.source_dir / 'mirbase.fasta'], self.target_dir)
+
+        for patcher in [
+            mock.patch('sequence_search.consumer.resident_databases.database_file_path',
+                       lambda database: self.source_dir / database),
+            mock.patch.object(settings, 'RESIDENT_DATABASES_DIR', self.target_dir),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def search(self, backend):
+        """rnacentral_ids of the hits of the query in the fixture database"""
+        async def search():
+            process, filename = await nhmmer_search(self.query, str(uuid.uuid4()), 'mirbase.fasta')
+            await process.communicate()
+            assert process.returncode == 0
+            return set(record['rnacentral_id'] for record in nhmmer_stream_parse(filename))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with mock.patch.object(settings, 'SEARCH_BACKEND', backend):
+                return loop.run_until_complete(search())
+        finally:
+            loop.close()
+
+    def test_hits(self):
+        fasta = self.search('subprocess')
+        resident = self.search('resident')
+
+        exact = {'URS000075A3B2_9606', 'URS000039ED8D_9606'}
+        assert exact <= fasta
+        assert exact <= resident
+        assert resident <= fasta
@@ -15,14 +15,19 @@ import datetime
 import json
 import logging
 import sqlalchemy as sa
+import tempfile
 import uuid
 
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from unittest import mock
 
+from sequence_search.consumer import infernal_deoverlap as deoverlap_module
+from sequence_search.consumer import infernal_search as search_module
 from sequence_search.consumer.__main__ import create_app
+from sequence_search.consumer.views.submit_infernal_job import start_infernal_job_batch
 from sequence_search.db.consumers import get_ip
 from sequence_search.db.jobs import JOB_STATUS_CHOICES
-from sequence_search.db.models import Job, InfernalJob
+from sequence_search.db.models import Job, InfernalJob, JOB_CHUNK_STATUS_CHOICES
 from sequence_search.db.settings import get_postgres_credentials
 
 
@@ -41,6 +46,18 @@ class SubmitInfernalTestCase(AioHTTPTestCase):
     async def setUpAsync(self):
         await super().setUpAsync()
 
+        # the searches spawned by the requests write their queries and results in a directory of their own,
+        # it is removed after the application, together with its background jobs, is closed
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patcher in [
+            mock.patch.object(search_module, 'INFERNAL_QUERY_DIR', directory.name),
+            mock.patch.object(search_module, 'INFERNAL_RESULTS_DIR', directory.name),
+            mock.patch.object(deoverlap_module, 'INFERNAL_RESULTS_DIR', directory.name),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
         self.consumer_ip = get_ip(self.app)
 
         async with self.app['engine'].acquire() as connection:
@@ -57,6 +74,7 @@ class SubmitInfernalTestCase(AioHTTPTestCase):
             await connection.execute(
                 InfernalJob.insert().values(
                     job_id=self.job_id,
+                    status=JOB_CHUNK_STATUS_CHOICES.dispatching
                 )
             )
 
@@ -90,3 +108,83 @@ class SubmitInfernalTestCase(AioHTTPTestCase):
                 assert row.status == JOB_STATUS_CHOICES.started
                 assert row.consumer == self.consumer_ip
                 break
+
+    @unittest_run_loop
+    async def test_submit_infernal_job_batch(self):
+        job_id = str(uuid.uuid4())
+        query = 'AGUUACGGCCAUACCUCAGAGAAUAUACCGUAUCCCGUUCGAUCUGCGAAGUUAAGCUCUGAAGGG'
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=job_id, query=query, submitted=datetime.datetime.now(),
+                                    status=JOB_STATUS_CHOICES.started)
+            )
+            await connection.execute(InfernalJob.insert().values(job_id=job_id,
+                                                                 status=JOB_CHUNK_STATUS_CHOICES.dispatching))
+
+        url = self.app.router["submit-infernal-job-batch"].url_for()
+        json_data = json.dumps({"jobs": [{"job_id": self.job_id, "sequence": query}, {"job_id": job_id, "sequence": query}]})
+        headers = {'content-type': 'application/json'}
+
+        async with self.client.post(path=url, data=json_data, headers=headers) as response:
+            assert response.status == 201
+
+        async with self.app['engine'].acquire() as connection:
+            query = sa.text('''
+                SELECT job_id, status, consumer
+                FROM infernal_job
+                WHERE job_id IN (:job_id1, :job_id2)
+            ''')
+            rows = [row async for row in await connection.execute(query, job_id1=self.job_id, job_id2=job_id)]
+            assert sorted(row.job_id for row in rows) == sorted([self.job_id, job_id])
+            assert all(row.status == JOB_STATUS_CHOICES.started for row in rows)
+            assert all(row.consumer == self.consumer_ip for row in rows)
+
+        async with self.client.post(path=url, data=json.dumps({"jobs": []}), headers=headers) as response:
+            assert response.status == 400
+
+
+    @unittest_run_loop
+    async def test_start_infernal_job_batch_records_infernal_job(self):
+        job_id = str(uuid.uuid4())
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=job_id, query='AGUUACGGCCAUACC', submitted=datetime.datetime.now(),
+                                    status=JOB_STATUS_CHOICES.started)
+            )
+            await connection.execute(InfernalJob.insert().values(job_id=job_id,
+                                                                 status=JOB_CHUNK_STATUS_CHOICES.dispatching))
+
+        slot = await start_infernal_job_batch(self.app['engine'], [self.job_id, job_id], self.consumer_ip)
+
+        # the scheduler frees the slot, once the last infernal job of the batch is finished
+        async with self.app['engine'].acquire() as connection:
+            infernal_job_id = await connection.scalar(
+                sa.text('SELECT id FROM infernal_job WHERE job_id=:job_id'), job_id=job_id
+            )
+            query = sa.text('SELECT job_chunk_id, infernal_job_id FROM consumer_slot WHERE consumer=:ip AND slot=:slot')
+            rows = [row async for row in await connection.execute(query, ip=self.consumer_ip, slot=slot)]
+            assert [(row.job_chunk_id, row.infernal_job_id) for row in rows] == [('infernal-job', infernal_job_id)]
+
+    @unittest_run_loop
+    async def test_submit_infernal_job_not_dispatching(self):
+        # e.g. the producer released the infernal job, before the request got here
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                sa.text('UPDATE infernal_job SET status=:status WHERE job_id=:job_id'),
+                status=JOB_CHUNK_STATUS_CHOICES.pending, job_id=self.job_id
+            )
+
+        json_data = json.dumps({"job_id": self.job_id, "sequence": 'AGUUACGGCCAUACCUCAGAGAAUAUACCGUAUCCCGUUCG'})
+        headers = {'content-type': 'application/json'}
+        async with self.client.post(path=self.url, data=json_data, headers=headers) as response:
+            assert response.status == 409
+
+        async with self.app['engine'].acquire() as connection:
+            status = await connection.scalar(
+                sa.text('SELECT status FROM infernal_job WHERE job_id=:job_id'), job_id=self.job_id
+            )
+            assert status == JOB_CHUNK_STATUS_CHOICES.pending
+            slots = await connection.scalar(
+                sa.text('SELECT count(*) FROM consumer_slot WHERE consumer=:ip'), ip=self.consumer_ip
+            )
+            assert slots == 0
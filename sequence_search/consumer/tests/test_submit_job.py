@@ -0,0 +1,247 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import asyncio
+import importlib
+import os
+import tempfile
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import sqlalchemy as sa
+from aiohttp.test_utils import unittest_run_loop
+from concurrent.futures import ProcessPoolExecutor
+
+from sequence_search.benchmarks.nhmmer_parse import write_synthetic_nhmmer_output
+from sequence_search.consumer.nhmmer_parse import nhmmer_results
+from sequence_search.consumer.settings import NHMMER_LIMIT
+from sequence_search.consumer.views.submit_job import parse_nhmmer_results, start_job_chunk, finish_job_chunk, \
+    start_job_chunk_batch, finish_job_chunk_batch, nhmmer, search_batch
+from sequence_search.db import DoesNotExist, NotDispatched
+from sequence_search.db.models import Job, JobChunk, Consumer, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES, \
+    CONSUMER_STATUS_CHOICES
+from sequence_search.db.tests.test_base import DBTestCase, CountingEngine
+
+# the module, not the submit_job view exported by the views package
+submit_job_module = importlib.import_module('sequence_search.consumer.views.submit_job')
+
+
+class ParseNhmmerResultsTestCase(unittest.TestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python3 -m unittest sequence_search.consumer.tests.test_submit_job
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'nhmmer_results')
+        write_synthetic_nhmmer_output(self.filename, hits=NHMMER_LIMIT * 5)
+
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.loop.close()
+        self.directory.cleanup()
+
+    def test_loop_is_responsive_while_parsing(self):
+        pauses = []
+
+        async def heartbeat(parsing):
+            last = time.perf_counter()
+            while not parsing.done():
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                pauses.append(now - last)
+                last = now
+
+        async def run():
+            parsing = asyncio.ensure_future(parse_nhmmer_results(self.executor, self.filename))
+            await heartbeat(parsing)
+            return await parsing
+
+        stats, results = self.loop.run_until_complete(run())
+
+        assert stats['total_hits'] == NHMMER_LIMIT * 5
+        assert results == nhmmer_results(self.filename, NHMMER_LIMIT)
+        assert len(pauses) > 1
+        assert max(pauses) < 0.5
+
+
+class JobChunkConnectionsTestCase(DBTestCase):
+    """
+    Starting and finishing a job chunk should check out a single connection from the pool each.
+
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python3 -m unittest sequence_search.consumer.tests.test_submit_job
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.job_id = str(uuid.uuid4())
+        self.consumer_ip = '192.168.0.2'
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=self.job_id, query='AACAGCAUGAGUGCGCUGGAUG', status=JOB_STATUS_CHOICES.started)
+            )
+            for database in ['mirbase', 'pombase']:
+                await connection.execute(
+                    JobChunk.insert().values(job_id=self.job_id, database=database,
+                                             status=JOB_CHUNK_STATUS_CHOICES.dispatching)
+                )
+            await connection.execute(
+                Consumer.insert().values(ip=self.consumer_ip, status=CONSUMER_STATUS_CHOICES.available, port='8000',
+                                         slots=2)
+            )
+
+        self.engine = CountingEngine(self.app['engine'])
+
+    async def query(self, query, **params):
+        async with self.app['engine'].acquire() as connection:
+            return [tuple(row.values()) async for row in await connection.execute(sa.text(query), **params)]
+
+    @unittest_run_loop
+    async def test_start_and_finish_job_chunks(self):
+        for database, status in [('mirbase', JOB_CHUNK_STATUS_CHOICES.error),
+                                 ('pombase', JOB_CHUNK_STATUS_CHOICES.success)]:
+            self.engine.checkouts = 0
+            slot = await start_job_chunk(self.engine, self.job_id, database, self.consumer_ip)
+            assert self.engine.checkouts == 1
+
+            assert await self.query(
+                'SELECT status, consumer FROM job_chunks WHERE job_id=:job_id AND database=:database',
+                job_id=self.job_id, database=database
+            ) == [(JOB_CHUNK_STATUS_CHOICES.started, self.consumer_ip)]
+            assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == \
+                [(slot,)]
+
+            self.engine.checkouts = 0
+            stats = {'total_hits': 3, 'target_sequences': 38589, 'residues_searched': 4657073, 'search_seconds': 0.2}
+            await finish_job_chunk(self.engine, self.job_id, database, self.consumer_ip, slot, status, [], stats)
+            assert self.engine.checkouts == 1
+
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+        assert await self.query('SELECT status FROM jobs WHERE id=:job_id', job_id=self.job_id) == \
+            [(JOB_STATUS_CHOICES.partial_success,)]
+
+        # pipeline statistics are only saved with the results of a successful search
+        assert await self.query(
+            'SELECT database, hits, target_sequences, residues_searched, residues_passed_ssv, search_seconds '
+            'FROM job_chunks WHERE job_id=:job_id ORDER BY database', job_id=self.job_id
+        ) == [('mirbase', None, None, None, None, None), ('pombase', 3, 38589, 4657073, None, 0.2)]
+
+    @unittest_run_loop
+    async def test_start_job_chunk_rolls_back(self):
+        with self.assertRaises(DoesNotExist):
+            await start_job_chunk(self.engine, self.job_id, 'unknown', self.consumer_ip)
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+
+        # a job chunk, that is not dispatching (e.g. started already), is rejected and takes no slot
+        await start_job_chunk(self.engine, self.job_id, 'mirbase', self.consumer_ip)
+        with self.assertRaises(NotDispatched):
+            await start_job_chunk(self.engine, self.job_id, 'mirbase', self.consumer_ip)
+        assert len(await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip)) == 1
+
+        # the consumer has no free slots
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                JobChunk.insert().values(job_id=self.job_id, database='rfam',
+                                         status=JOB_CHUNK_STATUS_CHOICES.dispatching)
+            )
+        await start_job_chunk(self.engine, self.job_id, 'pombase', self.consumer_ip)
+        assert await start_job_chunk(self.engine, self.job_id, 'rfam', self.consumer_ip) is None
+        assert await self.query(
+            'SELECT status FROM job_chunks WHERE job_id=:job_id AND database=:database',
+            job_id=self.job_id, database='rfam'
+        ) == [(JOB_CHUNK_STATUS_CHOICES.dispatching,)]
+
+    @unittest_run_loop
+    async def test_start_and_finish_job_chunk_batch(self):
+        job_id = str(uuid.uuid4())
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=job_id, query='AACAGCAUGAGUGCGCUGGAUG', status=JOB_STATUS_CHOICES.started)
+            )
+            await connection.execute(
+                JobChunk.insert().values(job_id=job_id, database='mirbase', status=JOB_CHUNK_STATUS_CHOICES.pending)
+            )
+
+        # the job chunk of the second job is not claimed by a producer yet, neither job chunk is started
+        with self.assertRaises(NotDispatched):
+            await start_job_chunk_batch(self.engine, [self.job_id, job_id], 'mirbase', self.consumer_ip)
+        assert await self.query(
+            'SELECT job_id, status FROM job_chunks WHERE database=:database ORDER BY job_id', database='mirbase'
+        ) == sorted([(job_id, JOB_CHUNK_STATUS_CHOICES.pending),
+                     (self.job_id, JOB_CHUNK_STATUS_CHOICES.dispatching)])
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                sa.text('UPDATE job_chunks SET status=:status WHERE job_id=:job_id'),
+                status=JOB_CHUNK_STATUS_CHOICES.dispatching, job_id=job_id
+            )
+        self.engine.checkouts = 0
+
+        # both job chunks take a single slot
+        slot = await start_job_chunk_batch(self.engine, [self.job_id, job_id], 'mirbase', self.consumer_ip)
+        assert self.engine.checkouts == 1
+        assert await self.query(
+            'SELECT job_id, status, consumer FROM job_chunks WHERE database=:database ORDER BY job_id',
+            database='mirbase'
+        ) == sorted([(job_id, JOB_CHUNK_STATUS_CHOICES.started, self.consumer_ip),
+                     (self.job_id, JOB_CHUNK_STATUS_CHOICES.started, self.consumer_ip)])
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == \
+            [(slot,)]
+
+        self.engine.checkouts = 0
+        await finish_job_chunk_batch(self.engine, 'mirbase', self.consumer_ip, slot, [
+            (self.job_id, JOB_CHUNK_STATUS_CHOICES.success, [], {'total_hits': 0}),
+            (job_id, JOB_CHUNK_STATUS_CHOICES.timeout, [], None),
+        ])
+        assert self.engine.checkouts == 1
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+        assert await self.query('SELECT status FROM jobs WHERE id=:job_id', job_id=job_id) == \
+            [(JOB_STATUS_CHOICES.partial_success,)]
+
+        # the slot is not taken, if any of the job chunks doesn't exist
+        with self.assertRaises(DoesNotExist):
+            await start_job_chunk_batch(self.engine, [self.job_id, job_id], 'pombase', self.consumer_ip)
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+
+    @unittest_run_loop
+    async def test_parse_error(self):
+        # nhmmer succeeds, but its result file can't be parsed
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'missing')
+
+        async def search(*args, **kwargs):
+            return await asyncio.create_subprocess_exec('true'), filename
+
+        slot = await start_job_chunk(self.engine, self.job_id, 'mirbase', self.consumer_ip)
+        with mock.patch.object(submit_job_module, 'nhmmer_search', search):
+            await nhmmer(self.engine, self.job_id, 'AACAGCAUGAGUGCGCUGGAUG', 'mirbase', self.consumer_ip, slot)
+
+        # the job chunk fails and its slot is freed
+        assert await self.query(
+            'SELECT status FROM job_chunks WHERE job_id=:job_id AND database=:database',
+            job_id=self.job_id, database='mirbase'
+        ) == [(JOB_CHUNK_STATUS_CHOICES.error,)]
+        assert await self.query('SELECT slot FROM consumer_slot WHERE consumer=:ip', ip=self.consumer_ip) == []
+
+        with mock.patch.object(submit_job_module, 'nhmmer_batch_search', search):
+            assert await search_batch([(self.job_id, 'AACAGCAUGAGUGCGCUGGAUG')], 'pombase') == \
+                [(self.job_id, JOB_CHUNK_STATUS_CHOICES.error, [], None)]
@@ -11,7 +11,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from .views import index, result, submit_job, submit_infernal_job
+from .views import index, result, submit_job, submit_job_batch, submit_infernal_job, \
+    submit_infernal_job_batch, metrics
 from . import settings
 
 
@@ -19,7 +20,10 @@ def setup_routes(app):
     app.router.add_get('/', index, name='index')
     app.router.add_get('/results/{result_id}', result, name='result')
     app.router.add_post('/submit-job', submit_job, name='submit-job')
+    app.router.add_post('/submit-job-batch', submit_job_batch, name='submit-job-batch')
     app.router.add_post('/submit-infernal-job', submit_infernal_job, name='submit-infernal-job')
+    app.router.add_post('/submit-infernal-job-batch', submit_infernal_job_batch, name='submit-infernal-job-batch')
+    app.router.add_get('/metrics', metrics, name='metrics')
     setup_static_routes(app)
 
 
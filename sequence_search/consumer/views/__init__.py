@@ -13,5 +13,6 @@ limitations under the License.
 
 from .index import index
 from .result import result
-from .submit_job import submit_job
-from .submit_infernal_job import submit_infernal_job
+from .submit_job import submit_job, submit_job_batch
+from .submit_infernal_job import submit_infernal_job, submit_infernal_job_batch
+from .metrics import metrics
@@ -12,19 +12,21 @@ limitations under the License.
 """
 import asyncio
 import logging
+import time
 
 from aiohttp import web
 from aiojobs.aiohttp import spawn
 
-from ..infernal_parse import infernal_parse, alignment
-from ..infernal_search import infernal_search
-from ..infernal_deoverlap import infernal_deoverlap
-from ..settings import MAX_RUN_TIME
-from ...db import DatabaseConnectionError, SQLError
-from ...db.consumers import get_ip, set_consumer_fields
-from ...db.models import CONSUMER_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
-from ...db.infernal_job import set_infernal_job_status, set_consumer_to_infernal_job
-from ...db.infernal_results import set_infernal_job_results, get_infernal_result_id, save_alignment
+from ..infernal_parse import infernal_results, infernal_batch_results
+from ..infernal_search import infernal_search, infernal_batch_search, batch_query_name
+from ..infernal_deoverlap import infernal_deoverlap, native_deoverlap
+from ..metrics import SEARCH_SECONDS, PARSE_SECONDS, SAVE_RESULTS_SECONDS, INFERNAL_BATCH_SIZE, occupies_slot
+from ..settings import MAX_RUN_TIME, DEOVERLAP_BACKEND
+from ...db import DatabaseConnectionError, SQLError, NotDispatched, unit_of_work
+from ...db.consumers import get_ip, occupy_consumer_slot, free_consumer_slot, set_consumer_slot_infernal_job
+from ...db.models import JOB_CHUNK_STATUS_CHOICES
+from ...db.infernal_job import set_infernal_job_status, start_dispatched_infernal_jobs
+from ...db.infernal_results import set_infernal_job_results
 
 logger = logging.Logger('aiohttp.web')
 
@@ -37,9 +39,38 @@ class InfernalError(Exception):
         return str(self.text)
 
 
-async def infernal(engine, job_id, sequence, consumer_ip):
+async def run_deoverlap(job_id, executor=None):
+    """
+    Removes the overlapping hits from the tblout of the job, see DEOVERLAP_BACKEND in settings.
+    cmsearch-deoverlap.pl is the fallback, in case the native deoverlap fails.
+    :return: path to the deoverlapped file
+    """
+    if DEOVERLAP_BACKEND == 'native':
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(executor, native_deoverlap, job_id)
+        except Exception as e:
+            logger.warning('Native deoverlap error for job_id: %s, falling back to cmsearch-deoverlap.pl - '
+                           'Message: %s' % (job_id, e))
+
+    process_deoverlap, file_deoverlap = await infernal_deoverlap(job_id=job_id)
+    try:
+        task_deoverlap = asyncio.ensure_future(process_deoverlap.communicate())
+        await asyncio.wait_for(task_deoverlap, MAX_RUN_TIME)
+    except asyncio.TimeoutError:
+        process_deoverlap.kill()
+        raise
+
+    if process_deoverlap.returncode != 0:
+        raise InfernalError("Deoverlap process returned non-zero status code")
+    return file_deoverlap
+
+
+@occupies_slot
+async def infernal(engine, job_id, sequence, consumer_ip, slot, executor=None):
     process, filename = await infernal_search(sequence=sequence, job_id=job_id)
 
+    t0 = time.perf_counter()
     try:
         task = asyncio.ensure_future(process.communicate())
         await asyncio.wait_for(task, MAX_RUN_TIME)
@@ -48,57 +79,159 @@ async def infernal(engine, job_id, sequence, consumer_ip):
     except asyncio.TimeoutError:
         logger.warning('Infernal timeout for: job_id = %s' % job_id)
         process.kill()
-        # TODO: what do we do in case we lost the database connection here?
-        await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.timeout)
-        await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available, job_chunk_id=None)
+        SEARCH_SECONDS.labels('cmscan', 'rfam', JOB_CHUNK_STATUS_CHOICES.timeout).observe(time.perf_counter() - t0)
+        await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.timeout)
         return
     except Exception as e:
         logger.error('Infernal error for job_id: %s - Message: %s' % (job_id, e))
-        # TODO: what do we do in case we lost the database connection here?
-        await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.error)
-        await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available, job_chunk_id=None)
+        SEARCH_SECONDS.labels('cmscan', 'rfam', JOB_CHUNK_STATUS_CHOICES.error).observe(time.perf_counter() - t0)
+        await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.error)
         return
     else:
         logger.debug('Infernal search success for: job_id = %s' % job_id)
-
-    process_deoverlap, file_deoverlap = await infernal_deoverlap(job_id=job_id)
+        SEARCH_SECONDS.labels('cmscan', 'rfam', JOB_CHUNK_STATUS_CHOICES.success).observe(time.perf_counter() - t0)
 
     try:
-        task_deoverlap = asyncio.ensure_future(process_deoverlap.communicate())
-        await asyncio.wait_for(task_deoverlap, MAX_RUN_TIME)
-        if process_deoverlap.returncode != 0:
-            raise InfernalError("Deoverlap process returned non-zero status code")
+        file_deoverlap = await run_deoverlap(job_id, executor)
     except asyncio.TimeoutError:
         logging.debug('Deoverlap timeout for: job_id = %s' % job_id)
-        process_deoverlap.kill()
-        await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.timeout)
-        await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available, job_chunk_id=None)
+        await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.timeout)
     except Exception as e:
         logging.debug('Deoverlap error for job_id: %s - Message: %s' % (job_id, e))
-        await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.error)
-        await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available, job_chunk_id=None)
+        await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.error)
     else:
         logging.debug('Deoverlap success for: job_id = %s' % job_id)
 
-        # save results of the infernal job to the database
-        infernal_job_id = None
-        results = infernal_parse(file_deoverlap)
-        if results:
-            infernal_job_id = await set_infernal_job_results(engine, job_id, results)
+        # parse cmscan results and alignments in executor, so that the event loop keeps serving requests
+        loop = asyncio.get_event_loop()
+        try:
+            with PARSE_SECONDS.labels('cmscan').time():
+                results = await loop.run_in_executor(executor, infernal_results, file_deoverlap, filename)
+        except Exception as e:
+            # e.g. a malformed result file or a parser process, that died
+            logger.error('Infernal results parse error for job_id: %s - Message: %s' % (job_id, e))
+            await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.error)
+            return
+
+        await finish_infernal_job(engine, job_id, consumer_ip, slot, JOB_CHUNK_STATUS_CHOICES.success, results)
+
+
+@occupies_slot
+async def infernal_batch(engine, jobs, consumer_ip, slot, executor=None):
+    """
+    Searches the sequences of several infernal jobs with a single cmscan and a single deoverlap
+    in a single consumer slot, then reports the results of each job.
+    :param jobs: list of (job_id, sequence)
+    """
+    job_id = jobs[0][0]
+    process, filename = await infernal_batch_search([sequence for _, sequence in jobs], job_id)
+    INFERNAL_BATCH_SIZE.observe(len(jobs))
+
+    t0 = time.perf_counter()
+    try:
+        # every query gets as much time, as it would get in a run of its own
+        task = asyncio.ensure_future(process.communicate())
+        await asyncio.wait_for(task, MAX_RUN_TIME * len(jobs))
+        if process.returncode != 0:
+            raise InfernalError("Infernal process returned non-zero status code")
+    except asyncio.TimeoutError:
+        logger.warning('Infernal batch timeout for: job_id = %s' % job_id)
+        process.kill()
+        status = JOB_CHUNK_STATUS_CHOICES.timeout
+    except Exception as e:
+        logger.error('Infernal batch error for job_id: %s - Message: %s' % (job_id, e))
+        status = JOB_CHUNK_STATUS_CHOICES.error
+    else:
+        logger.debug('Infernal batch success for: job_id = %s, size = %s' % (job_id, len(jobs)))
+        status = JOB_CHUNK_STATUS_CHOICES.success
+
+    SEARCH_SECONDS.labels('cmscan', 'rfam', status).observe(time.perf_counter() - t0)
+
+    batch = {}
+    if status == JOB_CHUNK_STATUS_CHOICES.success:
+        # hits of different queries never overlap, a single deoverlap does for the whole batch
+        try:
+            file_deoverlap = await run_deoverlap(job_id, executor)
+        except asyncio.TimeoutError:
+            logging.debug('Deoverlap timeout for: job_id = %s' % job_id)
+            status = JOB_CHUNK_STATUS_CHOICES.timeout
+        except Exception as e:
+            logging.debug('Deoverlap error for job_id: %s - Message: %s' % (job_id, e))
+            status = JOB_CHUNK_STATUS_CHOICES.error
+        else:
+            loop = asyncio.get_event_loop()
+            try:
+                with PARSE_SECONDS.labels('cmscan').time():
+                    batch = await loop.run_in_executor(executor, infernal_batch_results, file_deoverlap, filename)
+            except Exception as e:
+                logger.error('Infernal batch parse error for job_id: %s - Message: %s' % (job_id, e))
+                status = JOB_CHUNK_STATUS_CHOICES.error
+
+    outcomes = [
+        (job_id, status, batch.get(batch_query_name(index), [])) for index, (job_id, _) in enumerate(jobs)
+    ]
+    await finish_infernal_job_batch(engine, consumer_ip, slot, outcomes)
+
+
+async def report_infernal_job(connection, job_id, status, results=()):
+    """Saves the results of an infernal job, together with their alignments, and its status"""
+    if results:
+        try:
+            with SAVE_RESULTS_SECONDS.labels('cmscan').time():
+                await set_infernal_job_results(connection, job_id, results)
+        except (DatabaseConnectionError, SQLError) as e:
+            logging.debug('Error saving infernal results = %s' % e)
+            status = JOB_CHUNK_STATUS_CHOICES.error
+
+    # update infernal status
+    await set_infernal_job_status(connection, job_id, status=status)
+
+
+async def finish_infernal_job(engine, job_id, consumer_ip, slot, status, results=()):
+    """Reports the outcome of an infernal job to the database, using a single connection"""
+    # TODO: what do we do in case we lost the database connection here?
+    async with unit_of_work(engine, transaction=False) as connection:
+        await report_infernal_job(connection, job_id, status, results)
 
-        # save the alignment
-        output = alignment(filename)
-        if output and infernal_job_id:
-            for item in output:
-                infernal_result_id = await get_infernal_result_id(engine, infernal_job_id, item)
-                if infernal_result_id:
-                    await save_alignment(engine, infernal_result_id, item['alignment'])
+        # free the consumer slot
+        await free_consumer_slot(connection, consumer_ip, slot)
 
-        # update infernal status
-        await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.success)
 
-        # update consumer fields
-        await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available, job_chunk_id=None)
+async def finish_infernal_job_batch(engine, consumer_ip, slot, outcomes):
+    """
+    Reports the outcomes of a batch of infernal jobs to the database and frees their slot, using a single connection
+    :param outcomes: list of (job_id, status, results)
+    """
+    async with unit_of_work(engine, transaction=False) as connection:
+        for job_id, status, results in outcomes:
+            await report_infernal_job(connection, job_id, status, results)
+
+        await free_consumer_slot(connection, consumer_ip, slot)
+
+
+async def start_infernal_job_batch(engine, job_ids, consumer_ip):
+    """
+    Occupies a single consumer slot for several infernal jobs and marks them as started, in a single transaction,
+    so that the slot is not taken if anything goes wrong. Only infernal jobs claimed by a producer ('dispatching')
+    are started, otherwise nothing is.
+    :return: number of the occupied slot or None, if the consumer has no free slots
+    :raise: NotDispatched, if any of the infernal jobs is not 'dispatching'
+    """
+    async with unit_of_work(engine) as connection:
+        slot = await occupy_consumer_slot(connection, consumer_ip, 'infernal-job')
+        if slot is None:
+            return None
+
+        started = await start_dispatched_infernal_jobs(connection, job_ids, consumer_ip)
+        if len(started) < len(set(job_ids)):
+            # rolls back the slot and the infernal jobs, that were started
+            raise NotDispatched("Infernal jobs of job_ids = %s are not dispatching" % (
+                sorted(set(job_ids) - set(infernal_job.job_id for infernal_job in started))))
+
+        # the outcomes of a batch are reported in order, the slot is done, once the last infernal job is finished
+        infernal_job_ids = {infernal_job.job_id: infernal_job.id for infernal_job in started}
+        await set_consumer_slot_infernal_job(connection, consumer_ip, slot, infernal_job_ids[job_ids[-1]])
+        return slot
 
 
 async def submit_infernal_job(request):
@@ -114,18 +247,56 @@ async def submit_infernal_job(request):
 
     consumer_ip = get_ip(request.app)
 
-    # if request was successful, save the consumer state and infernal_job state to the database
+    # if request was successful, occupy a consumer slot and save the infernal_job state to the database
     if engine and job_id and sequence:
         try:
-            await set_consumer_fields(engine, consumer_ip, CONSUMER_STATUS_CHOICES.busy, job_chunk_id='infernal-job')
-            await set_infernal_job_status(engine, job_id, status=JOB_CHUNK_STATUS_CHOICES.started)
-            await set_consumer_to_infernal_job(engine, job_id, consumer_ip)
+            slot = await start_infernal_job_batch(engine, [job_id], consumer_ip)
+            if slot is None:
+                # the producer will release the infernal_job and send it again, once a slot is free
+                return web.HTTPServiceUnavailable(text='All slots of consumer %s are busy' % consumer_ip)
+        except NotDispatched as e:
+            logger.error(e)
+            raise web.HTTPConflict(text=str(e)) from e
         except (DatabaseConnectionError, SQLError) as e:
             logger.error(e)
             raise web.HTTPBadRequest(text=str(e)) from e
 
         # spawn cmscan job in the background and return 201
-        await spawn(request, infernal(engine, job_id, sequence, consumer_ip))
+        await spawn(request, infernal(engine, job_id, sequence, consumer_ip, slot, request.app.get('executor')))
         return web.HTTPCreated()
     else:
         raise web.HTTPBadRequest(text='Invalid data. Engine, job_id and sequence not found.')
+
+
+async def submit_infernal_job_batch(request):
+    """Several infernal jobs, searched with a single cmscan run in a single slot"""
+    # validate the data
+    data = await request.json()
+    try:
+        engine = request.app['engine']
+        jobs = [(job['job_id'], job['sequence']) for job in data['jobs']]
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(e)
+        raise web.HTTPBadRequest(text=str(e)) from e
+
+    if not jobs or not all(job_id and sequence for job_id, sequence in jobs):
+        raise web.HTTPBadRequest(text='Invalid data. Every job needs a job_id and a sequence.')
+
+    consumer_ip = get_ip(request.app)
+
+    # occupy a consumer slot and save the state of the infernal_jobs to the database
+    try:
+        slot = await start_infernal_job_batch(engine, [job_id for job_id, _ in jobs], consumer_ip)
+        if slot is None:
+            # the producer will release the infernal_jobs and send them again, once a slot is free
+            return web.HTTPServiceUnavailable(text='All slots of consumer %s are busy' % consumer_ip)
+    except NotDispatched as e:
+        logger.error(e)
+        raise web.HTTPConflict(text=str(e)) from e
+    except (DatabaseConnectionError, SQLError) as e:
+        logger.error(e)
+        raise web.HTTPBadRequest(text=str(e)) from e
+
+    # spawn cmscan batch in the background and return 201
+    await spawn(request, infernal_batch(engine, jobs, consumer_ip, slot, request.app.get('executor')))
+    return web.HTTPCreated()
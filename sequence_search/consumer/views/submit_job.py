@@ -15,23 +15,21 @@ import os
 import logging
 import asyncio
 import datetime
-import re
 
 from aiohttp import web
 from aiojobs.aiohttp import spawn
-from itertools import islice
 
-from ..nhmmer_parse import nhmmer_parse, parse_number_of_hits
-from ..nhmmer_search import nhmmer_search
+from ..metrics import SEARCH_SECONDS, PARSE_SECONDS, SAVE_RESULTS_SECONDS, NHMMER_BATCH_SIZE, occupies_slot
+from ..nhmmer_parse import nhmmer_results, nhmmer_batch_results, nhmmer_pipeline_stats
+from ..nhmmer_search import nhmmer_search, nhmmer_batch_search, batch_query_name, is_short
 from ..rnacentral_databases import query_file_path, result_file_path, consumer_validator
 from ..settings import MAX_RUN_TIME, NHMMER_LIMIT
-from ...db import DatabaseConnectionError, SQLError
-from ...db.models import CONSUMER_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
+from ...db import DatabaseConnectionError, SQLError, DoesNotExist, NotDispatched, unit_of_work
+from ...db.models import JOB_CHUNK_STATUS_CHOICES
 from ...db.job_chunk_results import set_job_chunk_results
-from ...db.job_chunks import get_consumer_ip_from_job_chunk, get_job_chunk_from_job_and_database, \
-    set_job_chunk_status, set_job_chunk_consumer
+from ...db.job_chunks import get_job_chunk_from_job_and_database, set_job_chunk_status, start_dispatched_job_chunks
 from ...db.jobs import update_job_status_from_job_chunks_status
-from ...db.consumers import set_consumer_status, set_consumer_job_chunk_id, get_ip
+from ...db.consumers import occupy_consumer_slot, free_consumer_slot, get_ip
 
 
 class NhmmerError(Exception):
@@ -45,7 +43,32 @@ class NhmmerError(Exception):
 logger = logging.Logger('aiohttp.web')
 
 
-async def nhmmer(engine, job_id, sequence, database):
+async def parse_nhmmer_results(executor, filename):
+    """
+    Parse nhmmer result file in executor, so that the event loop keeps serving requests.
+
+    :param executor: process pool created in create_app (None means the default thread pool)
+    :param filename: nhmmer result file
+    :return: (internal pipeline statistics, list of up to NHMMER_LIMIT parsed records)
+    """
+    loop = asyncio.get_event_loop()
+    stats = await loop.run_in_executor(executor, nhmmer_pipeline_stats, filename)
+    results = await loop.run_in_executor(executor, nhmmer_results, filename, NHMMER_LIMIT)
+    return stats, results
+
+
+async def parse_nhmmer_batch_results(executor, filename):
+    """
+    Parse the result file of a batch in executor, see parse_nhmmer_results.
+
+    :return: {query name: (internal pipeline statistics, list of up to NHMMER_LIMIT parsed records)}
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, nhmmer_batch_results, filename, NHMMER_LIMIT)
+
+
+@occupies_slot
+async def nhmmer(engine, job_id, sequence, database, consumer_ip, slot, executor=None):
     """
     Function that performs nhmmer search and then reports the result to provider API.
 
@@ -53,17 +76,19 @@ async def nhmmer(engine, job_id, sequence, database):
     :param sequence: string, e.g. AAAAGGTCGGAGCGAGGCAAAATTGGCTTTCAAACTAGGTTCTGGGTTCACATAAGACCT
     :param job_id: id of this job, generated by producer
     :param database: name of the database to search against
+    :param consumer_ip: ip of this consumer
+    :param slot: consumer slot occupied by this job chunk, freed when the search is over
+    :param executor: executor to parse the results in
     :return:
     """
-    job_chunk_id = await get_job_chunk_from_job_and_database(engine, job_id, database)
-
     logging.debug('Nhmmer search started for: job_id = %s, database = %s' % (job_id, database))
 
     # I assume, subprocess creation can't raise exceptions
     process, filename = await nhmmer_search(sequence=sequence, job_id=job_id, database=database)
 
+    results, stats = [], None
+    t0 = datetime.datetime.now()
     try:
-        t0 = datetime.datetime.now()
         task = asyncio.ensure_future(process.communicate())
         await asyncio.wait_for(task, MAX_RUN_TIME)
         logging.debug("Time - Nhmmer searched for sequences in {} for {} seconds".format(
@@ -76,52 +101,215 @@ async def nhmmer(engine, job_id, sequence, database):
     except asyncio.TimeoutError as e:
         logging.debug('Nhmmer job chunk timeout out: job_id = %s, database = %s' % (job_id, database))
         process.kill()
-
-        # TODO: what do we do in case we lost the database connection here?
-        await set_job_chunk_status(engine, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.timeout)
+        status = JOB_CHUNK_STATUS_CHOICES.timeout
     except Exception as e:
         logging.debug('Nhmmer search error for: job_id = %s, database = %s' % (job_id, database))
-        # TODO: what do we do in case we lost the database connection here?
-        await set_job_chunk_status(engine, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.error)
+        status = JOB_CHUNK_STATUS_CHOICES.error
     else:
         logging.debug('Nhmmer search success for: job_id = %s, database = %s' % (job_id, database))
+        status = JOB_CHUNK_STATUS_CHOICES.success
 
-        # check the total number of hits
-        hits = 0
-        try:
-            line = parse_number_of_hits(filename)
-            hits = re.split("[: ]+", line)[4]
-        except (TypeError, ValueError):
-            pass
+    SEARCH_SECONDS.labels('nhmmer', database, status).observe((datetime.datetime.now() - t0).total_seconds())
 
+    if status == JOB_CHUNK_STATUS_CHOICES.success:
+        # parse nhmmer results to python (up to the limit set in NHMMER_LIMIT)
+        t0 = datetime.datetime.now()
         try:
-            # parse nhmmer results to python (up to the limit set in NHMMER_LIMIT)
-            results = list(islice((record for record in nhmmer_parse(filename=filename)), NHMMER_LIMIT))
+            stats, results = await parse_nhmmer_results(executor, filename)
+        except Exception as e:
+            # e.g. a malformed result file or a parser process, that died
+            logging.error('Nhmmer results parse error for: job_id = %s, database = %s: %s' % (job_id, database, e))
+            status = JOB_CHUNK_STATUS_CHOICES.error
+        else:
+            parse_time = (datetime.datetime.now() - t0).total_seconds()
+            PARSE_SECONDS.labels('nhmmer').observe(parse_time)
+            logging.debug("Time - parsing {} results in {} seconds".format(len(results), parse_time))
+
+    await finish_job_chunk(engine, job_id, database, consumer_ip, slot, status, results, stats)
+
+
+async def search_batch(jobs, database, executor=None):
+    """
+    Searches the sequences of several job chunks of the same database with a single nhmmer run.
+
+    :param jobs: list of (job_id, sequence), sequences should be either all short or not, see is_short
+    :param database: name of the database to search against
+    :param executor: executor to parse the results in
+    :return: list of (job_id, status, results, stats) in the order of jobs
+    """
+    job_id = jobs[0][0]
+    logging.debug('Nhmmer batch search started for: job_id = %s, database = %s, size = %s' %
+                  (job_id, database, len(jobs)))
+
+    process, filename = await nhmmer_batch_search([sequence for _, sequence in jobs], job_id, database)
+    NHMMER_BATCH_SIZE.observe(len(jobs))
+
+    t0 = datetime.datetime.now()
+    try:
+        # every query gets as much time, as it would get in a run of its own
+        task = asyncio.ensure_future(process.communicate())
+        await asyncio.wait_for(task, MAX_RUN_TIME * len(jobs))
+
+        if process.returncode != 0:
+            raise NhmmerError("Nhmmer process returned non-zero status code")
+    except asyncio.TimeoutError as e:
+        logging.debug('Nhmmer batch timeout out: job_id = %s, database = %s' % (job_id, database))
+        process.kill()
+        status = JOB_CHUNK_STATUS_CHOICES.timeout
+    except Exception as e:
+        logging.debug('Nhmmer batch error for: job_id = %s, database = %s' % (job_id, database))
+        status = JOB_CHUNK_STATUS_CHOICES.error
+    else:
+        status = JOB_CHUNK_STATUS_CHOICES.success
+
+    SEARCH_SECONDS.labels('nhmmer', database, status).observe((datetime.datetime.now() - t0).total_seconds())
+
+    if status != JOB_CHUNK_STATUS_CHOICES.success:
+        return [(job_id, status, [], None) for job_id, _ in jobs]
+
+    t0 = datetime.datetime.now()
+    try:
+        sections = await parse_nhmmer_batch_results(executor, filename)
+    except Exception as e:
+        logging.error('Nhmmer batch parse error for: job_id = %s, database = %s: %s' % (job_id, database, e))
+        return [(job_id, JOB_CHUNK_STATUS_CHOICES.error, [], None) for job_id, _ in jobs]
+    PARSE_SECONDS.labels('nhmmer').observe((datetime.datetime.now() - t0).total_seconds())
+
+    outcomes = []
+    for index, (job_id, _) in enumerate(jobs):
+        if batch_query_name(index) in sections:
+            stats, results = sections[batch_query_name(index)]
+            outcomes.append((job_id, status, results, stats))
+        else:
+            # the output has no section of this query
+            outcomes.append((job_id, JOB_CHUNK_STATUS_CHOICES.error, [], None))
+    return outcomes
+
+
+@occupies_slot
+async def nhmmer_batch(engine, jobs, database, consumer_ip, slot, executor=None):
+    """
+    Searches a batch of job chunks of the same database in a single consumer slot and reports the results
+    of each job chunk. Short and long sequences are searched with different nhmmer options, so a batch
+    takes up to 2 nhmmer runs.
 
+    :param jobs: list of (job_id, sequence)
+    :param database: name of the database to search against
+    :param consumer_ip: ip of this consumer
+    :param slot: consumer slot occupied by the batch, freed when the last search is over
+    :param executor: executor to parse the results in
+    """
+    outcomes = []
+    for short in [True, False]:
+        group = [(job_id, sequence) for job_id, sequence in jobs if is_short(sequence) == short]
+        if group:
+            outcomes.extend(await search_batch(group, database, executor))
+
+    await finish_job_chunk_batch(engine, database, consumer_ip, slot, outcomes)
+
+
+async def report_job_chunk(connection, job_id, database, status, results=(), stats=None):
+    """
+    Saves the results and the status of a job chunk and updates the status of its job.
+
+    :param connection: sqlalchemy connection acquired from the engine
+    :param job_id: id of the job
+    :param database: name of the database the job chunk searched against
+    :param status: status of the job chunk, success, error or timeout
+    :param results: parsed nhmmer results of a successful job chunk
+    :param stats: internal pipeline statistics of a successful job chunk, with the total number of hits
+    """
+    stats = stats or {}
+    if status == JOB_CHUNK_STATUS_CHOICES.success:
+        try:
             # save results of the job_chunk to the database
             if results:
                 t0 = datetime.datetime.now()
-                await set_job_chunk_results(engine, job_id, database, results)
-                logging.debug("Time - saving {} results in {} seconds".format(
-                    len(results), (datetime.datetime.now() - t0).total_seconds())
-                )
+                await set_job_chunk_results(connection, job_id, database, results)
+                save_time = (datetime.datetime.now() - t0).total_seconds()
+                SAVE_RESULTS_SECONDS.labels('nhmmer').observe(save_time)
+                logging.debug("Time - saving {} results in {} seconds".format(len(results), save_time))
             # set status of the job_chunk to the database
-            await set_job_chunk_status(engine, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.success, hits=hits)
+            await set_job_chunk_status(connection, job_id, database, status=status,
+                                       hits=stats.get('total_hits', 0), stats=stats)
         except (DatabaseConnectionError, SQLError) as e:
-            # TODO: what do we do in case we lost the database connection here?
             # TODO: probably, clean the nhmmer query and result files?
             logging.debug('Error saving job chunk results = %s' % e)
-            await set_job_chunk_status(engine, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.error)
+            await set_job_chunk_status(connection, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.error)
+    else:
+        await set_job_chunk_status(connection, job_id, database, status=status)
 
-    # TODO: what do we do in case we lost the database connection here?
     # update job in the database (maybe the whole job is done)
-    await update_job_status_from_job_chunks_status(engine, job_id)
+    await update_job_status_from_job_chunks_status(connection, job_id)
+
 
+async def finish_job_chunk(engine, job_id, database, consumer_ip, slot, status, results=(), stats=None):
+    """
+    Reports the outcome of a job chunk to the database, using a single connection.
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param database: name of the database the job chunk searched against
+    :param consumer_ip: ip of this consumer
+    :param slot: consumer slot occupied by this job chunk
+    :param status: status of the job chunk, success, error or timeout
+    :param results: parsed nhmmer results of a successful job chunk
+    :param stats: internal pipeline statistics of a successful job chunk, with the total number of hits
+    """
     # TODO: what do we do in case we lost the database connection here?
-    # update consumer status and
-    consumer_ip = await get_consumer_ip_from_job_chunk(engine, job_chunk_id)
-    await set_consumer_status(engine, consumer_ip, CONSUMER_STATUS_CHOICES.available)
-    await set_consumer_job_chunk_id(engine, consumer_ip, None, None)
+    async with unit_of_work(engine, transaction=False) as connection:
+        await report_job_chunk(connection, job_id, database, status, results, stats)
+
+        # free the consumer slot, so that the producer can send the next job chunk
+        await free_consumer_slot(connection, consumer_ip, slot)
+
+
+async def finish_job_chunk_batch(engine, database, consumer_ip, slot, outcomes):
+    """
+    Reports the outcomes of a batch of job chunks to the database and frees their slot, using a single connection.
+
+    :param outcomes: list of (job_id, status, results, stats), see search_batch
+    """
+    async with unit_of_work(engine, transaction=False) as connection:
+        for job_id, status, results, stats in outcomes:
+            await report_job_chunk(connection, job_id, database, status, results, stats)
+
+        await free_consumer_slot(connection, consumer_ip, slot)
+
+
+async def start_job_chunk(engine, job_id, database, consumer_ip):
+    """
+    Occupies a consumer slot and marks the job chunk as started, in a single transaction,
+    so that the slot is not taken if anything goes wrong.
+
+    :return: number of the occupied slot or None, if the consumer has no free slots
+    """
+    return await start_job_chunk_batch(engine, [job_id], database, consumer_ip)
+
+
+async def start_job_chunk_batch(engine, job_ids, database, consumer_ip):
+    """
+    Occupies a single consumer slot for the job chunks of several jobs in the same database and marks
+    them as started, in a single transaction. The slot is taken by the job chunk of the first job.
+    Only job chunks claimed by a producer ('dispatching') are started, otherwise nothing is.
+
+    :return: number of the occupied slot or None, if the consumer has no free slots
+    :raise: NotDispatched, if any of the job chunks is not 'dispatching'
+    """
+    async with unit_of_work(engine) as connection:
+        job_chunk_ids = [
+            await get_job_chunk_from_job_and_database(connection, job_id, database) for job_id in job_ids
+        ]
+        slot = await occupy_consumer_slot(connection, consumer_ip, job_chunk_ids[0])
+        if slot is None:
+            return None
+
+        started = await start_dispatched_job_chunks(connection, job_ids, database, consumer_ip)
+        if len(started) < len(set(job_ids)):
+            # rolls back the slot and the job chunks, that were started
+            raise NotDispatched("Job chunks of job_ids = %s, database = %s are not dispatching" % (
+                sorted(set(job_ids) - set(job_chunk.job_id for job_chunk in started)), database))
+        return slot
 
 
 def serialize(request, data):
@@ -146,6 +334,20 @@ def serialize(request, data):
     return data
 
 
+def serialize_batch(request, data):
+    """Ad-hoc validator for input JSON data of a batch, every job is validated like a job of its own"""
+    database = data['database']
+    jobs = data['jobs']
+
+    if not jobs:
+        raise ValueError("jobs should be non-empty")
+
+    for job in jobs:
+        serialize(request, {'job_id': job['job_id'], 'sequence': job['sequence'], 'database': database})
+
+    return data
+
+
 async def submit_job(request):
     """
     For testing purposes, try the following command:
@@ -167,13 +369,17 @@ async def submit_job(request):
     database = data["database"]
     consumer_ip = get_ip(request.app)  # 'host.docker.internal'
 
-    # if request was successful, save the consumer state and job_chunk state to the database
+    # if request was successful, occupy a consumer slot and save the job_chunk state to the database
     try:
-        await set_consumer_status(engine, consumer_ip, CONSUMER_STATUS_CHOICES.busy)
-        await set_consumer_job_chunk_id(engine, consumer_ip, job_id, database)
-        await set_job_chunk_status(engine, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.started)
-        await set_job_chunk_consumer(engine, job_id, database, consumer_ip)
-    except (DatabaseConnectionError, SQLError) as e:
+        slot = await start_job_chunk(engine, job_id, database, consumer_ip)
+        if slot is None:
+            # the producer will release the job_chunk and send it again, once a slot is free
+            return web.HTTPServiceUnavailable(text=f"All slots of consumer {consumer_ip} are busy")
+    except NotDispatched as e:
+        # e.g. the producer released the job chunk, before it got here
+        logging.error(f"Job chunk rejected, consumer={consumer_ip}: {e}")
+        raise web.HTTPConflict(text=str(e))
+    except (DatabaseConnectionError, SQLError, DoesNotExist) as e:
         logging.error(f"Database error for job_id={job_id}, consumer={consumer_ip}, database={database}: {e}")
         raise web.HTTPBadRequest(text=f"Database error: {e}")
     except Exception as e:
@@ -181,5 +387,50 @@ async def submit_job(request):
         raise web.HTTPInternalServerError(text=f"Unexpected error occurred: {e}")
 
     # spawn nhmmer job in the background and return 201
-    await spawn(request, nhmmer(engine, job_id, sequence, database))
+    await spawn(request, nhmmer(engine, job_id, sequence, database, consumer_ip, slot, request.app.get('executor')))
+    return web.HTTPCreated()
+
+
+async def submit_job_batch(request):
+    """
+    Job chunks of several jobs against the same database, searched with a single nhmmer run in a single slot.
+
+    For testing purposes, try the following command:
+
+    curl -H "Content-Type:application/json" -d "{\"database\": \"mirbase.fasta\", \"jobs\": [{\"job_id\": 1, \"sequence\": \"AAAAGGTCGGAGCGAGGCAAAATTGGCTTTCAAACTAGG\"}, {\"job_id\": 2, \"sequence\": \"UAGCUUAUCAGACUGAUGUUGA\"}]}" localhost:8000/submit-job-batch
+    """
+    # validate the incoming data
+    data = await request.json()
+    try:
+        data = serialize_batch(request, data)
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"Serialization error: {e}")
+        raise web.HTTPBadRequest(text=str(e)) from e
+
+    # cache variables for brevity
+    engine = request.app["engine"]
+    jobs = [(job["job_id"], job["sequence"]) for job in data["jobs"]]
+    job_ids = [job_id for job_id, _ in jobs]
+    database = data["database"]
+    consumer_ip = get_ip(request.app)
+
+    # if request was successful, occupy a consumer slot and save the job_chunks state to the database
+    try:
+        slot = await start_job_chunk_batch(engine, job_ids, database, consumer_ip)
+        if slot is None:
+            # the producer will release the job_chunks and send them again, once a slot is free
+            return web.HTTPServiceUnavailable(text=f"All slots of consumer {consumer_ip} are busy")
+    except NotDispatched as e:
+        # e.g. the producer released the job chunk, before it got here
+        logging.error(f"Job chunk rejected, consumer={consumer_ip}: {e}")
+        raise web.HTTPConflict(text=str(e))
+    except (DatabaseConnectionError, SQLError, DoesNotExist) as e:
+        logging.error(f"Database error for job_ids={job_ids}, consumer={consumer_ip}, database={database}: {e}")
+        raise web.HTTPBadRequest(text=f"Database error: {e}")
+    except Exception as e:
+        logging.error(f"Unexpected error while processing job_ids={job_ids}, consumer_ip={consumer_ip}: {e}")
+        raise web.HTTPInternalServerError(text=f"Unexpected error occurred: {e}")
+
+    # spawn nhmmer batch in the background and return 201
+    await spawn(request, nhmmer_batch(engine, jobs, database, consumer_ip, slot, request.app.get('executor')))
     return web.HTTPCreated()
@@ -11,6 +11,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from contextlib import asynccontextmanager
+
+import sqlalchemy as sa
+from aiopg.sa import SAConnection
+from sqlalchemy.dialects import postgresql
+
 
 class DatabaseConnectionError(Exception):
     def __init__(self, text):
@@ -34,4 +40,95 @@ class DoesNotExist(Exception):
         self.value = value
 
     def __str__(self):
-        return "%s: %s not found" % (self.key, self.value)
\ No newline at end of file
+        return "%s: %s not found" % (self.key, self.value)
+
+
+class NotDispatched(Exception):
+    """Job_chunks or infernal jobs, that a consumer was asked to start, are not in the 'dispatching' status"""
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class PoolTimeoutError(DatabaseConnectionError):
+    """None of the connections of the pool got free within the acquire timeout, see pool.py"""
+
+
+@asynccontextmanager
+async def acquire(engine):
+    """
+    Connection for a db helper.
+
+    Every db helper takes either the engine or a connection, that the caller already acquired to run several
+    helpers as a unit of work (see unit_of_work). Given the engine, the helper checks out a connection of its own.
+    """
+    if isinstance(engine, SAConnection):
+        yield engine
+    else:
+        async with engine.acquire() as connection:
+            yield connection
+
+
+@asynccontextmanager
+async def unit_of_work(engine, transaction=True):
+    """
+    Checks out a single connection for a request, that is passed to all the db helpers it calls:
+
+        async with unit_of_work(request.app['engine']) as connection:
+            job_chunk_id = await get_job_chunk_from_job_and_database(connection, job_id, database)
+            await set_job_chunk_status(connection, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.started)
+
+    :param engine: params to connect to the db (or a connection of an outer unit of work)
+    :param transaction: run the helpers in a transaction, that is rolled back if an exception is raised,
+    otherwise each statement is committed on its own
+    """
+    async with acquire(engine) as connection:
+        if transaction:
+            async with connection.begin():
+                yield connection
+        else:
+            yield connection
+
+
+def select_by_keys(query, key, keys):
+    """
+    Restricts a select to the rows with the given primary keys, that are returned in the order of keys,
+    see fetch_in_batches.
+
+    :param query: sqlalchemy select of the rows
+    :param key: primary key column of the rows
+    :param keys: list of primary keys
+    """
+    keys = sa.literal(list(keys), type_=postgresql.ARRAY(key.type))
+    return query.where(key == sa.any_(keys)).order_by(None).order_by(sa.func.array_position(keys, key))
+
+
+async def fetch_in_batches(engine, keys_query, rows_query, batch_size=100):
+    """
+    Yields the rows of a select, read `batch_size` rows at a time, so that a large result is never held
+    in memory as a whole:
+
+        async for row in fetch_in_batches(engine, keys_query, lambda keys: select_by_keys(query, key, keys)):
+            ...
+
+    The primary keys of the rows are selected once, in the order the rows are yielded, so that an expensive
+    (e.g. grouped and sorted) query is never re-run for the next batch. Every batch is then read by its keys
+    with a connection of its own, that goes back to the pool before the rows are yielded, so that a slow reader
+    (e.g. a client downloading a streaming response) never keeps a connection or a transaction open.
+
+    :param engine: params to connect to the db
+    :param keys_query: sqlalchemy select of the primary keys of the rows, ordered
+    :param rows_query: function, that returns the sqlalchemy select of the rows with the given keys, in their order
+    :param batch_size: number of rows fetched at a time
+    """
+    async with acquire(engine) as connection:
+        keys = [row[0] for row in await (await connection.execute(keys_query)).fetchall()]
+
+    for start in range(0, len(keys), batch_size):
+        async with acquire(engine) as connection:
+            rows = await (await connection.execute(rows_query(keys[start:start + batch_size]))).fetchall()
+
+        for row in rows:
+            yield row
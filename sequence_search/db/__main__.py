@@ -11,22 +11,31 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import argparse
 import os
 
-from .models import migrate
+from .migrations import migrate
 
 
 if __name__ == "__main__":
     """
-    This code creates the necessary tables in the database - in django this
-    would've been initial migration.
+    This code creates the necessary tables in the database or applies the
+    migrations that are new since the last run - in django this would've
+    been migrate.
 
-    To apply this migration to the database, go two directories up and say:
+    To apply the migrations to the database, go two directories up and say:
 
     $ python3 -m sequence_search.db
+
+    To drop all the tables (and data) and create them from scratch:
+
+    $ python3 -m sequence_search.db --drop
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--drop', action='store_true', help='Drop all tables before applying the migrations')
+    args = parser.parse_args()
 
     ENVIRONMENT = os.getenv('ENVIRONMENT', 'LOCAL')
 
     import asyncio
-    asyncio.get_event_loop().run_until_complete(migrate(ENVIRONMENT))
+    print(asyncio.get_event_loop().run_until_complete(migrate(ENVIRONMENT, drop=args.drop)))
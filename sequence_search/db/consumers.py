@@ -21,9 +21,9 @@ from collections import namedtuple
 from netifaces import interfaces, ifaddresses, AF_INET
 from tenacity import retry, stop_after_attempt, wait_fixed
 
-from . import DatabaseConnectionError, SQLError
+from . import DatabaseConnectionError, SQLError, acquire
 from .job_chunks import get_job_chunk_from_job_and_database
-from ..consumer.settings import PORT
+from ..consumer.settings import PORT, SLOTS
 from .models import CONSUMER_STATUS_CHOICES
 
 
@@ -40,7 +40,7 @@ async def find_available_consumers(engine):
     Consumer = namedtuple('Consumer', ['ip', 'status', 'port', 'job_chunk_id'])
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 SELECT ip, status, port, job_chunk_id
                 FROM consumer
@@ -55,12 +55,66 @@ async def find_available_consumers(engine):
         raise DatabaseConnectionError(str(e)) from e
 
 
+async def find_available_consumer_slots(engine):
+    """
+    Returns a list with an entry for every free slot of the available consumers.
+    Slots are interleaved across consumers, so that work is spread over all consumers before they fill up.
+    """
+    ConsumerSlot = namedtuple('ConsumerSlot', ['ip', 'port'])
+
+    try:
+        async with acquire(engine) as connection:
+            query = sa.text('''
+                SELECT consumer.ip, consumer.port, consumer.slots - count(consumer_slot.slot) AS free_slots
+                FROM consumer
+                LEFT JOIN consumer_slot ON consumer_slot.consumer=consumer.ip
+                WHERE consumer.status=:status
+                GROUP BY consumer.ip
+                ORDER BY consumer.ip
+            ''')
+
+            consumers = []
+            async for row in await connection.execute(query, status=CONSUMER_STATUS_CHOICES.available):
+                consumers.append((ConsumerSlot(row.ip, row.port), row.free_slots))
+
+            result = []
+            for index in range(max([free_slots for consumer, free_slots in consumers], default=0)):
+                result.extend([consumer for consumer, free_slots in consumers if free_slots > index])
+
+            return result
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
+async def find_busy_consumer_slots(engine):
+    """Returns a list of occupied consumer slots together with the job_chunk or infernal_job they are running."""
+    ConsumerSlot = namedtuple('ConsumerSlot', ['ip', 'slot', 'job_chunk_id', 'infernal_job_id'])
+
+    try:
+        async with acquire(engine) as connection:
+            query = sa.text('''
+                SELECT consumer, slot, job_chunk_id, infernal_job_id
+                FROM consumer_slot
+                ORDER BY consumer, slot
+            ''')
+
+            result = []
+            async for row in await connection.execute(query):
+                result.append(ConsumerSlot(row.consumer, row.slot, row.job_chunk_id, row.infernal_job_id))
+
+            return result
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
 async def find_busy_consumers(engine):
     """Returns a list of busy consumers that can be used to run."""
     Consumer = namedtuple('Consumer', ['ip', 'status', 'port', 'job_chunk_id'])
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 SELECT ip, status, port, job_chunk_id
                 FROM consumer
@@ -80,7 +134,7 @@ async def find_busy_consumers(engine):
 async def get_consumers_statuses(engine):
     """Lists statuses of all the consumers in the database."""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 SELECT ip, status
                 FROM consumer
@@ -97,7 +151,7 @@ async def get_consumers_statuses(engine):
 async def get_consumer_status(engine, consumer_ip):
     """Get consumer status from the database."""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 SELECT status
                 FROM consumer
@@ -121,7 +175,7 @@ async def set_consumer_status(engine, consumer_ip, status):
     :return: None
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 UPDATE consumer
                 SET status = :status
@@ -151,12 +205,12 @@ async def set_consumer_job_chunk_id(engine, consumer_ip, job_id=None, database=N
     :return: None
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             job_chunk_id = None
 
             if job_id is not None:
                 try:
-                    job_chunk_id = await get_job_chunk_from_job_and_database(engine, job_id, database)
+                    job_chunk_id = await get_job_chunk_from_job_and_database(connection, job_id, database)
                 except Exception as e:
                     logging.error(f"Error fetching job_chunk_id for job_id={job_id} and database={database}: {e}")
                     raise SQLError(f"Failed to fetch job_chunk_id for job_id={job_id} and database={database}") from e
@@ -186,15 +240,15 @@ async def delegate_job_chunk_to_consumer(engine, consumer_ip, consumer_port, job
     :param database: an all-except-rrna- or whitelist-rrna-* file
     :param query: the sequence that the user wants to search
     :param consumer_client: the client initialized in on_startup
-    :return: None (if there are no errors)
+    :return: True if the consumer accepted the job_chunk, False otherwise
     """
     try:
-        async with engine.acquire() as connection:
-            response = await consumer_client.submit_job(consumer_ip, consumer_port, job_id, database, query)
+        response = await consumer_client.submit_job(consumer_ip, consumer_port, job_id, database, query)
 
-            if response is None or response.status >= 400:
-                text = await response.text() if response else "No response from consumer"
-                raise ConsumerConnectionError(f"Error from consumer: {text}")
+        if response is None or response.status >= 400:
+            text = await response.text() if response else "No response from consumer"
+            raise ConsumerConnectionError(f"Error from consumer: {text}")
+        return True
     except ClientConnectionError:
         logging.error(f"Connection error while submitting job {job_id} to {consumer_ip}:{consumer_port}.")
     except ClientResponseError as e:
@@ -205,7 +259,41 @@ async def delegate_job_chunk_to_consumer(engine, consumer_ip, consumer_port, job
         logging.error(f"Database error: {str(e)}")
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
+    return False
+
+
+
+async def delegate_job_chunk_batch_to_consumer(engine, consumer_ip, consumer_port, database, jobs, consumer_client):
+    """
+    This function calls submit_job_batch to submit job_chunks of several jobs against the same database
+    to a consumer, that searches them with a single nhmmer run
+    :param engine: params to connect to the db
+    :param consumer_ip: ip of the consumer
+    :param consumer_port: port used by the consumer
+    :param database: an all-except-rrna- or whitelist-rrna-* file
+    :param jobs: list of (job_id, query)
+    :param consumer_client: the client initialized in on_startup
+    :return: True if the consumer accepted the job_chunks, False otherwise
+    """
+    job_ids = [job_id for job_id, query in jobs]
+    try:
+        response = await consumer_client.submit_job_batch(consumer_ip, consumer_port, database, jobs)
 
+        if response is None or response.status >= 400:
+            text = await response.text() if response else "No response from consumer"
+            raise ConsumerConnectionError(f"Error from consumer: {text}")
+        return True
+    except ClientConnectionError:
+        logging.error(f"Connection error while submitting jobs {job_ids} to {consumer_ip}:{consumer_port}.")
+    except ClientResponseError as e:
+        logging.error(f"Invalid response from consumer {consumer_ip}:{consumer_port} with status {e.status}.")
+    except TimeoutError:
+        logging.error(f"Timeout while submitting jobs {job_ids} to {consumer_ip}:{consumer_port}.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error: {str(e)}")
+    except Exception as e:
+        logging.error(f"Unexpected error: {str(e)}")
+    return False
 
 
 async def delegate_infernal_job_to_consumer(engine, consumer_ip, consumer_port, job_id, query, consumer_client):
@@ -217,15 +305,15 @@ async def delegate_infernal_job_to_consumer(engine, consumer_ip, consumer_port,
     :param job_id: id of the job
     :param query: the sequence that the user wants to search
     :param consumer_client: the client initialized in on_startup
-    :return: None (if there are no errors)
+    :return: True if the consumer accepted the infernal_job, False otherwise
     """
     try:
-        async with engine.acquire() as connection:
-            response = await consumer_client.submit_infernal_job(consumer_ip, consumer_port, job_id, query)
+        response = await consumer_client.submit_infernal_job(consumer_ip, consumer_port, job_id, query)
 
-            if response is None or response.status >= 400:
-                text = await response.text() if response else "No response from consumer"
-                raise ConsumerConnectionError(f"Error from consumer: {text}")
+        if response is None or response.status >= 400:
+            text = await response.text() if response else "No response from consumer"
+            raise ConsumerConnectionError(f"Error from consumer: {text}")
+        return True
     except ClientConnectionError:
         logging.error(f"Connection error while submitting job {job_id} to {consumer_ip}:{consumer_port}.")
     except ClientResponseError as e:
@@ -236,6 +324,39 @@ async def delegate_infernal_job_to_consumer(engine, consumer_ip, consumer_port,
         logging.error(f"Database error: {str(e)}")
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
+    return False
+
+
+async def delegate_infernal_job_batch_to_consumer(engine, consumer_ip, consumer_port, jobs, consumer_client):
+    """
+    This function calls submit_infernal_job_batch to submit several infernal_jobs to a consumer,
+    that searches them with a single cmscan run
+    :param engine: params to connect to the db
+    :param consumer_ip: ip of the consumer
+    :param consumer_port: port used by the consumer
+    :param jobs: list of (job_id, query)
+    :param consumer_client: the client initialized in on_startup
+    :return: True if the consumer accepted the infernal_jobs, False otherwise
+    """
+    job_ids = [job_id for job_id, query in jobs]
+    try:
+        response = await consumer_client.submit_infernal_job_batch(consumer_ip, consumer_port, jobs)
+
+        if response is None or response.status >= 400:
+            text = await response.text() if response else "No response from consumer"
+            raise ConsumerConnectionError(f"Error from consumer: {text}")
+        return True
+    except ClientConnectionError:
+        logging.error(f"Connection error while submitting jobs {job_ids} to {consumer_ip}:{consumer_port}.")
+    except ClientResponseError as e:
+        logging.error(f"Invalid response from consumer {consumer_ip}:{consumer_port} with status {e.status}.")
+    except TimeoutError:
+        logging.error(f"Timeout while submitting jobs {job_ids} to {consumer_ip}:{consumer_port}.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error: {str(e)}")
+    except Exception as e:
+        logging.error(f"Unexpected error: {str(e)}")
+    return False
 
 
 def get_ip(app):
@@ -285,21 +406,191 @@ def get_ip(app):
 
 
 async def register_consumer_in_the_database(app):
-    """Utility for consumer to register itself in the database."""
+    """
+    Utility for consumer to register itself in the database.
+    A consumer that was restarted doesn't run anything, so all of its slots are freed.
+    """
+    consumer_ip = get_ip(app)  # 'host.docker.internal'
+
     try:
         async with app['engine'].acquire() as connection:
-            sql_query = sa.text('''
-                INSERT INTO consumer(ip, status, port)
-                VALUES (:consumer_ip, :status, :port)
+            async with connection.begin():
+                sql_query = sa.text('''
+                    INSERT INTO consumer(ip, status, port, slots)
+                    VALUES (:consumer_ip, :status, :port, :slots)
+                    ON CONFLICT (ip) DO UPDATE
+                    SET status=EXCLUDED.status, port=EXCLUDED.port, slots=EXCLUDED.slots, job_chunk_id=NULL
+                ''')
+                await connection.execute(
+                    sql_query,
+                    consumer_ip=consumer_ip,
+                    status=CONSUMER_STATUS_CHOICES.available,
+                    port=PORT,
+                    slots=SLOTS
+                )
+
+                await connection.execute(
+                    sa.text('DELETE FROM consumer_slot WHERE consumer=:consumer_ip'),
+                    consumer_ip=consumer_ip
+                )
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
+async def occupy_consumer_slot(engine, consumer_ip, job_chunk_id):
+    """
+    Occupy a free slot of the consumer. The consumer becomes busy, when its last free slot is occupied.
+
+    :param engine: params to connect to the db
+    :param consumer_ip: IP address of the consumer
+    :param job_chunk_id: id of the job_chunk, that is going to run in the slot, or 'infernal-job'
+    :return: number of the occupied slot or None, if the consumer has no free slots
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                async with connection.begin():
+                    # lock the consumer, so that concurrent requests don't pick the same slot
+                    slots = await connection.scalar(
+                        sa.text('SELECT slots FROM consumer WHERE ip=:consumer_ip FOR UPDATE'),
+                        consumer_ip=consumer_ip
+                    )
+                    if slots is None:
+                        return None
+
+                    busy_slots = set()
+                    query = sa.text('SELECT slot FROM consumer_slot WHERE consumer=:consumer_ip')
+                    async for row in await connection.execute(query, consumer_ip=consumer_ip):
+                        busy_slots.add(row.slot)
+
+                    free_slots = [slot for slot in range(1, slots + 1) if slot not in busy_slots]
+                    if not free_slots:
+                        return None
+
+                    await connection.execute(
+                        sa.text('''
+                            INSERT INTO consumer_slot(consumer, slot, job_chunk_id)
+                            VALUES (:consumer_ip, :slot, :job_chunk_id)
+                        '''),
+                        consumer_ip=consumer_ip,
+                        slot=free_slots[0],
+                        job_chunk_id=job_chunk_id
+                    )
+
+                    # status is only set when it changes, setting it to available would wake up the producers
+                    if len(free_slots) == 1:
+                        query = sa.text('''
+                            UPDATE consumer SET status=:status, job_chunk_id=:job_chunk_id WHERE ip=:consumer_ip
+                        ''')
+                    else:
+                        query = sa.text('''
+                            UPDATE consumer SET job_chunk_id=:job_chunk_id WHERE ip=:consumer_ip
+                        ''')
+                    await connection.execute(
+                        query,
+                        consumer_ip=consumer_ip,
+                        status=CONSUMER_STATUS_CHOICES.busy,
+                        job_chunk_id=job_chunk_id
+                    )
+
+                    return free_slots[0]
+            except Exception as e:
+                raise SQLError("Failed to occupy_consumer_slot in the database, consumer_ip = %s" % consumer_ip) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in occupy_consumer_slot, "
+                                      "consumer_ip = %s" % consumer_ip) from e
+
+
+async def set_consumer_slot_infernal_job(engine, consumer_ip, slot, infernal_job_id):
+    """
+    Record the infernal job, that runs in an occupied slot, so that the scheduler can free the slot,
+    once the infernal job is finished
+
+    :param engine: params to connect to the db
+    :param consumer_ip: IP address of the consumer
+    :param slot: number of the slot, returned by occupy_consumer_slot
+    :param infernal_job_id: id of the infernal_job
+    :return: None
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                await connection.execute(
+                    sa.text('''
+                        UPDATE consumer_slot SET infernal_job_id=:infernal_job_id
+                        WHERE consumer=:consumer_ip AND slot=:slot
+                    '''),
+                    consumer_ip=consumer_ip,
+                    slot=slot,
+                    infernal_job_id=infernal_job_id
+                )
+            except Exception as e:
+                raise SQLError("Failed to set_consumer_slot_infernal_job in the database, "
+                               "consumer_ip = %s" % consumer_ip) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in set_consumer_slot_infernal_job, "
+                                      "consumer_ip = %s" % consumer_ip) from e
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
+async def free_consumer_slot(engine, consumer_ip, slot):
+    """
+    Free the slot of the consumer and make the consumer available.
+    Retry up to 3 times with a 3-second wait
+
+    :param engine: params to connect to the db
+    :param consumer_ip: IP address of the consumer
+    :param slot: number of the slot, returned by occupy_consumer_slot
+    :return: None
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                async with connection.begin():
+                    await connection.execute(
+                        sa.text('DELETE FROM consumer_slot WHERE consumer=:consumer_ip AND slot=:slot'),
+                        consumer_ip=consumer_ip,
+                        slot=slot
+                    )
+
+                    # job_chunk_id of the consumer shows one of the job_chunks it is still running
+                    await connection.execute(
+                        sa.text('''
+                            UPDATE consumer
+                            SET status=:status, job_chunk_id=(
+                              SELECT job_chunk_id FROM consumer_slot
+                              WHERE consumer=:consumer_ip
+                              ORDER BY slot DESC
+                              LIMIT 1
+                            )
+                            WHERE ip=:consumer_ip
+                        '''),
+                        consumer_ip=consumer_ip,
+                        status=CONSUMER_STATUS_CHOICES.available
+                    )
+            except Exception as e:
+                raise SQLError("Failed to free_consumer_slot in the database, consumer_ip = %s" % consumer_ip) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in free_consumer_slot, "
+                                      "consumer_ip = %s" % consumer_ip) from e
+
+
+async def set_idle_consumers_available(engine):
+    """Make consumers available, if they are marked as busy, but still have free slots."""
+    try:
+        async with acquire(engine) as connection:
+            query = sa.text('''
+                UPDATE consumer
+                SET status=:available
+                WHERE status=:busy AND slots > (
+                  SELECT count(*) FROM consumer_slot WHERE consumer_slot.consumer=consumer.ip
+                )
             ''')
             await connection.execute(
-                sql_query,
-                consumer_ip=get_ip(app), # 'host.docker.internal',
-                status=CONSUMER_STATUS_CHOICES.available,
-                port=PORT
+                query,
+                available=CONSUMER_STATUS_CHOICES.available,
+                busy=CONSUMER_STATUS_CHOICES.busy
             )
-    except psycopg2.IntegrityError as e:
-        pass  # this is usually a duplicate key error - which is acceptable
     except psycopg2.Error as e:
         raise DatabaseConnectionError(str(e)) from e
 
@@ -307,7 +598,7 @@ async def register_consumer_in_the_database(app):
 async def set_consumer_fields(engine, consumer_ip, status, job_chunk_id):
     """Write consumer status and job_chunk_id as infernal-job in the database."""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = sa.text('''
                 UPDATE consumer
                 SET status = :status, job_chunk_id = :job_chunk_id
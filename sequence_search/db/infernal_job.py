@@ -14,27 +14,28 @@ import datetime
 import sqlalchemy as sa
 import psycopg2
 
-from . import DatabaseConnectionError, SQLError
+from . import DatabaseConnectionError, DoesNotExist, SQLError, acquire
 
 from .models import InfernalJob, JOB_CHUNK_STATUS_CHOICES
 
 
 async def save_infernal_job(engine, job_id, priority):
     """
-    Create infernal job
+    Create infernal job with the "created" status, so that the scheduler doesn't dispatch it,
+    before the producer either sends it to a consumer (see claim_created_infernal_job) or makes it pending
     :param engine: params to connect to the db
     :param job_id: id of the job
     :param priority: priority of the job, high or low
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 await connection.scalar(
                     InfernalJob.insert().values(
                         job_id=job_id,
                         submitted=datetime.datetime.now(),
                         priority=priority,
-                        status=JOB_CHUNK_STATUS_CHOICES.pending)
+                        status=JOB_CHUNK_STATUS_CHOICES.created)
                 )
             except Exception as e:
                 raise SQLError("Failed to save_infernal_job for job_id = %s" % job_id) from e
@@ -43,6 +44,26 @@ async def save_infernal_job(engine, job_id, priority):
                                       "job_id = %s" % job_id) from e
 
 
+async def get_infernal_job(engine, infernal_job_id):
+    try:
+        async with acquire(engine) as connection:
+            query = (
+                sa.select([InfernalJob.c.id, InfernalJob.c.job_id, InfernalJob.c.submitted, InfernalJob.c.finished,
+                           InfernalJob.c.consumer, InfernalJob.c.status])
+                .select_from(InfernalJob)
+                .where(InfernalJob.c.id == infernal_job_id)
+            )
+
+            async for row in await connection.execute(query):
+                return row
+
+            raise DoesNotExist("InfernalJob", "infernal_job_id = %s" % infernal_job_id)
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in get_infernal_job "
+                                      "for infernal_job_id = %s" % infernal_job_id) from e
+
+
 async def set_infernal_job_status(engine, job_id, status):
     """
     Update the status of the infernal job
@@ -62,7 +83,7 @@ async def set_infernal_job_status(engine, job_id, status):
         submitted = datetime.datetime.now()
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 if submitted:
                     query = sa.text('''
@@ -120,7 +141,7 @@ async def set_consumer_to_infernal_job(engine, job_id, consumer_ip):
     :return: id or none
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = sa.text('''
                     UPDATE infernal_job
@@ -138,3 +159,176 @@ async def set_consumer_to_infernal_job(engine, job_id, consumer_ip):
     except psycopg2.Error as e:
         raise DatabaseConnectionError("Failed to open connection to the database in set_consumer_to_infernal_job, "
                                       "job_id = %s" % job_id) from e
+
+
+async def claim_infernal_jobs(engine, limit):
+    """
+    Atomically move up to `limit` pending infernal jobs to the 'dispatching' status,
+    skipping rows locked by other producers. See job_chunks.claim_job_chunks
+    :param engine: params to connect to the db
+    :param limit: maximum number of infernal jobs to claim, usually the number of available consumers
+    :return: list of claimed infernal jobs (id, job_id, database, priority, submitted, query),
+    database is always None
+    """
+    query = sa.text('''
+        WITH claimed AS (
+            UPDATE infernal_job
+            SET status = :dispatching, dispatched = :dispatched
+            FROM (
+                SELECT id
+                FROM infernal_job
+                WHERE status = :pending
+                ORDER BY priority, submitted
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            ) AS pending
+            WHERE infernal_job.id = pending.id
+            RETURNING infernal_job.id, infernal_job.job_id, infernal_job.priority, infernal_job.submitted
+        )
+        SELECT claimed.id, claimed.job_id, NULL AS database, claimed.priority, claimed.submitted, jobs.query
+        FROM claimed JOIN jobs ON jobs.id = claimed.job_id
+        ORDER BY claimed.priority, claimed.submitted
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now(),
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    limit=limit
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to claim infernal jobs, limit = %s" % limit) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in claim_infernal_jobs") from e
+
+
+async def claim_created_infernal_job(engine, job_id):
+    """
+    Atomically move the new infernal job of a job from 'created' to the 'dispatching' status,
+    see job_chunks.claim_created_job_chunks
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :return: id of the claimed infernal job or None
+    """
+    query = sa.text('''
+        UPDATE infernal_job
+        SET status = :dispatching, dispatched = :dispatched
+        WHERE job_id = :job_id AND status = :created
+        RETURNING id
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                return await connection.scalar(
+                    query,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now(),
+                    created=JOB_CHUNK_STATUS_CHOICES.created,
+                    job_id=job_id
+                )
+            except Exception as e:
+                raise SQLError("Failed to claim created infernal job of job_id = %s" % job_id) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in "
+                                      "claim_created_infernal_job") from e
+
+
+async def start_dispatched_infernal_jobs(engine, job_ids, consumer_ip):
+    """
+    Move the infernal jobs of the jobs from 'dispatching' to the 'started' status and assign them to the consumer,
+    see job_chunks.start_dispatched_job_chunks
+    :param engine: params to connect to the db
+    :param job_ids: ids of the jobs
+    :param consumer_ip: ip of the consumer that runs the infernal jobs
+    :return: list of started infernal jobs (id, job_id)
+    """
+    query = sa.text('''
+        UPDATE infernal_job
+        SET status = :started, submitted = :submitted, consumer = :consumer_ip
+        WHERE job_id = ANY(:job_ids) AND status = :dispatching
+        RETURNING id, job_id
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    started=JOB_CHUNK_STATUS_CHOICES.started,
+                    submitted=datetime.datetime.now(),
+                    consumer_ip=consumer_ip,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    job_ids=list(job_ids)
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to start infernal jobs of job_ids = %s" % job_ids) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in "
+                                      "start_dispatched_infernal_jobs") from e
+
+
+async def release_infernal_jobs(engine, infernal_job_ids):
+    """
+    Return claimed infernal jobs to the 'pending' status, unless they were already started
+    :param engine: params to connect to the db
+    :param infernal_job_ids: ids of the infernal jobs returned by claim_infernal_jobs
+    :return: number of released infernal jobs
+    """
+    query = sa.text('''
+        UPDATE infernal_job
+        SET status = :pending, dispatched = NULL
+        WHERE id = ANY(:infernal_job_ids) AND status = :dispatching
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    infernal_job_ids=list(infernal_job_ids)
+                )
+                return result.rowcount
+            except Exception as e:
+                raise SQLError("Failed to release infernal jobs %s" % infernal_job_ids) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in release_infernal_jobs") from e
+
+
+async def release_stale_infernal_jobs(engine, timeout):
+    """
+    Return infernal jobs that were claimed more than `timeout` seconds ago, but never started,
+    to the 'pending' status
+    :param engine: params to connect to the db
+    :param timeout: number of seconds
+    :return: number of released infernal jobs
+    """
+    query = sa.text('''
+        UPDATE infernal_job
+        SET status = :pending, dispatched = NULL
+        WHERE status = :dispatching AND dispatched < :dispatched
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+                )
+                return result.rowcount
+            except Exception as e:
+                raise SQLError("Failed to release stale infernal jobs") from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in "
+                                      "release_stale_infernal_jobs") from e
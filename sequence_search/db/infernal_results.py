@@ -14,30 +14,27 @@ limitations under the License.
 import sqlalchemy as sa
 import psycopg2
 
-from . import DatabaseConnectionError, SQLError
-from .models import InfernalResult
+from . import DatabaseConnectionError, SQLError, DoesNotExist, acquire
+from .models import InfernalJob, InfernalResult
 
 
 async def set_infernal_job_results(engine, job_id, results):
     """
-    Save infernal results
+    Save infernal results together with their alignments in a single INSERT statement,
+    raises SQLError if the job has no infernal_job
     :param engine: params to connect to the db
     :param job_id: id of the job
-    :param results: data from the deoverlapped file
-    :return: id of the infernal_job. It will be used to get the result and save the alignment
+    :param results: data from the deoverlapped file, optionally with the alignment of each hit
+    :return: id of the infernal_job
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
-                query = sa.text('''
-                    SELECT id
-                    FROM infernal_job
-                    WHERE job_id=:job_id
-                ''')
-
-                async for row in await connection.execute(query, job_id=job_id):
-                    infernal_job_id = row.id
-                    break
+                infernal_job_id = await connection.scalar(
+                    sa.select([InfernalJob.c.id]).where(InfernalJob.c.job_id == job_id)
+                )
+                if infernal_job_id is None:
+                    raise DoesNotExist("InfernalJob", "job_id = %s" % job_id)
 
                 for result in results:
                     result['infernal_job_id'] = infernal_job_id
@@ -63,7 +60,7 @@ async def get_infernal_result_id(engine, infernal_job_id, item):
     :return: id of the infernal_result
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = sa.text('''
                     SELECT id
@@ -99,7 +96,7 @@ async def save_alignment(engine, infernal_result_id, alignment):
     :param alignment: alignment to be saved
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = sa.text('''
                     UPDATE infernal_result SET alignment=:alignment 
@@ -14,28 +14,85 @@ limitations under the License.
 import sqlalchemy as sa
 import psycopg2
 
-from . import DatabaseConnectionError, SQLError
-from .models import JobChunkResult
+from . import DatabaseConnectionError, SQLError, DoesNotExist, acquire
+from .models import JobChunkResult, JobChunkResultAlignment
+
+
+# number of rows sent to postgres in a single INSERT statement
+INSERT_BATCH_SIZE = 250
+
+# all columns, except for the serial primary key, taxid and week, generated by postgres; job_chunk_id goes first
+JOB_CHUNK_RESULT_COLUMNS = [column.name for column in JobChunkResult.columns
+                            if column.name not in ('id', 'taxid', 'week')]
+
+# alignment columns, stored in job_chunk_result_alignments; job_chunk_result_id and week go first
+JOB_CHUNK_RESULT_ALIGNMENT_COLUMNS = [column.name for column in JobChunkResultAlignment.columns]
+
+
+async def insert_job_chunk_results(connection, job_chunk_id, results, batch_size=INSERT_BATCH_SIZE):
+    """
+    Bulk insert results of a job_chunk.
+
+    psycopg2 does not support COPY on asynchronous connections, so rows are
+    rendered client-side with cursor.mogrify (like psycopg2.extras.execute_values)
+    and sent as multi-row INSERT statements of up to `batch_size` rows. This is
+    much cheaper than compiling a single sqlalchemy insert with all the rows.
+
+    Alignments go to job_chunk_result_alignments, keyed by the ids and weeks that
+    postgres returns for each batch of results (result_id is unique within a job_chunk).
+
+    :param connection: sqlalchemy connection acquired from the engine
+    :param job_chunk_id: id of the job_chunk the results belong to
+    :param results: list of dicts with the results of nhmmer_parse
+    :param batch_size: max number of rows in a single statement
+    :return: number of inserted rows
+    """
+    statement = 'INSERT INTO job_chunk_results (%s) VALUES ' % ', '.join(JOB_CHUNK_RESULT_COLUMNS)
+    template = '(%s)' % ', '.join(['%s'] * len(JOB_CHUNK_RESULT_COLUMNS))
+    alignment_statement = 'INSERT INTO job_chunk_result_alignments (%s) VALUES ' % \
+                          ', '.join(JOB_CHUNK_RESULT_ALIGNMENT_COLUMNS)
+    alignment_template = '(%s)' % ', '.join(['%s'] * len(JOB_CHUNK_RESULT_ALIGNMENT_COLUMNS))
+
+    cursor = await connection.connection.cursor()
+    try:
+        for start in range(0, len(results), batch_size):
+            batch = results[start:start + batch_size]
+
+            rows = []
+            for result in batch:
+                values = [job_chunk_id] + [result.get(column) for column in JOB_CHUNK_RESULT_COLUMNS[1:]]
+                rows.append(cursor.mogrify(template, values))
+            await cursor.execute(statement.encode('utf-8') + b','.join(rows) + b' RETURNING result_id, id, week')
+            keys = {row[0]: list(row[1:]) for row in await cursor.fetchall()}
+
+            rows = []
+            for result in batch:
+                values = keys[result['result_id']] + \
+                         [result.get(column) for column in JOB_CHUNK_RESULT_ALIGNMENT_COLUMNS[2:]]
+                rows.append(cursor.mogrify(alignment_template, values))
+            await cursor.execute(alignment_statement.encode('utf-8') + b','.join(rows))
+    finally:
+        cursor.close()
+
+    return len(results)
 
 
 async def set_job_chunk_results(engine, job_id, database, results):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
-                query = sa.text('''
-                    SELECT id
-                    FROM job_chunks
-                    WHERE job_id=:job_id AND database=:database
-                ''')
-
-                async for row in await connection.execute(query, job_id=job_id, database=database):
-                    job_chunk_id = row.id
-                    break
+                async with connection.begin():
+                    query = sa.text('''
+                        SELECT id
+                        FROM job_chunks
+                        WHERE job_id=:job_id AND database=:database
+                    ''')
 
-                for result in results:
-                    result['job_chunk_id'] = job_chunk_id
+                    job_chunk_id = await connection.scalar(query, job_id=job_id, database=database)
+                    if job_chunk_id is None:
+                        raise DoesNotExist("JobChunk", "job_id = %s, database = %s" % (job_id, database))
 
-                await connection.execute(JobChunkResult.insert().values(results))
+                    await insert_job_chunk_results(connection, job_chunk_id, results)
             except Exception as e:
                 raise SQLError("Failed to set_job_chunk_results in the database, "
                                "job_id = %s, database = %s" % (job_id, database)) from e
@@ -17,13 +17,18 @@ import sqlalchemy as sa
 import psycopg2
 
 from tenacity import retry, stop_after_attempt, wait_fixed
-from . import DatabaseConnectionError, SQLError, DoesNotExist
-from .models import JobChunk, JOB_CHUNK_STATUS_CHOICES
+from . import DatabaseConnectionError, SQLError, DoesNotExist, acquire
+from .models import JobChunk, JOB_CHUNK_STATUS_CHOICES, JOB_STATUS_CHOICES
+
+
+# internal pipeline statistics of nhmmer, that are saved along with the status of a finished job chunk
+PIPELINE_STATS_COLUMNS = ['target_sequences', 'residues_searched', 'residues_passed_ssv', 'residues_passed_bias',
+                          'residues_passed_vit', 'residues_passed_fwd', 'search_seconds']
 
 
 async def get_job_chunk(engine, job_chunk_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = (
                 sa.select([JobChunk.c.id, JobChunk.c.job_id, JobChunk.c.database, JobChunk.c.submitted,
                            JobChunk.c.finished, JobChunk.c.consumer, JobChunk.c.status])
@@ -43,7 +48,7 @@ async def get_job_chunk(engine, job_chunk_id):
 
 async def get_job_chunk_from_job_and_database(engine, job_id, database):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = (
                 sa.select([JobChunk.c.id, JobChunk.c.job_id, JobChunk.c.database])
                 .select_from(JobChunk)
@@ -70,7 +75,7 @@ async def save_job_chunk(engine, job_id, database):
     :return: id of the job chunk
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 job_chunk_id = await connection.scalar(
                     JobChunk.insert().values(
@@ -89,7 +94,7 @@ async def save_job_chunk(engine, job_id, database):
 
 async def get_consumer_ip_from_job_chunk(engine, job_chunk_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query = (sa.select([JobChunk.c.consumer])
                      .select_from(JobChunk)
                      .where(JobChunk.c.id == job_chunk_id)
@@ -103,7 +108,7 @@ async def get_consumer_ip_from_job_chunk(engine, job_chunk_id):
 
 
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
-async def set_job_chunk_status(engine, job_id, database, status, hits=None):
+async def set_job_chunk_status(engine, job_id, database, status, hits=None, stats=None):
     """
     Update the job_chunk's status in the database.
     Retry up to 3 times with a 3-second wait
@@ -113,6 +118,7 @@ async def set_job_chunk_status(engine, job_id, database, status, hits=None):
     :param database: Consumer-side database (actual file name stored in the database)
     :param status: an option from consumer.JOB_CHUNK_STATUS
     :param hits: total number of hits (optional)
+    :param stats: internal pipeline statistics of nhmmer (optional), see PIPELINE_STATS_COLUMNS
     :return: None
     """
     finished = None
@@ -126,7 +132,7 @@ async def set_job_chunk_status(engine, job_id, database, status, hits=None):
         submitted = datetime.datetime.now()
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             query_params = {"status": status, "job_id": job_id, "database": database}
             extra_fields = ""
 
@@ -139,6 +145,11 @@ async def set_job_chunk_status(engine, job_id, database, status, hits=None):
                 query_params["hits"] = hits
                 extra_fields += ", finished = :finished, hits = :hits"
 
+                for column in PIPELINE_STATS_COLUMNS:
+                    if stats and column in stats:
+                        query_params[column] = stats[column]
+                        extra_fields += f", {column} = :{column}"
+
             query = sa.text(f'''
                 UPDATE job_chunks
                 SET status = :status {extra_fields}
@@ -182,7 +193,7 @@ async def set_job_chunk_consumer(engine, job_id, database, consumer_ip):
     ''')
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             result = await connection.execute(query, job_id=job_id, database=database, consumer_ip=consumer_ip)
             row = await result.fetchone()  # expecting one row or None
             return row.id if row else None
@@ -197,3 +208,239 @@ async def set_job_chunk_consumer(engine, job_id, database, consumer_ip):
     except Exception as e:
         logging.error(f"Unexpected error in set_job_chunk_consumer: {e}. Job_id={job_id}, database={database}")
         raise SQLError(f"Failed to set job_chunk consumer for job_id={job_id}, database={database}") from e
+
+
+async def claim_job_chunks(engine, limit):
+    """
+    Atomically move up to `limit` pending job_chunks to the 'dispatching' status, so that
+    several producers can schedule job_chunks from the same database without sending
+    the same job_chunk twice. Rows locked by another producer are skipped.
+
+    :param engine: params to connect to the db
+    :param limit: maximum number of job_chunks to claim, usually the number of available consumers
+    :return: list of claimed job_chunks (id, job_id, database, priority, submitted, query),
+    sorted by priority and submission date of the job
+    """
+    query = sa.text('''
+        WITH claimed AS (
+            UPDATE job_chunks
+            SET status = :dispatching, dispatched = :dispatched
+            FROM (
+                SELECT job_chunks.id
+                FROM job_chunks JOIN jobs ON jobs.id = job_chunks.job_id
+                WHERE jobs.status = :started AND job_chunks.status = :pending
+                ORDER BY jobs.priority, jobs.submitted
+                LIMIT :limit
+                FOR UPDATE OF job_chunks SKIP LOCKED
+            ) AS pending
+            WHERE job_chunks.id = pending.id
+            RETURNING job_chunks.id, job_chunks.job_id, job_chunks.database
+        )
+        SELECT claimed.id, claimed.job_id, claimed.database, jobs.priority, jobs.submitted, jobs.query
+        FROM claimed JOIN jobs ON jobs.id = claimed.job_id
+        ORDER BY jobs.priority, jobs.submitted
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now(),
+                    started=JOB_STATUS_CHOICES.started,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    limit=limit
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to claim job_chunks, limit = %s" % limit) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in claim_job_chunks") from e
+
+
+async def claim_job_chunks_of_database(engine, database, limit):
+    """
+    Atomically move up to `limit` pending job_chunks of the given database to the 'dispatching' status,
+    like claim_job_chunks does, so that they can be searched together with a job_chunk of the same
+    database that was claimed already.
+
+    :param engine: params to connect to the db
+    :param database: name of the database chunk, e.g. mirbase.fasta
+    :param limit: maximum number of job_chunks to claim
+    :return: list of claimed job_chunks (id, job_id, database, priority, submitted, query),
+    sorted by priority and submission date of the job
+    """
+    query = sa.text('''
+        WITH claimed AS (
+            UPDATE job_chunks
+            SET status = :dispatching, dispatched = :dispatched
+            FROM (
+                SELECT job_chunks.id
+                FROM job_chunks JOIN jobs ON jobs.id = job_chunks.job_id
+                WHERE jobs.status = :started AND job_chunks.status = :pending AND job_chunks.database = :database
+                ORDER BY jobs.priority, jobs.submitted
+                LIMIT :limit
+                FOR UPDATE OF job_chunks SKIP LOCKED
+            ) AS pending
+            WHERE job_chunks.id = pending.id
+            RETURNING job_chunks.id, job_chunks.job_id, job_chunks.database
+        )
+        SELECT claimed.id, claimed.job_id, claimed.database, jobs.priority, jobs.submitted, jobs.query
+        FROM claimed JOIN jobs ON jobs.id = claimed.job_id
+        ORDER BY jobs.priority, jobs.submitted
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now(),
+                    started=JOB_STATUS_CHOICES.started,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    database=database,
+                    limit=limit
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to claim job_chunks of database %s, limit = %s" % (database, limit)) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in claim_job_chunks_of_database") from e
+
+
+async def claim_created_job_chunks(engine, job_id, databases):
+    """
+    Atomically move the new job_chunks of a job in the given databases from 'created' to the 'dispatching' status,
+    for the producer that sends them to consumers right after it saved the job. Claimed job_chunks are
+    returned to 'pending' by release_job_chunks, like the ones of claim_job_chunks, if no consumer starts them.
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param databases: names of the database chunks
+    :return: list of claimed job_chunks (id, database)
+    """
+    query = sa.text('''
+        UPDATE job_chunks
+        SET status = :dispatching, dispatched = :dispatched
+        WHERE job_id = :job_id AND database = ANY(:databases) AND status = :created
+        RETURNING id, database
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now(),
+                    created=JOB_CHUNK_STATUS_CHOICES.created,
+                    job_id=job_id,
+                    databases=list(databases)
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to claim created job_chunks of job_id = %s" % job_id) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in claim_created_job_chunks") from e
+
+
+async def start_dispatched_job_chunks(engine, job_ids, database, consumer_ip):
+    """
+    Move the job_chunks of the jobs in the database from 'dispatching' to the 'started' status and assign them
+    to the consumer. Job_chunks in any other status (e.g. released by the producer in the meantime, or started
+    by another consumer) are left as they are.
+
+    :param engine: params to connect to the db
+    :param job_ids: ids of the jobs
+    :param database: name of the database chunk
+    :param consumer_ip: ip of the consumer that runs the job_chunks
+    :return: list of started job_chunks (id, job_id)
+    """
+    query = sa.text('''
+        UPDATE job_chunks
+        SET status = :started, submitted = :submitted, consumer = :consumer_ip
+        WHERE job_id = ANY(:job_ids) AND database = :database AND status = :dispatching
+        RETURNING id, job_id
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    started=JOB_CHUNK_STATUS_CHOICES.started,
+                    submitted=datetime.datetime.now(),
+                    consumer_ip=consumer_ip,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    job_ids=list(job_ids),
+                    database=database
+                )
+                return await result.fetchall()
+            except Exception as e:
+                raise SQLError("Failed to start job_chunks of job_ids = %s, database = %s" % (job_ids, database)) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in start_dispatched_job_chunks") from e
+
+
+async def release_job_chunks(engine, job_chunk_ids):
+    """
+    Return claimed job_chunks to the 'pending' status, e.g. if the consumer could not be reached.
+    Job_chunks that were already started by a consumer are not affected.
+
+    :param engine: params to connect to the db
+    :param job_chunk_ids: ids of the job_chunks returned by claim_job_chunks
+    :return: number of released job_chunks
+    """
+    query = sa.text('''
+        UPDATE job_chunks
+        SET status = :pending, dispatched = NULL
+        WHERE id = ANY(:job_chunk_ids) AND status = :dispatching
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    job_chunk_ids=list(job_chunk_ids)
+                )
+                return result.rowcount
+            except Exception as e:
+                raise SQLError("Failed to release job_chunks %s" % job_chunk_ids) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in release_job_chunks") from e
+
+
+async def release_stale_job_chunks(engine, timeout):
+    """
+    Return job_chunks that were claimed more than `timeout` seconds ago, but never started, to
+    the 'pending' status. This happens if a producer dies between claiming and dispatching.
+
+    :param engine: params to connect to the db
+    :param timeout: number of seconds
+    :return: number of released job_chunks
+    """
+    query = sa.text('''
+        UPDATE job_chunks
+        SET status = :pending, dispatched = NULL
+        WHERE status = :dispatching AND dispatched < :dispatched
+    ''')
+
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = await connection.execute(
+                    query,
+                    pending=JOB_CHUNK_STATUS_CHOICES.pending,
+                    dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching,
+                    dispatched=datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+                )
+                return result.rowcount
+            except Exception as e:
+                raise SQLError("Failed to release stale job_chunks") from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open database connection in release_stale_job_chunks") from e
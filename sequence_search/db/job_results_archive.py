@@ -0,0 +1,114 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import array
+import json
+import struct
+import sys
+import zlib
+
+
+"""
+Archive format of the results of finished jobs, see archive_job_results in jobs.py.
+
+A blob is a zlib-compressed columnar table:
+
+    4 bytes - length of the json header, big-endian
+    header  - {"version": 1, "count": rows, "columns": [{"name": ..., "type": ..., "size": bytes}, ...]}
+    columns - one after another, in the order of the header
+
+Numeric columns are typed arrays in little-endian byte order ('q' - int64, 'd' - float64),
+other columns (and numeric columns with nulls) are json lists.
+"""
+ARCHIVE_VERSION = 1
+
+COMPRESSION_LEVEL = 6
+
+
+def column_type(values):
+    """Typecode of the array that can hold all the values, or 'json'"""
+    types = set(type(value) for value in values)
+    if types == {int}:
+        return 'q'
+    elif types and types <= {int, float}:
+        return 'd'
+    else:
+        return 'json'
+
+
+def pack_column(values, typecode):
+    if typecode == 'json':
+        return json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+    data = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack_column(data, typecode):
+    if typecode == 'json':
+        return json.loads(data.decode('utf-8'))
+
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tolist()
+
+
+def pack_job_results(results, columns=None):
+    """
+    Packs a list of job results into a compressed columnar blob.
+
+    :param results: list of dicts with the same keys, e.g. rows of get_job_results
+    :param columns: names of the columns to store, all keys of the first result by default
+    :return: bytes
+    """
+    if columns is None:
+        columns = list(results[0].keys()) if results else []
+
+    header = {'version': ARCHIVE_VERSION, 'count': len(results), 'columns': []}
+    body = []
+    for name in columns:
+        values = [result.get(name) for result in results]
+        typecode = column_type(values)
+        data = pack_column(values, typecode)
+        header['columns'].append({'name': name, 'type': typecode, 'size': len(data)})
+        body.append(data)
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return zlib.compress(struct.pack('>I', len(header)) + header + b''.join(body), COMPRESSION_LEVEL)
+
+
+def unpack_job_results(blob):
+    """
+    Unpacks a blob, created by pack_job_results.
+
+    :param blob: bytes (or memoryview, as returned by psycopg2 for BYTEA)
+    :return: list of dicts
+    """
+    data = zlib.decompress(bytes(blob))
+    (header_size,) = struct.unpack_from('>I', data)
+    header = json.loads(data[4:4 + header_size].decode('utf-8'))
+    if header['version'] != ARCHIVE_VERSION:
+        raise ValueError("Unsupported job results archive version %s" % header['version'])
+
+    offset = 4 + header_size
+    names, columns = [], []
+    for column in header['columns']:
+        names.append(column['name'])
+        columns.append(unpack_column(data[offset:offset + column['size']], column['type']))
+        offset += column['size']
+
+    return [dict(zip(names, row)) for row in zip(*columns)] if columns else [{} for _ in range(header['count'])]
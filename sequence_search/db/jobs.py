@@ -12,6 +12,8 @@ limitations under the License.
 """
 
 import datetime
+import hashlib
+import re
 import uuid
 
 import sqlalchemy as sa
@@ -19,9 +21,12 @@ import psycopg2
 from collections import Counter
 from operator import itemgetter
 
-from . import DatabaseConnectionError, SQLError
-from .models import Job, InfernalJob, InfernalResult, JobChunk, JobChunkResult, JOB_STATUS_CHOICES, \
-    JOB_CHUNK_STATUS_CHOICES
+from . import DatabaseConnectionError, SQLError, DoesNotExist, acquire, fetch_in_batches, select_by_keys, \
+    unit_of_work
+from .models import Job, InfernalJob, InfernalResult, JobChunk, JobChunkResult, JobChunkResultAlignment, \
+    JobResultsArchive, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
+from .job_results_archive import pack_job_results, unpack_job_results
+from .statistic import count_submitted_search
 
 
 class JobNotFound(Exception):
@@ -32,6 +37,44 @@ class JobNotFound(Exception):
         return "Job '%s' not found" % self.job_id
 
 
+def search_key(query, databases, release):
+    """
+    Key of the search cache. Identical searches of the same databases release have the same key.
+    :param query: the sequence that the user wants to search, optionally with a fasta header
+    :param databases: list of database chunks (e.g. ['mirbase.fasta']), order doesn't matter
+    :param release: fingerprint of the database chunks, see rnacentral_databases.databases_release()
+    :return: sha256 hex digest
+    """
+    # normalize query: strip fasta header and whitespace, convert nucleotides to upper-case RNA
+    sequence = ''.join(line for line in query.splitlines() if not line.startswith('>'))
+    sequence = re.sub(r'\s+', '', sequence).upper().replace('T', 'U')
+
+    key = '\n'.join([sequence, ','.join(sorted(databases)), release])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+async def find_cached_job(engine, key):
+    """
+    Find the most recent job with the given search_key
+    :param engine: params to connect to the db
+    :param key: search key, see search_key()
+    :return: job_id or None
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                sql_query = sa.select([Job.c.id]).select_from(Job)\
+                    .where(Job.c.search_key == key)\
+                    .order_by(Job.c.submitted.desc())\
+                    .limit(1)
+                return await connection.scalar(sql_query)
+            except Exception as e:
+                raise SQLError("Failed to find cached job for search_key = %s" % key) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in find_cached_job() for "
+                                      "search_key = %s" % key) from e
+
+
 async def sequence_exists(engine, query):
     """
     Check if this query has already been searched
@@ -40,7 +83,7 @@ async def sequence_exists(engine, query):
     :return: list of job_ids
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 sql_query = sa.select([Job.c.id]).select_from(Job).where((Job.c.query == query))
                 job_list = []
@@ -64,7 +107,7 @@ async def database_used_in_search(engine, job_id, databases):
     :return: "true" if the database used in "job_id" is the same as in "databases", otherwise "false".
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 sql_query = sa.select([JobChunk.c.database]).select_from(JobChunk).where(JobChunk.c.job_id == job_id)
                 result = []
@@ -80,7 +123,7 @@ async def database_used_in_search(engine, job_id, databases):
 
 async def get_job(engine, job_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 sql_query = sa.select([
                     Job.c.id,
@@ -110,11 +153,12 @@ async def get_job(engine, job_id):
                                       "get_job() for job with job_id = %s" % job_id) from e
 
 
-async def save_job(engine, query, description, url, priority):
+async def save_job(engine, query, description, url, priority, search_key=None):
     try:
-        async with engine.acquire() as connection:
+        async with unit_of_work(engine) as connection:
             try:
                 job_id = str(uuid.uuid4())
+                submitted = datetime.datetime.now()
 
                 await connection.execute(
                     Job.insert().values(
@@ -122,13 +166,17 @@ async def save_job(engine, query, description, url, priority):
                         query=query,
                         description=description,
                         ordering='e_value',
-                        submitted=datetime.datetime.now(),
+                        submitted=submitted,
                         status=JOB_STATUS_CHOICES.started,
                         url=url,
-                        priority=priority
+                        priority=priority,
+                        search_key=search_key
                     )
                 )
 
+                if description != 'sequence-search-test':
+                    await count_submitted_search(connection, priority or 'low', submitted)
+
                 return job_id
             except Exception as e:
                 raise SQLError("Failed to save job for query = %s, description = %s, priority = %s, url = %s "
@@ -147,10 +195,27 @@ async def set_job_status(engine, job_id, status, hits=None):
         finished = None
 
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
+                # the first time the job finishes, its run time is added to the hourly rollup of the searches
+                # (see statistic.py), the row lock keeps concurrent updates from adding it twice
                 query = sa.text('''
-                    UPDATE jobs SET status = :status, finished = :finished, hits = :hits WHERE id = :job_id
+                    WITH previous AS (
+                      SELECT id, finished FROM jobs WHERE id = :job_id FOR UPDATE
+                    ), job AS (
+                      UPDATE jobs SET status = :status, finished = :finished, hits = :hits
+                      FROM previous WHERE jobs.id = previous.id
+                      RETURNING jobs.submitted, jobs.finished, jobs.priority, jobs.description,
+                        previous.finished AS previously_finished
+                    )
+                    INSERT INTO search_rollup AS rollup (hour, priority, finished, runtime)
+                    SELECT date_trunc('hour', submitted), coalesce(priority, 'low'), 1,
+                      extract(epoch FROM finished - submitted)
+                    FROM job
+                    WHERE finished IS NOT NULL AND previously_finished IS NULL AND submitted IS NOT NULL
+                      AND description IS DISTINCT FROM 'sequence-search-test'
+                    ON CONFLICT (hour, priority) DO UPDATE
+                    SET finished = rollup.finished + 1, runtime = rollup.runtime + excluded.runtime
                 ''')
                 await connection.execute(query, job_id=job_id, status=status, finished=finished, hits=hits)
             except Exception as e:
@@ -164,7 +229,7 @@ async def set_job_status(engine, job_id, status, hits=None):
 async def get_jobs_statuses(engine):
     """Returns all jobs from the last 15 days with job_chunks status"""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 # ambiguity in column names forces us to manually assign column labels
                 select_statement = sa.select([
@@ -215,7 +280,7 @@ async def get_jobs_statuses(engine):
 async def get_job_chunks_status(engine, job_id):
     """Returns the status of the job and its job_chunks as a namedtuple"""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 # ambiguity in column names forces us to manually assign column labels
                 select_statement = sa.select(
@@ -273,9 +338,9 @@ async def get_job_chunks_status(engine, job_id):
 
 
 async def update_job_status_from_job_chunks_status(engine, job_id):
-    """Infer job status for the statuses of all chunks that constitute it"""
+    """Infer job status for the statuses of all chunks that constitute it, archive results of finished jobs"""
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = (sa.select([Job.c.id, JobChunk.c.job_id, JobChunk.c.status, JobChunk.c.hits])
                          .select_from(sa.join(Job, JobChunk, Job.c.id == JobChunk.c.job_id))  # noqa
@@ -285,7 +350,8 @@ async def update_job_status_from_job_chunks_status(engine, job_id):
                 errors_found = False
                 hits = 0
                 async for row in await connection.execute(query):
-                    if row.status == JOB_CHUNK_STATUS_CHOICES.pending or row.status == JOB_CHUNK_STATUS_CHOICES.started:
+                    if row.status in (JOB_CHUNK_STATUS_CHOICES.pending, JOB_CHUNK_STATUS_CHOICES.dispatching,
+                                      JOB_CHUNK_STATUS_CHOICES.started):
                         unfinished_chunks_found = True
                         break
                     elif row.status == JOB_CHUNK_STATUS_CHOICES.error or row.status == JOB_CHUNK_STATUS_CHOICES.timeout:
@@ -294,9 +360,11 @@ async def update_job_status_from_job_chunks_status(engine, job_id):
                         hits += row.hits
 
                 if unfinished_chunks_found is False and errors_found is False:
-                    await set_job_status(engine, job_id, status=JOB_STATUS_CHOICES.success, hits=hits)
+                    await set_job_status(connection, job_id, status=JOB_STATUS_CHOICES.success, hits=hits)
+                    await archive_job_results(connection, job_id)
                 elif unfinished_chunks_found is False and errors_found is True:
-                    await set_job_status(engine, job_id, status=JOB_STATUS_CHOICES.partial_success, hits=hits)
+                    await set_job_status(connection, job_id, status=JOB_STATUS_CHOICES.partial_success, hits=hits)
+                    await archive_job_results(connection, job_id)
 
             except Exception as e:
                 raise SQLError("Failed to check job_chunk status, job_id = %s" % job_id) from e
@@ -308,7 +376,7 @@ async def update_job_status_from_job_chunks_status(engine, job_id):
 
 async def job_exists(engine, job_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 exists = False
                 async for row in await connection.execute(sa.text('''SELECT * FROM jobs WHERE id=:job_id'''), job_id=job_id):
@@ -325,7 +393,7 @@ async def job_exists(engine, job_id):
 
 async def get_job_query(engine, job_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 sql_query = sa.select([Job.c.query]).select_from(Job).where(Job.c.id == job_id)
 
@@ -341,7 +409,7 @@ async def get_job_query(engine, job_id):
 
 async def get_job_ordering(engine, job_id):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 sql_query = sa.select([Job.c.ordering]).select_from(Job).where(Job.c.id == job_id)
 
@@ -357,7 +425,7 @@ async def get_job_ordering(engine, job_id):
 
 async def set_job_ordering(engine, job_id, ordering):
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = sa.text('''UPDATE jobs SET ordering=:ordering WHERE id = :job_id''')
                 await connection.execute(query, job_id=job_id, ordering=ordering)
@@ -369,118 +437,370 @@ async def set_job_ordering(engine, job_id, ordering):
                                       "set_job_ordering() for job with job_id = %s" % job_id) from e
 
 
-async def get_job_results(engine, job_id, limit=1000):
+"""Orderings of job results, a leading '-' means descending"""
+JOB_RESULTS_ORDERINGS = ['e_value', 'identity', 'query_coverage', 'target_coverage']
+
+# popular species: zebrafish, arabidopsis thaliana, caenorhabditis elegans, drosophila melanogaster,
+# saccharomyces cerevisiae S288c, schizosaccharomyces pombe, escherichia coli str. K-12 substr. MG1655
+# and bacillus subtilis subsp. subtilis str. 168, respectively.
+POPULAR_SPECIES = [7955, 3702, 6239, 7227, 559292, 4896, 511145, 224308]
+
+
+JOB_RESULT_COLUMNS = [
+    JobChunkResult.c.rnacentral_id,
+    JobChunkResult.c.description,
+    JobChunkResult.c.score,
+    JobChunkResult.c.bias,
+    JobChunkResult.c.e_value,
+    JobChunkResult.c.target_length,
+    JobChunkResult.c.alignment_length,
+    JobChunkResult.c.gap_count,
+    JobChunkResult.c.match_count,
+    JobChunkResult.c.nts_count1,
+    JobChunkResult.c.nts_count2,
+    JobChunkResult.c.identity,
+    JobChunkResult.c.query_coverage,
+    JobChunkResult.c.target_coverage,
+    JobChunkResult.c.gaps,
+    JobChunkResult.c.query_length,
+    JobChunkResult.c.result_id,
+    JobChunkResult.c.alignment_start,
+    JobChunkResult.c.alignment_stop,
+]
+
+SPECIES_PRIORITY = sa.case([
+    (JobChunkResult.c.taxid == 9606, 'a'),  # Very high priority
+    (JobChunkResult.c.taxid == 10090, 'b'),  # High priority
+    (JobChunkResult.c.taxid.in_(POPULAR_SPECIES), 'c'),  # Medium priority
+], else_='d')  # Low priority
+
+
+def job_results_query(job_id, ordering=None, limit=1000, alignment=False, rnacentral_ids=None, ids_only=False,
+                      primary_keys=False):
+    """
+    Select query for get_job_results and get_job_result_ids.
+
+    The best `limit` results by score are ordered by `ordering`. Ascending orderings sort by the field and then
+    by species priority, descending orderings sort by species priority first. Species priority comes from the
+    taxid column: human (9606), mouse (10090), popular species, others.
+
+    Results are summaries, that only read job_chunk_results. Identical results of different job_chunks
+    are returned once, with the smallest id. Alignments are joined to the selected page, if requested.
+    With ids_only, only the rnacentral_ids are selected, with primary_keys only the ids, see job_result_rows_query.
+    """
+    columns = JOB_RESULT_COLUMNS
+    best_results = (sa.select([sa.func.min(JobChunkResult.c.id).label('id')] + columns +
+                              [SPECIES_PRIORITY.label('species_priority')])
+                    .select_from(sa.join(JobChunk, JobChunkResult, JobChunk.c.id == JobChunkResult.c.job_chunk_id))
+                    .where(JobChunk.c.job_id == job_id)
+                    .group_by(*columns + [JobChunkResult.c.taxid])
+                    .order_by(JobChunkResult.c.score.desc())
+                    .limit(limit)
+                    .alias('best_results'))
+
+    # use the ordering stored in the database, unless it is given
+    if ordering is None:
+        ordering = sa.select([Job.c.ordering]).where(Job.c.id == job_id).as_scalar()
+    else:
+        ordering = sa.literal(ordering)
+
+    ascending = sa.case([(ordering == field, best_results.c[field]) for field in JOB_RESULTS_ORDERINGS])
+    descending = sa.case([(ordering == '-' + field, best_results.c[field]) for field in JOB_RESULTS_ORDERINGS])
+    species_priority = best_results.c.species_priority
+
+    if ids_only:
+        query = sa.select([best_results.c.rnacentral_id])
+    elif primary_keys:
+        query = sa.select([best_results.c.id])
+    elif alignment:
+        query = (sa.select([best_results, JobChunkResultAlignment.c.alignment,
+                            JobChunkResultAlignment.c.alignment_sequence])
+                 .select_from(best_results.outerjoin(
+                     JobChunkResultAlignment, JobChunkResultAlignment.c.job_chunk_result_id == best_results.c.id
+                 )))
+    else:
+        query = sa.select([best_results])
+
+    query = query.order_by(
+        sa.case([(ordering.in_(['-' + field for field in JOB_RESULTS_ORDERINGS]), species_priority)]),
+        ascending.asc(),
+        descending.desc(),
+        sa.case([(ordering.in_(JOB_RESULTS_ORDERINGS), species_priority)]),
+        best_results.c.score.desc(),
+        best_results.c.rnacentral_id,
+        best_results.c.id
+    )
+
+    if rnacentral_ids is not None:
+        query = query.where(best_results.c.rnacentral_id.in_(rnacentral_ids))
+
+    return query
+
+
+def job_result_rows_query(alignment=False):
+    """
+    Select query for the rows of job_results_query by their ids, that are selected with primary_keys=True
+    and passed to select_by_keys, see stream_job_results
+    """
+    columns = [JobChunkResult.c.id] + JOB_RESULT_COLUMNS + [SPECIES_PRIORITY.label('species_priority')]
+    if alignment:
+        return (sa.select(columns + [JobChunkResultAlignment.c.alignment, JobChunkResultAlignment.c.alignment_sequence])
+                .select_from(JobChunkResult.outerjoin(
+                    JobChunkResultAlignment, JobChunkResultAlignment.c.job_chunk_result_id == JobChunkResult.c.id
+                )))
+    return sa.select(columns)
+
+
+def order_job_results(results, ordering):
+    """Orders results of an archived job in the same way as job_results_query"""
+    if ordering in JOB_RESULTS_ORDERINGS:
+        def key(result):
+            return result[ordering], result['species_priority'], -result['score'], result['rnacentral_id']
+    elif ordering and ordering[0] == '-' and ordering[1:] in JOB_RESULTS_ORDERINGS:
+        def key(result):
+            return result['species_priority'], -result[ordering[1:]], -result['score'], result['rnacentral_id']
+    else:
+        def key(result):
+            return -result['score'], result['rnacentral_id']
+
+    return sorted(results, key=key)
+
+
+async def get_archived_job_results(connection, job_id, alignment=False):
+    """
+    Unpacks the results of an archived job, the alignments blob is only read, if requested
+
+    :param connection: sqlalchemy connection acquired from the engine
+    :param job_id: id of the job
+    :param alignment: whether to add the alignment and alignment_sequence to each result
+    :return: (ordering of the job, list of results in the order of score) or None, if the job is not archived
     """
-    Aggregates results from multiple job_chunks and returns them.
+    columns = [Job.c.ordering, JobResultsArchive.c.results]
+    if alignment:
+        columns.append(JobResultsArchive.c.alignments)
 
-    By default, we're using a limit of 10000 on the number of hits due to
+    query = (sa.select(columns)
+             .select_from(sa.join(Job, JobResultsArchive, Job.c.id == JobResultsArchive.c.job_id))
+             .where(Job.c.id == job_id))
+
+    archive = None
+    async for row in await connection.execute(query):
+        archive = row
+    if archive is None:
+        return None
+
+    results = unpack_job_results(archive.results)
+    if alignment:
+        for result, alignments in zip(results, unpack_job_results(archive.alignments)):
+            result.update(alignments)
+    return archive.ordering, results
+
+
+async def archive_job_results(engine, job_id):
+    """
+    Packs the results of a finished job into job_results_archive and deletes its job_chunk_results.
+
+    The archive holds all the results of the job, so that get_job_results returns the same results with any limit,
+    summaries and alignments in separate blobs. Archiving the same job twice is harmless.
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :return: number of archived results
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                async with connection.begin():
+                    results = []
+                    query = job_results_query(job_id, ordering='score', limit=None, alignment=True)
+                    async for row in await connection.execute(query):
+                        results.append(dict(row))
+
+                    alignments = [{
+                        'alignment': result.pop('alignment'),
+                        'alignment_sequence': result.pop('alignment_sequence')
+                    } for result in results]
+
+                    await connection.execute(
+                        sa.text('''
+                            INSERT INTO job_results_archive(job_id, week, archived, results, alignments)
+                            SELECT id, date_trunc('week', COALESCE(submitted, now())), :archived, :results, :alignments
+                            FROM jobs
+                            WHERE id=:job_id
+                            ON CONFLICT (job_id, week) DO NOTHING
+                        '''),
+                        job_id=job_id,
+                        archived=datetime.datetime.now(),
+                        results=pack_job_results(results),
+                        alignments=pack_job_results(alignments, columns=['alignment', 'alignment_sequence'])
+                    )
+
+                    await connection.execute(
+                        sa.text('''
+                            DELETE FROM job_chunk_results
+                            WHERE job_chunk_id IN (SELECT id FROM job_chunks WHERE job_id=:job_id)
+                        '''),
+                        job_id=job_id
+                    )
+
+                    return len(results)
+            except Exception as e:
+                raise SQLError("Failed to archive_job_results, job_id = %s" % job_id) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in archive_job_results, "
+                                      "job_id = %s" % job_id) from e
+
+
+def paginate(results, start=0, size=None):
+    return results[start:] if size is None else results[start:start + size]
+
+
+async def get_job_results(engine, job_id, ordering=None, start=0, size=None, alignment=False, rnacentral_ids=None,
+                          limit=1000):
+    """
+    Aggregates results from multiple job_chunks and returns them, ordered and paginated by postgres.
+    Results of archived jobs are unpacked from job_results_archive instead.
+
+    By default, we're using a limit of 1000 on the number of hits due to
     recommendation from text search team. You can increase it up to infinity,
     shall the need arise.
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param ordering: one of JOB_RESULTS_ORDERINGS, optionally with a leading '-', the ordering of the job by default
+    :param start: return results, starting from 'start' (counts from 0)
+    :param size: return 'size' results, all of them by default
+    :param alignment: whether to return the alignment and alignment_sequence of each result, see also
+    get_job_result_alignment
+    :param rnacentral_ids: return only the results with these rnacentral_ids
+    :param limit: maximum number of results to order and paginate
+    :return: list of results
     """
     try:
-        async with engine.acquire() as connection:
-            sql = (sa.select([
-                    JobChunkResult.c.rnacentral_id.distinct(),
-                    JobChunk.c.job_id,
-                    JobChunk.c.database,
-                    JobChunkResult.c.description,
-                    JobChunkResult.c.score,
-                    JobChunkResult.c.bias,
-                    JobChunkResult.c.e_value,
-                    JobChunkResult.c.target_length,
-                    JobChunkResult.c.alignment,
-                    JobChunkResult.c.alignment_length,
-                    JobChunkResult.c.gap_count,
-                    JobChunkResult.c.match_count,
-                    JobChunkResult.c.nts_count1,
-                    JobChunkResult.c.nts_count2,
-                    JobChunkResult.c.identity,
-                    JobChunkResult.c.query_coverage,
-                    JobChunkResult.c.target_coverage,
-                    JobChunkResult.c.gaps,
-                    JobChunkResult.c.query_length,
-                    JobChunkResult.c.result_id,
-                    JobChunkResult.c.alignment_start,
-                    JobChunkResult.c.alignment_stop,
-                    JobChunkResult.c.alignment_sequence,
-                ])
-                .select_from(sa.join(JobChunk, JobChunkResult, JobChunk.c.id == JobChunkResult.c.job_chunk_id))  # noqa
-                .order_by(JobChunkResult.c.score.desc())
-                .limit(limit)
-                .where(JobChunk.c.job_id == job_id))  # noqa
-
-            # popular species: zebrafish, arabidopsis thaliana, caenorhabditis elegans, drosophila melanogaster,
-            # saccharomyces cerevisiae S288c, schizosaccharomyces pombe, escherichia coli str. K-12 substr. MG1655
-            # and bacillus subtilis subsp. subtilis str. 168, respectively.
-            popular_species = {7955, 3702, 6239, 7227, 559292, 4896, 511145, 224308}
+        async with acquire(engine) as connection:
+            archived = await get_archived_job_results(connection, job_id, alignment)
+            if archived is not None:
+                job_ordering, results = archived
+                results = order_job_results(results[:limit], job_ordering if ordering is None else ordering)
+                if rnacentral_ids is not None:
+                    rnacentral_ids = set(rnacentral_ids)
+                    results = [result for result in results if result['rnacentral_id'] in rnacentral_ids]
+                return paginate(results, start, size)
+
+            query = job_results_query(job_id, ordering, limit, alignment, rnacentral_ids).offset(start).limit(size)
 
             results = []
-            async for row in await connection.execute(sql):
-                # check species priority.
-                # priority order = human (9606), mouse (10090), popular species, others
-                try:
-                    taxid = row[0].split('_')[1]
-                    if taxid == '9606':
-                        species_priority = 'a'  # Very high priority
-                    elif taxid == '10090':
-                        species_priority = 'b'  # High priority
-                    elif int(taxid) in popular_species:
-                        species_priority = 'c'  # Medium priority
-                    else:
-                        species_priority = 'd'  # Low priority
-                except Exception:
-                    pass
-
-                # add result
-                results.append({
-                    'rnacentral_id': row[0],
-                    'description': row[3],
-                    'score': row[4],
-                    'bias': row[5],
-                    'e_value': row[6],
-                    'target_length': row[7],
-                    'alignment': row[8],
-                    'alignment_length': row[9],
-                    'gap_count': row[10],
-                    'match_count': row[11],
-                    'nts_count1': row[12],
-                    'nts_count2': row[13],
-                    'identity': row[14],
-                    'query_coverage': row[15],
-                    'target_coverage': row[16],
-                    'gaps': row[17],
-                    'query_length': row[18],
-                    'result_id': row[19],
-                    'alignment_start': row[20],
-                    'alignment_stop': row[21],
-                    'alignment_sequence': row[22],
-                    'species_priority': species_priority if species_priority else 'd'
-                })
-
-            # sort results by ordering, ordering is stored in the database
-            ordering = await get_job_ordering(engine, job_id)
-
-            if ordering == 'e_value':
-                results.sort(key=itemgetter('e_value', 'species_priority'))
-            elif ordering == '-e_value':
-                results.sort(key=itemgetter('e_value'), reverse=True)
-                results.sort(key=itemgetter('species_priority'))
-            elif ordering == 'identity':
-                results.sort(key=itemgetter('identity', 'species_priority'))
-            elif ordering == '-identity':
-                results.sort(key=itemgetter('identity'), reverse=True)
-                results.sort(key=itemgetter('species_priority'))
-            elif ordering == 'query_coverage':
-                results.sort(key=itemgetter('query_coverage', 'species_priority'))
-            elif ordering == '-query_coverage':
-                results.sort(key=itemgetter('query_coverage'), reverse=True)
-                results.sort(key=itemgetter('species_priority'))
-            elif ordering == 'target_coverage':
-                results.sort(key=itemgetter('target_coverage', 'species_priority'))
-            elif ordering == '-target_coverage':
-                results.sort(key=itemgetter('target_coverage'), reverse=True)
-                results.sort(key=itemgetter('species_priority'))
+            async for row in await connection.execute(query):
+                results.append(dict(row))
+            return results
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
+async def stream_job_results(engine, job_id, ordering=None, alignment=False, limit=1000, batch_size=1000):
+    """
+    Yields the results of get_job_results one by one, as they are read from the database, so that all of them
+    (with alignments, several MB for a 1000 hits) can be sent without holding them in memory, see fetch_in_batches.
+    No connection is kept while the results are yielded. Results of archived jobs come from a single blob,
+    that is unpacked at once.
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param ordering: one of JOB_RESULTS_ORDERINGS, optionally with a leading '-', the ordering of the job by default
+    :param alignment: whether to return the alignment and alignment_sequence of each result
+    :param limit: maximum number of results
+    :param batch_size: number of results read from the database at a time
+    """
+    try:
+        async with acquire(engine) as connection:
+            archived = await get_archived_job_results(connection, job_id, alignment)
+
+        if archived is not None:
+            job_ordering, results = archived
+            for result in order_job_results(results[:limit], job_ordering if ordering is None else ordering):
+                yield result
+            return
+
+        keys_query = job_results_query(job_id, ordering, limit, primary_keys=True)
+        rows_query = job_result_rows_query(alignment)
+        async for row in fetch_in_batches(
+                engine, keys_query, lambda keys: select_by_keys(rows_query, JobChunkResult.c.id, keys), batch_size):
+            yield dict(row)
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
+async def get_job_result_alignment(engine, job_id, result_id):
+    """
+    Returns the alignment of a single result of the job
+
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param result_id: id of the result, as returned by get_job_results
+    :return: dict with the id, rnacentral_id, alignment and alignment_sequence of the result
+    """
+    try:
+        async with acquire(engine) as connection:
+            try:
+                result = None
+                archived = await get_archived_job_results(connection, job_id, alignment=True)
+                if archived is not None:
+                    for row in archived[1]:
+                        if row['id'] == result_id:
+                            result = {key: row[key] for key in ['id', 'rnacentral_id', 'alignment',
+                                                                'alignment_sequence']}
+                else:
+                    query = (sa.select([JobChunkResult.c.id, JobChunkResult.c.rnacentral_id,
+                                        JobChunkResultAlignment.c.alignment,
+                                        JobChunkResultAlignment.c.alignment_sequence])
+                             .select_from(
+                                 JobChunkResult
+                                 .join(JobChunk, JobChunk.c.id == JobChunkResult.c.job_chunk_id)
+                                 .join(JobChunkResultAlignment,
+                                       JobChunkResultAlignment.c.job_chunk_result_id == JobChunkResult.c.id)
+                             )
+                             .where(sa.and_(JobChunkResult.c.id == result_id, JobChunk.c.job_id == job_id)))
+
+                    async for row in await connection.execute(query):
+                        result = dict(row)
+            except Exception as e:
+                raise SQLError("Failed to get_job_result_alignment, job_id = %s, result_id = %s" %
+                               (job_id, result_id)) from e
+
+            if result is None:
+                raise DoesNotExist("JobChunkResult", "job_id = %s, id = %s" % (job_id, result_id))
+            return result
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in get_job_result_alignment, "
+                                      "job_id = %s, result_id = %s" % (job_id, result_id)) from e
+
+
+async def get_job_result_ids(engine, job_id, ordering=None, limit=1000):
+    """
+    Returns rnacentral_ids of the job results, in the same order as get_job_results
 
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param ordering: see get_job_results
+    :param limit: see get_job_results
+    :return: list of rnacentral_ids
+    """
+    try:
+        async with acquire(engine) as connection:
+            archived = await get_archived_job_results(connection, job_id)
+            if archived is not None:
+                job_ordering, results = archived
+                results = order_job_results(results[:limit], job_ordering if ordering is None else ordering)
+                return [result['rnacentral_id'] for result in results]
+
+            query = job_results_query(job_id, ordering, limit, alignment=False, ids_only=True)
+
+            results = []
+            async for row in await connection.execute(query):
+                results.append(row.rnacentral_id)
             return results
 
     except psycopg2.Error as e:
@@ -496,7 +816,7 @@ async def find_highest_priority_jobs(engine):
     """
     # among the running jobs, find the one with high priority, submitted first
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             output = []
             query = (
                 sa.select(
@@ -543,6 +863,101 @@ async def find_highest_priority_jobs(engine):
         raise SQLError("Failed to find highest priority jobs") from e
 
 
+async def count_pending_jobs(engine):
+    """
+    Count job chunks and infernal jobs waiting for a consumer.
+
+    :param engine: params to connect to the db
+    :return: number of pending job chunks and infernal jobs
+    """
+    try:
+        async with acquire(engine) as connection:
+            query = sa.text('''
+                SELECT
+                  (SELECT count(*)
+                   FROM job_chunks JOIN jobs ON jobs.id = job_chunks.job_id
+                   WHERE jobs.status = :started AND job_chunks.status = :pending)
+                  +
+                  (SELECT count(*) FROM infernal_job WHERE status = :pending)
+            ''')
+            return await connection.scalar(
+                query, started=JOB_STATUS_CHOICES.started, pending=JOB_CHUNK_STATUS_CHOICES.pending
+            )
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+    except Exception as e:
+        raise SQLError("Failed to count pending jobs") from e
+
+
+async def count_pending_jobs_by_priority(engine):
+    """
+    Count job chunks and infernal jobs waiting for a consumer, by priority of their job.
+
+    :param engine: params to connect to the db
+    :return: dict {priority: number of pending job chunks and infernal jobs}
+    """
+    try:
+        async with acquire(engine) as connection:
+            query = sa.text('''
+                SELECT priority, count(*) AS total
+                FROM (
+                  SELECT jobs.priority
+                  FROM job_chunks JOIN jobs ON jobs.id = job_chunks.job_id
+                  WHERE jobs.status = :started AND job_chunks.status = :pending
+                  UNION ALL
+                  SELECT priority FROM infernal_job WHERE status = :pending
+                ) AS pending
+                GROUP BY priority
+            ''')
+            pending = {}
+            async for row in await connection.execute(
+                query, started=JOB_STATUS_CHOICES.started, pending=JOB_CHUNK_STATUS_CHOICES.pending
+            ):
+                pending[row.priority] = row.total
+            return pending
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+    except Exception as e:
+        raise SQLError("Failed to count pending jobs by priority") from e
+
+
+INFERNAL_RESULT_COLUMNS = [
+    InfernalResult.c.target_name,
+    InfernalResult.c.accession_rfam,
+    InfernalResult.c.query_name,
+    InfernalResult.c.accession_seq,
+    InfernalResult.c.mdl,
+    InfernalResult.c.mdl_from,
+    InfernalResult.c.mdl_to,
+    InfernalResult.c.seq_from,
+    InfernalResult.c.seq_to,
+    InfernalResult.c.strand,
+    InfernalResult.c.trunc,
+    InfernalResult.c.pipeline_pass,
+    InfernalResult.c.gc,
+    InfernalResult.c.bias,
+    InfernalResult.c.score,
+    InfernalResult.c.e_value,
+    InfernalResult.c.inc,
+    InfernalResult.c.description,
+    InfernalResult.c.alignment,
+]
+
+
+def infernal_job_results_query(job_id, primary_keys=False):
+    """
+    Select query for get_infernal_job_results and stream_infernal_job_results,
+    with primary_keys only the ids of the results are selected
+    """
+    columns = [InfernalResult.c.id] if primary_keys else INFERNAL_RESULT_COLUMNS
+    return (sa.select(columns)
+            .select_from(sa.join(InfernalJob, InfernalResult, InfernalJob.c.id == InfernalResult.c.infernal_job_id))  # noqa
+            .where(InfernalJob.c.job_id == job_id)  # noqa
+            .order_by(InfernalResult.c.id))  # noqa
+
+
 async def get_infernal_job_results(engine, job_id):
     """
     Function to get cmscan command results
@@ -551,55 +966,10 @@ async def get_infernal_job_results(engine, job_id):
     :return: list of dicts with cmscan command results
     """
     try:
-        async with engine.acquire() as connection:
-            sql = (sa.select([
-                    InfernalJob.c.job_id,
-                    InfernalResult.c.target_name,
-                    InfernalResult.c.accession_rfam,
-                    InfernalResult.c.query_name,
-                    InfernalResult.c.accession_seq,
-                    InfernalResult.c.mdl,
-                    InfernalResult.c.mdl_from,
-                    InfernalResult.c.mdl_to,
-                    InfernalResult.c.seq_from,
-                    InfernalResult.c.seq_to,
-                    InfernalResult.c.strand,
-                    InfernalResult.c.trunc,
-                    InfernalResult.c.pipeline_pass,
-                    InfernalResult.c.gc,
-                    InfernalResult.c.bias,
-                    InfernalResult.c.score,
-                    InfernalResult.c.e_value,
-                    InfernalResult.c.inc,
-                    InfernalResult.c.description,
-                    InfernalResult.c.alignment,
-                ])
-                .select_from(sa.join(InfernalJob, InfernalResult, InfernalJob.c.id == InfernalResult.c.infernal_job_id))  # noqa
-                .where(InfernalJob.c.job_id == job_id))  # noqa
-
+        async with acquire(engine) as connection:
             results = []
-            async for row in await connection.execute(sql):
-                results.append({
-                    'target_name': row[1],
-                    'accession_rfam': row[2],
-                    'query_name': row[3],
-                    'accession_seq': row[4],
-                    'mdl': row[5],
-                    'mdl_from': row[6],
-                    'mdl_to': row[7],
-                    'seq_from': row[8],
-                    'seq_to': row[9],
-                    'strand': row[10],
-                    'trunc': row[11],
-                    'pipeline_pass': row[12],
-                    'gc': row[13],
-                    'bias': row[14],
-                    'score': row[15],
-                    'e_value': row[16],
-                    'inc': row[17],
-                    'description': row[18],
-                    'alignment': row[19]
-                })
+            async for row in await connection.execute(infernal_job_results_query(job_id)):
+                results.append(dict(row))
 
             return results
 
@@ -607,6 +977,24 @@ async def get_infernal_job_results(engine, job_id):
         raise DatabaseConnectionError(str(e)) from e
 
 
+async def stream_infernal_job_results(engine, job_id, batch_size=1000):
+    """
+    Yields the cmscan command results one by one, as they are read from the database, see fetch_in_batches
+    :param engine: params to connect to the db
+    :param job_id: id of the job
+    :param batch_size: number of results read from the database at a time
+    """
+    rows_query = sa.select(INFERNAL_RESULT_COLUMNS)
+    try:
+        async for row in fetch_in_batches(engine, infernal_job_results_query(job_id, primary_keys=True),
+                                          lambda keys: select_by_keys(rows_query, InfernalResult.c.id, keys),
+                                          batch_size):
+            yield dict(row)
+
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError(str(e)) from e
+
+
 async def get_infernal_job_status(engine, job_id):
     """
     Function to get the status of the infernal job
@@ -615,7 +1003,7 @@ async def get_infernal_job_status(engine, job_id):
     :return: data about infernal job as a namedtuple
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 select_statement = sa.select(
                     [
@@ -661,7 +1049,7 @@ async def save_r2dt_id(engine, job_id, r2dt_id, r2dt_date):
     :return: r2dt_id
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
                 query = sa.text('''UPDATE jobs SET r2dt_id = :r2dt_id, r2dt_date = :r2dt_date WHERE id = :job_id''')
                 await connection.execute(query, r2dt_id=r2dt_id, r2dt_date=r2dt_date, job_id=job_id)
@@ -0,0 +1,580 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import logging
+
+import psycopg2
+import sqlalchemy as sa
+from aiopg.sa import create_engine
+
+from . import DatabaseConnectionError, SQLError
+from .models import create_tables, drop_tables, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES, \
+    CONSUMER_STATUS_CHOICES, DISPATCH_CHANNEL
+from .retention import PARTITIONED_TABLES, create_partitions, partition_name, week_start
+from .settings import get_postgres_credentials
+
+
+"""
+Versioned, additive migrations.
+
+Applied versions are recorded in the schema_migrations table, so running the migrations again only applies
+the new ones and leaves the data in place. New migrations are appended to MIGRATIONS with the next version,
+the applied ones are never edited.
+"""
+
+# only one process at a time applies the migrations
+MIGRATIONS_LOCK = 4243
+
+
+async def create_index_concurrently(connection, name, definition):
+    """
+    Creates an index without locking the table against writes.
+
+    CREATE INDEX CONCURRENTLY can't run in a transaction, and if it fails, it leaves an invalid index behind,
+    which is dropped here before trying again.
+
+    :param connection: sqlalchemy connection acquired from the engine, not in a transaction
+    :param name: name of the index
+    :param definition: rest of the statement after ON, e.g. "jobs (query)"
+    """
+    valid = await connection.scalar('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)', name)
+    if valid is False:
+        logging.warning("Dropping invalid index %s" % name)
+        await connection.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+
+    await connection.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s' % (name, definition))
+
+
+async def add_dispatch_notifications(connection):
+    """
+    Notifications of the producer scheduler
+
+    Triggers send a notification on DISPATCH_CHANNEL, whenever a job_chunk or an infernal_job is pending
+    or a consumer gets available, see producer/scheduler.py.
+    """
+    await connection.execute('''
+        CREATE OR REPLACE FUNCTION notify_dispatch() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('%s', TG_TABLE_NAME);
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''' % DISPATCH_CHANNEL)
+
+    # claims released by the scheduler itself (see job_chunks.release_job_chunks) are left for the sweep,
+    # otherwise an unreachable consumer would be retried in a busy loop
+    for table in ['job_chunks', 'infernal_job']:
+        await connection.execute('''
+            CREATE TRIGGER %s_pending AFTER INSERT ON %s
+            FOR EACH ROW WHEN (NEW.status = '%s') EXECUTE PROCEDURE notify_dispatch()
+        ''' % (table, table, JOB_CHUNK_STATUS_CHOICES.pending))
+
+        await connection.execute('''
+            CREATE TRIGGER %s_pending_again AFTER UPDATE OF status ON %s
+            FOR EACH ROW WHEN (NEW.status = '%s' AND OLD.status IS DISTINCT FROM '%s')
+            EXECUTE PROCEDURE notify_dispatch()
+        ''' % (table, table, JOB_CHUNK_STATUS_CHOICES.pending, JOB_CHUNK_STATUS_CHOICES.dispatching))
+
+    # consumers.free_consumer_slot always sets the status, so every freed slot sends a notification
+    await connection.execute('''
+        CREATE TRIGGER consumer_available AFTER INSERT OR UPDATE OF status ON consumer
+        FOR EACH ROW WHEN (NEW.status = '%s') EXECUTE PROCEDURE notify_dispatch()
+    ''' % CONSUMER_STATUS_CHOICES.available)
+
+
+async def add_dispatched(connection):
+    """Time when a job_chunk or an infernal_job was claimed by the scheduler, see release_stale_job_chunks"""
+    await connection.execute('ALTER TABLE job_chunks ADD COLUMN IF NOT EXISTS dispatched TIMESTAMP')
+    await connection.execute('ALTER TABLE infernal_job ADD COLUMN IF NOT EXISTS dispatched TIMESTAMP')
+
+
+async def add_consumer_slots(connection):
+    """
+    Slots of the consumers, that run several job_chunks concurrently
+
+    Busy consumers keep running their job_chunk in the first slot.
+    """
+    await connection.execute('ALTER TABLE consumer ADD COLUMN IF NOT EXISTS slots INTEGER NOT NULL DEFAULT 1')
+    await connection.execute('''
+        CREATE TABLE consumer_slot (
+          consumer VARCHAR(20) references consumer(ip) ON UPDATE CASCADE ON DELETE CASCADE,
+          slot INTEGER,
+          job_chunk_id VARCHAR(15),
+          PRIMARY KEY (consumer, slot))
+    ''')
+    await connection.execute(
+        sa.text('''
+            INSERT INTO consumer_slot (consumer, slot, job_chunk_id)
+            SELECT ip, 1, job_chunk_id FROM consumer WHERE status = :busy AND job_chunk_id IS NOT NULL
+        '''),
+        busy=CONSUMER_STATUS_CHOICES.busy
+    )
+
+
+async def add_search_key(connection):
+    """Key of the cached search results of a job, see jobs.search_key"""
+    await connection.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS search_key VARCHAR(64)')
+    await connection.execute('''CREATE INDEX on jobs (search_key, submitted)''')
+
+
+async def add_taxid(connection):
+    """
+    Taxid of the job_chunk_results, for ordering them by species in postgres
+
+    The taxid is a generated column, computed from the rnacentral_id, so the table is rewritten.
+    The results of a job_chunk are read by score.
+    """
+    await connection.execute('''
+        ALTER TABLE job_chunk_results ADD COLUMN taxid INTEGER GENERATED ALWAYS AS (
+          CASE WHEN split_part(rnacentral_id, '_', 2) ~ '^[0-9]+$'
+          THEN split_part(rnacentral_id, '_', 2)::integer END
+        ) STORED
+    ''')
+    await connection.execute('''CREATE INDEX on job_chunk_results (job_chunk_id, score DESC)''')
+    await connection.execute('''DROP INDEX IF EXISTS job_chunk_results_job_chunk_id_idx''')
+
+
+async def add_alignments(connection):
+    """
+    Alignments of the job_chunk_results in a table of their own
+
+    Listing the results doesn't read the alignment blobs anymore, they are moved out of job_chunk_results.
+    """
+    await connection.execute('''
+        CREATE TABLE job_chunk_result_alignments (
+          job_chunk_result_id INT PRIMARY KEY references job_chunk_results(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          alignment TEXT NOT NULL,
+          alignment_sequence TEXT NOT NULL)
+    ''')
+    await connection.execute('''
+        INSERT INTO job_chunk_result_alignments (job_chunk_result_id, alignment, alignment_sequence)
+        SELECT id, alignment, alignment_sequence FROM job_chunk_results
+    ''')
+    await connection.execute('''
+        ALTER TABLE job_chunk_results DROP COLUMN alignment, DROP COLUMN alignment_sequence
+    ''')
+
+
+async def add_results_archive(connection):
+    """Archive of the results of finished jobs, see job_results_archive.py"""
+    await connection.execute('''
+        CREATE TABLE job_results_archive (
+          job_id VARCHAR(36) PRIMARY KEY references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          archived TIMESTAMP NOT NULL,
+          results BYTEA NOT NULL,
+          alignments BYTEA NOT NULL)
+    ''')
+
+
+async def rename_table(connection, table, name):
+    """Renames a table together with its indexes and the sequence of its id, so that their names can be reused"""
+    await connection.execute('ALTER TABLE %s RENAME TO %s' % (table, name))
+
+    query = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s"
+    for row in await (await connection.execute(query, name)).fetchall():
+        await connection.execute('ALTER INDEX %s RENAME TO %s' % (row.indexname, row.indexname.replace(table, name, 1)))
+
+    sequence = await connection.scalar(
+        "SELECT pg_get_serial_sequence(%s, attname) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'",
+        name, name
+    )
+    if sequence:
+        await connection.execute('ALTER SEQUENCE %s RENAME TO %s_id_seq' % (sequence, name))
+
+
+async def attach_legacy_partition(connection, table, week):
+    """
+    Attaches an existing, unpartitioned table to the partitioned table of the same columns, as the partition
+    of the given week and all the weeks before it. The rows are left in place: attaching scans the table
+    to check the partition constraint and the foreign keys and builds the primary key, but doesn't copy anything.
+    An empty table is dropped instead, so that a new database gets weekly partitions only.
+
+    :param table: name of the partitioned table, the unpartitioned one is named after its partition
+    :param week: monday of the week of the partition
+    """
+    partition = partition_name(table, week)
+
+    # ids of the rows, that are there already, are not given out again
+    if await connection.scalar("SELECT to_regclass(%s) IS NOT NULL", '%s_id_seq' % partition):
+        await connection.execute(
+            "SELECT setval(pg_get_serial_sequence(%%s, 'id'), last_value, is_called) FROM %s_id_seq" % partition,
+            table
+        )
+
+    # primary key of the partitioned table includes the week, the foreign keys that reference the old one
+    # are replaced with those of the partitioned tables on attaching
+    primary_key = await connection.scalar(
+        "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", partition
+    )
+    if primary_key:
+        await connection.execute('ALTER TABLE %s DROP CONSTRAINT %s CASCADE' % (partition, primary_key))
+
+    if not await connection.scalar('SELECT EXISTS (SELECT 1 FROM %s)' % partition):
+        await connection.execute('DROP TABLE %s' % partition)
+        return
+
+    await connection.execute(
+        "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO ('%s')"
+        % (table, partition, week + datetime.timedelta(weeks=1))
+    )
+
+
+async def partition_by_week(connection):
+    """
+    Weekly partitions of the tables with the bulk of the data
+
+    Old searches are dropped together with their partitions, see retention.py. Partitioned tables can't be made
+    of the existing ones, so these are renamed and attached to the new tables as the partition of the current
+    week, that also covers all the weeks before it. Their rows are not copied, and the tables are only scanned
+    to check the partition constraints, while the migration holds the lock. The partition is dropped by
+    the retention once the current week has expired, along with the searches that were there before.
+
+    jobs is not partitioned: job_chunks, infernal_job and the tables above reference jobs.id, and a partitioned
+    table can only be referenced by a key that includes its partition key. Its rows are small, one per search,
+    and the expired ones are deleted with a single statement, see retention.expire_jobs.
+    """
+    week = week_start(datetime.date.today())
+    for table in PARTITIONED_TABLES:
+        await rename_table(connection, table, partition_name(table, week))
+        await connection.execute(
+            "ALTER TABLE %s ADD COLUMN week DATE NOT NULL DEFAULT '%s'" % (partition_name(table, week), week)
+        )
+
+    await connection.execute('''
+        CREATE TABLE job_chunk_results (
+          id serial,
+          week DATE NOT NULL DEFAULT date_trunc('week', now()),
+          job_chunk_id INT references job_chunks(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          rnacentral_id VARCHAR(255) NOT NULL,
+          description TEXT,
+          score FLOAT NOT NULL,
+          bias FLOAT NOT NULL,
+          e_value FLOAT NOT NULL,
+          target_length INTEGER NOT NULL,
+          alignment_length INTEGER NOT NULL,
+          gap_count INTEGER NOT NULL,
+          match_count INTEGER NOT NULL,
+          nts_count1 INTEGER NOT NULL,
+          nts_count2 INTEGER NOT NULL,
+          identity FLOAT NOT NULL,
+          query_coverage FLOAT NOT NULL,
+          target_coverage FLOAT NOT NULL,
+          gaps FLOAT NOT NULL,
+          query_length INTEGER NOT NULL,
+          alignment_start INTEGER NOT NULL,
+          alignment_stop INTEGER NOT NULL,
+          result_id INTEGER NOT NULL,
+          taxid INTEGER GENERATED ALWAYS AS (
+            CASE WHEN split_part(rnacentral_id, '_', 2) ~ '^[0-9]+$'
+            THEN split_part(rnacentral_id, '_', 2)::integer END
+          ) STORED,
+          PRIMARY KEY (id, week))
+        PARTITION BY RANGE (week)
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE job_results_archive (
+          job_id VARCHAR(36) references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          week DATE NOT NULL,
+          archived TIMESTAMP NOT NULL,
+          results BYTEA NOT NULL,
+          alignments BYTEA NOT NULL,
+          PRIMARY KEY (job_id, week))
+        PARTITION BY RANGE (week)
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE job_chunk_result_alignments (
+          job_chunk_result_id INT NOT NULL,
+          week DATE NOT NULL DEFAULT date_trunc('week', now()),
+          alignment TEXT NOT NULL,
+          alignment_sequence TEXT NOT NULL,
+          PRIMARY KEY (job_chunk_result_id, week),
+          FOREIGN KEY (job_chunk_result_id, week) references job_chunk_results(id, week)
+            ON UPDATE CASCADE ON DELETE CASCADE)
+        PARTITION BY RANGE (week)
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE infernal_result (
+          id serial,
+          week DATE NOT NULL DEFAULT date_trunc('week', now()),
+          infernal_job_id INT references infernal_job(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          target_name VARCHAR(255),
+          accession_rfam VARCHAR(255),
+          query_name VARCHAR(255),
+          accession_seq VARCHAR(255),
+          mdl VARCHAR(255),
+          mdl_from INTEGER NOT NULL,
+          mdl_to INTEGER NOT NULL,
+          seq_from INTEGER NOT NULL,
+          seq_to INTEGER NOT NULL,
+          strand VARCHAR(255),
+          trunc VARCHAR(255),
+          pipeline_pass INTEGER NOT NULL,
+          gc FLOAT NOT NULL,
+          bias FLOAT NOT NULL,
+          score FLOAT NOT NULL,
+          e_value FLOAT NOT NULL,
+          inc VARCHAR(255),
+          description VARCHAR(255),
+          alignment TEXT,
+          PRIMARY KEY (id, week))
+        PARTITION BY RANGE (week)
+    ''')
+
+    # referenced tables first, so that the foreign keys of the referencing ones can be checked
+    for table in reversed(PARTITIONED_TABLES):
+        await attach_legacy_partition(connection, table, week)
+
+    await create_partitions(connection, week)
+
+    await connection.execute('''CREATE INDEX on jobs (submitted)''')
+    await connection.execute('''CREATE INDEX on job_chunk_results (job_chunk_id, score DESC)''')
+    await connection.execute('''CREATE INDEX on infernal_result (infernal_job_id)''')
+
+
+async def add_indexes(connection):
+    """Indexes on the predicates of the scheduler, the consumers and the job status queries"""
+    indexes = [
+        # jobs.sequence_exists, the query can be too long for a btree
+        ('jobs_query_idx', 'jobs USING hash (query)'),
+        # job_chunks.claim_job_chunks, jobs.find_highest_priority_jobs, jobs.count_pending_jobs
+        ('jobs_started_idx', "jobs (priority, submitted) WHERE status = '%s'" % JOB_STATUS_CHOICES.started),
+        ('job_chunks_pending_idx', "job_chunks (job_id) WHERE status = '%s'" % JOB_CHUNK_STATUS_CHOICES.pending),
+        # job_chunks.set_job_chunk_status, job_chunks.get_job_chunk_from_job_and_database and the like
+        ('job_chunks_job_id_database_idx', 'job_chunks (job_id, database)'),
+        # job_chunks.release_stale_job_chunks
+        ('job_chunks_dispatching_idx',
+         "job_chunks (dispatched) WHERE status = '%s'" % JOB_CHUNK_STATUS_CHOICES.dispatching),
+        # consumers.find_available_consumers, consumers.find_busy_consumers and the like
+        ('consumer_status_idx', 'consumer (status, ip)'),
+        # infernal_job.set_infernal_job_status, jobs.get_infernal_job_status and the like
+        ('infernal_job_job_id_idx', 'infernal_job (job_id)'),
+        # infernal_job.claim_infernal_jobs
+        ('infernal_job_pending_idx',
+         "infernal_job (priority, submitted) WHERE status = '%s'" % JOB_CHUNK_STATUS_CHOICES.pending),
+        # infernal_job.release_stale_infernal_jobs
+        ('infernal_job_dispatching_idx',
+         "infernal_job (dispatched) WHERE status = '%s'" % JOB_CHUNK_STATUS_CHOICES.dispatching),
+    ]
+
+    for name, definition in indexes:
+        await create_index_concurrently(connection, name, definition)
+
+
+async def add_search_statistics(connection):
+    """
+    Atomic search counters and hourly rollups of the searches
+
+    The statistic table was created by hand in production, with duplicate rows of a period and source left
+    by concurrent searches. These are merged before the unique index, that the counter upserts on.
+    The rollups are filled in from the jobs, set_job_status and save_job keep them up to date.
+    """
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS statistic (
+          id serial PRIMARY KEY,
+          period VARCHAR(7),
+          source VARCHAR(50),
+          total INTEGER NOT NULL)
+    ''')
+    await connection.execute('''
+        UPDATE statistic SET total = merged.total
+        FROM (SELECT min(id) AS id, sum(total) AS total FROM statistic GROUP BY period, source HAVING count(*) > 1)
+          AS merged
+        WHERE statistic.id = merged.id
+    ''')
+    await connection.execute('''
+        DELETE FROM statistic WHERE id NOT IN (SELECT min(id) FROM statistic GROUP BY period, source)
+    ''')
+    await connection.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS statistic_period_source_idx ON statistic (period, source)
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS search_rollup (
+          hour TIMESTAMP NOT NULL,
+          priority VARCHAR(255) NOT NULL,
+          searches INTEGER NOT NULL DEFAULT 0,
+          finished INTEGER NOT NULL DEFAULT 0,
+          runtime DOUBLE PRECISION NOT NULL DEFAULT 0,
+          PRIMARY KEY (hour, priority))
+    ''')
+    await connection.execute('''
+        INSERT INTO search_rollup (hour, priority, searches, finished, runtime)
+        SELECT date_trunc('hour', submitted), coalesce(priority, 'low'), count(*), count(finished),
+          coalesce(sum(extract(epoch FROM finished - submitted)), 0)
+        FROM jobs
+        WHERE submitted IS NOT NULL AND description IS DISTINCT FROM 'sequence-search-test'
+        GROUP BY 1, 2
+        ON CONFLICT (hour, priority) DO NOTHING
+    ''')
+
+
+async def add_batch_index(connection):
+    """Index on the pending job_chunks of a database, that are dispatched in a batch"""
+    # job_chunks.claim_job_chunks_of_database
+    await create_index_concurrently(
+        connection, 'job_chunks_pending_database_idx',
+        "job_chunks (database) WHERE status = '%s'" % JOB_CHUNK_STATUS_CHOICES.pending
+    )
+
+
+async def add_pipeline_stats(connection):
+    """
+    Internal pipeline statistics of nhmmer per job chunk
+
+    Numbers of target sequences and residues searched, residues that passed each filter and the run time
+    of the search, for capacity planning, e.g. residues searched per second of each database.
+    """
+    await connection.execute('''
+        ALTER TABLE job_chunks
+          ADD COLUMN IF NOT EXISTS target_sequences INTEGER,
+          ADD COLUMN IF NOT EXISTS residues_searched BIGINT,
+          ADD COLUMN IF NOT EXISTS residues_passed_ssv BIGINT,
+          ADD COLUMN IF NOT EXISTS residues_passed_bias BIGINT,
+          ADD COLUMN IF NOT EXISTS residues_passed_vit BIGINT,
+          ADD COLUMN IF NOT EXISTS residues_passed_fwd BIGINT,
+          ADD COLUMN IF NOT EXISTS search_seconds DOUBLE PRECISION
+    ''')
+
+
+
+async def add_slot_infernal_job(connection):
+    """
+    Infernal job, that runs in a consumer slot
+
+    Slots of infernal jobs only had 'infernal-job' in job_chunk_id, so the scheduler couldn't tell, if they were
+    still running. These keep their slot until the consumer frees it.
+    """
+    await connection.execute('ALTER TABLE consumer_slot ADD COLUMN IF NOT EXISTS infernal_job_id INTEGER')
+
+"""List of (version, migration, transactional), a migration is a coroutine that takes a connection"""
+MIGRATIONS = [
+    (1, create_tables, True),
+    (2, add_dispatch_notifications, True),
+    (3, add_dispatched, True),
+    (4, add_consumer_slots, True),
+    (5, add_search_key, True),
+    (6, add_taxid, True),
+    (7, add_alignments, True),
+    (8, add_results_archive, True),
+    (9, partition_by_week, True),
+    (10, add_indexes, False),  # CREATE INDEX CONCURRENTLY
+    (11, add_search_statistics, True),
+    (12, add_batch_index, False),  # CREATE INDEX CONCURRENTLY
+    (13, add_pipeline_stats, True),
+    (14, add_slot_infernal_job, True),
+]
+
+
+def describe(migration):
+    return migration.__doc__.strip().split('\n')[0]
+
+
+async def get_applied_migrations(connection):
+    """
+    :param connection: sqlalchemy connection acquired from the engine
+    :return: set of applied versions
+    """
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+          version INTEGER PRIMARY KEY,
+          description TEXT,
+          applied TIMESTAMP NOT NULL)
+    ''')
+
+    applied = set()
+    async for row in await connection.execute('SELECT version FROM schema_migrations'):
+        applied.add(row.version)
+
+    # databases created before the migrations were versioned already have the initial schema
+    if not applied and await connection.scalar("SELECT to_regclass('jobs') IS NOT NULL"):
+        await record_migration(connection, 1, describe(create_tables) + ' (baseline)')
+        applied.add(1)
+
+    return applied
+
+
+async def record_migration(connection, version, description):
+    await connection.execute(
+        sa.text('INSERT INTO schema_migrations(version, description, applied) VALUES (:version, :description, :applied)'),
+        version=version,
+        description=description,
+        applied=datetime.datetime.now()
+    )
+
+
+async def apply_migrations(engine):
+    """
+    Applies the migrations that were not applied to the database yet.
+
+    :param engine: params to connect to the db
+    :return: list of applied versions
+    """
+    try:
+        async with engine.acquire() as connection:
+            try:
+                await connection.execute('SELECT pg_advisory_lock(%s)', MIGRATIONS_LOCK)
+                try:
+                    applied = await get_applied_migrations(connection)
+
+                    versions = []
+                    for version, migration, transactional in MIGRATIONS:
+                        if version in applied:
+                            continue
+
+                        logging.info("Applying migration %s: %s" % (version, describe(migration)))
+                        if transactional:
+                            async with connection.begin():
+                                await migration(connection)
+                                await record_migration(connection, version, describe(migration))
+                        else:
+                            # has to be safe to run again, if it fails half way through
+                            await migration(connection)
+                            await record_migration(connection, version, describe(migration))
+
+                        versions.append(version)
+                finally:
+                    await connection.execute('SELECT pg_advisory_unlock(%s)', MIGRATIONS_LOCK)
+
+                return versions
+            except Exception as e:
+                raise SQLError("Failed to apply_migrations") from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in apply_migrations") from e
+
+
+async def migrate(ENVIRONMENT, drop=False):
+    """
+    Applies the new migrations to the database of the given environment.
+
+    :param ENVIRONMENT: LOCAL, TEST, DOCKER-COMPOSE or PRODUCTION
+    :param drop: drop all tables (and data) first and create the schema from scratch
+    """
+    settings = get_postgres_credentials(ENVIRONMENT)
+
+    engine = await create_engine(
+        user=settings.POSTGRES_USER,
+        database=settings.POSTGRES_DATABASE,
+        host=settings.POSTGRES_HOST,
+        password=settings.POSTGRES_PASSWORD
+    )
+
+    async with engine:
+        if drop:
+            async with engine.acquire() as connection:
+                await drop_tables(connection)
+
+        return await apply_migrations(engine)
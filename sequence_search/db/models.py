@@ -13,9 +13,8 @@ limitations under the License.
 
 import logging
 import sqlalchemy as sa
-from aiopg.sa import create_engine
 
-from .settings import get_postgres_credentials
+from .pool import create_pool
 
 
 # Connection initialization code
@@ -28,12 +27,7 @@ async def init_pg(app):
     logger.debug("POSTGRES_HOST = %s" % app['settings'].POSTGRES_HOST)
     logger.debug("POSTGRES_PASSWORD = %s" % app['settings'].POSTGRES_PASSWORD)
 
-    app['engine'] = await create_engine(
-        user=app['settings'].POSTGRES_USER,
-        database=app['settings'].POSTGRES_DATABASE,
-        host=app['settings'].POSTGRES_HOST,
-        password=app['settings'].POSTGRES_PASSWORD
-    )
+    app['engine'] = await create_pool(app['settings'])
 
 
 # Graceful shutdown
@@ -58,6 +52,7 @@ class JOB_STATUS_CHOICES(object):
 class JOB_CHUNK_STATUS_CHOICES(object):
     created = 'created'
     pending = 'pending'
+    dispatching = 'dispatching'  # claimed by a producer, that is sending it to a consumer
     started = 'started'
     error = 'error'
     timeout = 'timeout'
@@ -69,6 +64,10 @@ class CONSUMER_STATUS_CHOICES(object):
     busy = 'busy'
 
 
+"""Channel used to notify the producer scheduler that a job_chunk is pending or a consumer is available"""
+DISPATCH_CHANNEL = 'dispatch'
+
+
 metadata = sa.MetaData()
 
 # TODO: consistent naming for tables: either 'jobs' and 'consumers' or 'job' and 'consumer'
@@ -77,7 +76,15 @@ Consumer = sa.Table('consumer', metadata,
                     sa.Column('ip', sa.String(20), primary_key=True),
                     sa.Column('status', sa.String(255)),  # choices=CONSUMER_STATUS_CHOICES, default='available'
                     sa.Column('job_chunk_id', sa.ForeignKey('job_chunks.id')),
-                    sa.Column('port', sa.String(10)))
+                    sa.Column('port', sa.String(10)),
+                    sa.Column('slots', sa.Integer))  # number of job_chunks/infernal_jobs it can run concurrently
+
+"""Occupied slot of a consumer, there's a row for every job_chunk or infernal_job the consumer is running"""
+ConsumerSlot = sa.Table('consumer_slot', metadata,
+                        sa.Column('consumer', sa.ForeignKey('consumer.ip'), primary_key=True),
+                        sa.Column('slot', sa.Integer, primary_key=True),
+                        sa.Column('job_chunk_id', sa.String(15)),  # job_chunk id or 'infernal-job'
+                        sa.Column('infernal_job_id', sa.Integer, nullable=True))  # id of the infernal_job
 
 """A search job that is divided into multiple job chunks per database"""
 Job = sa.Table('jobs', metadata,
@@ -92,7 +99,8 @@ Job = sa.Table('jobs', metadata,
                sa.Column('r2dt_id', sa.String(255)),
                sa.Column('r2dt_date', sa.DateTime),
                sa.Column('priority', sa.String(255)),
-               sa.Column('url', sa.String(255)))
+               sa.Column('url', sa.String(255)),
+               sa.Column('search_key', sa.String(64), nullable=True))  # see jobs.search_key()
 
 """Part of the search job, run against a specific database and assigned to a specific consumer"""
 JobChunk = sa.Table('job_chunks', metadata,
@@ -101,9 +109,18 @@ JobChunk = sa.Table('job_chunks', metadata,
                     sa.Column('database', sa.String(255)),
                     sa.Column('submitted', sa.DateTime, nullable=True),
                     sa.Column('finished', sa.DateTime, nullable=True),
+                    sa.Column('dispatched', sa.DateTime, nullable=True),
                     sa.Column('consumer', sa.ForeignKey('consumer.ip'), nullable=True),
                     sa.Column('hits', sa.Integer, nullable=True),
-                    sa.Column('status', sa.String(255)))  # choices=JOB_CHUNK_STATUS_CHOICES, default='started'
+                    sa.Column('status', sa.String(255)),  # choices=JOB_CHUNK_STATUS_CHOICES, default='started'
+                    # internal pipeline statistics of nhmmer, see migrations.add_pipeline_stats
+                    sa.Column('target_sequences', sa.Integer, nullable=True),
+                    sa.Column('residues_searched', sa.BigInteger, nullable=True),
+                    sa.Column('residues_passed_ssv', sa.BigInteger, nullable=True),
+                    sa.Column('residues_passed_bias', sa.BigInteger, nullable=True),
+                    sa.Column('residues_passed_vit', sa.BigInteger, nullable=True),
+                    sa.Column('residues_passed_fwd', sa.BigInteger, nullable=True),
+                    sa.Column('search_seconds', sa.Float, nullable=True))
 
 """Result of a specific JobChunk"""
 JobChunkResult = sa.Table('job_chunk_results', metadata,
@@ -115,7 +132,6 @@ JobChunkResult = sa.Table('job_chunk_results', metadata,
                           sa.Column('bias', sa.Float),
                           sa.Column('e_value', sa.Float),
                           sa.Column('target_length', sa.Integer),
-                          sa.Column('alignment', sa.Text),
                           sa.Column('alignment_length', sa.Integer),
                           sa.Column('gap_count', sa.Integer),
                           sa.Column('match_count', sa.Integer),
@@ -128,8 +144,25 @@ JobChunkResult = sa.Table('job_chunk_results', metadata,
                           sa.Column('query_length', sa.Integer),
                           sa.Column('alignment_start', sa.Integer),
                           sa.Column('alignment_stop', sa.Integer),
-                          sa.Column('alignment_sequence', sa.Text),
-                          sa.Column('result_id', sa.Integer))
+                          sa.Column('result_id', sa.Integer),
+                          sa.Column('taxid', sa.Integer),  # computed by postgres from rnacentral_id
+                          sa.Column('week', sa.Date))  # partition key, see retention.py
+
+"""Alignment of a JobChunkResult, kept apart so that listing the results doesn't read the alignment blobs"""
+JobChunkResultAlignment = sa.Table('job_chunk_result_alignments', metadata,
+                                   sa.Column('job_chunk_result_id', None, sa.ForeignKey('job_chunk_results.id'),
+                                             primary_key=True),
+                                   sa.Column('week', sa.Date),  # same as the week of the JobChunkResult
+                                   sa.Column('alignment', sa.Text),
+                                   sa.Column('alignment_sequence', sa.Text))
+
+"""Results of a finished job, packed by archive_job_results, that replace its JobChunkResults"""
+JobResultsArchive = sa.Table('job_results_archive', metadata,
+                             sa.Column('job_id', sa.String(36), sa.ForeignKey('jobs.id'), primary_key=True),
+                             sa.Column('week', sa.Date),  # week of the job submission
+                             sa.Column('archived', sa.DateTime),
+                             sa.Column('results', sa.LargeBinary),  # see job_results_archive.py
+                             sa.Column('alignments', sa.LargeBinary))
 
 InfernalJob = sa.Table('infernal_job', metadata,
                        sa.Column('id', sa.Integer, primary_key=True),
@@ -137,6 +170,7 @@ InfernalJob = sa.Table('infernal_job', metadata,
                        sa.Column('consumer', sa.ForeignKey('consumer.ip'), nullable=True),
                        sa.Column('submitted', sa.DateTime, nullable=True),
                        sa.Column('finished', sa.DateTime, nullable=True),
+                       sa.Column('dispatched', sa.DateTime, nullable=True),
                        sa.Column('priority', sa.String(255)),
                        sa.Column('status', sa.String(255)))  # choices=JOB_CHUNK_STATUS_CHOICES
 
@@ -161,7 +195,8 @@ InfernalResult = sa.Table('infernal_result', metadata,
                           sa.Column('e_value', sa.Float),
                           sa.Column('inc', sa.String(255)),
                           sa.Column('description', sa.String(255)),
-                          sa.Column('alignment', sa.Text))
+                          sa.Column('alignment', sa.Text),
+                          sa.Column('week', sa.Date))
 
 """Number of searches performed"""
 Statistic = sa.Table('statistic', metadata,
@@ -170,137 +205,147 @@ Statistic = sa.Table('statistic', metadata,
                      sa.Column('source', sa.String(50)),
                      sa.Column('total', sa.Integer))
 
+"""Searches submitted per hour and priority, with the run time of the finished ones, see statistic.py"""
+SearchRollup = sa.Table('search_rollup', metadata,
+                        sa.Column('hour', sa.DateTime, primary_key=True),
+                        sa.Column('priority', sa.String(255), primary_key=True),
+                        sa.Column('searches', sa.Integer),
+                        sa.Column('finished', sa.Integer),
+                        sa.Column('runtime', sa.Float))  # seconds, sum over the finished searches
+
 # Migrations
 # ----------
 
 
-async def migrate(ENVIRONMENT):
-    settings = get_postgres_credentials(ENVIRONMENT)
-
-    engine = await create_engine(
-        user=settings.POSTGRES_USER,
-        database=settings.POSTGRES_DATABASE,
-        host=settings.POSTGRES_HOST,
-        password=settings.POSTGRES_PASSWORD
-    )
-
-    async with engine:
-        async with engine.acquire() as connection:
-            await connection.execute('DROP TABLE IF EXISTS job_chunk_results')
-            await connection.execute('DROP TABLE IF EXISTS job_chunks')
-            await connection.execute('DROP TABLE IF EXISTS infernal_result')
-            await connection.execute('DROP TABLE IF EXISTS infernal_job')
-            await connection.execute('DROP TABLE IF EXISTS jobs')
-            await connection.execute('DROP TABLE IF EXISTS consumer')
-            # await connection.execute('DROP TABLE IF EXISTS statistic')
-
-            await connection.execute('''
-                CREATE TABLE consumer (
-                  ip VARCHAR(20) PRIMARY KEY,
-                  status VARCHAR(255) NOT NULL,
-                  job_chunk_id VARCHAR(15),
-                  port VARCHAR(10))
-            ''')
-
-            await connection.execute('''
-                CREATE TABLE jobs (
-                  id VARCHAR(36) PRIMARY KEY,
-                  query TEXT,
-                  description TEXT,
-                  ordering TEXT,
-                  submitted TIMESTAMP,
-                  finished TIMESTAMP,
-                  hits INTEGER,
-                  status VARCHAR(255),
-                  r2dt_id VARCHAR(255),
-                  r2dt_date TIMESTAMP,
-                  priority VARCHAR(255),
-                  url VARCHAR(255))
-            ''')
-
-            await connection.execute('''
-                CREATE TABLE job_chunks (
-                  id serial PRIMARY KEY,
-                  job_id VARCHAR(36) references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                  database VARCHAR(255),
-                  submitted TIMESTAMP,
-                  finished TIMESTAMP,
-                  consumer VARCHAR(20) references consumer(ip) ON UPDATE CASCADE ON DELETE SET NULL,
-                  hits INTEGER,
-                  status VARCHAR(255))
-            ''')
-
-            await connection.execute('''
-                CREATE TABLE job_chunk_results (
-                  id serial PRIMARY KEY,
-                  job_chunk_id INT references job_chunks(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                  rnacentral_id VARCHAR(255) NOT NULL,
-                  description TEXT,
-                  score FLOAT NOT NULL,
-                  bias FLOAT NOT NULL,
-                  e_value FLOAT NOT NULL,
-                  target_length INTEGER NOT NULL,
-                  alignment TEXT NOT NULL,
-                  alignment_length INTEGER NOT NULL,
-                  gap_count INTEGER NOT NULL,
-                  match_count INTEGER NOT NULL,
-                  nts_count1 INTEGER NOT NULL,
-                  nts_count2 INTEGER NOT NULL,
-                  identity FLOAT NOT NULL,
-                  query_coverage FLOAT NOT NULL,
-                  target_coverage FLOAT NOT NULL,
-                  gaps FLOAT NOT NULL,
-                  query_length INTEGER NOT NULL,
-                  alignment_start INTEGER NOT NULL,
-                  alignment_stop INTEGER NOT NULL,
-                  alignment_sequence TEXT NOT NULL,
-                  result_id INTEGER NOT NULL)
-            ''')
-
-            await connection.execute('''
-                CREATE TABLE infernal_job (
-                  id serial PRIMARY KEY,
-                  job_id VARCHAR(36) references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                  consumer VARCHAR(20) references consumer(ip) ON UPDATE CASCADE ON DELETE SET NULL,
-                  submitted TIMESTAMP,
-                  finished TIMESTAMP,
-                  priority VARCHAR(255),
-                  status VARCHAR(255))
-            ''')
-
-            await connection.execute('''
-                CREATE TABLE infernal_result (
-                  id serial PRIMARY KEY,
-                  infernal_job_id INT references infernal_job(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                  target_name VARCHAR(255),
-                  accession_rfam VARCHAR(255),
-                  query_name VARCHAR(255),
-                  accession_seq VARCHAR(255),
-                  mdl VARCHAR(255),
-                  mdl_from INTEGER NOT NULL,
-                  mdl_to INTEGER NOT NULL,
-                  seq_from INTEGER NOT NULL,
-                  seq_to INTEGER NOT NULL,
-                  strand VARCHAR(255),
-                  trunc VARCHAR(255),
-                  pipeline_pass INTEGER NOT NULL,
-                  gc FLOAT NOT NULL,
-                  bias FLOAT NOT NULL,
-                  score FLOAT NOT NULL,
-                  e_value FLOAT NOT NULL,
-                  inc VARCHAR(255),
-                  description VARCHAR(255),
-                  alignment TEXT)
-            ''')
-
-            # await connection.execute('''
-            #     CREATE TABLE statistic (
-            #       id serial PRIMARY KEY,
-            #       period VARCHAR(7),
-            #       source VARCHAR(50),
-            #       total INTEGER NOT NULL)
-            # ''')
-
-            await connection.execute('''CREATE INDEX on job_chunks (job_id)''')
-            await connection.execute('''CREATE INDEX on job_chunk_results (job_chunk_id)''')
-            await connection.execute('''CREATE INDEX on infernal_result (infernal_job_id)''')
+async def drop_tables(connection):
+    await connection.execute('DROP TABLE IF EXISTS schema_migrations')
+    await connection.execute('DROP TABLE IF EXISTS job_chunk_result_alignments')
+    await connection.execute('DROP TABLE IF EXISTS job_chunk_results')
+    await connection.execute('DROP TABLE IF EXISTS job_chunks')
+    await connection.execute('DROP TABLE IF EXISTS job_results_archive')
+    await connection.execute('DROP TABLE IF EXISTS infernal_result')
+    await connection.execute('DROP TABLE IF EXISTS infernal_job')
+    await connection.execute('DROP TABLE IF EXISTS jobs')
+    await connection.execute('DROP TABLE IF EXISTS consumer_slot')
+    await connection.execute('DROP TABLE IF EXISTS consumer')
+    await connection.execute('DROP TABLE IF EXISTS search_rollup')
+    # await connection.execute('DROP TABLE IF EXISTS statistic')
+
+
+async def create_tables(connection):
+    """
+    Initial schema
+
+    This is the schema of the databases, that were created before the migrations were versioned, and the first
+    of the migrations in migrations.py. It is never changed, later changes go there as new migrations.
+    """
+    await connection.execute('''
+        CREATE TABLE consumer (
+          ip VARCHAR(20) PRIMARY KEY,
+          status VARCHAR(255) NOT NULL,
+          job_chunk_id VARCHAR(15),
+          port VARCHAR(10))
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE jobs (
+          id VARCHAR(36) PRIMARY KEY,
+          query TEXT,
+          description TEXT,
+          ordering TEXT,
+          submitted TIMESTAMP,
+          finished TIMESTAMP,
+          hits INTEGER,
+          status VARCHAR(255),
+          r2dt_id VARCHAR(255),
+          r2dt_date TIMESTAMP,
+          priority VARCHAR(255),
+          url VARCHAR(255))
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE job_chunks (
+          id serial PRIMARY KEY,
+          job_id VARCHAR(36) references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          database VARCHAR(255),
+          submitted TIMESTAMP,
+          finished TIMESTAMP,
+          consumer VARCHAR(20) references consumer(ip) ON UPDATE CASCADE ON DELETE SET NULL,
+          hits INTEGER,
+          status VARCHAR(255))
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE job_chunk_results (
+          id serial PRIMARY KEY,
+          job_chunk_id INT references job_chunks(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          rnacentral_id VARCHAR(255) NOT NULL,
+          description TEXT,
+          score FLOAT NOT NULL,
+          bias FLOAT NOT NULL,
+          e_value FLOAT NOT NULL,
+          target_length INTEGER NOT NULL,
+          alignment TEXT NOT NULL,
+          alignment_length INTEGER NOT NULL,
+          gap_count INTEGER NOT NULL,
+          match_count INTEGER NOT NULL,
+          nts_count1 INTEGER NOT NULL,
+          nts_count2 INTEGER NOT NULL,
+          identity FLOAT NOT NULL,
+          query_coverage FLOAT NOT NULL,
+          target_coverage FLOAT NOT NULL,
+          gaps FLOAT NOT NULL,
+          query_length INTEGER NOT NULL,
+          alignment_start INTEGER NOT NULL,
+          alignment_stop INTEGER NOT NULL,
+          alignment_sequence TEXT NOT NULL,
+          result_id INTEGER NOT NULL)
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE infernal_job (
+          id serial PRIMARY KEY,
+          job_id VARCHAR(36) references jobs(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          consumer VARCHAR(20) references consumer(ip) ON UPDATE CASCADE ON DELETE SET NULL,
+          submitted TIMESTAMP,
+          finished TIMESTAMP,
+          priority VARCHAR(255),
+          status VARCHAR(255))
+    ''')
+
+    await connection.execute('''
+        CREATE TABLE infernal_result (
+          id serial PRIMARY KEY,
+          infernal_job_id INT references infernal_job(id) ON UPDATE CASCADE ON DELETE CASCADE,
+          target_name VARCHAR(255),
+          accession_rfam VARCHAR(255),
+          query_name VARCHAR(255),
+          accession_seq VARCHAR(255),
+          mdl VARCHAR(255),
+          mdl_from INTEGER NOT NULL,
+          mdl_to INTEGER NOT NULL,
+          seq_from INTEGER NOT NULL,
+          seq_to INTEGER NOT NULL,
+          strand VARCHAR(255),
+          trunc VARCHAR(255),
+          pipeline_pass INTEGER NOT NULL,
+          gc FLOAT NOT NULL,
+          bias FLOAT NOT NULL,
+          score FLOAT NOT NULL,
+          e_value FLOAT NOT NULL,
+          inc VARCHAR(255),
+          description VARCHAR(255),
+          alignment TEXT)
+    ''')
+
+    # await connection.execute('''
+    #     CREATE TABLE statistic (
+    #       id serial PRIMARY KEY,
+    #       period VARCHAR(7),
+    #       source VARCHAR(50),
+    #       total INTEGER NOT NULL)
+    # ''')
+
+    await connection.execute('''CREATE INDEX on job_chunks (job_id)''')
+    await connection.execute('''CREATE INDEX on job_chunk_results (job_chunk_id)''')
+    await connection.execute('''CREATE INDEX on infernal_result (infernal_job_id)''')
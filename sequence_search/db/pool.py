@@ -0,0 +1,182 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from aiopg import DEFAULT_TIMEOUT
+from aiopg.sa import create_engine
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+from . import PoolTimeoutError
+
+
+"""
+Pool of connections to postgres, shared by the request handlers, the scheduler and the background jobs.
+
+aiopg waits for a free connection as long as it takes and doesn't tell anyone about it, so under load the requests
+queue up on engine.acquire() unnoticed. InstrumentedEngine puts a timeout on the wait and keeps the metrics of
+the pool: connections in use, requests waiting, a histogram of the wait times and the number of timeouts.
+"""
+
+# upper bounds of the buckets of the wait time histogram (in seconds)
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+
+def abandon(acquiring):
+    """Stops waiting for a connection, the connection is returned to the pool, in case it was acquired after all"""
+    def release(task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(task.result().close())
+
+    acquiring.cancel()
+    acquiring.add_done_callback(release)
+
+
+class InstrumentedEngine(object):
+    """
+    Engine that times out and measures the checkouts of connections from its pool.
+
+    Everything else (close, wait_closed, size, freesize...) is the aiopg engine it wraps.
+    """
+    def __init__(self, engine, acquire_timeout=0):
+        """
+        :param engine: aiopg.sa engine
+        :param acquire_timeout: seconds to wait for a free connection (0 - wait forever)
+        """
+        self.engine = engine
+        self.acquire_timeout = acquire_timeout or None
+        self.metrics = {
+            'checkouts': 0,
+            'in_use': 0,
+            'waiting': 0,
+            'acquire_timeouts': 0,
+            'wait_count': 0,
+            'wait_sum': 0.0,
+            'wait_max': 0.0,
+            'wait_buckets': {str(bucket): 0 for bucket in WAIT_BUCKETS},  # cumulative, like in prometheus
+        }
+
+    def acquire(self):
+        """Get a connection from pool, raises PoolTimeoutError if none gets free within acquire_timeout"""
+        return self._acquire()
+
+    @asynccontextmanager
+    async def _acquire(self):
+        self.metrics['waiting'] += 1
+        start = time.perf_counter()
+        # not asyncio.wait_for: if the caller is cancelled just as the pool hands out a connection,
+        # wait_for drops the connection and the pool never gets it back
+        acquiring = asyncio.ensure_future(self.engine.acquire())
+        try:
+            await asyncio.wait([acquiring], timeout=self.acquire_timeout)
+        except asyncio.CancelledError:
+            abandon(acquiring)
+            raise
+        finally:
+            self.metrics['waiting'] -= 1
+
+        if not acquiring.done():
+            abandon(acquiring)
+            self.metrics['acquire_timeouts'] += 1
+            raise PoolTimeoutError(
+                "No connection to the database got free in %s seconds, %s of %s are in use" %
+                (self.acquire_timeout, self.metrics['in_use'], self.engine.maxsize)
+            )
+        connection = acquiring.result()
+
+        self.observe_wait(time.perf_counter() - start)
+        self.metrics['checkouts'] += 1
+        self.metrics['in_use'] += 1
+        try:
+            yield connection
+        finally:
+            self.metrics['in_use'] -= 1
+            await connection.close()  # returns the connection to the pool
+
+    def observe_wait(self, wait):
+        self.metrics['wait_count'] += 1
+        self.metrics['wait_sum'] += wait
+        self.metrics['wait_max'] = max(self.metrics['wait_max'], wait)
+        for bucket in WAIT_BUCKETS:
+            if wait <= bucket:
+                self.metrics['wait_buckets'][str(bucket)] += 1
+
+    def get_metrics(self):
+        """Metrics of the checkouts along with the size of the pool"""
+        return dict(
+            self.metrics,
+            wait_buckets=dict(self.metrics['wait_buckets']),
+            size=self.engine.size,
+            freesize=self.engine.freesize,
+            minsize=self.engine.minsize,
+            maxsize=self.engine.maxsize
+        )
+
+    def collect(self):
+        """Metrics of the pool in prometheus format, the engine is registered as a collector, see /metrics"""
+        metrics = self.get_metrics()
+
+        connections = GaugeMetricFamily(
+            'sequence_search_db_pool_connections', 'Connections of the postgres pool', labels=['state']
+        )
+        connections.add_metric(['in_use'], metrics['in_use'])
+        connections.add_metric(['free'], metrics['freesize'])
+        connections.add_metric(['max'], metrics['maxsize'])
+        yield connections
+
+        yield GaugeMetricFamily(
+            'sequence_search_db_pool_waiting', 'Requests waiting for a connection', value=metrics['waiting']
+        )
+        yield CounterMetricFamily(
+            'sequence_search_db_pool_checkouts', 'Connections checked out of the pool', value=metrics['checkouts']
+        )
+        yield CounterMetricFamily(
+            'sequence_search_db_pool_acquire_timeouts', 'Requests that got no connection within the acquire timeout',
+            value=metrics['acquire_timeouts']
+        )
+        yield HistogramMetricFamily(
+            'sequence_search_db_pool_wait_seconds', 'Time requests waited for a connection',
+            buckets=[('+Inf' if bucket == float('inf') else str(bucket), metrics['wait_buckets'][str(bucket)])
+                     for bucket in WAIT_BUCKETS],
+            sum_value=metrics['wait_sum']
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+async def create_pool(settings):
+    """
+    Creates the engine with the pool configured by the POSTGRES_* settings.
+
+    Settings, that are missing, default to the aiopg defaults: 1 to 10 connections, no acquire timeout
+    and 60 seconds statement timeout.
+
+    :param settings: settings module of the producer or the consumer, with the postgres credentials
+    :return: InstrumentedEngine
+    """
+    engine = await create_engine(
+        user=settings.POSTGRES_USER,
+        database=settings.POSTGRES_DATABASE,
+        host=settings.POSTGRES_HOST,
+        password=settings.POSTGRES_PASSWORD,
+        minsize=getattr(settings, 'POSTGRES_POOL_MINSIZE', 1),
+        maxsize=getattr(settings, 'POSTGRES_POOL_MAXSIZE', 10),
+        # aiopg times out each statement on its own, the statement_timeout of postgres would show up
+        # as asyncio.CancelledError in aiopg and slip through the error handling of the db helpers
+        timeout=getattr(settings, 'POSTGRES_STATEMENT_TIMEOUT', DEFAULT_TIMEOUT)
+    )
+
+    return InstrumentedEngine(engine, acquire_timeout=getattr(settings, 'POSTGRES_POOL_ACQUIRE_TIMEOUT', 0))
@@ -0,0 +1,211 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import logging
+
+import sqlalchemy as sa
+import psycopg2
+
+from . import DatabaseConnectionError, SQLError
+
+
+"""
+Retention of old searches.
+
+The tables that hold the bulk of the data are partitioned by week (the `week` column is the monday of
+the week, when the row was created). Instead of deleting old rows one by one, whole partitions are
+detached and dropped, then the remaining old jobs are deleted with a single statement (jobs is not partitioned,
+see migrations.partition_by_week).
+
+Tables are listed in the order in which their partitions can be dropped: referencing tables first.
+"""
+PARTITIONED_TABLES = ['job_chunk_result_alignments', 'job_chunk_results', 'infernal_result', 'job_results_archive']
+
+# searches are kept for this number of days
+RETENTION_DAYS = 7
+
+# partitions are created in advance for this number of weeks, rows outside of them go to the default partitions
+WEEKS_AHEAD = 4
+
+# only one producer at a time applies the retention
+RETENTION_LOCK = 4242
+
+
+def week_start(date):
+    """Monday of the week of the date, same as date_trunc('week', ...) in postgres"""
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def partition_name(table, week):
+    return '%s_%s' % (table, week.strftime('%Y%m%d'))
+
+
+async def create_partitions(connection, week, weeks=WEEKS_AHEAD):
+    """
+    Creates the default partition of each partitioned table and weekly partitions, starting from the given week.
+
+    A weekly partition can't be created, if the default partition already has rows of that week; these rows stay
+    in the default partition and are deleted together with their jobs.
+
+    :param connection: sqlalchemy connection acquired from the engine
+    :param week: monday of the first week
+    :param weeks: number of weeks
+    :return: list of names of the created partitions
+    """
+    created = []
+    for table in PARTITIONED_TABLES:
+        await connection.execute('CREATE TABLE IF NOT EXISTS %s_default PARTITION OF %s DEFAULT' % (table, table))
+
+    for index in range(weeks):
+        start = week + datetime.timedelta(weeks=index)
+        end = start + datetime.timedelta(weeks=1)
+        for table in reversed(PARTITIONED_TABLES):
+            name = partition_name(table, start)
+            exists = await connection.scalar("SELECT to_regclass(%s) IS NOT NULL", name)
+            if exists:
+                continue
+
+            try:
+                await connection.execute(
+                    "CREATE TABLE %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (name, table, start, end)
+                )
+                created.append(name)
+            except psycopg2.errors.CheckViolation as e:
+                logging.warning("Partition %s was not created: %s" % (name, str(e)))
+
+    return created
+
+
+async def list_partitions(connection):
+    """
+    :param connection: sqlalchemy connection acquired from the engine
+    :return: dict {week: [(table, partition), ...]} of the weekly partitions, default partitions are not listed
+    """
+    query = sa.text('''
+        SELECT parent.relname AS table, child.relname AS partition
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = ANY(:tables) AND parent.relnamespace = current_schema()::regnamespace
+    ''')
+
+    partitions = {}
+    async for row in await connection.execute(query, tables=PARTITIONED_TABLES):
+        suffix = row.partition[len(row.table) + 1:]
+        if suffix == 'default':
+            continue
+        week = datetime.datetime.strptime(suffix, '%Y%m%d').date()
+        partitions.setdefault(week, []).append((row.table, row.partition))
+
+    return partitions
+
+
+async def drop_partitions(connection, before):
+    """
+    Detaches and drops the weekly partitions that end on or before the given date.
+
+    :param connection: sqlalchemy connection acquired from the engine
+    :param before: date
+    :return: list of names of the dropped partitions
+    """
+    dropped = []
+    partitions = await list_partitions(connection)
+    for week in sorted(partitions):
+        if week + datetime.timedelta(weeks=1) > before:
+            continue
+
+        # partitions of referencing tables go first, so that foreign keys don't prevent detaching
+        async with connection.begin():
+            for table, partition in sorted(partitions[week], key=lambda item: PARTITIONED_TABLES.index(item[0])):
+                await connection.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, partition))
+                await connection.execute('DROP TABLE %s' % partition)
+                dropped.append(partition)
+
+    return dropped
+
+
+async def expire_jobs(engine, retention_days=RETENTION_DAYS, weeks_ahead=WEEKS_AHEAD, now=None):
+    """
+    Deletes searches submitted more than retention_days ago and creates partitions for the next weeks.
+
+    :param engine: params to connect to the db
+    :param retention_days: searches are kept for this number of days
+    :param weeks_ahead: number of weeks to create partitions for, starting from the current one
+    :param now: current time, used in tests
+    :return: dict with the names of the dropped and created partitions and the number of deleted jobs,
+    or None, if another producer is applying the retention at the moment
+    """
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=retention_days)
+
+    try:
+        async with engine.acquire() as connection:
+            try:
+                locked = await connection.scalar('SELECT pg_try_advisory_lock(%s)', RETENTION_LOCK)
+                if not locked:
+                    return None
+
+                try:
+                    dropped = await drop_partitions(connection, cutoff.date())
+
+                    # old jobs that are left (their rows in the default partitions are deleted by cascade)
+                    result = await connection.execute(
+                        sa.text('DELETE FROM jobs WHERE submitted < :cutoff'), cutoff=cutoff
+                    )
+                    deleted = result.rowcount
+
+                    created = await create_partitions(connection, week_start(now), weeks_ahead)
+                finally:
+                    await connection.execute('SELECT pg_advisory_unlock(%s)', RETENTION_LOCK)
+
+                return {'dropped': dropped, 'deleted': deleted, 'created': created}
+            except Exception as e:
+                raise SQLError("Failed to expire_jobs, cutoff = %s" % cutoff) from e
+    except psycopg2.Error as e:
+        raise DatabaseConnectionError("Failed to open connection to the database in expire_jobs, "
+                                      "cutoff = %s" % cutoff) from e
+
+
+if __name__ == "__main__":
+    """
+    Apply the retention once, e.g. from cron:
+
+    $ ENVIRONMENT=PRODUCTION python3 -m sequence_search.db.retention --days 7
+    """
+    import argparse
+    import asyncio
+    import os
+
+    from aiopg.sa import create_engine
+
+    from .settings import get_postgres_credentials
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='Keep searches for this number of days')
+    args = parser.parse_args()
+
+    async def main():
+        settings = get_postgres_credentials(os.getenv('ENVIRONMENT', 'LOCAL'))
+        engine = await create_engine(
+            user=settings.POSTGRES_USER,
+            database=settings.POSTGRES_DATABASE,
+            host=settings.POSTGRES_HOST,
+            password=settings.POSTGRES_PASSWORD
+        )
+        async with engine:
+            print(await expire_jobs(engine, retention_days=args.days))
+
+    asyncio.get_event_loop().run_until_complete(main())
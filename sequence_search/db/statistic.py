@@ -11,73 +11,90 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import datetime
+
 import sqlalchemy as sa
 import psycopg2
 
-from . import DatabaseConnectionError, SQLError
-from .models import Statistic
+from . import DatabaseConnectionError, SQLError, acquire
 
 
-async def get_statistic(engine, source, period):
+async def count_search(engine, source, period):
     """
-    Check if there is a record for the source/period passed as a parameter
+    Add a search to the number of searches performed from the source in the period.
+    A single upsert, so that no search is lost, when several are submitted at the same time.
     :param engine: params to connect to the db
     :param source: source of the search (db name or API)
     :param period: Year-month
-    :return: dict with id and total
+    :return: number of searches from the source in the period
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
-                sql_query = sa.select([Statistic.c.id, Statistic.c.total]).select_from(Statistic).where(
-                    (Statistic.c.source == source) & (Statistic.c.period == period)
-                )
-                async for row in await connection.execute(sql_query):
-                    return {"statistic_id": row.id, "statistic_total": row.total}
+                query = sa.text('''
+                    INSERT INTO statistic AS statistic (period, source, total) VALUES (:period, :source, 1)
+                    ON CONFLICT (period, source) DO UPDATE SET total = statistic.total + 1
+                    RETURNING total
+                ''')
+                return await connection.scalar(query, source=source, period=period)
             except Exception as e:
-                raise SQLError("Failed to check if record exists for source %s and period %s" % (source, period)) from e
+                raise SQLError("Failed to count search for source = %s and period = %s" % (source, period)) from e
     except psycopg2.Error as e:
-        raise DatabaseConnectionError("Failed to open connection to the database in get_statistic() for "
-                                      "source %s and period %s" % (source, period)) from e
+        raise DatabaseConnectionError("Failed to open connection to the database in count_search() for "
+                                      "source = %s and period = %s" % (source, period)) from e
 
 
-async def update_statistic(engine, identifier, total):
+async def count_submitted_search(engine, priority, submitted):
     """
-    Update the number of searches performed
+    Add a search to the hourly rollup of its priority, the run time is added by set_job_status, once it finishes.
     :param engine: params to connect to the db
-    :param identifier: id of the statistic to be updated
-    :param total: number of searches
+    :param priority: priority of the search
+    :param submitted: time of submission
     :return: None
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
-                query = sa.text('''UPDATE statistic SET total=:total WHERE id=:id''')
-                await connection.execute(query, id=identifier, total=total)
+                query = sa.text('''
+                    INSERT INTO search_rollup AS rollup (hour, priority, searches)
+                    VALUES (date_trunc('hour', CAST(:submitted AS TIMESTAMP)), :priority, 1)
+                    ON CONFLICT (hour, priority) DO UPDATE SET searches = rollup.searches + 1
+                ''')
+                await connection.execute(query, priority=priority, submitted=submitted)
             except Exception as e:
-                raise SQLError("Failed to update statistic for id = %s and total = %s" % (identifier, total)) from e
+                raise SQLError("Failed to count submitted search for priority = %s" % priority) from e
     except psycopg2.Error as e:
-        raise DatabaseConnectionError("Failed to open connection to the database in update_statistic() for "
-                                      "id = %s and total = %s" % (identifier, total)) from e
+        raise DatabaseConnectionError("Failed to open connection to the database in count_submitted_search() for "
+                                      "priority = %s" % priority) from e
 
 
-async def create_statistic(engine, source, period):
+async def get_searches_summary(engine, since, high_priority=False):
     """
-    Create search statistics
+    Number of searches submitted since the given time and their average run time, read from the hourly rollups,
+    so the hour of `since` is counted in full
     :param engine: params to connect to the db
-    :param source: source of the search (db name or API)
-    :param period: Year-month
-    :return: id
+    :param since: datetime
+    :param high_priority: only count the searches with a priority other than low
+    :return: dict with count and avg_time (timedelta, None if none of the searches finished)
     """
     try:
-        async with engine.acquire() as connection:
+        async with acquire(engine) as connection:
             try:
-                statistic_id = await connection.scalar(
-                    Statistic.insert().values(source=source, period=period, total=1)
-                )
-                return statistic_id
+                query = '''
+                    SELECT coalesce(sum(searches), 0) AS count, sum(runtime) / nullif(sum(finished), 0) AS avg_time
+                    FROM search_rollup
+                    WHERE hour >= date_trunc('hour', CAST(:since AS TIMESTAMP))
+                '''
+                if high_priority:
+                    query += " AND priority != 'low'"
+
+                async for row in await connection.execute(sa.text(query), since=since):
+                    return {
+                        'count': row.count,
+                        'avg_time': datetime.timedelta(seconds=row.avg_time) if row.avg_time is not None else None
+                    }
             except Exception as e:
-                raise SQLError("Failed to create statistic for source = %s and period = %s" % (source, period)) from e
+                raise SQLError("Failed to get searches summary since %s" % since) from e
     except psycopg2.Error as e:
-        raise DatabaseConnectionError("Failed to open connection to the database in create_statistic() for "
-                                      "source = %s and period = %s" % (source, period)) from e
+        raise DatabaseConnectionError("Failed to open connection to the database in get_searches_summary() "
+                                      "since %s" % since) from e
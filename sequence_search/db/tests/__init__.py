@@ -13,10 +13,16 @@ limitations under the License.
 
 from .test_base import DBTestCase
 from .test_consumers import FindAvailableConsumersTestCase, GetConsumerStatusTestCase, SetConsumerStatusTestCase, \
-    DelegateJobChunkToConsumerTestCase, RegisterConsumerInTheDatabaseTestCase
+    DelegateJobChunkToConsumerTestCase, RegisterConsumerInTheDatabaseTestCase, ConsumerSlotsTestCase
 from .test_job_chunk_results import SetJobChunkResultsTestCase
+from .test_job_results_archive import PackJobResultsTestCase, JobResultsArchiveTestCase
 from .test_job_chunks import GetConsumerIpFromJobChunkTestCase, GetJobChunkFromJobAndDatabase, SaveJobChunkTestCase, \
-    SetJobChunkStatusTestCase, FindHighestPriorityJobChunkTestCase
-from .test_jobs import GetJobTestCase, GetJobQueryTestCase
-from .test_infernal_jobs import InfernalTestCase
+    SetJobChunkStatusTestCase, FindHighestPriorityJobChunkTestCase, ClaimJobChunksTestCase
+from .test_jobs import GetJobTestCase, GetJobQueryTestCase, SearchCacheTestCase, GetJobResultsTestCase
+from .test_infernal_jobs import InfernalTestCase, ClaimInfernalJobsTestCase
 from .test_infernal_results import InfernalResultTestCase
+from .test_migrations import MigrationsTestCase
+from .test_pool import PoolTestCase
+from .test_query_plans import QueryPlansTestCase
+from .test_retention import RetentionTestCase
+from .test_statistic import StatisticTestCase
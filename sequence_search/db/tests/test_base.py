@@ -20,6 +20,20 @@ from sequence_search.db.models import init_pg
 from sequence_search.db.settings import get_postgres_credentials
 
 
+class CountingEngine(object):
+    """Engine that counts the connections checked out of its pool, e.g. to see how many a request takes"""
+    def __init__(self, engine):
+        self.engine = engine
+        self.checkouts = 0
+
+    def acquire(self):
+        self.checkouts += 1
+        return self.engine.acquire()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
 class DBTestCase(AioHTTPTestCase):
     """
     Base unit-test for all the tests in db. Run all tests with the following command:
@@ -11,6 +11,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
 import datetime
 import uuid
 
@@ -19,7 +20,9 @@ from aiohttp.test_utils import unittest_run_loop
 from sequence_search.db.models import Job, JobChunk, Consumer, CONSUMER_STATUS_CHOICES, JOB_STATUS_CHOICES, \
     JOB_CHUNK_STATUS_CHOICES
 from sequence_search.db.consumers import get_consumer_status, set_consumer_status, find_available_consumers, \
-    delegate_job_chunk_to_consumer, register_consumer_in_the_database, get_ip, set_consumer_fields
+    delegate_job_chunk_to_consumer, register_consumer_in_the_database, get_ip, set_consumer_fields, \
+    find_available_consumer_slots, find_busy_consumer_slots, occupy_consumer_slot, free_consumer_slot, \
+    set_idle_consumers_available
 from sequence_search.db.tests.test_base import DBTestCase
 
 
@@ -220,3 +223,83 @@ class SetConsumerFieldsTestCase(DBTestCase):
         async with self.app['engine'].acquire() as connection:
             consumer_fields = await get_consumer_status(self.app['engine'], self.consumer_ip)
             assert consumer_fields == CONSUMER_STATUS_CHOICES.busy
+
+
+class ConsumerSlotsTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_consumers.ConsumerSlotsTestCase
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Consumer.insert().values(ip='192.168.0.2', status=CONSUMER_STATUS_CHOICES.available, slots=3)
+            )
+            await connection.execute(
+                Consumer.insert().values(ip='192.168.0.3', status=CONSUMER_STATUS_CHOICES.available, slots=1)
+            )
+
+    @unittest_run_loop
+    async def test_occupy_and_free_consumer_slots(self):
+        engine = self.app['engine']
+
+        slots = await find_available_consumer_slots(engine)
+        assert [slot.ip for slot in slots] == ['192.168.0.2', '192.168.0.3', '192.168.0.2', '192.168.0.2']
+
+        assert await occupy_consumer_slot(engine, '192.168.0.2', '1') == 1
+        assert await occupy_consumer_slot(engine, '192.168.0.2', '2') == 2
+        assert await get_consumer_status(engine, '192.168.0.2') == CONSUMER_STATUS_CHOICES.available
+
+        assert await occupy_consumer_slot(engine, '192.168.0.2', 'infernal-job') == 3
+        assert await get_consumer_status(engine, '192.168.0.2') == CONSUMER_STATUS_CHOICES.busy
+        assert await occupy_consumer_slot(engine, '192.168.0.2', '4') is None
+
+        slots = await find_available_consumer_slots(engine)
+        assert [slot.ip for slot in slots] == ['192.168.0.3']
+
+        await free_consumer_slot(engine, '192.168.0.2', 2)
+        assert await get_consumer_status(engine, '192.168.0.2') == CONSUMER_STATUS_CHOICES.available
+
+        busy_slots = await find_busy_consumer_slots(engine)
+        assert [(slot.ip, slot.slot, slot.job_chunk_id) for slot in busy_slots] == [
+            ('192.168.0.2', 1, '1'), ('192.168.0.2', 3, 'infernal-job')
+        ]
+
+        # the freed slot is occupied again
+        assert await occupy_consumer_slot(engine, '192.168.0.2', '5') == 2
+
+    @unittest_run_loop
+    async def test_concurrent_requests_occupy_different_slots(self):
+        engine = self.app['engine']
+
+        slots = await asyncio.gather(*[occupy_consumer_slot(engine, '192.168.0.2', str(i)) for i in range(5)])
+        assert sorted(slot for slot in slots if slot is not None) == [1, 2, 3]
+        assert slots.count(None) == 2
+        assert await get_consumer_status(engine, '192.168.0.2') == CONSUMER_STATUS_CHOICES.busy
+
+    @unittest_run_loop
+    async def test_set_idle_consumers_available(self):
+        engine = self.app['engine']
+
+        await occupy_consumer_slot(engine, '192.168.0.2', '1')
+        await occupy_consumer_slot(engine, '192.168.0.3', '2')
+        await set_consumer_status(engine, '192.168.0.2', CONSUMER_STATUS_CHOICES.busy)
+
+        await set_idle_consumers_available(engine)
+        assert await get_consumer_status(engine, '192.168.0.2') == CONSUMER_STATUS_CHOICES.available
+        assert await get_consumer_status(engine, '192.168.0.3') == CONSUMER_STATUS_CHOICES.busy
+
+    @unittest_run_loop
+    async def test_register_consumer_frees_its_slots(self):
+        engine = self.app['engine']
+        consumer_ip = get_ip(self.app)
+
+        await register_consumer_in_the_database(self.app)
+        assert await occupy_consumer_slot(engine, consumer_ip, '1') == 1
+
+        await register_consumer_in_the_database(self.app)
+        assert await get_consumer_status(engine, consumer_ip) == CONSUMER_STATUS_CHOICES.available
+        assert [slot.ip for slot in await find_busy_consumer_slots(engine)] == []
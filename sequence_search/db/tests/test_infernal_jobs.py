@@ -11,17 +11,20 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
 import datetime
 import uuid
 import sqlalchemy as sa
 
 from aiohttp.test_utils import unittest_run_loop
+from aiopg.sa import create_engine
 
 from sequence_search.db.tests.test_base import DBTestCase
 from sequence_search.db.models import Job, InfernalJob, Consumer, JOB_CHUNK_STATUS_CHOICES
 from sequence_search.db.jobs import JOB_STATUS_CHOICES
 from sequence_search.db.consumers import get_ip
-from sequence_search.db.infernal_job import save_infernal_job, set_infernal_job_status, set_consumer_to_infernal_job
+from sequence_search.db.infernal_job import save_infernal_job, set_infernal_job_status, set_consumer_to_infernal_job, \
+    claim_infernal_jobs, claim_created_infernal_job, release_infernal_jobs
 
 
 class InfernalTestCase(DBTestCase):
@@ -63,15 +66,28 @@ class InfernalTestCase(DBTestCase):
 
         async with self.app['engine'].acquire() as connection:
             query = sa.text('''
-                SELECT id
+                SELECT id, status
                 FROM infernal_job
                 WHERE job_id=:job_id
             ''')
 
             async for row in await connection.execute(query, job_id=self.job_id):
                 assert row.id is not None
+                # not pending, so that the scheduler doesn't dispatch it, while the producer does
+                assert row.status == JOB_CHUNK_STATUS_CHOICES.created
                 break
 
+    @unittest_run_loop
+    async def test_claim_created_infernal_job(self):
+        await save_infernal_job(self.app['engine'], self.job_id, priority='low')
+
+        infernal_job_id = await claim_created_infernal_job(self.app['engine'], self.job_id)
+        assert infernal_job_id is not None
+        assert await claim_created_infernal_job(self.app['engine'], self.job_id) is None
+
+        # claimed like the pending infernal jobs of claim_infernal_jobs
+        assert await release_infernal_jobs(self.app['engine'], [infernal_job_id]) == 1
+
     @unittest_run_loop
     async def test_set_infernal_job_status(self):
         await save_infernal_job(self.app['engine'], self.job_id, priority='low')
@@ -104,3 +120,65 @@ class InfernalTestCase(DBTestCase):
             async for row in await connection.execute(query, job_id=self.job_id):
                 assert row.consumer == consumer
                 break
+
+
+class ClaimInfernalJobsTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_infernal_jobs.ClaimInfernalJobsTestCase
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+
+        self.job_ids = []
+        for index in range(40):
+            job_id = str(uuid.uuid4())
+            async with self.app['engine'].acquire() as connection:
+                await connection.execute(
+                    Job.insert().values(
+                        id=job_id,
+                        query='AACAGCATGAGTGCGCTGGATGCTG',
+                        submitted=datetime.datetime.now(),
+                        status=JOB_STATUS_CHOICES.started
+                    )
+                )
+            await save_infernal_job(self.app['engine'], job_id, priority='high' if index % 2 else 'low')
+            await set_infernal_job_status(self.app['engine'], job_id, JOB_CHUNK_STATUS_CHOICES.pending)
+            self.job_ids.append(job_id)
+
+    @unittest_run_loop
+    async def test_concurrent_producers(self):
+        """Several producers, each with its own connection pool, must never claim the same infernal job"""
+        settings = self.app['settings']
+
+        async def producer(claimed):
+            async with create_engine(user=settings.POSTGRES_USER, database=settings.POSTGRES_DATABASE,
+                                     host=settings.POSTGRES_HOST, password=settings.POSTGRES_PASSWORD) as engine:
+                while True:
+                    infernal_jobs = await claim_infernal_jobs(engine, 2)
+                    if not infernal_jobs:
+                        break
+                    assert all(infernal_job.database is None for infernal_job in infernal_jobs)
+                    claimed.extend(infernal_job.job_id for infernal_job in infernal_jobs)
+                    await asyncio.sleep(0)
+
+        producers = [[] for _ in range(6)]
+        await asyncio.gather(*[producer(claimed) for claimed in producers])
+
+        claimed = [job_id for claimed in producers for job_id in claimed]
+        assert sorted(claimed) == sorted(self.job_ids)
+
+    @unittest_run_loop
+    async def test_release_infernal_jobs(self):
+        claimed = await claim_infernal_jobs(self.app['engine'], 3)
+        assert [infernal_job.priority for infernal_job in claimed] == ['high', 'high', 'high']
+
+        assert await release_infernal_jobs(self.app['engine'], [infernal_job.id for infernal_job in claimed]) == 3
+
+        async with self.app['engine'].acquire() as connection:
+            count = await connection.scalar(
+                sa.text('''SELECT count(*) FROM infernal_job WHERE status = :pending'''),
+                pending=JOB_CHUNK_STATUS_CHOICES.pending
+            )
+            assert count == 40
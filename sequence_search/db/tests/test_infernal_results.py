@@ -14,12 +14,17 @@ limitations under the License.
 import datetime
 import uuid
 import sqlalchemy as sa
+from unittest.mock import patch
+
+from aiopg import Cursor
 
 from aiohttp.test_utils import unittest_run_loop
 
-from sequence_search.db.tests.test_base import DBTestCase
+from sequence_search.db import SQLError, DoesNotExist
+from sequence_search.db.tests.test_base import DBTestCase, CountingEngine
 from sequence_search.db.models import Job, InfernalJob
-from sequence_search.db.jobs import get_infernal_job_results, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
+from sequence_search.db.jobs import get_infernal_job_results, stream_infernal_job_results, JOB_STATUS_CHOICES, \
+    JOB_CHUNK_STATUS_CHOICES
 from sequence_search.db.infernal_results import set_infernal_job_results, get_infernal_result_id, save_alignment
 
 
@@ -45,13 +50,13 @@ class InfernalResultTestCase(DBTestCase):
                 )
             )
 
-        self.infernal_job_id = await connection.scalar(
-            InfernalJob.insert().values(
-                job_id=self.job_id,
-                submitted=datetime.datetime.now(),
-                status=JOB_CHUNK_STATUS_CHOICES.pending
+            self.infernal_job_id = await connection.scalar(
+                InfernalJob.insert().values(
+                    job_id=self.job_id,
+                    submitted=datetime.datetime.now(),
+                    status=JOB_CHUNK_STATUS_CHOICES.pending
+                )
             )
-        )
 
         self.results = [
             {
@@ -103,12 +108,44 @@ class InfernalResultTestCase(DBTestCase):
                 assert row.target_name == 'SSU_rRNA_eukarya'
                 break
 
+    @unittest_run_loop
+    async def test_set_infernal_job_results_without_infernal_job(self):
+        job_id = str(uuid.uuid4())
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(Job.insert().values(id=job_id, query='CACGGUGGGGGCGCGCCGG',
+                                                         status=JOB_STATUS_CHOICES.started))
+
+        with self.assertRaises(SQLError) as context:
+            await set_infernal_job_results(self.app['engine'], job_id, results=[dict(self.results[0])])
+        assert isinstance(context.exception.__cause__, DoesNotExist)
+
+        async with self.app['engine'].acquire() as connection:
+            count = await connection.scalar('SELECT count(*) FROM infernal_result WHERE infernal_job_id IS NULL')
+            assert count == 0
+
     @unittest_run_loop
     async def test_get_infernal_job_results(self):
         await set_infernal_job_results(self.app['engine'], self.job_id, results=self.results)
         result = await get_infernal_job_results(self.app['engine'], self.job_id)
         assert result == [{key: value for key, value in d.items() if key != 'infernal_job_id'} for d in self.results]
 
+    @unittest_run_loop
+    async def test_stream_infernal_job_results(self):
+        results = [dict(self.results[0], seq_from=index, seq_to=index + 100) for index in range(5)]
+        await set_infernal_job_results(self.app['engine'], self.job_id, results=results)
+
+        # ids are read once, then every batch is read with a connection of its own,
+        # none is kept while the results are yielded
+        engine = CountingEngine(self.app['engine'])
+        streamed = []
+        async for result in stream_infernal_job_results(engine, self.job_id, batch_size=2):
+            assert engine.metrics['in_use'] == 0
+            streamed.append(result)
+        assert engine.checkouts == 4
+        assert sorted(streamed, key=lambda result: result['seq_from']) == \
+            [{key: value for key, value in d.items() if key != 'infernal_job_id'} for d in results]
+        assert streamed == await get_infernal_job_results(self.app['engine'], self.job_id)
+
     @unittest_run_loop
     async def test_get_infernal_result_id(self):
         save_infernal_result = await set_infernal_job_results(self.app['engine'], self.job_id, results=self.results)
@@ -157,3 +194,35 @@ class InfernalResultTestCase(DBTestCase):
             async for row in await connection.execute(query, id=infernal_result_id):
                 assert row.alignment == alignment
                 break
+
+    @unittest_run_loop
+    async def test_set_infernal_job_results_in_one_statement(self):
+        results = [dict(self.results[0], seq_from=index, seq_to=index + 100, alignment='alignment %s' % index)
+                   for index in range(1, 51)]
+
+        statements = []
+        execute = Cursor.execute
+
+        async def count_statements(cursor, operation, *args, **kwargs):
+            statements.append(operation)
+            return await execute(cursor, operation, *args, **kwargs)
+
+        with patch.object(Cursor, 'execute', count_statements):
+            infernal_job_id = await set_infernal_job_results(self.app['engine'], self.job_id, results=results)
+
+        # the id of the infernal_job and a single INSERT with all the results
+        assert len(statements) == 2
+        assert infernal_job_id == self.infernal_job_id
+
+        async with self.app['engine'].acquire() as connection:
+            query = sa.text('''
+                SELECT seq_from, alignment
+                FROM infernal_result
+                WHERE infernal_job_id=:infernal_job_id
+                ORDER BY seq_from
+            ''')
+
+            rows = [row async for row in await connection.execute(query, infernal_job_id=self.infernal_job_id)]
+            assert [(row.seq_from, row.alignment) for row in rows] == [
+                (index, 'alignment %s' % index) for index in range(1, 51)
+            ]
@@ -18,7 +18,9 @@ from aiohttp.test_utils import unittest_run_loop
 import sqlalchemy as sa
 
 from sequence_search.db.models import Job, JobChunk, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
-from sequence_search.db.job_chunk_results import set_job_chunk_results
+from sequence_search.db import SQLError
+from sequence_search.db.job_chunk_results import set_job_chunk_results, insert_job_chunk_results, \
+    INSERT_BATCH_SIZE
 from sequence_search.db.tests.test_base import DBTestCase
 
 
@@ -72,6 +74,9 @@ class SetJobChunkResultsTestCase(DBTestCase):
             "target_coverage": 0.0,
             "gaps": 0.0,
             "query_length": 30,
+            "alignment_start": 22,
+            "alignment_stop": 43,
+            "alignment_sequence": "GAGUUCGAGGCCAGCCUGCUCA",
             "result_id": 1
         }]
 
@@ -87,3 +92,80 @@ class SetJobChunkResultsTestCase(DBTestCase):
             async for row in await connection.execute(query, job_chunk_id=self.job_chunk_id):
                 assert row.rnacentral_id == 'URS000075D2D2'
                 assert row.description == 'Mus musculus miR - 1195 stem - loop'
+
+    @unittest_run_loop
+    async def test_insert_job_chunk_results_in_batches(self):
+        results = [{
+            "rnacentral_id": 'URS000075D2D2_%s' % index,
+            "description": "it's a 'quoted' description",
+            "score": 6.5,
+            "bias": 0.7,
+            "e_value": 1.5e-20,
+            "target_length": 98,
+            "alignment": "Query  8 GAGUUUGAGACCAGCCUGGCCA 29",
+            "alignment_length": 22,
+            "gap_count": 0,
+            "match_count": 18,
+            "nts_count1": 22,
+            "nts_count2": 0,
+            "identity": 81.8181818181818,
+            "query_coverage": 73.3333333333333,
+            "target_coverage": 0.0,
+            "gaps": 0.0,
+            "query_length": 30,
+            "alignment_start": 22.0,
+            "alignment_stop": 43.0,
+            "alignment_sequence": "GAGUUCGAGGCCAGCCUGCUCA",
+            "result_id": index
+        } for index in range(1, 1001)]
+
+        async with self.app['engine'].acquire() as connection:
+            inserted = await insert_job_chunk_results(connection, self.job_chunk_id, results, batch_size=300)
+            assert inserted == 1000
+
+            query = sa.text('''
+                SELECT count(*), min(result_id), max(result_id), min(description), min(e_value)
+                FROM job_chunk_results
+                WHERE job_chunk_id=:job_chunk_id
+            ''')
+            async for row in await connection.execute(query, job_chunk_id=self.job_chunk_id):
+                assert row[0] == 1000
+                assert row[1] == 1
+                assert row[2] == 1000
+                assert row[3] == "it's a 'quoted' description"
+                assert row[4] == 1.5e-20
+
+            # every result has its alignment in a separate table
+            query = sa.text('''
+                SELECT count(*), min(alignment), min(alignment_sequence)
+                FROM job_chunk_results
+                JOIN job_chunk_result_alignments ON job_chunk_result_alignments.job_chunk_result_id = job_chunk_results.id
+                WHERE job_chunk_id=:job_chunk_id
+            ''')
+            async for row in await connection.execute(query, job_chunk_id=self.job_chunk_id):
+                assert row[0] == 1000
+                assert row[1] == "Query  8 GAGUUUGAGACCAGCCUGGCCA 29"
+                assert row[2] == "GAGUUCGAGGCCAGCCUGCUCA"
+
+    @unittest_run_loop
+    async def test_set_job_chunk_results_rolls_back(self):
+        results = [{
+            "rnacentral_id": 'URS000075D2D2_%s' % index,
+            "description": 'Mus musculus miR - 1195 stem - loop',
+            "score": 6.5,
+            "e_value": 32.0,
+            "alignment": "Query  8 GAGUUUGAGACCAGCCUGGCCA 29",
+            "result_id": index
+        } for index in range(1, 2 * INSERT_BATCH_SIZE + 2)]
+        # the first batches are inserted, before the last one fails
+        results[-1]['score'] = 'not a number'
+
+        with self.assertRaises(SQLError):
+            await set_job_chunk_results(self.app['engine'], self.job_id, database='mirbase', results=results)
+
+        async with self.app['engine'].acquire() as connection:
+            count = await connection.scalar(
+                sa.text('SELECT count(*) FROM job_chunk_results WHERE job_chunk_id=:job_chunk_id'),
+                job_chunk_id=self.job_chunk_id
+            )
+            assert count == 0
@@ -11,10 +11,13 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
 import datetime
 import uuid
 
+import sqlalchemy as sa
 from aiohttp.test_utils import unittest_run_loop
+from aiopg.sa import create_engine
 
 from sequence_search.db.tests.test_base import DBTestCase
 from sequence_search.db import DoesNotExist
@@ -22,7 +25,8 @@ from sequence_search.db.models import Job, JobChunk, Consumer, JOB_STATUS_CHOICE
     CONSUMER_STATUS_CHOICES
 from sequence_search.db.jobs import find_highest_priority_jobs, database_used_in_search
 from sequence_search.db.job_chunks import save_job_chunk, get_consumer_ip_from_job_chunk, set_job_chunk_status, \
-    get_job_chunk_from_job_and_database
+    get_job_chunk_from_job_and_database, claim_job_chunks, claim_job_chunks_of_database, claim_created_job_chunks, \
+    release_job_chunks, release_stale_job_chunks
 
 
 class GetJobChunkFromJobAndDatabase(DBTestCase):
@@ -324,3 +328,138 @@ class DatabaseUsedInSearch(DBTestCase):
         databases = ['pdbe-0.fasta']
         result = await database_used_in_search(self.app['engine'], self.job_id, databases)
         assert not result
+
+
+class ClaimJobChunksTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_job_chunks.ClaimJobChunksTestCase
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+
+        self.job_chunk_ids = []
+        async with self.app['engine'].acquire() as connection:
+            for priority in ['low', 'high']:
+                job_id = str(uuid.uuid4())
+                await connection.execute(
+                    Job.insert().values(
+                        id=job_id,
+                        query='AACAGCATGAGTGCGCTGGATGCTG',
+                        submitted=datetime.datetime.now(),
+                        priority=priority,
+                        status=JOB_STATUS_CHOICES.started
+                    )
+                )
+
+                for index in range(30):
+                    job_chunk_id = await connection.scalar(
+                        JobChunk.insert().values(
+                            job_id=job_id,
+                            database='database-%s' % index,
+                            status=JOB_CHUNK_STATUS_CHOICES.pending
+                        )
+                    )
+                    self.job_chunk_ids.append(job_chunk_id)
+
+    async def get_statuses(self):
+        async with self.app['engine'].acquire() as connection:
+            query = sa.text('''SELECT status, count(*) FROM job_chunks GROUP BY status''')
+            return {row[0]: row[1] async for row in await connection.execute(query)}
+
+    @unittest_run_loop
+    async def test_claim_job_chunks(self):
+        claimed = await claim_job_chunks(self.app['engine'], 5)
+
+        assert len(claimed) == 5
+        assert all(job_chunk.priority == 'high' for job_chunk in claimed)
+        assert all(job_chunk.query == 'AACAGCATGAGTGCGCTGGATGCTG' for job_chunk in claimed)
+        assert await self.get_statuses() == {
+            JOB_CHUNK_STATUS_CHOICES.dispatching: 5,
+            JOB_CHUNK_STATUS_CHOICES.pending: 55
+        }
+
+    @unittest_run_loop
+    async def test_claim_job_chunks_of_database(self):
+        claimed = await claim_job_chunks_of_database(self.app['engine'], 'database-7', 5)
+
+        # each job has a single job_chunk of the database, the one of the high priority job comes first
+        assert [job_chunk.priority for job_chunk in claimed] == ['high', 'low']
+        assert all(job_chunk.database == 'database-7' for job_chunk in claimed)
+        assert await claim_job_chunks_of_database(self.app['engine'], 'database-7', 5) == []
+        assert await self.get_statuses() == {
+            JOB_CHUNK_STATUS_CHOICES.dispatching: 2,
+            JOB_CHUNK_STATUS_CHOICES.pending: 58
+        }
+
+    @unittest_run_loop
+    async def test_claim_created_job_chunks(self):
+        job_id = str(uuid.uuid4())
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=job_id, query='AACAGCATGAGTGCGCTGGATGCTG', status=JOB_STATUS_CHOICES.started)
+            )
+        for database in ['mirbase', 'pombase', 'rfam']:
+            await save_job_chunk(self.app['engine'], job_id, database)
+
+        claimed = await claim_created_job_chunks(self.app['engine'], job_id, ['mirbase', 'pombase'])
+        assert sorted(job_chunk.database for job_chunk in claimed) == ['mirbase', 'pombase']
+        assert await claim_created_job_chunks(self.app['engine'], job_id, ['mirbase', 'pombase']) == []
+        assert await self.get_statuses() == {
+            JOB_CHUNK_STATUS_CHOICES.created: 1,
+            JOB_CHUNK_STATUS_CHOICES.dispatching: 2,
+            JOB_CHUNK_STATUS_CHOICES.pending: 60
+        }
+
+    @unittest_run_loop
+    async def test_concurrent_producers(self):
+        """Several producers, each with its own connection pool, must never claim the same job_chunk"""
+        settings = self.app['settings']
+
+        async def producer(claimed):
+            async with create_engine(user=settings.POSTGRES_USER, database=settings.POSTGRES_DATABASE,
+                                     host=settings.POSTGRES_HOST, password=settings.POSTGRES_PASSWORD) as engine:
+                while True:
+                    job_chunks = await claim_job_chunks(engine, 3)
+                    if not job_chunks:
+                        break
+                    claimed.extend(job_chunk.id for job_chunk in job_chunks)
+                    await asyncio.sleep(0)
+
+        producers = [[] for _ in range(6)]
+        await asyncio.gather(*[producer(claimed) for claimed in producers])
+
+        claimed = [job_chunk_id for claimed in producers for job_chunk_id in claimed]
+        assert sorted(claimed) == sorted(self.job_chunk_ids)
+        assert await self.get_statuses() == {JOB_CHUNK_STATUS_CHOICES.dispatching: 60}
+
+    @unittest_run_loop
+    async def test_release_job_chunks(self):
+        claimed = await claim_job_chunks(self.app['engine'], 4)
+        await set_job_chunk_status(self.app['engine'], claimed[0].job_id, claimed[0].database,
+                                   status=JOB_CHUNK_STATUS_CHOICES.started)
+
+        # job_chunks that were already started by a consumer stay started
+        released = await release_job_chunks(self.app['engine'], [job_chunk.id for job_chunk in claimed])
+        assert released == 3
+        assert await self.get_statuses() == {
+            JOB_CHUNK_STATUS_CHOICES.started: 1,
+            JOB_CHUNK_STATUS_CHOICES.pending: 59
+        }
+
+    @unittest_run_loop
+    async def test_release_stale_job_chunks(self):
+        await claim_job_chunks(self.app['engine'], 4)
+
+        assert await release_stale_job_chunks(self.app['engine'], timeout=60) == 0
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                sa.text('''UPDATE job_chunks SET dispatched = :dispatched WHERE status = :dispatching'''),
+                dispatched=datetime.datetime.now() - datetime.timedelta(seconds=120),
+                dispatching=JOB_CHUNK_STATUS_CHOICES.dispatching
+            )
+
+        assert await release_stale_job_chunks(self.app['engine'], timeout=60) == 4
+        assert await self.get_statuses() == {JOB_CHUNK_STATUS_CHOICES.pending: 60}
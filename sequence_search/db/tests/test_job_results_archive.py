@@ -0,0 +1,177 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import unittest
+import uuid
+
+import sqlalchemy as sa
+from aiohttp.test_utils import unittest_run_loop
+
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+from sequence_search.db.job_results_archive import pack_job_results, unpack_job_results
+from sequence_search.db.jobs import archive_job_results, get_job_results, get_job_result_ids, \
+    get_job_result_alignment, stream_job_results, JOB_RESULTS_ORDERINGS
+from sequence_search.db.models import Job, JobChunk, JOB_STATUS_CHOICES
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class PackJobResultsTestCase(unittest.TestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_job_results_archive.PackJobResultsTestCase
+    """
+    def test_pack_job_results(self):
+        results = [
+            {'id': 1, 'rnacentral_id': 'URS0000000001_9606', 'score': 10.5, 'description': None, 'e_value': 1e-300},
+            {'id': 2 ** 40, 'rnacentral_id': 'URS0000000002_562', 'score': -1.0, 'description': "it's", 'e_value': 0.0},
+        ]
+        assert unpack_job_results(pack_job_results(results)) == results
+        assert unpack_job_results(memoryview(pack_job_results(results))) == results
+
+    def test_pack_selected_columns(self):
+        results = [{'alignment': 'A' * 100, 'alignment_sequence': None, 'other': 1}] * 3
+        assert unpack_job_results(pack_job_results(results, columns=['alignment', 'alignment_sequence'])) == [
+            {'alignment': 'A' * 100, 'alignment_sequence': None}
+        ] * 3
+
+    def test_pack_no_results(self):
+        assert unpack_job_results(pack_job_results([])) == []
+
+
+class JobResultsArchiveTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_job_results_archive.JobResultsArchiveTestCase
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.job_id = str(uuid.uuid4())
+
+        taxids = [9606, 10090, 7955, 562]
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(
+                    id=self.job_id,
+                    query='AACAGCATGAGTGCGCTGGATGCTG',
+                    ordering='-identity',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_STATUS_CHOICES.success
+                )
+            )
+            for database in ['mirbase', 'pombase']:
+                job_chunk_id = await connection.scalar(
+                    JobChunk.insert().values(job_id=self.job_id, database=database, status='success')
+                )
+                await insert_job_chunk_results(connection, job_chunk_id, [{
+                    'rnacentral_id': 'URS%010X_%s' % (index, taxids[index % 4]),
+                    'description': 'result %s' % index,
+                    'score': float(index % 7),
+                    'bias': 0.1,
+                    'e_value': 10.0 ** -(index % 5),
+                    'target_length': 100,
+                    'alignment': 'alignment %s' % index,
+                    'alignment_length': 20,
+                    'gap_count': 0,
+                    'match_count': 20,
+                    'nts_count1': 20,
+                    'nts_count2': 0,
+                    'identity': float(index % 3) * 10,
+                    'query_coverage': float(index % 4) * 10,
+                    'target_coverage': float(index % 6) * 10,
+                    'gaps': 0.0,
+                    'query_length': 25,
+                    'alignment_start': 1,
+                    'alignment_stop': 20,
+                    'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA',
+                    'result_id': index
+                } for index in range(30)])  # both databases find the same results
+
+    async def all_results(self):
+        """Everything that can be read about the job results"""
+        engine = self.app['engine']
+        output = {
+            'default': await get_job_results(engine, self.job_id),
+            'ids': await get_job_result_ids(engine, self.job_id),
+            'alignments': await get_job_results(engine, self.job_id, alignment=True),
+            'page': await get_job_results(engine, self.job_id, 'e_value', start=5, size=10, alignment=True),
+            'filtered': await get_job_results(engine, self.job_id, 'identity', rnacentral_ids=['URS0000000003_562']),
+            'limit': await get_job_result_ids(engine, self.job_id, 'query_coverage', limit=5),
+        }
+        for ordering in JOB_RESULTS_ORDERINGS + ['-' + ordering for ordering in JOB_RESULTS_ORDERINGS]:
+            output[ordering] = await get_job_results(engine, self.job_id, ordering)
+
+        result_id = output['default'][0]['id']
+        output['alignment'] = await get_job_result_alignment(engine, self.job_id, result_id)
+        return output
+
+    @unittest_run_loop
+    async def test_archive_job_results(self):
+        before = await self.all_results()
+        assert len(before['default']) == 30
+
+        assert await archive_job_results(self.app['engine'], self.job_id) == 30
+        assert await self.all_results() == before
+
+        # job_chunk_results of the job are deleted, archiving again does nothing
+        async with self.app['engine'].acquire() as connection:
+            count = await connection.scalar(sa.text('''
+                SELECT count(*)
+                FROM job_chunk_results
+                JOIN job_chunks ON job_chunks.id = job_chunk_results.job_chunk_id
+                WHERE job_chunks.job_id=:job_id
+            '''), job_id=self.job_id)
+            assert count == 0
+
+        assert await archive_job_results(self.app['engine'], self.job_id) == 0
+        assert await self.all_results() == before
+
+    @unittest_run_loop
+    async def test_stream_job_results(self):
+        # results are read a few at a time, in the same order as get_job_results
+        engine = self.app['engine']
+        for ordering in [None] + JOB_RESULTS_ORDERINGS + ['-' + ordering for ordering in JOB_RESULTS_ORDERINGS]:
+            for alignment in [False, True]:
+                results = await get_job_results(engine, self.job_id, ordering, alignment=alignment)
+                streamed = [result async for result in stream_job_results(
+                    engine, self.job_id, ordering, alignment=alignment, batch_size=4)]
+                assert streamed == results
+
+        streamed = [result async for result in stream_job_results(engine, self.job_id, limit=10, batch_size=4)]
+        assert streamed == (await get_job_results(engine, self.job_id, limit=10))
+
+    @unittest_run_loop
+    async def test_archive_all_results(self):
+        # more results than get_job_results returns by default
+        async with self.app['engine'].acquire() as connection:
+            job_chunk_id = await connection.scalar(
+                JobChunk.insert().values(job_id=self.job_id, database='ena1', status='success')
+            )
+            await insert_job_chunk_results(connection, job_chunk_id, [{
+                'rnacentral_id': 'URS%010X_9606' % (100 + index), 'description': '', 'score': 0.5, 'bias': 0.1,
+                'e_value': 1.0, 'target_length': 100, 'alignment': 'alignment', 'alignment_length': 20,
+                'gap_count': 0, 'match_count': 20, 'nts_count1': 20, 'nts_count2': 0, 'identity': 50.0,
+                'query_coverage': 50.0, 'target_coverage': 20.0, 'gaps': 0.0, 'query_length': 25,
+                'alignment_start': 1, 'alignment_stop': 20, 'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA',
+                'result_id': index
+            } for index in range(1000)])
+
+        engine = self.app['engine']
+        before = await get_job_results(engine, self.job_id, limit=2000)
+        assert len(before) == 1030
+
+        assert await archive_job_results(engine, self.job_id) == 1030
+        assert await get_job_results(engine, self.job_id, limit=2000) == before
+        assert len(await get_job_results(engine, self.job_id)) == 1000
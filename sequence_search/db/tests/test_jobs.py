@@ -17,8 +17,10 @@ import uuid
 from aiohttp.test_utils import unittest_run_loop
 
 from sequence_search.db.jobs import get_job, get_job_query, job_exists, JOB_STATUS_CHOICES, save_job, save_r2dt_id, \
-    sequence_exists, set_job_status
-from sequence_search.db.models import Job
+    sequence_exists, set_job_status, search_key, find_cached_job, get_job_results, get_job_result_ids, \
+    get_job_result_alignment
+from sequence_search.db.models import Job, JobChunk, JobChunkResult, JobChunkResultAlignment
+from sequence_search.db import DoesNotExist
 from sequence_search.db.tests.test_base import DBTestCase
 
 
@@ -196,3 +198,157 @@ class SaveR2DTTestCase(DBTestCase):
             datetime.datetime.now()
         )
         assert job is "r2dt-R20200819-142803-0200-7914324-p1m"
+
+
+class SearchCacheTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_jobs.SearchCacheTestCase
+    """
+    def test_search_key(self):
+        key = search_key('AACAGCAUGAGUGCGCUGGAUGCUG', ['mirbase.fasta', 'ena1.fasta'], 'release')
+
+        # fasta header, whitespace, case and T/U don't matter, neither does the order of databases
+        assert key == search_key(
+            '>CATE_ECOLI\naacagcatga gtgcgc\nTGGATGCTG\n', ['ena1.fasta', 'mirbase.fasta'], 'release'
+        )
+        assert key != search_key('AACAGCAUGAGUGCGCUGGAUGCUG', ['mirbase.fasta'], 'release')
+        assert key != search_key('AACAGCAUGAGUGCGCUGGAUGCUG', ['mirbase.fasta', 'ena1.fasta'], 'new release')
+
+    @unittest_run_loop
+    async def test_find_cached_job(self):
+        key = search_key('AACAGCAUGAGUGCGCUGGAUGCUG', ['mirbase.fasta'], 'release')
+        assert await find_cached_job(self.app['engine'], key) is None
+
+        first_job_id = await save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUGCUG', '', 'localhost', 'low', key)
+        second_job_id = await save_job(self.app['engine'], 'AACAGCATGAGTGCGCTGGATGCTG', '', 'localhost', 'low', key)
+        await save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUGCUG', '', 'localhost', 'low')
+        assert first_job_id != second_job_id
+
+        # the most recent job is returned
+        assert await find_cached_job(self.app['engine'], key) == second_job_id
+
+        # jobs searched against a previous release of the databases are not returned
+        new_key = search_key('AACAGCAUGAGUGCGCUGGAUGCUG', ['mirbase.fasta'], 'new release')
+        assert await find_cached_job(self.app['engine'], new_key) is None
+
+
+class GetJobResultsTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_jobs.GetJobResultsTestCase
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.job_id = str(uuid.uuid4())
+
+        # rnacentral_id, e_value, identity, score
+        results = [
+            ('URS0000000001_562', 1e-10, 90.0, 50.0),
+            ('URS0000000002_9606', 1e-10, 80.0, 40.0),
+            ('URS0000000003_10090', 1e-5, 100.0, 30.0),
+            ('URS0000000004_7955', 1e-20, 70.0, 60.0),
+            ('URS0000000005_9606', 1e-3, 60.0, 20.0),
+        ]
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(
+                    id=self.job_id,
+                    query='AACAGCATGAGTGCGCTGGATGCTG',
+                    ordering='-identity',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_STATUS_CHOICES.success
+                )
+            )
+            job_chunk_id = await connection.scalar(
+                JobChunk.insert().values(job_id=self.job_id, database='mirbase', status='success')
+            )
+            self.result_ids = []
+            for index, (rnacentral_id, e_value, identity, score) in enumerate(results):
+                result_id = await connection.scalar(
+                    JobChunkResult.insert().values(
+                        job_chunk_id=job_chunk_id, rnacentral_id=rnacentral_id, description='', score=score,
+                        bias=0.0, e_value=e_value, target_length=100, alignment_length=20, gap_count=0,
+                        match_count=20, nts_count1=20, nts_count2=0, identity=identity, query_coverage=100.0,
+                        target_coverage=20.0, gaps=0.0, query_length=20, alignment_start=1, alignment_stop=20,
+                        result_id=index
+                    )
+                )
+                await connection.execute(
+                    JobChunkResultAlignment.insert().values(
+                        job_chunk_result_id=result_id, alignment='alignment %s' % index,
+                        alignment_sequence='AACAGCAUGAGUGCGCUGGA'
+                    )
+                )
+                self.result_ids.append(result_id)
+
+    @unittest_run_loop
+    async def test_get_job_results_ordering(self):
+        engine = self.app['engine']
+
+        # ascending: by e_value, ties are broken by species priority
+        results = await get_job_results(engine, self.job_id, 'e_value')
+        assert [result['rnacentral_id'] for result in results] == [
+            'URS0000000004_7955', 'URS0000000002_9606', 'URS0000000001_562', 'URS0000000003_10090',
+            'URS0000000005_9606'
+        ]
+        assert [result['species_priority'] for result in results] == ['c', 'a', 'd', 'b', 'a']
+
+        # descending: by species priority first
+        results = await get_job_results(engine, self.job_id, '-e_value')
+        assert [result['rnacentral_id'] for result in results] == [
+            'URS0000000005_9606', 'URS0000000002_9606', 'URS0000000003_10090', 'URS0000000004_7955',
+            'URS0000000001_562'
+        ]
+
+        # the ordering stored in the database is used by default, unknown orderings sort by score
+        assert await get_job_result_ids(engine, self.job_id) == [
+            'URS0000000002_9606', 'URS0000000005_9606', 'URS0000000003_10090', 'URS0000000004_7955',
+            'URS0000000001_562'
+        ]
+        assert await get_job_result_ids(engine, self.job_id, 'unknown') == [
+            'URS0000000004_7955', 'URS0000000001_562', 'URS0000000002_9606', 'URS0000000003_10090',
+            'URS0000000005_9606'
+        ]
+
+    @unittest_run_loop
+    async def test_get_job_results_pagination(self):
+        engine = self.app['engine']
+
+        results = await get_job_results(engine, self.job_id, 'e_value', start=1, size=2)
+        assert [result['rnacentral_id'] for result in results] == ['URS0000000002_9606', 'URS0000000001_562']
+        assert 'alignment' not in results[0]
+
+        results = await get_job_results(engine, self.job_id, 'e_value', rnacentral_ids=['URS0000000003_10090'],
+                                        alignment=True)
+        assert len(results) == 1
+        assert results[0]['alignment'] == 'alignment 2'
+        assert results[0]['alignment_sequence'] == 'AACAGCAUGAGUGCGCUGGA'
+
+        # only the best results by score are ordered and paginated
+        assert await get_job_result_ids(engine, self.job_id, 'e_value', limit=2) == [
+            'URS0000000004_7955', 'URS0000000001_562'
+        ]
+
+    @unittest_run_loop
+    async def test_get_job_result_alignment(self):
+        engine = self.app['engine']
+
+        # summaries carry the id, that is used to fetch the alignment
+        results = await get_job_results(engine, self.job_id, 'e_value', size=1)
+        assert results[0]['id'] == self.result_ids[3]
+
+        alignment = await get_job_result_alignment(engine, self.job_id, results[0]['id'])
+        assert alignment == {
+            'id': self.result_ids[3],
+            'rnacentral_id': 'URS0000000004_7955',
+            'alignment': 'alignment 3',
+            'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA'
+        }
+
+        # results of other jobs are not found
+        with self.assertRaises(DoesNotExist):
+            await get_job_result_alignment(engine, 'another-job', self.result_ids[3])
@@ -0,0 +1,179 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+
+import sqlalchemy as sa
+from aiohttp.test_utils import unittest_run_loop
+from aiopg.sa import create_engine
+
+from sequence_search.db.jobs import get_job_results, get_infernal_job_results
+from sequence_search.db.migrations import apply_migrations, MIGRATIONS
+from sequence_search.db.retention import PARTITIONED_TABLES, expire_jobs, partition_name, week_start
+from sequence_search.db.models import create_tables, metadata, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES, \
+    CONSUMER_STATUS_CHOICES
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class MigrationsTestCase(DBTestCase):
+    """
+    Applies the migrations to a database with the schema, that was there before the migrations were versioned.
+    The database is a postgres schema of its own, so that the tables of the other tests are left alone.
+
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_migrations
+    """
+    schema = 'migrations_test'
+
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DROP SCHEMA IF EXISTS %s CASCADE' % self.schema)
+            await connection.execute('CREATE SCHEMA %s' % self.schema)
+
+        settings = self.app['settings']
+        self.engine = await create_engine(
+            user=settings.POSTGRES_USER,
+            database=settings.POSTGRES_DATABASE,
+            host=settings.POSTGRES_HOST,
+            password=settings.POSTGRES_PASSWORD,
+            options='-c search_path=%s' % self.schema
+        )
+
+    async def tearDownAsync(self):
+        self.engine.close()
+        await self.engine.wait_closed()
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DROP SCHEMA IF EXISTS %s CASCADE' % self.schema)
+        await super().tearDownAsync()
+
+    async def create_baseline(self):
+        """Tables of the initial schema with a search, that has results of nhmmer and cmscan"""
+        async with self.engine.acquire() as connection:
+            await create_tables(connection)
+
+            await connection.execute(
+                sa.text('''
+                    INSERT INTO consumer (ip, status, job_chunk_id, port) VALUES ('192.168.0.2', :busy, '1', '8000')
+                '''),
+                busy=CONSUMER_STATUS_CHOICES.busy
+            )
+            await connection.execute(
+                sa.text('''
+                    INSERT INTO jobs (id, query, submitted, status)
+                    VALUES ('job', 'AACAGCAUGAGUGCGCUGGAUGCUG', :submitted, :status)
+                '''),
+                submitted=datetime.datetime.now() - datetime.timedelta(days=2),
+                status=JOB_STATUS_CHOICES.success
+            )
+            await connection.execute(
+                sa.text('''
+                    INSERT INTO job_chunks (id, job_id, database, consumer, status)
+                    VALUES (1, 'job', 'mirbase', '192.168.0.2', :status)
+                '''),
+                status=JOB_CHUNK_STATUS_CHOICES.success
+            )
+            for index, rnacentral_id in enumerate(['URS000075D2D2_10090', 'URS00008B2F5F_9606']):
+                await connection.execute(
+                    sa.text('''
+                        INSERT INTO job_chunk_results (id, job_chunk_id, rnacentral_id, description, score, bias,
+                          e_value, target_length, alignment, alignment_length, gap_count, match_count, nts_count1,
+                          nts_count2, identity, query_coverage, target_coverage, gaps, query_length, alignment_start,
+                          alignment_stop, alignment_sequence, result_id)
+                        VALUES (:id, 1, :rnacentral_id, 'description', :score, 0.0, 1e-5, 100, :alignment, 20, 0,
+                          20, 20, 0, 100.0, 100.0, 20.0, 0.0, 20, 1, 20, 'AACAGCAUGAGUGCGCUGGA', :id)
+                    '''),
+                    id=index + 1,
+                    rnacentral_id=rnacentral_id,
+                    score=10.0 + index,
+                    alignment='alignment %s' % index
+                )
+            await connection.execute("SELECT setval('job_chunk_results_id_seq', 2)")
+
+            await connection.execute(
+                sa.text("INSERT INTO infernal_job (id, job_id, status) VALUES (1, 'job', :status)"),
+                status=JOB_CHUNK_STATUS_CHOICES.success
+            )
+            await connection.execute('''
+                INSERT INTO infernal_result (infernal_job_id, target_name, accession_rfam, query_name, mdl,
+                  mdl_from, mdl_to, seq_from, seq_to, strand, trunc, pipeline_pass, gc, bias, score, e_value, inc,
+                  description, alignment)
+                VALUES (1, '5S_rRNA', 'RF00001', 'query', 'cm', 1, 119, 2, 115, '+', 'no', 1, 0.52, 0.3, 104.9,
+                  1.6e-25, '!', '5S ribosomal RNA', 'alignment')
+            ''')
+
+    async def columns(self, connection, table):
+        query = 'SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s'
+        return set(row.column_name for row in await (await connection.execute(query, self.schema, table)).fetchall())
+
+    @unittest_run_loop
+    async def test_upgrade_from_baseline(self):
+        await self.create_baseline()
+
+        # the baseline is recorded as version 1, all the other migrations are applied on top of it
+        versions = await apply_migrations(self.engine)
+        assert versions == [version for version, migration, transactional in MIGRATIONS if version != 1]
+        assert await apply_migrations(self.engine) == []
+
+        async with self.engine.acquire() as connection:
+            # the tables have the columns of the models
+            for table in metadata.tables.values():
+                assert set(table.columns.keys()) <= await self.columns(connection, table.name), table.name
+            assert 'alignment' not in await self.columns(connection, 'job_chunk_results')
+
+            partitioned = await connection.scalar('''
+                SELECT count(*) FROM pg_partitioned_table
+                WHERE partrelid IN ('job_chunk_results'::regclass, 'job_chunk_result_alignments'::regclass,
+                                    'infernal_result'::regclass, 'job_results_archive'::regclass)
+            ''')
+            assert partitioned == 4
+
+            # the consumer keeps running its job_chunk in the first slot
+            query = 'SELECT consumer, slot, job_chunk_id FROM consumer_slot'
+            slots = await (await connection.execute(query)).fetchall()
+            assert [(row.consumer, row.slot, row.job_chunk_id) for row in slots] == [('192.168.0.2', 1, '1')]
+
+            # the results, that were there before, are left in the partition of the current week
+            legacy_partition = partition_name('job_chunk_results', week_start(datetime.date.today()))
+            assert await connection.scalar('SELECT count(*) FROM %s' % legacy_partition) == 2
+
+            # ids of these results are not given out again
+            assert await connection.scalar("SELECT nextval(pg_get_serial_sequence('job_chunk_results', 'id'))") == 3
+
+        # the results are there, with their alignments and taxids
+        results = await get_job_results(self.engine, 'job', ordering='-score', alignment=True)
+        assert [(result['rnacentral_id'], result['alignment']) for result in results] == [
+            ('URS00008B2F5F_9606', 'alignment 1'), ('URS000075D2D2_10090', 'alignment 0')
+        ]
+
+        infernal_results = await get_infernal_job_results(self.engine, 'job')
+        assert [(result['accession_rfam'], result['alignment']) for result in infernal_results] == [
+            ('RF00001', 'alignment')
+        ]
+
+        # the partition is dropped, once the current week has expired
+        expired = datetime.datetime.combine(week_start(datetime.date.today()), datetime.time()) + \
+            datetime.timedelta(weeks=1, days=7)
+        dropped = (await expire_jobs(self.engine, now=expired))['dropped']
+        assert set(partition_name(table, week_start(datetime.date.today())) for table in PARTITIONED_TABLES) <= \
+            set(dropped)
+
+    @unittest_run_loop
+    async def test_create_from_scratch(self):
+        versions = await apply_migrations(self.engine)
+        assert versions == [version for version, migration, transactional in MIGRATIONS]
+
+        async with self.engine.acquire() as connection:
+            for table in metadata.tables.values():
+                assert set(table.columns.keys()) <= await self.columns(connection, table.name), table.name
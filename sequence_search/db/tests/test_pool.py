@@ -0,0 +1,137 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import asyncio
+import types
+
+from aiohttp.test_utils import unittest_run_loop
+
+from sequence_search.db import acquire, DatabaseConnectionError, PoolTimeoutError, SQLError
+from sequence_search.db.jobs import get_jobs_statuses
+from sequence_search.db.pool import create_pool
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class PoolTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_pool
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.engine = await create_pool(types.SimpleNamespace(
+            **self.app['settings']._asdict(),
+            POSTGRES_POOL_MINSIZE=1,
+            POSTGRES_POOL_MAXSIZE=1,
+            POSTGRES_POOL_ACQUIRE_TIMEOUT=0.1,
+            POSTGRES_STATEMENT_TIMEOUT=0.5
+        ))
+
+    async def tearDownAsync(self):
+        self.engine.close()
+        await self.engine.wait_closed()
+        await super().tearDownAsync()
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        async with self.engine.acquire() as connection:
+            await connection.scalar('SELECT 1')
+            metrics = self.engine.get_metrics()
+            assert metrics['in_use'] == 1
+            assert metrics['freesize'] == 0
+            assert metrics['maxsize'] == 1
+
+        await get_jobs_statuses(self.engine)
+
+        metrics = self.engine.get_metrics()
+        assert metrics['checkouts'] == 2
+        assert metrics['in_use'] == 0
+        assert metrics['waiting'] == 0
+        assert metrics['freesize'] == 1
+        assert metrics['wait_count'] == 2
+        assert metrics['wait_buckets']['inf'] == 2
+        assert metrics['acquire_timeouts'] == 0
+
+    @unittest_run_loop
+    async def test_waiting_for_a_connection(self):
+        async def hold(seconds):
+            async with self.engine.acquire():
+                await asyncio.sleep(seconds)
+
+        self.engine.acquire_timeout = 1
+        holding = asyncio.ensure_future(hold(0.2))
+        while self.engine.get_metrics()['in_use'] == 0:
+            await asyncio.sleep(0.001)
+        await get_jobs_statuses(self.engine)
+        await holding
+
+        metrics = self.engine.get_metrics()
+        assert metrics['checkouts'] == 2
+        assert metrics['wait_max'] >= 0.15
+        assert metrics['wait_buckets']['0.1'] == 1
+        assert metrics['wait_buckets']['inf'] == 2
+
+    @unittest_run_loop
+    async def test_acquire_timeout(self):
+        async with self.engine.acquire():
+            with self.assertRaises(PoolTimeoutError):
+                async with self.engine.acquire():
+                    pass
+
+            # the db helpers report it as a lost connection
+            with self.assertRaises(DatabaseConnectionError):
+                await get_jobs_statuses(self.engine)
+
+            assert self.engine.get_metrics()['waiting'] == 0
+
+        metrics = self.engine.get_metrics()
+        assert metrics['acquire_timeouts'] == 2
+        assert metrics['checkouts'] == 1
+
+        # the pool is usable after the timeouts
+        await get_jobs_statuses(self.engine)
+
+    @unittest_run_loop
+    async def test_cancelled_while_waiting(self):
+        async def wait():
+            async with self.engine.acquire():
+                pass
+
+        for _ in range(10):
+            async with self.engine.acquire():
+                waiting = asyncio.ensure_future(wait())
+                await asyncio.sleep(0.01)
+            # the connection may have been handed to the waiting task already
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            await asyncio.sleep(0.01)
+
+            assert self.engine.get_metrics()['freesize'] == 1
+
+    @unittest_run_loop
+    async def test_statement_timeout(self):
+        async def sleep(engine):
+            async with acquire(engine) as connection:
+                try:
+                    await connection.scalar('SELECT pg_sleep(2)')
+                except Exception as e:
+                    raise SQLError("Failed to sleep") from e
+
+        with self.assertRaises(SQLError):
+            await sleep(self.engine)
+
+        # the connection is closed and replaced with a new one
+        await get_jobs_statuses(self.engine)
+        assert self.engine.get_metrics()['in_use'] == 0
@@ -0,0 +1,224 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import json
+import re
+
+import psycopg2.extensions
+from aiohttp.test_utils import unittest_run_loop
+from aiopg.sa import create_engine
+
+from sequence_search.db import consumers, infernal_job, infernal_results, job_chunk_results, job_chunks, jobs, \
+    statistic
+from sequence_search.db.migrations import apply_migrations, MIGRATIONS
+from sequence_search.db.models import Consumer, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES, CONSUMER_STATUS_CHOICES
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class RecordingCursor(psycopg2.extensions.cursor):
+    """Cursor that remembers every statement it executes, with the parameters substituted"""
+    statements = []
+    label = None
+
+    def execute(self, query, vars=None):
+        RecordingCursor.statements.append((RecordingCursor.label, self.mogrify(query, vars).decode('utf-8')))
+        return super().execute(query, vars)
+
+
+"""
+Tables that are expected to be read in full by these functions, e.g. lists of all consumers.
+Any other sequential scan means that a query has no index to use.
+"""
+ALLOWED_SEQ_SCANS = {
+    'get_consumers_statuses': {'consumer'},
+}
+
+
+class QueryPlansTestCase(DBTestCase):
+    """
+    Runs the queries of the db modules and checks their plans, so that a query that stops using
+    the indexes (or a new query without one) is noticed before it gets to production.
+
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_query_plans
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        settings = self.app['settings']
+        self.engine = await create_engine(
+            user=settings.POSTGRES_USER,
+            database=settings.POSTGRES_DATABASE,
+            host=settings.POSTGRES_HOST,
+            password=settings.POSTGRES_PASSWORD,
+            cursor_factory=RecordingCursor
+        )
+        RecordingCursor.statements = []
+
+    async def tearDownAsync(self):
+        self.engine.close()
+        await self.engine.wait_closed()
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute("DELETE FROM statistic WHERE period = '2000-01'")
+        await super().tearDownAsync()
+
+    async def call(self, function, *args, **kwargs):
+        RecordingCursor.label = function.__name__
+        try:
+            return await function(self.engine, *args, **kwargs)
+        finally:
+            RecordingCursor.label = None
+
+    async def run_queries(self):
+        """Calls the functions of the db modules the way a search goes through them"""
+        consumer_ip = '192.168.0.2'
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Consumer.insert().values(ip=consumer_ip, status=CONSUMER_STATUS_CHOICES.available, port='8000', slots=2)
+            )
+
+        # producer receives a search
+        job_id = await self.call(jobs.save_job, 'AACAGCAUGAGUGCGCUGGAUG', '', '', 'high', search_key='key')
+        await self.call(statistic.count_search, 'API', '2000-01')
+        await self.call(jobs.find_cached_job, 'key')
+        await self.call(jobs.sequence_exists, 'AACAGCAUGAGUGCGCUGGAUG')
+        await self.call(jobs.set_job_ordering, job_id, 'e_value')
+        for database in ['mirbase', 'pombase']:
+            await self.call(job_chunks.save_job_chunk, job_id, database)
+        await self.call(infernal_job.save_infernal_job, job_id, 'high')
+        claimed = await self.call(job_chunks.claim_created_job_chunks, job_id, ['mirbase'])
+        await self.call(job_chunks.release_job_chunks, [item['id'] for item in claimed])
+        await self.call(job_chunks.set_job_chunk_status, job_id, 'pombase', JOB_CHUNK_STATUS_CHOICES.pending)
+        infernal_job_id = await self.call(infernal_job.claim_created_infernal_job, job_id)
+        await self.call(infernal_job.release_infernal_jobs, [infernal_job_id])
+        await self.call(jobs.set_job_status, job_id, JOB_STATUS_CHOICES.started)
+
+        # scheduler dispatches it
+        await self.call(jobs.find_highest_priority_jobs)
+        await self.call(jobs.count_pending_jobs)
+        await self.call(jobs.count_pending_jobs_by_priority)
+        await self.call(consumers.find_available_consumers)
+        await self.call(consumers.find_available_consumer_slots)
+        claimed = await self.call(job_chunks.claim_job_chunks, 1)
+        await self.call(job_chunks.release_job_chunks, [item['id'] for item in claimed])
+        claimed = await self.call(job_chunks.claim_job_chunks_of_database, 'pombase', 1)
+        await self.call(job_chunks.release_job_chunks, [item['id'] for item in claimed])
+        await self.call(job_chunks.release_stale_job_chunks, 60)
+        claimed = await self.call(infernal_job.claim_infernal_jobs, 1)
+        await self.call(infernal_job.release_infernal_jobs, [item['id'] for item in claimed])
+        await self.call(infernal_job.release_stale_infernal_jobs, 60)
+
+        job_chunk_id = await self.call(job_chunks.get_job_chunk_from_job_and_database, job_id, 'mirbase')
+        await self.call(job_chunks.get_job_chunk, job_chunk_id)
+        slot = await self.call(consumers.occupy_consumer_slot, consumer_ip, str(job_chunk_id))
+        await self.call(job_chunks.set_job_chunk_consumer, job_id, 'mirbase', consumer_ip)
+        await self.call(job_chunks.get_consumer_ip_from_job_chunk, job_chunk_id)
+        await self.call(consumers.set_consumer_job_chunk_id, consumer_ip, job_id, 'mirbase')
+        await self.call(consumers.set_consumer_fields, consumer_ip, CONSUMER_STATUS_CHOICES.busy, str(job_chunk_id))
+        await self.call(consumers.set_consumer_status, consumer_ip, CONSUMER_STATUS_CHOICES.busy)
+        await self.call(consumers.get_consumer_status, consumer_ip)
+        await self.call(consumers.find_busy_consumers)
+        await self.call(consumers.find_busy_consumer_slots)
+        await self.call(consumers.get_consumers_statuses)
+        await self.call(job_chunks.start_dispatched_job_chunks, [job_id], 'mirbase', consumer_ip)
+        await self.call(job_chunks.set_job_chunk_status, job_id, 'mirbase', JOB_CHUNK_STATUS_CHOICES.started)
+        await self.call(infernal_job.start_dispatched_infernal_jobs, [job_id], consumer_ip)
+        await self.call(infernal_job.set_consumer_to_infernal_job, job_id, consumer_ip)
+        await self.call(infernal_job.set_infernal_job_status, job_id, JOB_CHUNK_STATUS_CHOICES.started)
+
+        # consumers report the results
+        await self.call(job_chunk_results.set_job_chunk_results, job_id, 'mirbase', [{
+            'rnacentral_id': 'URS%010X_9606' % index, 'description': '', 'score': 10.0, 'bias': 0.0,
+            'e_value': 1e-5, 'target_length': 100, 'alignment': 'alignment', 'alignment_length': 20,
+            'gap_count': 0, 'match_count': 20, 'nts_count1': 20, 'nts_count2': 0, 'identity': 100.0,
+            'query_coverage': 100.0, 'target_coverage': 20.0, 'gaps': 0.0, 'query_length': 20,
+            'alignment_start': 1, 'alignment_stop': 20, 'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA',
+            'result_id': index
+        } for index in range(3)])
+        await self.call(job_chunks.set_job_chunk_status, job_id, 'mirbase', JOB_CHUNK_STATUS_CHOICES.success, hits=3,
+                        stats={'target_sequences': 38589, 'residues_searched': 4657073, 'search_seconds': 0.2})
+        await self.call(consumers.free_consumer_slot, consumer_ip, slot)
+        await self.call(consumers.set_idle_consumers_available)
+
+        item = {'accession_rfam': 'RF00001', 'mdl_from': 1, 'mdl_to': 20, 'seq_from': 1, 'seq_to': 20,
+                'pipeline_pass': 1, 'gc': 0.5, 'bias': 0.0, 'score': 20.0, 'e_value': 1e-5}
+        infernal_job_id = await self.call(infernal_results.set_infernal_job_results, job_id, [dict(item)])
+        infernal_result_id = await self.call(infernal_results.get_infernal_result_id, infernal_job_id, item)
+        await self.call(infernal_results.save_alignment, infernal_result_id, 'alignment')
+        await self.call(infernal_job.set_infernal_job_status, job_id, JOB_CHUNK_STATUS_CHOICES.success)
+
+        # frontend polls the status and reads the results
+        await self.call(jobs.job_exists, job_id)
+        await self.call(jobs.get_job, job_id)
+        await self.call(jobs.get_job_query, job_id)
+        await self.call(jobs.get_job_ordering, job_id)
+        await self.call(jobs.get_jobs_statuses)
+        await self.call(jobs.get_job_chunks_status, job_id)
+        await self.call(jobs.database_used_in_search, job_id, ['mirbase'])
+        await self.call(jobs.get_infernal_job_status, job_id)
+        await self.call(jobs.get_infernal_job_results, job_id)
+        results = await self.call(jobs.get_job_results, job_id, alignment=True)
+        await self.call(jobs.get_job_result_ids, job_id)
+        await self.call(jobs.get_job_result_alignment, job_id, results[0]['id'])
+        await self.call(jobs.save_r2dt_id, job_id, 'r2dt', datetime.datetime.now())
+        await self.call(statistic.get_searches_summary, datetime.datetime.now() - datetime.timedelta(days=7))
+
+        # the last job chunk finishes, the results are archived
+        await self.call(job_chunks.set_job_chunk_status, job_id, 'pombase', JOB_CHUNK_STATUS_CHOICES.success, hits=0)
+        await self.call(jobs.update_job_status_from_job_chunks_status, job_id)
+        await self.call(jobs.get_job_results, job_id)
+
+    async def seq_scans(self, connection, statement):
+        """Names of the tables that are read with a sequential scan, partitions are named after their table"""
+        plan = await connection.scalar('EXPLAIN (FORMAT JSON) ' + statement.replace('%', '%%'))
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+
+        tables = set()
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                tables.add(re.sub(r'_(\d{8}|default)$', '', node['Relation Name']))
+            nodes.extend(node.get('Plans', []))
+        return tables
+
+    @unittest_run_loop
+    async def test_queries_use_indexes(self):
+        await self.run_queries()
+
+        statements = [
+            (label, statement) for (label, statement) in RecordingCursor.statements
+            if label and re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', statement, re.IGNORECASE)
+            and 'pg_advisory' not in statement
+        ]
+        assert len(set(label for label, statement in statements)) >= 50
+
+        async with self.app['engine'].acquire() as connection:
+            # with the tiny tables of the tests a sequential scan is always the cheapest,
+            # so the planner is told to use an index wherever there's one that fits
+            await connection.execute('SET enable_seqscan = off')
+            try:
+                for label, statement in statements:
+                    tables = await self.seq_scans(connection, statement)
+                    assert tables <= ALLOWED_SEQ_SCANS.get(label, set()), (label, tables, statement)
+            finally:
+                await connection.execute('RESET enable_seqscan')
+
+    @unittest_run_loop
+    async def test_migrations_are_applied_once(self):
+        async with self.app['engine'].acquire() as connection:
+            versions = [row.version async for row in await connection.execute('SELECT version FROM schema_migrations')]
+        assert sorted(versions) == [version for version, migration, transactional in MIGRATIONS]
+
+        assert await apply_migrations(self.app['engine']) == []
@@ -0,0 +1,162 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import uuid
+
+import sqlalchemy as sa
+from aiohttp.test_utils import unittest_run_loop
+
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+from sequence_search.db.jobs import archive_job_results
+from sequence_search.db.models import Job, JobChunk, InfernalJob, InfernalResult, JOB_STATUS_CHOICES
+from sequence_search.db.retention import expire_jobs, create_partitions, list_partitions, week_start, \
+    partition_name, RETENTION_LOCK
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class RetentionTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_retention
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.now = datetime.datetime.now()
+        self.this_week = week_start(self.now)
+        self.old_week = self.this_week - datetime.timedelta(weeks=3)  # has its own partitions
+        self.older_week = self.this_week - datetime.timedelta(weeks=5)  # rows go to the default partitions
+
+        async with self.app['engine'].acquire() as connection:
+            await create_partitions(connection, self.old_week, weeks=1)
+
+        self.new_job = await self.create_job(self.now)
+        self.old_job = await self.create_job(datetime.datetime.combine(self.old_week, datetime.time(12)))
+        self.older_job = await self.create_job(datetime.datetime.combine(self.older_week, datetime.time(12)))
+
+    async def create_job(self, submitted):
+        """A job with nhmmer results, archived results and infernal results, created in the week of submission"""
+        job_id = str(uuid.uuid4())
+        week = week_start(submitted)
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(id=job_id, query='AACAGCAUGAGUGCGCUGGAUGCUG', submitted=submitted,
+                                    status=JOB_STATUS_CHOICES.success)
+            )
+            job_chunk_id = await connection.scalar(
+                JobChunk.insert().values(job_id=job_id, database='mirbase', submitted=submitted, status='success')
+            )
+            await insert_job_chunk_results(connection, job_chunk_id, [{
+                'rnacentral_id': 'URS%010X_9606' % index, 'description': '', 'score': 10.0, 'bias': 0.0,
+                'e_value': 1e-5, 'target_length': 100, 'alignment': 'alignment', 'alignment_length': 20,
+                'gap_count': 0, 'match_count': 20, 'nts_count1': 20, 'nts_count2': 0, 'identity': 100.0,
+                'query_coverage': 100.0, 'target_coverage': 20.0, 'gaps': 0.0, 'query_length': 20,
+                'alignment_start': 1, 'alignment_stop': 20, 'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA',
+                'result_id': index
+            } for index in range(3)])
+            await connection.execute(
+                sa.text('UPDATE job_chunk_results SET week=:week WHERE job_chunk_id=:job_chunk_id'),
+                week=week, job_chunk_id=job_chunk_id
+            )
+
+            infernal_job_id = await connection.scalar(
+                InfernalJob.insert().values(job_id=job_id, submitted=submitted, status='success')
+            )
+            await connection.execute(
+                InfernalResult.insert().values(
+                    infernal_job_id=infernal_job_id, mdl_from=1, mdl_to=20, seq_from=1, seq_to=20, pipeline_pass=1,
+                    gc=0.5, bias=0.0, score=20.0, e_value=1e-5, week=week
+                )
+            )
+
+        await archive_job_results(self.app['engine'], job_id)
+        return job_id
+
+    async def count(self, table, job_id):
+        query = {
+            'jobs': 'SELECT count(*) FROM jobs WHERE id=:job_id',
+            'job_chunks': 'SELECT count(*) FROM job_chunks WHERE job_id=:job_id',
+            'job_results_archive': 'SELECT count(*) FROM job_results_archive WHERE job_id=:job_id',
+            'infernal_result': '''
+                SELECT count(*) FROM infernal_result
+                JOIN infernal_job ON infernal_job.id = infernal_result.infernal_job_id
+                WHERE infernal_job.job_id=:job_id
+            '''
+        }[table]
+        async with self.app['engine'].acquire() as connection:
+            return await connection.scalar(sa.text(query), job_id=job_id)
+
+    async def counts(self, job_id):
+        return [await self.count(table, job_id) for table in ['jobs', 'job_chunks', 'job_results_archive',
+                                                              'infernal_result']]
+
+    @unittest_run_loop
+    async def test_expire_jobs(self):
+        for job_id in [self.new_job, self.old_job, self.older_job]:
+            assert await self.counts(job_id) == [1, 1, 1, 1]
+
+        expired = await expire_jobs(self.app['engine'], retention_days=7, now=self.now)
+
+        # partitions of the old week are dropped as a whole, jobs are deleted with a single statement
+        assert sorted(expired['dropped']) == sorted([
+            partition_name(table, self.old_week)
+            for table in ['job_chunk_result_alignments', 'job_chunk_results', 'infernal_result', 'job_results_archive']
+        ])
+        assert expired['deleted'] == 2
+
+        async with self.app['engine'].acquire() as connection:
+            partitions = await list_partitions(connection)
+            assert self.old_week not in partitions
+            assert self.this_week in partitions
+
+        assert await self.counts(self.new_job) == [1, 1, 1, 1]
+        assert await self.counts(self.old_job) == [0, 0, 0, 0]
+        assert await self.counts(self.older_job) == [0, 0, 0, 0]
+
+        # nothing is left to expire
+        expired = await expire_jobs(self.app['engine'], retention_days=7, now=self.now)
+        assert expired == {'dropped': [], 'deleted': 0, 'created': []}
+
+    @unittest_run_loop
+    async def test_create_partitions(self):
+        week = self.this_week + datetime.timedelta(weeks=10)
+        async with self.app['engine'].acquire() as connection:
+            try:
+                assert sorted(await create_partitions(connection, week, weeks=1)) == sorted([
+                    partition_name(table, week)
+                    for table in ['job_chunk_result_alignments', 'job_chunk_results', 'infernal_result',
+                                  'job_results_archive']
+                ])
+                assert await create_partitions(connection, week, weeks=1) == []
+            finally:
+                for table, partition in (await list_partitions(connection)).get(week, []):
+                    await connection.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, partition))
+                    await connection.execute('DROP TABLE %s' % partition)
+
+    @unittest_run_loop
+    async def test_only_one_producer_applies_retention(self):
+        async with self.app['engine'].acquire() as connection:
+            await connection.scalar('SELECT pg_advisory_lock(%s)', RETENTION_LOCK)
+            try:
+                assert await expire_jobs(self.app['engine'], retention_days=7, now=self.now) is None
+            finally:
+                await connection.scalar('SELECT pg_advisory_unlock(%s)', RETENTION_LOCK)
+
+        assert await self.counts(self.old_job) == [1, 1, 1, 1]
+
+        async with self.app['engine'].acquire() as connection:
+            for table, partition in (await list_partitions(connection))[self.old_week]:
+                await connection.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, partition))
+                await connection.execute('DROP TABLE %s' % partition)
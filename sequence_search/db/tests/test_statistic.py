@@ -0,0 +1,99 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import datetime
+
+from aiohttp.test_utils import unittest_run_loop
+
+from sequence_search.db.jobs import save_job, set_job_status
+from sequence_search.db.models import JOB_STATUS_CHOICES
+from sequence_search.db.statistic import count_search, get_searches_summary
+from sequence_search.db.tests.test_base import DBTestCase
+
+
+class StatisticTestCase(DBTestCase):
+    """
+    Run this test with the following command:
+
+    ENVIRONMENT=TEST python -m unittest sequence_search.db.tests.test_statistic
+    """
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.period = '2000-01'  # no real searches are counted in it
+        self.since = datetime.datetime.now() - datetime.timedelta(days=1)
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DELETE FROM search_rollup')
+
+    async def tearDownAsync(self):
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DELETE FROM statistic WHERE period = %s', self.period)
+        await super().tearDownAsync()
+
+    async def rollup(self, priority):
+        async with self.app['engine'].acquire() as connection:
+            query = 'SELECT sum(searches) AS searches, sum(finished) AS finished FROM search_rollup WHERE priority = %s'
+            async for row in await connection.execute(query, priority):
+                return tuple(row.values())
+
+    @unittest_run_loop
+    async def test_count_search_concurrently(self):
+        totals = await asyncio.gather(*[count_search(self.app['engine'], 'API', self.period) for _ in range(100)])
+
+        # every search got a total of its own, none of the increments was lost
+        assert sorted(totals) == list(range(1, 101))
+        async with self.app['engine'].acquire() as connection:
+            query = 'SELECT count(*), sum(total) FROM statistic WHERE period = %s AND source = %s'
+            async for row in await connection.execute(query, self.period, 'API'):
+                assert tuple(row.values()) == (1, 100)
+
+    @unittest_run_loop
+    async def test_save_jobs_concurrently(self):
+        await asyncio.gather(*[
+            save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUG', '', '', 'high') for _ in range(20)
+        ])
+        await save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUG', 'sequence-search-test', '', 'high')
+
+        assert await self.rollup('high') == (20, 0)
+
+    @unittest_run_loop
+    async def test_finished_search_is_counted_once(self):
+        job_id = await save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUG', '', '', 'high')
+        await set_job_status(self.app['engine'], job_id, JOB_STATUS_CHOICES.started)
+        assert await self.rollup('high') == (1, 0)
+
+        # the consumers of the last job chunks report at the same time
+        await asyncio.gather(*[
+            set_job_status(self.app['engine'], job_id, JOB_STATUS_CHOICES.success) for _ in range(5)
+        ])
+        assert await self.rollup('high') == (1, 1)
+
+    @unittest_run_loop
+    async def test_get_searches_summary(self):
+        assert await get_searches_summary(self.app['engine'], self.since) == {'count': 0, 'avg_time': None}
+
+        for priority in ['high', 'low', 'low']:
+            job_id = await save_job(self.app['engine'], 'AACAGCAUGAGUGCGCUGGAUG', '', '', priority)
+        await set_job_status(self.app['engine'], job_id, JOB_STATUS_CHOICES.success)
+
+        summary = await get_searches_summary(self.app['engine'], self.since)
+        assert summary['count'] == 3
+        assert datetime.timedelta(0) <= summary['avg_time'] < datetime.timedelta(minutes=1)
+
+        summary = await get_searches_summary(self.app['engine'], self.since, high_priority=True)
+        assert summary == {'count': 1, 'avg_time': None}
+
+        # searches submitted before the period are not counted
+        summary = await get_searches_summary(self.app['engine'], datetime.datetime.now() + datetime.timedelta(hours=1))
+        assert summary == {'count': 0, 'avg_time': None}
@@ -12,23 +12,26 @@ limitations under the License.
 """
 
 import argparse
-import logging
 import asyncio
+import logging
 
 import aiohttp_jinja2
 import jinja2
 import aiohttp_cors
 from aiojobs.aiohttp import setup as setup_aiojobs
 from aiohttp import web, web_middlewares
+from prometheus_client import CollectorRegistry
 
 from . import settings
-from ..db.models import close_pg, init_pg, migrate
-from ..db.job_chunks import get_job_chunk
-from ..db.jobs import get_job_query, find_highest_priority_jobs
-from ..db.consumers import delegate_job_chunk_to_consumer, find_available_consumers, find_busy_consumers, \
-    set_consumer_status, set_consumer_job_chunk_id, CONSUMER_STATUS_CHOICES, delegate_infernal_job_to_consumer
+from ..consumer.rnacentral_databases import databases_release
+from ..db.migrations import apply_migrations
+from ..db.models import close_pg, init_pg
+from ..db.retention import expire_jobs
 from ..db.settings import get_postgres_credentials
 from .consumer_client import ConsumerClient
+from .metrics import ProducerCollector
+from .scheduler import Scheduler
+from .text_search_cache import TextSearchCache
 from .urls import setup_routes
 
 """
@@ -45,89 +48,107 @@ async def on_startup(app):
     await init_pg(app)
 
     if hasattr(app['settings'], "MIGRATE") and app['settings'].MIGRATE:
-        # create initial migrations in the database
-        await migrate(app['settings'].ENVIRONMENT)
+        # apply the new migrations to the database
+        await apply_migrations(app['engine'])
 
-    # initialize scheduling tasks to consumers in the background
-    app['check_chunks_task'] = asyncio.create_task(check_chunks_and_consumers(app))
+    # fingerprint of the database chunks, that keys the search cache, the chunks are on NFS, so it is
+    # computed in a thread and refreshed in the background, instead of on every submitted job
+    loop = asyncio.get_event_loop()
+    app['databases_release'] = await loop.run_in_executor(None, databases_release)
+    if settings.DATABASES_RELEASE_INTERVAL:
+        app['databases_release_task'] = asyncio.ensure_future(refresh_databases_release(app))
 
     # initialize ConsumerClient
     app['consumer_client'] = ConsumerClient()
 
+    # initialize the cache of EBI text search results
+    app['text_search_cache'] = TextSearchCache(
+        host=settings.MEMCACHED_HOST,
+        port=settings.MEMCACHED_PORT,
+        pool_size=settings.MEMCACHED_POOL_SIZE,
+        ttl=settings.TEXT_SEARCH_CACHE_TTL,
+        lru_size=settings.TEXT_SEARCH_CACHE_LRU_SIZE
+    )
+
+    # initialize scheduling tasks to consumers in the background
+    app['scheduler'] = Scheduler(
+        app,
+        sweep_interval=settings.SCHEDULER_SWEEP_INTERVAL,
+        dispatching_timeout=settings.SCHEDULER_DISPATCHING_TIMEOUT,
+        batch_size=settings.NHMMER_BATCH_SIZE,
+        infernal_batch_size=settings.INFERNAL_BATCH_SIZE
+    )
+    await app['scheduler'].start()
+
+    # delete old searches in the background
+    if settings.RETENTION_INTERVAL:
+        app['retention_task'] = asyncio.ensure_future(retention(app))
+
+
+async def refresh_databases_release(app):
+    """Every DATABASES_RELEASE_INTERVAL seconds, recompute the fingerprint of the database chunks in a thread"""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(settings.DATABASES_RELEASE_INTERVAL)
+        try:
+            app['databases_release'] = await loop.run_in_executor(None, databases_release)
+        except Exception as e:
+            logging.error(f"Error computing the databases release: {str(e)}")
+
+
+async def retention(app):
+    """Every RETENTION_INTERVAL seconds, drop the partitions of old searches and create the upcoming ones"""
+    while True:
+        try:
+            expired = await expire_jobs(app['engine'], retention_days=settings.RETENTION_DAYS)
+            if expired is not None:
+                logging.info("Retention: dropped partitions %s, deleted %s jobs, created partitions %s" % (
+                    expired['dropped'], expired['deleted'], expired['created']
+                ))
+        except Exception as e:
+            logging.error(f"Error applying retention: {str(e)}")
+
+        await asyncio.sleep(settings.RETENTION_INTERVAL)
+
 
 async def on_cleanup(app):
-    # proper cleanup for background task on app shutdown
-    task = app.get('check_chunks_task')
-    if task:
-        task.cancel()
+    # stop refreshing the databases release
+    databases_release_task = app.get('databases_release_task')
+    if databases_release_task:
+        databases_release_task.cancel()
         try:
-            await task
+            await databases_release_task
         except asyncio.CancelledError:
-            logging.info("Background task check_chunks_and_consumers was cancelled")
+            logging.info("Background task refresh_databases_release was cancelled")
+
+    # stop the retention task
+    retention_task = app.get('retention_task')
+    if retention_task:
+        retention_task.cancel()
+        try:
+            await retention_task
+        except asyncio.CancelledError:
+            logging.info("Background task retention was cancelled")
+
+    # proper cleanup for background tasks on app shutdown
+    scheduler = app.get('scheduler')
+    if scheduler:
+        await scheduler.stop()
 
     # close the aiohttp session if it exists
     consumer_client = app.get('consumer_client')
     if consumer_client:
         await consumer_client.close_session()
 
+    # close memcached connections
+    text_search_cache = app.get('text_search_cache')
+    if text_search_cache:
+        await text_search_cache.close()
+
     # close the database connection
     await close_pg(app)
 
 
-async def check_chunks_and_consumers(app):
-    """
-    Periodically runs a task that checks the status of consumers in the database and
-     - schedules job_chunks to run on consumers
-     - restarts stuck consumers
-    """
-    while True:
-        try:
-            # Fetch jobs and available consumers
-            unfinished_jobs = await find_highest_priority_jobs(app['engine'])
-            available_consumers = await find_available_consumers(app['engine'])
-
-            # Assign jobs to available consumers
-            while unfinished_jobs and available_consumers:
-                consumer = available_consumers.pop(0)
-                job = unfinished_jobs.pop(0)
-                query = await get_job_query(app['engine'], job[0])
-
-                if job[3] is not None:  # data from JobChunk
-                    await delegate_job_chunk_to_consumer(
-                        engine=app['engine'],
-                        consumer_ip=consumer.ip,
-                        consumer_port=consumer.port,
-                        job_id=job[0],
-                        database=job[3],
-                        query=query,
-                        consumer_client=app['consumer_client']
-                    )
-                else:  # data from InfernalJob
-                    await delegate_infernal_job_to_consumer(
-                        engine=app['engine'],
-                        consumer_ip=consumer.ip,
-                        consumer_port=consumer.port,
-                        job_id=job[0],
-                        query=query,
-                        consumer_client=app['consumer_client']
-                    )
-
-            busy_consumers = await find_busy_consumers(app['engine'])
-            for consumer in busy_consumers:
-                if consumer.job_chunk_id is None:
-                    await set_consumer_status(app['engine'], consumer.ip, CONSUMER_STATUS_CHOICES.available)
-                elif consumer.job_chunk_id != 'infernal-job':
-                    job_chunk = await get_job_chunk(app['engine'], consumer.job_chunk_id)
-                    if job_chunk.finished is not None:
-                        await set_consumer_job_chunk_id(app['engine'], consumer.ip, None)
-                        await set_consumer_status(app['engine'], consumer.ip, CONSUMER_STATUS_CHOICES.available)
-
-        except Exception as e:
-            logging.error(f"Unexpected error in check_chunks_and_consumers: {str(e)}", exc_info=True)
-        finally:
-            await asyncio.sleep(5)
-
-
 def create_app():
     logging.basicConfig(level=logging.WARNING)
 
@@ -148,6 +169,10 @@ def create_app():
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
 
+    # metrics of the scheduler, the caches and the pool, that are served at /metrics
+    app['metrics'] = CollectorRegistry()
+    app['metrics'].register(ProducerCollector(app))
+
     # setup views and routes
     setup_routes(app)
 
@@ -180,7 +205,7 @@ if __name__ == '__main__':
         dest='MIGRATE',
         default=False,
         action='store_true',
-        help='Should migrations (that clean the database) be applied on producer startup'
+        help='Should new migrations be applied on producer startup'
     )
     args = parser.parse_args()
 
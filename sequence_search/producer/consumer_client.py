@@ -17,7 +17,8 @@ import aiohttp
 import json
 from aiohttp import test_utils, web
 
-from .settings import ENVIRONMENT, CONSUMER_SUBMIT_JOB_URL, CONSUMER_SUBMIT_INFERNAL_JOB_URL
+from .settings import ENVIRONMENT, CONSUMER_SUBMIT_JOB_URL, CONSUMER_SUBMIT_JOB_BATCH_URL, \
+    CONSUMER_SUBMIT_INFERNAL_JOB_URL, CONSUMER_SUBMIT_INFERNAL_JOB_BATCH_URL
 
 
 class ConsumerClient(object):
@@ -57,6 +58,34 @@ class ConsumerClient(object):
 
         return response
 
+    async def submit_job_batch(self, consumer_ip, consumer_port, database, jobs):
+        await self.init_session()
+
+        # prepare the data for request
+        url = f"http://{consumer_ip}:{consumer_port}/{CONSUMER_SUBMIT_JOB_BATCH_URL}"
+        json_data = json.dumps({
+            "database": database,
+            "jobs": [{"job_id": job_id, "sequence": query} for job_id, query in jobs]
+        })
+        headers = {"content-type": "application/json"}
+
+        if ENVIRONMENT != "TEST":
+            logging.debug(f"Queuing batch of JobChunks to consumer: url = {url}, json_data = {json_data}, headers = {headers}, consumer_ip = {consumer_ip}")
+
+            try:
+                response = await self.session.post(url, data=json_data, headers=headers, timeout=10)
+            except asyncio.TimeoutError:
+                logging.error(f"Request to {url} timed out.")
+                raise
+        else:
+            # Mock request in TEST environment
+            logging.debug(f"Queuing batch of JobChunks to consumer: url = {url}, json_data = {json_data}, headers = {headers}, consumer_ip = {consumer_ip}")
+            request = test_utils.make_mocked_request("POST", url, headers=headers)
+            await asyncio.sleep(1)
+            response = web.Response(status=200)
+
+        return response
+
     async def submit_infernal_job(self, consumer_ip, consumer_port, job_id, query):
         await self.init_session()
 
@@ -81,3 +110,28 @@ class ConsumerClient(object):
             response = web.Response(status=200)
 
         return response
+
+    async def submit_infernal_job_batch(self, consumer_ip, consumer_port, jobs):
+        await self.init_session()
+
+        # prepare the data for request
+        url = f"http://{consumer_ip}:{consumer_port}/{CONSUMER_SUBMIT_INFERNAL_JOB_BATCH_URL}"
+        json_data = json.dumps({"jobs": [{"job_id": job_id, "sequence": query} for job_id, query in jobs]})
+        headers = {"content-type": "application/json"}
+
+        if ENVIRONMENT != "TEST":
+            logging.debug(f"Queuing batch of InfernalJobs to consumer: url = {url}, json_data = {json_data}, headers = {headers}, consumer_ip = {consumer_ip}")
+
+            try:
+                response = await self.session.post(url, data=json_data, headers=headers, timeout=10)
+            except asyncio.TimeoutError:
+                logging.error(f"Request to {url} timed out.")
+                raise
+        else:
+            # Mock request in TEST environment
+            logging.debug(f"Queuing batch of InfernalJobs to consumer: url = {url}, json_data = {json_data}, headers = {headers}, consumer_ip = {consumer_ip}")
+            request = test_utils.make_mocked_request("POST", url, headers=headers)
+            await asyncio.sleep(1)
+            response = web.Response(status=200)
+
+        return response
@@ -0,0 +1,117 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, SummaryMetricFamily
+
+
+"""
+Prometheus metrics of the producer, served at /metrics.
+
+Events are counted in the metrics below, as they happen. The state of the scheduler, the text search cache
+and the postgres pool is read from the app, when the metrics are scraped, see ProducerCollector.
+"""
+
+JOBS_SUBMITTED = Counter(
+    'sequence_search_jobs_submitted', 'Searches saved to the database', ['priority']
+)
+
+CACHED_SEARCHES = Counter(
+    'sequence_search_cached_searches', 'Searches answered with the results of an earlier job'
+)
+
+EBI_SEARCH_SECONDS = Histogram(
+    'sequence_search_ebi_search_seconds', 'Duration of the requests to EBI text search', ['status'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+)
+
+
+class ProducerCollector(object):
+    """Reads the metrics of the scheduler, the text search cache and the postgres pool of the app"""
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        engine = self.app.get('engine')
+        if engine is not None:
+            yield from engine.collect()
+
+        scheduler = self.app.get('scheduler')
+        if scheduler is not None:
+            yield from self.collect_scheduler(scheduler.metrics)
+
+        text_search_cache = self.app.get('text_search_cache')
+        if text_search_cache is not None:
+            yield from self.collect_text_search_cache(text_search_cache.metrics)
+
+    def collect_scheduler(self, metrics):
+        queue_depth = GaugeMetricFamily(
+            'sequence_search_queue_depth', 'Job chunks and infernal jobs waiting for a consumer', labels=['priority']
+        )
+        for priority, total in sorted(metrics['queue_depth_by_priority'].items(), key=lambda item: str(item[0])):
+            queue_depth.add_metric([str(priority)], total)
+        yield queue_depth
+
+        slots = GaugeMetricFamily('sequence_search_consumers_slots', 'Slots of all consumers', labels=['state'])
+        slots.add_metric(['free'], metrics['free_slots'])
+        slots.add_metric(['busy'], metrics['busy_slots'])
+        yield slots
+
+        total = metrics['free_slots'] + metrics['busy_slots']
+        yield GaugeMetricFamily(
+            'sequence_search_consumers_busy_ratio', 'Share of the consumer slots that run a search',
+            value=metrics['busy_slots'] / total if total else 0.0
+        )
+
+        yield CounterMetricFamily(
+            'sequence_search_dispatched', 'Job chunks and infernal jobs handed to consumers', value=metrics['dispatched']
+        )
+        yield CounterMetricFamily(
+            'sequence_search_released', 'Claims returned to the queue, because a consumer could not be reached',
+            value=metrics['released']
+        )
+        yield CounterMetricFamily(
+            'sequence_search_batched', 'Job chunks and infernal jobs dispatched in a batch along with another one',
+            value=metrics['batched']
+        )
+        yield CounterMetricFamily(
+            'sequence_search_notifications', 'Notifications received from postgres', value=metrics['notifications']
+        )
+        yield SummaryMetricFamily(
+            'sequence_search_dispatch_latency_seconds', 'Time between a wakeup of the scheduler and a dispatch',
+            count_value=metrics['dispatched'], sum_value=metrics['dispatch_latency_sum']
+        )
+        yield SummaryMetricFamily(
+            'sequence_search_queue_wait_seconds', 'Time between the submission of a job and a dispatch',
+            count_value=metrics['dispatched'], sum_value=metrics['queue_wait_sum']
+        )
+
+    def collect_text_search_cache(self, metrics):
+        requests = CounterMetricFamily(
+            'sequence_search_text_search_cache_requests', 'Text search requests by where the results came from',
+            labels=['result']
+        )
+        for result in ['lru_hits', 'memcached_hits', 'misses', 'coalesced']:
+            requests.add_metric([result], metrics[result])
+        yield requests
+
+        yield CounterMetricFamily(
+            'sequence_search_memcached_errors', 'Failed memcached calls', value=metrics['errors']
+        )
+
+        lookups = metrics['memcached_hits'] + metrics['misses']
+        yield GaugeMetricFamily(
+            'sequence_search_memcached_hit_ratio', 'Share of the memcached lookups that found the results',
+            value=metrics['memcached_hits'] / lookups if lookups else 0.0
+        )
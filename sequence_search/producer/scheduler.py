@@ -0,0 +1,321 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+
+from ..db import DoesNotExist, unit_of_work
+from ..db.job_chunks import get_job_chunk, claim_job_chunks, claim_job_chunks_of_database, release_job_chunks, \
+    release_stale_job_chunks
+from ..db.infernal_job import get_infernal_job, claim_infernal_jobs, release_infernal_jobs, \
+    release_stale_infernal_jobs
+from ..db.jobs import count_pending_jobs_by_priority
+from ..db.consumers import delegate_job_chunk_to_consumer, delegate_job_chunk_batch_to_consumer, \
+    delegate_infernal_job_to_consumer, delegate_infernal_job_batch_to_consumer, \
+    find_available_consumer_slots, find_busy_consumer_slots, free_consumer_slot, set_idle_consumers_available
+from ..db.models import DISPATCH_CHANNEL
+
+
+class Scheduler(object):
+    """
+    Schedules job_chunks and infernal_jobs to run on consumers.
+
+    Database triggers send a notification on DISPATCH_CHANNEL whenever a job_chunk or an infernal_job
+    becomes pending or a consumer becomes available. The scheduler LISTENs to that channel and dispatches
+    work right away. A periodic sweep runs every `sweep_interval` seconds anyway, in case a notification
+    was lost (e.g. the listening connection was dropped), and frees the slots of stuck consumers.
+
+    Work is claimed with SELECT ... FOR UPDATE SKIP LOCKED before it is sent to a consumer, so several
+    producers can run against the same database. Claims that were not started by a consumer within
+    `dispatching_timeout` seconds (e.g. the producer died) are returned to the queue by the sweep.
+
+    A consumer runs as many job_chunks/infernal_jobs at a time as it has slots, the scheduler fills every
+    free slot of every available consumer.
+
+    Every claimed job_chunk takes up to `batch_size - 1` other pending job_chunks of the same database
+    along, the consumer searches them with a single nhmmer run in a single slot, instead of reading
+    the database chunk once per job_chunk. Likewise, every claimed infernal_job takes up to
+    `infernal_batch_size - 1` other pending infernal_jobs along, to be searched with a single cmscan run.
+    """
+    def __init__(self, app, sweep_interval=5, reconnect_interval=5, dispatching_timeout=60, batch_size=1,
+                 infernal_batch_size=1):
+        self.app = app
+        self.sweep_interval = sweep_interval
+        self.reconnect_interval = reconnect_interval
+        self.dispatching_timeout = dispatching_timeout
+        self.batch_size = batch_size
+        self.infernal_batch_size = infernal_batch_size
+
+        self.running = False
+        self.wakeup = None
+        self.woken_at = None
+        self.tasks = []
+
+        self.metrics = {
+            'queue_depth': 0,  # pending job_chunks and infernal_jobs seen by the last dispatch
+            'queue_depth_by_priority': {},  # same, by priority of their job
+            'available_consumers': 0,  # available consumers seen by the last dispatch
+            'free_slots': 0,  # free slots of the available consumers seen by the last dispatch
+            'busy_slots': 0,  # busy slots of all consumers seen by the last sweep
+            'notifications': 0,  # notifications received from postgres
+            'dispatches': 0,  # dispatch rounds, caused either by notifications or by sweeps
+            'sweeps': 0,  # dispatch rounds caused by the periodic sweep
+            'dispatched': 0,  # job_chunks and infernal_jobs handed to consumers
+            'released': 0,  # claims returned to the queue, because a consumer could not be reached
+            'batched': 0,  # job_chunks/infernal_jobs dispatched along with another one, see batch_size
+            'dispatch_latency_sum': 0.0,  # seconds between a wakeup and the dispatch of a job_chunk/infernal_job
+            'dispatch_latency_max': 0.0,
+            'queue_wait_sum': 0.0,  # seconds between job submission and the dispatch of a job_chunk/infernal_job
+            'queue_wait_max': 0.0,
+        }
+
+    async def start(self):
+        self.running = True
+        self.wakeup = asyncio.Event()
+        self.tasks = [
+            asyncio.ensure_future(self.listen()),
+            asyncio.ensure_future(self.run()),
+        ]
+
+    async def stop(self):
+        # the flag and the wakeup stop the loops even if cancellation gets swallowed,
+        # e.g. by `except Exception` in db functions on python < 3.8
+        self.running = False
+        self.wakeup.set()
+        for task in self.tasks:
+            task.cancel()
+
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        logging.info("Scheduler was stopped")
+
+    def notify(self):
+        """Wake up the scheduler, e.g. after a notification was received"""
+        if self.woken_at is None:
+            self.woken_at = time.monotonic()
+        self.wakeup.set()
+
+    async def listen(self):
+        """Keep a connection that LISTENs to DISPATCH_CHANNEL and wake up the scheduler on every notification"""
+        while self.running:
+            try:
+                async with self.app['engine'].acquire() as connection:
+                    await connection.execute('LISTEN %s' % DISPATCH_CHANNEL)
+                    notifies = connection.connection.notifies
+
+                    # the sweep may have missed the notifications sent while we were not listening
+                    self.notify()
+
+                    while self.running:
+                        await notifies.get()
+                        self.metrics['notifications'] += 1
+                        self.notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Scheduler lost connection to the database: {str(e)}")
+                await asyncio.sleep(self.reconnect_interval)
+
+    async def run(self):
+        """Dispatch work whenever the scheduler is woken up, or after sweep_interval seconds at the latest"""
+        swept_at = time.monotonic()
+        while self.running:
+            try:
+                timeout = max(swept_at + self.sweep_interval - time.monotonic(), 0)
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            if not self.running:
+                break
+
+            self.wakeup.clear()
+            try:
+                if time.monotonic() - swept_at >= self.sweep_interval:
+                    swept_at = time.monotonic()
+                    await self.sweep()
+                await self.dispatch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Unexpected error in scheduler: {str(e)}", exc_info=True)
+
+    async def sweep(self):
+        """
+        Runs every sweep_interval seconds, in addition to the dispatch:
+         - returns stale claims to the queue
+         - frees the slots of stuck consumers
+        """
+        self.metrics['sweeps'] += 1
+        if self.woken_at is None:
+            self.woken_at = time.monotonic()
+
+        async with unit_of_work(self.app['engine'], transaction=False) as connection:
+            await release_stale_job_chunks(connection, self.dispatching_timeout)
+            await release_stale_infernal_jobs(connection, self.dispatching_timeout)
+
+            busy_slots = await find_busy_consumer_slots(connection)
+            self.metrics['busy_slots'] = len(busy_slots)
+            for consumer_slot in busy_slots:
+                if await self.slot_is_finished(consumer_slot, connection):
+                    await free_consumer_slot(connection, consumer_slot.ip, consumer_slot.slot)
+
+            await set_idle_consumers_available(connection)
+
+    async def slot_is_finished(self, consumer_slot, connection):
+        """
+        Whether the job_chunk or infernal_job, that runs in a busy slot, is finished, so that the slot can be freed.
+        Work, that was deleted from the database, is finished. Slots of infernal jobs, that were occupied before
+        consumer_slot.infernal_job_id was recorded, are kept.
+        """
+        try:
+            if consumer_slot.infernal_job_id is not None:
+                work = await get_infernal_job(connection, consumer_slot.infernal_job_id)
+            elif consumer_slot.job_chunk_id == 'infernal-job':
+                return False
+            elif consumer_slot.job_chunk_id is not None:
+                work = await get_job_chunk(connection, consumer_slot.job_chunk_id)
+            else:
+                return True
+        except DoesNotExist:
+            return True
+
+        return work.finished is not None
+
+    async def dispatch(self):
+        """
+        Claims pending job_chunks and infernal_jobs and schedules them to run on available consumers.
+
+        Claims are committed before the consumers are called (they update the claimed rows), and no connection
+        is held while waiting for the consumers.
+        """
+        engine = self.app['engine']
+        woken_at, self.woken_at = self.woken_at or time.monotonic(), None
+        self.metrics['dispatches'] += 1
+
+        async with unit_of_work(engine, transaction=False) as connection:
+            free_slots = await find_available_consumer_slots(connection)
+            self.metrics['available_consumers'] = len(set(consumer.ip for consumer in free_slots))
+            self.metrics['free_slots'] = len(free_slots)
+            self.metrics['queue_depth_by_priority'] = await count_pending_jobs_by_priority(connection)
+            self.metrics['queue_depth'] = sum(self.metrics['queue_depth_by_priority'].values())
+            if not free_slots:
+                return
+
+            # claim as much work as there are free slots from both queues, give back what doesn't fit
+            infernal_jobs = await claim_infernal_jobs(connection, len(free_slots))
+            job_chunks = await claim_job_chunks(connection, len(free_slots))
+            claimed = sorted(infernal_jobs + job_chunks, key=priority_order)
+            await self.release(claimed[len(free_slots):], connection)
+
+            batches = [[job] + await self.claim_batch(job, connection) for job in claimed[:len(free_slots)]]
+
+        # Assign jobs to free consumer slots
+        rejected = []
+        for consumer, batch in zip(free_slots, batches):
+            job = batch[0]
+            if len(batch) > 1 and job.database is None:  # InfernalJobs
+                accepted = await delegate_infernal_job_batch_to_consumer(
+                    engine=engine,
+                    consumer_ip=consumer.ip,
+                    consumer_port=consumer.port,
+                    jobs=[(item.job_id, item.query) for item in batch],
+                    consumer_client=self.app['consumer_client']
+                )
+            elif len(batch) > 1:  # JobChunks of the same database
+                accepted = await delegate_job_chunk_batch_to_consumer(
+                    engine=engine,
+                    consumer_ip=consumer.ip,
+                    consumer_port=consumer.port,
+                    database=job.database,
+                    jobs=[(item.job_id, item.query) for item in batch],
+                    consumer_client=self.app['consumer_client']
+                )
+            elif job.database is not None:  # data from JobChunk
+                accepted = await delegate_job_chunk_to_consumer(
+                    engine=engine,
+                    consumer_ip=consumer.ip,
+                    consumer_port=consumer.port,
+                    job_id=job.job_id,
+                    database=job.database,
+                    query=job.query,
+                    consumer_client=self.app['consumer_client']
+                )
+            else:  # data from InfernalJob
+                accepted = await delegate_infernal_job_to_consumer(
+                    engine=engine,
+                    consumer_ip=consumer.ip,
+                    consumer_port=consumer.port,
+                    job_id=job.job_id,
+                    query=job.query,
+                    consumer_client=self.app['consumer_client']
+                )
+
+            if accepted:
+                for item in batch:
+                    self.record_dispatch(woken_at, submitted=item.submitted)
+                self.metrics['batched'] += len(batch) - 1
+            else:
+                self.metrics['released'] += len(batch)
+                rejected.extend(batch)
+
+        await self.release(rejected, engine)
+
+    async def claim_batch(self, job, connection):
+        """Claims the pending job_chunks or infernal_jobs, that are searched along with the claimed one"""
+        if job.database is None:
+            if self.infernal_batch_size <= 1:
+                return []
+            return await claim_infernal_jobs(connection, self.infernal_batch_size - 1)
+
+        if self.batch_size <= 1:
+            return []
+        return await claim_job_chunks_of_database(connection, job.database, self.batch_size - 1)
+
+    async def release(self, claimed, engine):
+        """Return claimed job_chunks and infernal_jobs to the queue"""
+        job_chunk_ids = [job.id for job in claimed if job.database is not None]
+        infernal_job_ids = [job.id for job in claimed if job.database is None]
+        if not job_chunk_ids and not infernal_job_ids:
+            return
+
+        async with unit_of_work(engine, transaction=False) as connection:
+            if job_chunk_ids:
+                await release_job_chunks(connection, job_chunk_ids)
+            if infernal_job_ids:
+                await release_infernal_jobs(connection, infernal_job_ids)
+
+    def record_dispatch(self, woken_at, submitted=None):
+        latency = time.monotonic() - woken_at
+        self.metrics['dispatched'] += 1
+        self.metrics['dispatch_latency_sum'] += latency
+        self.metrics['dispatch_latency_max'] = max(self.metrics['dispatch_latency_max'], latency)
+
+        if submitted is not None:
+            wait = max((datetime.datetime.now() - submitted).total_seconds(), 0.0)
+            self.metrics['queue_wait_sum'] += wait
+            self.metrics['queue_wait_max'] = max(self.metrics['queue_wait_max'], wait)
+
+
+def priority_order(job):
+    """Same order as `ORDER BY priority, submitted` in postgres, where nulls come last"""
+    return (
+        job.priority is None, job.priority or '',
+        job.submitted is None, job.submitted or datetime.datetime.min
+    )
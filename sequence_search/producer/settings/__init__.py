@@ -30,11 +30,54 @@ Or, passing the custom setting as a keyword argument when initialising settings
 PROJECT_ROOT = pathlib.Path(__file__).parent.parent
 
 CONSUMER_SUBMIT_JOB_URL = 'submit-job'
+CONSUMER_SUBMIT_JOB_BATCH_URL = 'submit-job-batch'
 CONSUMER_SUBMIT_INFERNAL_JOB_URL = 'submit-infernal-job'
+CONSUMER_SUBMIT_INFERNAL_JOB_BATCH_URL = 'submit-infernal-job-batch'
+
+# the scheduler dispatches job_chunks as soon as postgres notifies it, this is the interval of
+# the safety-net sweep that also restarts stuck consumers (in seconds)
+SCHEDULER_SWEEP_INTERVAL = 5
+
+# job_chunks claimed by a producer, but not started by a consumer within this time (in seconds),
+# are returned to the queue; consumers are expected to answer within 10 seconds, see ConsumerClient
+SCHEDULER_DISPATCHING_TIMEOUT = 60
+
+# up to this many pending job_chunks of the same database are sent to a consumer together
+# and searched with a single nhmmer run in a single slot (1 - every job_chunk runs on its own)
+NHMMER_BATCH_SIZE = 4
+
+# up to this many pending infernal_jobs are searched with a single cmscan run in a single slot,
+# which loads Rfam.cm once for all of them (1 - every infernal_job runs on its own)
+INFERNAL_BATCH_SIZE = 10
+
+# searches older than RETENTION_DAYS are deleted every RETENTION_INTERVAL seconds (0 - never)
+# by dropping weekly partitions, see db/retention.py
+RETENTION_DAYS = 7
+RETENTION_INTERVAL = 60 * 60
+
+# fingerprint of the database chunks, that is part of the search cache key, is computed at startup and then
+# every DATABASES_RELEASE_INTERVAL seconds in a thread, see rnacentral_databases.databases_release (0 - never again)
+DATABASES_RELEASE_INTERVAL = 5 * 60
+
+# pool of connections to postgres, shared by the request handlers, the scheduler and the background jobs,
+# see db/pool.py and the pool metrics at /metrics
+POSTGRES_POOL_MINSIZE = 1
+POSTGRES_POOL_MAXSIZE = 20
+# seconds to wait for a free connection, before the request fails (0 - wait forever)
+POSTGRES_POOL_ACQUIRE_TIMEOUT = 10.0
+# statements that run longer than this fail with SQLError and their connection is closed (in seconds)
+POSTGRES_STATEMENT_TIMEOUT = 60.0
 
 MIN_QUERY_LENGTH = 10
 MAX_QUERY_LENGTH = 7000
 
+# EBI text search results are cached in memcached (MEMCACHED_HOST is set in environment-specific files)
+# and in an in-process LRU in front of it, see text_search_cache.py
+MEMCACHED_PORT = 11211
+MEMCACHED_POOL_SIZE = 8
+TEXT_SEARCH_CACHE_TTL = 60 * 60  # seconds
+TEXT_SEARCH_CACHE_LRU_SIZE = 256  # entries
+
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'LOCAL')
 
 # add settings from environment-specific files
@@ -3,3 +3,6 @@ HOST = '0.0.0.0'
 
 # TCP port for the server to listen on
 PORT = 8002
+
+# memcached server that caches EBI text search results
+MEMCACHED_HOST = 'localhost'
@@ -3,3 +3,9 @@ HOST = 'localhost'
 
 # TCP port for the server to listen on
 PORT = 8002
+
+# memcached server that caches EBI text search results
+MEMCACHED_HOST = 'localhost'
+
+# tests call db/retention.py directly
+RETENTION_INTERVAL = 0
@@ -0,0 +1,99 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""
+Streaming JSON responses, for results that are too large to be serialized in one go.
+
+Rows are serialized as they come out of the database and sent in chunks of about CHUNK_SIZE bytes,
+either as a JSON array (the same body as web.json_response) or as NDJSON, one row per line.
+orjson is used to serialize the rows, if it's installed.
+"""
+
+CHUNK_SIZE = 64 * 1024
+
+NDJSON = 'application/x-ndjson'
+
+# values of the `stream` query parameter
+STREAM_FORMATS = {'json': 'application/json', 'ndjson': NDJSON}
+
+
+def dumps(item):
+    """Serializes an item to JSON bytes, with orjson if it's installed"""
+    if orjson is not None:
+        # keys of the sqlalchemy rows are str subclasses, that orjson only takes with OPT_NON_STR_KEYS
+        return orjson.dumps(item, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(item).encode('utf-8')
+
+
+def stream_format(request):
+    """Content type of the streaming response requested with ?stream=json or ?stream=ndjson, None by default"""
+    return STREAM_FORMATS.get(request.query.get('stream'))
+
+
+async def stream_json(request, rows, content_type='application/json'):
+    """
+    Sends the rows of an async generator as a streaming response.
+
+    The first row is read before the response is started, so that the errors of the query (e.g. the
+    DatabaseConnectionError of the db helpers) are raised to the view, that can still respond with an error.
+    A later error can only cut the response short.
+
+    :param request: aiohttp request
+    :param rows: async generator of json-serializable items, it is closed in the end
+    :param content_type: application/json for a JSON array or application/x-ndjson for NDJSON
+    :return: web.StreamResponse
+    """
+    if content_type == NDJSON:
+        opening, separator, closing = b'', b'\n', b'\n'
+    else:
+        opening, separator, closing = b'[', b',', b']'
+
+    try:
+        try:
+            first = await rows.__anext__()
+        except StopAsyncIteration:
+            return web.Response(body=b'[]' if opening else b'', content_type=content_type, charset='utf-8')
+
+        response = web.StreamResponse()
+        response.content_type = content_type
+        response.charset = 'utf-8'
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        chunk, size = [dumps(first)], 0
+        prefix = opening
+        async for row in rows:
+            item = dumps(row)
+            chunk.append(item)
+            size += len(item)
+            if size >= CHUNK_SIZE:
+                await response.write(prefix + separator.join(chunk))
+                chunk, size = [], 0
+                prefix = separator
+
+        await response.write((prefix + separator.join(chunk) if chunk else b'') + closing)
+        await response.write_eof()
+        return response
+    finally:
+        await rows.aclose()
@@ -14,5 +14,8 @@ limitations under the License.
 from .test_facets_search import *
 from .test_job_result import *
 from .test_job_status import *
+from .test_metrics import *
 from .test_r2dt import *
+from .test_scheduler import *
 from .test_submit_job import *
+from .test_text_search_cache import *
@@ -12,16 +12,22 @@ limitations under the License.
 """
 
 import datetime
+import importlib
 import logging
 import uuid
+from unittest import mock
 
 from aiohttp.test_utils import unittest_run_loop
 from aiohttp.test_utils import AioHTTPTestCase
 
-from sequence_search.db.models import Job, JobChunk, JobChunkResult, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
+from sequence_search.db.models import Job, JobChunk, JobChunkResult, JobChunkResultAlignment, JOB_STATUS_CHOICES, \
+    JOB_CHUNK_STATUS_CHOICES
 from sequence_search.db.settings import get_postgres_credentials
 from sequence_search.producer.__main__ import create_app
 
+# the views package exports the view under the name of its module
+facets_search = importlib.import_module('sequence_search.producer.views.facets_search')
+
 
 """
 Run these tests with:
@@ -69,7 +75,7 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
                 )
             )
 
-            await connection.scalar(
+            result_id = await connection.scalar(
                 JobChunkResult.insert().values(
                     job_chunk_id=self.job_chunk_id1,
                     rnacentral_id='URS000075D2D2_10090',
@@ -78,7 +84,6 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
                     bias=0.7,
                     e_value=32,
                     target_length=98,
-                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
                     alignment_length=22,
                     gap_count=0,
                     match_count=18,
@@ -89,11 +94,20 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
                     target_coverage=0,
                     gaps=0,
                     query_length=30,
+                    alignment_start=22,
+                    alignment_stop=43,
                     result_id=1
                 )
             )
+            await connection.execute(
+                JobChunkResultAlignment.insert().values(
+                    job_chunk_result_id=result_id,
+                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
+                    alignment_sequence='GAGUUCGAGGCCAGCCUGCUCA'
+                )
+            )
 
-            await connection.scalar(
+            result_id = await connection.scalar(
                 JobChunkResult.insert().values(
                     job_chunk_id=self.job_chunk_id1,
                     rnacentral_id='URS000004F5D8_10090',
@@ -102,7 +116,6 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
                     bias=0.7,
                     e_value=32,
                     target_length=98,
-                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
                     alignment_length=22,
                     gap_count=0,
                     match_count=18,
@@ -113,9 +126,18 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
                     target_coverage=0,
                     gaps=0,
                     query_length=30,
+                    alignment_start=22,
+                    alignment_stop=43,
                     result_id=1
                 )
             )
+            await connection.execute(
+                JobChunkResultAlignment.insert().values(
+                    job_chunk_result_id=result_id,
+                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
+                    alignment_sequence='GAGUUCGAGGCCAGCCUGCUCA'
+                )
+            )
 
     async def tearDownAsync(self):
         async with self.app['engine'].acquire() as connection:
@@ -132,3 +154,23 @@ class EBISearchProxyTestCase(AioHTTPTestCase):
         url = self.app.router["facets-search"].url_for(job_id=str(self.job_id))
         async with self.client.get(path=url) as response:
             assert response.status == 200
+
+    @unittest_run_loop
+    async def test_cached_text_search_skips_the_database(self):
+        async def get_text_search_results(rnacentral_ids, job_id, query, start, size, facetcount, ENVIRONMENT):
+            return {'entries': [{'id': rnacentral_id, 'fields': {}} for rnacentral_id in rnacentral_ids],
+                    'facets': [], 'hitCount': len(rnacentral_ids)}
+
+        get_job_result_ids = mock.Mock(wraps=facets_search.get_job_result_ids)
+        url = self.app.router["facets-search"].url_for(job_id=str(self.job_id))
+        with mock.patch.object(facets_search, 'get_text_search_results', get_text_search_results), \
+                mock.patch.object(facets_search, 'get_job_result_ids', get_job_result_ids):
+            for _ in range(2):
+                async with self.client.get(path=url) as response:
+                    assert response.status == 200
+                    data = await response.json()
+                    assert data['hitCount'] == 2
+                    assert data['textSearchError'] is False
+
+        # the second request is served from the text search cache
+        assert get_job_result_ids.call_count == 1
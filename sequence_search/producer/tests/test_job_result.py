@@ -12,14 +12,20 @@ limitations under the License.
 """
 
 import datetime
+import json
 import logging
 import uuid
+from unittest import mock
 
 from aiohttp.test_utils import AioHTTPTestCase
 from aiohttp.test_utils import unittest_run_loop
 
-from sequence_search.db.models import Job, JobChunk, JobChunkResult, JOB_STATUS_CHOICES, JOB_CHUNK_STATUS_CHOICES
+from sequence_search.db.models import Job, JobChunk, JobChunkResult, JobChunkResultAlignment, JOB_STATUS_CHOICES, \
+    JOB_CHUNK_STATUS_CHOICES
+from sequence_search.db.job_chunk_results import insert_job_chunk_results
+from sequence_search.db.jobs import archive_job_results
 from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.producer import streaming
 from sequence_search.producer.__main__ import create_app
 
 
@@ -30,7 +36,7 @@ ENVIRONMENT=TEST python3 -m unittest sequence_search.producer.tests.test_job_res
 """
 
 
-class SubmitJobTestCase(AioHTTPTestCase):
+class JobResultTestCase(AioHTTPTestCase):
     async def get_application(self):
         logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
         app = create_app()
@@ -69,7 +75,7 @@ class SubmitJobTestCase(AioHTTPTestCase):
                 )
             )
 
-            await connection.scalar(
+            self.result_id = await connection.scalar(
                 JobChunkResult.insert().values(
                     job_chunk_id=self.job_chunk_id1,
                     rnacentral_id='URS000075D2D2_10090',
@@ -78,7 +84,6 @@ class SubmitJobTestCase(AioHTTPTestCase):
                     bias=0.7,
                     e_value=32,
                     target_length=98,
-                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
                     alignment_length=22,
                     gap_count=0,
                     match_count=18,
@@ -89,13 +94,23 @@ class SubmitJobTestCase(AioHTTPTestCase):
                     target_coverage=0,
                     gaps=0,
                     query_length=30,
+                    alignment_start=22,
+                    alignment_stop=43,
                     result_id=1
                 )
             )
+            await connection.execute(
+                JobChunkResultAlignment.insert().values(
+                    job_chunk_result_id=self.result_id,
+                    alignment="Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
+                    alignment_sequence='GAGUUCGAGGCCAGCCUGCUCA'
+                )
+            )
 
     async def tearDownAsync(self):
         async with self.app['engine'].acquire() as connection:
             await connection.execute('DELETE FROM job_chunk_results')
+            await connection.execute('DELETE FROM job_results_archive')
             await connection.execute('DELETE FROM job_chunks')
             await connection.execute('DELETE FROM jobs')
 
@@ -109,13 +124,13 @@ class SubmitJobTestCase(AioHTTPTestCase):
             data = await response.json()
 
             results = {
+                "id": self.result_id,
                 "rnacentral_id": 'URS000075D2D2_10090',
                 "description": 'Mus musculus miR - 1195 stem - loop',
                 "score": 6.5,
                 "bias": 0.7,
                 "e_value": 32.0,
                 "target_length": 98,
-                "alignment": "Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
                 "alignment_length": 22,
                 "gap_count": 0,
                 "match_count": 18,
@@ -127,7 +142,84 @@ class SubmitJobTestCase(AioHTTPTestCase):
                 "gaps": 0.0,
                 "query_length": 30,
                 "result_id": 1,
+                "alignment_start": 22,
+                "alignment_stop": 43,
                 'species_priority': 'b'
             }
 
             assert data[0] == results
+
+        # alignments are returned only if requested
+        async with self.client.get(path=url, params={'alignment': 'true'}) as response:
+            assert response.status == 200
+            data = await response.json()
+            assert data[0]['alignment_sequence'] == 'GAGUUCGAGGCCAGCCUGCUCA'
+            assert data[0]['alignment'].startswith('Query  8 GAGUUUGAGACCAGCCUGGCCA 29')
+
+    @unittest_run_loop
+    async def test_job_result_stream(self):
+        async with self.app['engine'].acquire() as connection:
+            await insert_job_chunk_results(connection, self.job_chunk_id1, [{
+                'rnacentral_id': 'URS%010X_9606' % index, 'description': '', 'score': 10.0 + index, 'bias': 0.0,
+                'e_value': 1e-5, 'target_length': 100, 'alignment': 'alignment', 'alignment_length': 20,
+                'gap_count': 0, 'match_count': 20, 'nts_count1': 20, 'nts_count2': 0, 'identity': 100.0,
+                'query_coverage': 100.0, 'target_coverage': 20.0, 'gaps': 0.0, 'query_length': 20,
+                'alignment_start': 1, 'alignment_stop': 20, 'alignment_sequence': 'AACAGCAUGAGUGCGCUGGA',
+                'result_id': index
+            } for index in range(250)])
+
+        url = self.app.router["job-result"].url_for(job_id=self.job_id)
+        for alignment in ['false', 'true']:
+            async with self.client.get(path=url, params={'alignment': alignment}) as response:
+                expected = await response.json()
+            assert len(expected) == 251
+
+            # the rows are sent in several chunks
+            with mock.patch.object(streaming, 'CHUNK_SIZE', 1000):
+                async with self.client.get(path=url, params={'alignment': alignment, 'stream': 'json'}) as response:
+                    assert response.status == 200
+                    assert response.content_type == 'application/json'
+                    assert await response.json() == expected
+
+                async with self.client.get(path=url, params={'alignment': alignment, 'stream': 'ndjson'}) as response:
+                    assert response.status == 200
+                    assert response.content_type == 'application/x-ndjson'
+                    lines = (await response.text()).split('\n')
+                    assert lines[-1] == ''
+                    assert [json.loads(line) for line in lines[:-1]] == expected
+
+        # results of archived jobs are streamed in the same order
+        await archive_job_results(self.app['engine'], self.job_id)
+        async with self.client.get(path=url, params={'stream': 'json'}) as response:
+            assert [result['rnacentral_id'] for result in await response.json()] == \
+                [result['rnacentral_id'] for result in expected]
+
+    @unittest_run_loop
+    async def test_job_result_stream_empty(self):
+        url = self.app.router["job-result"].url_for(job_id='another-job')
+        async with self.client.get(path=url, params={'stream': 'json'}) as response:
+            assert response.status == 200
+            assert await response.json() == []
+
+        async with self.client.get(path=url, params={'stream': 'ndjson'}) as response:
+            assert response.status == 200
+            assert await response.text() == ''
+
+    @unittest_run_loop
+    async def test_job_result_alignment(self):
+        url = self.app.router["job-result-alignment"].url_for(job_id=self.job_id, result_id=str(self.result_id))
+        async with self.client.get(path=url) as response:
+            assert response.status == 200
+            data = await response.json()
+            assert data == {
+                "id": self.result_id,
+                "rnacentral_id": 'URS000075D2D2_10090',
+                "alignment": "Query  8 GAGUUUGAGACCAGCCUGGCCA 29\n| | | | | | | | | | | | | | | | | |\nSbjct_10090\n22\nGAGUUCGAGGCCAGCCUGCUCA\n43",
+                "alignment_sequence": 'GAGUUCGAGGCCAGCCUGCUCA'
+            }
+
+    @unittest_run_loop
+    async def test_job_result_alignment_not_found(self):
+        url = self.app.router["job-result-alignment"].url_for(job_id='another-job', result_id=str(self.result_id))
+        async with self.client.get(path=url) as response:
+            assert response.status == 404
@@ -0,0 +1,86 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import logging
+
+import sqlalchemy as sa
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.producer.__main__ import create_app
+
+"""
+Run these tests with:
+
+ENVIRONMENT=TEST python3 -m unittest sequence_search.producer.tests.test_metrics
+"""
+
+
+class MetricsTestCase(AioHTTPTestCase):
+    async def get_application(self):
+        logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
+        app = create_app()
+        # create_app sets settings.ENVIRONMENT to LOCAL for the tests, the next app would connect to the LOCAL db
+        for key, value in get_postgres_credentials(ENVIRONMENT='TEST')._asdict().items():
+            setattr(app['settings'], key, value)
+        return app
+
+    async def tearDownAsync(self):
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(sa.text('DELETE FROM jobs WHERE description=:description'),
+                                     description='sequence-search-test')
+        await super().tearDownAsync()
+
+    async def get_metrics(self):
+        async with self.client.get(path='/metrics') as response:
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith('text/plain')
+            text = await response.text()
+
+        samples = {}
+        for family in text_string_to_metric_families(text):
+            for sample in family.samples:
+                samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+        return samples
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        submitted = REGISTRY.get_sample_value('sequence_search_jobs_submitted_total', {'priority': 'db-seq-test'}) or 0
+
+        # test searches are not counted in the statistic table
+        data = json.dumps({"query": ">sequence-search-test\nAACAGCAUGAGUGCGCUGGAUGCUG", "databases": ["mirbase"]})
+        async with self.client.post(path=self.app.router['submit-job'].url_for(), data=data) as response:
+            assert response.status == 201
+
+        samples = await self.get_metrics()
+        assert samples[('sequence_search_jobs_submitted_total', (('priority', 'db-seq-test'),))] == submitted + 1
+
+        # state of the pool, the scheduler and the text search cache
+        assert samples[('sequence_search_db_pool_connections', (('state', 'max'),))] == \
+            self.app['settings'].POSTGRES_POOL_MAXSIZE
+        assert samples[('sequence_search_db_pool_wait_seconds_count', ())] > 0
+        assert ('sequence_search_consumers_busy_ratio', ()) in samples
+        assert ('sequence_search_dispatched_total', ()) in samples
+        assert samples[('sequence_search_text_search_cache_requests_total', (('result', 'misses'),))] == 0
+        assert samples[('sequence_search_memcached_hit_ratio', ())] == 0.0
+
+    @unittest_run_loop
+    async def test_queue_depth_by_priority(self):
+        self.app['scheduler'].metrics['queue_depth_by_priority'] = {'high': 2, 'low': 1}
+        samples = await self.get_metrics()
+        assert samples[('sequence_search_queue_depth', (('priority', 'high'),))] == 2
+        assert samples[('sequence_search_queue_depth', (('priority', 'low'),))] == 1
@@ -0,0 +1,442 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import datetime
+import logging
+import uuid
+
+import sqlalchemy as sa
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+from sequence_search.db.models import init_pg, close_pg, Consumer, Job, JobChunk, InfernalJob, JOB_STATUS_CHOICES, \
+    JOB_CHUNK_STATUS_CHOICES, CONSUMER_STATUS_CHOICES
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.db.tests.test_base import CountingEngine
+from sequence_search.producer.scheduler import Scheduler
+
+
+"""
+Run these tests with:
+
+ENVIRONMENT=TEST python3 -m unittest sequence_search.producer.tests.test_scheduler
+"""
+
+
+class FakeResponse(object):
+    def __init__(self, status=201):
+        self.status = status
+
+    async def text(self):
+        return 'status %s' % self.status
+
+
+class FakeConsumerClient(object):
+    """Records the job_chunks submitted to consumers instead of sending http requests"""
+    def __init__(self, status=201):
+        self.status = status
+        self.submitted = []
+
+    async def submit_job(self, consumer_ip, consumer_port, job_id, database, query):
+        self.submitted.append((consumer_ip, job_id, database))
+        return FakeResponse(self.status)
+
+    async def submit_job_batch(self, consumer_ip, consumer_port, database, jobs):
+        self.submitted.append((consumer_ip, tuple(job_id for job_id, query in jobs), database))
+        return FakeResponse(self.status)
+
+    async def submit_infernal_job(self, consumer_ip, consumer_port, job_id, query):
+        self.submitted.append((consumer_ip, job_id, None))
+        return FakeResponse(self.status)
+
+    async def submit_infernal_job_batch(self, consumer_ip, consumer_port, jobs):
+        self.submitted.append((consumer_ip, tuple(job_id for job_id, query in jobs), None))
+        return FakeResponse(self.status)
+
+
+class SchedulerTestCase(AioHTTPTestCase):
+    async def get_application(self):
+        logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
+        app = web.Application()
+        app.update(name='test', settings=get_postgres_credentials(ENVIRONMENT='TEST'))
+        app['consumer_client'] = FakeConsumerClient()
+        app.on_startup.append(init_pg)
+        app.on_cleanup.append(close_pg)
+        return app
+
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.job_id = str(uuid.uuid4())
+
+        # long sweep interval, so that only notifications can wake the scheduler up during the test
+        self.scheduler = Scheduler(self.app, sweep_interval=60)
+        await self.scheduler.start()
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Job.insert().values(
+                    id=self.job_id,
+                    query='AACAGCAUGAGUGCGCUGGAUGCUG',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_STATUS_CHOICES.started
+                )
+            )
+            await connection.execute(
+                Consumer.insert().values(
+                    ip='192.168.0.2',
+                    status=CONSUMER_STATUS_CHOICES.busy,
+                    job_chunk_id='infernal-job',
+                    port='8000'
+                )
+            )
+
+    async def tearDownAsync(self):
+        await self.scheduler.stop()
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DELETE FROM job_chunks')
+            await connection.execute('DELETE FROM infernal_job')
+            await connection.execute('DELETE FROM jobs')
+            await connection.execute('DELETE FROM consumer')
+
+        await super().tearDownAsync()
+
+    async def wait_for(self, condition, timeout=2):
+        start = self.loop.time()
+        while not condition() and self.loop.time() - start < timeout:
+            await asyncio.sleep(0.01)
+        return condition()
+
+    @unittest_run_loop
+    async def test_pending_job_chunk_is_dispatched_to_available_consumer(self):
+        # wait for the initial dispatch, that runs once the scheduler is listening
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                JobChunk.insert().values(
+                    job_id=self.job_id,
+                    database='mirbase',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_CHUNK_STATUS_CHOICES.pending
+                )
+            )
+
+        # there's no available consumer yet
+        assert await self.wait_for(lambda: self.scheduler.metrics['queue_depth'] == 1)
+        assert self.app['consumer_client'].submitted == []
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, job_chunk_id=NULL WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatched'] == 1)
+        assert self.app['consumer_client'].submitted == [('192.168.0.2', self.job_id, 'mirbase')]
+        assert self.scheduler.metrics['notifications'] == 2
+        assert self.scheduler.metrics['sweeps'] == 0
+        assert 0 < self.scheduler.metrics['dispatch_latency_max'] < 1
+
+    @unittest_run_loop
+    async def test_other_updates_do_not_notify(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                JobChunk.insert().values(
+                    job_id=self.job_id,
+                    database='mirbase',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_CHUNK_STATUS_CHOICES.created
+                )
+            )
+
+        await asyncio.sleep(0.2)
+        assert self.scheduler.metrics['notifications'] == 0
+        assert self.scheduler.metrics['dispatches'] == 1
+
+    @unittest_run_loop
+    async def test_job_chunk_is_released_if_consumer_fails(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+        self.app['consumer_client'].status = 500
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                JobChunk.insert().values(
+                    job_id=self.job_id,
+                    database='mirbase',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_CHUNK_STATUS_CHOICES.pending
+                )
+            )
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, job_chunk_id=NULL WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        assert await self.wait_for(lambda: self.scheduler.metrics['released'] == 1)
+
+        # the released job_chunk waits for the next notification or sweep, instead of hammering the consumer
+        await asyncio.sleep(0.2)
+        assert len(self.app['consumer_client'].submitted) <= self.scheduler.metrics['notifications']
+        assert self.scheduler.metrics['dispatched'] == 0
+
+        async with self.app['engine'].acquire() as connection:
+            status = await connection.scalar(
+                sa.text('SELECT status FROM job_chunks WHERE job_id=:job_id'), job_id=self.job_id
+            )
+            assert status == JOB_CHUNK_STATUS_CHOICES.pending
+
+    @unittest_run_loop
+    async def test_every_free_slot_is_filled(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+
+        async with self.app['engine'].acquire() as connection:
+            for database in ['mirbase', 'pombase', 'rfam']:
+                await connection.execute(
+                    JobChunk.insert().values(
+                        job_id=self.job_id,
+                        database=database,
+                        submitted=datetime.datetime.now(),
+                        status=JOB_CHUNK_STATUS_CHOICES.pending
+                    )
+                )
+            await connection.execute(
+                sa.text('INSERT INTO consumer_slot(consumer, slot, job_chunk_id) VALUES (:ip, 1, :job_chunk_id)'),
+                ip='192.168.0.2',
+                job_chunk_id='infernal-job'
+            )
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, slots=3 WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        # one of 3 slots is still busy with the infernal_job
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatched'] == 2)
+        assert [submitted[:2] for submitted in self.app['consumer_client'].submitted] == [
+            ('192.168.0.2', self.job_id), ('192.168.0.2', self.job_id)
+        ]
+        assert self.scheduler.metrics['free_slots'] == 2
+        assert self.scheduler.metrics['available_consumers'] == 1
+
+    @unittest_run_loop
+    async def test_dispatch_and_sweep_check_out_one_connection(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+        await self.scheduler.stop()
+
+        async with self.app['engine'].acquire() as connection:
+            for database in ['mirbase', 'pombase']:
+                await connection.execute(
+                    JobChunk.insert().values(
+                        job_id=self.job_id,
+                        database=database,
+                        submitted=datetime.datetime.now(),
+                        status=JOB_CHUNK_STATUS_CHOICES.pending
+                    )
+                )
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, job_chunk_id=NULL, slots=2 WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        engine = self.app['engine']
+        self.app['engine'] = CountingEngine(engine)
+        try:
+            await self.scheduler.dispatch()
+            assert self.scheduler.metrics['dispatched'] == 2
+            assert self.app['engine'].checkouts == 1
+
+            await self.scheduler.sweep()
+            assert self.app['engine'].checkouts == 2
+
+            # claims that consumers don't accept are released together
+            self.app['consumer_client'].status = 500
+            async with engine.acquire() as connection:
+                await connection.execute(sa.text('UPDATE job_chunks SET status=:status'),
+                                         status=JOB_CHUNK_STATUS_CHOICES.pending)
+
+            await self.scheduler.dispatch()
+            assert self.scheduler.metrics['released'] == 2
+            assert self.app['engine'].checkouts == 4
+        finally:
+            self.app['engine'] = engine
+
+    @unittest_run_loop
+    async def test_sweep_frees_slots_of_finished_work(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+        await self.scheduler.stop()
+
+        async with self.app['engine'].acquire() as connection:
+            infernal_job_ids = {}
+            for status in [JOB_CHUNK_STATUS_CHOICES.success, JOB_CHUNK_STATUS_CHOICES.started]:
+                infernal_job_ids[status] = await connection.scalar(
+                    InfernalJob.insert().values(
+                        job_id=self.job_id,
+                        submitted=datetime.datetime.now(),
+                        finished=datetime.datetime.now() if status == JOB_CHUNK_STATUS_CHOICES.success else None,
+                        status=status
+                    )
+                )
+
+            slots = [
+                (1, 'infernal-job', infernal_job_ids[JOB_CHUNK_STATUS_CHOICES.success]),  # finished
+                (2, 'infernal-job', infernal_job_ids[JOB_CHUNK_STATUS_CHOICES.started]),  # still running
+                (3, 'infernal-job', None),  # occupied before the infernal job was recorded
+                (4, 'infernal-job', 999999999),  # infernal job was deleted
+                (5, '999999999', None),  # job chunk was deleted
+            ]
+            for slot, job_chunk_id, infernal_job_id in slots:
+                await connection.execute(
+                    sa.text('''
+                        INSERT INTO consumer_slot(consumer, slot, job_chunk_id, infernal_job_id)
+                        VALUES (:ip, :slot, :job_chunk_id, :infernal_job_id)
+                    '''),
+                    ip='192.168.0.2',
+                    slot=slot,
+                    job_chunk_id=job_chunk_id,
+                    infernal_job_id=infernal_job_id
+                )
+
+        await self.scheduler.sweep()
+
+        async with self.app['engine'].acquire() as connection:
+            busy_slots = []
+            async for row in await connection.execute('SELECT slot FROM consumer_slot ORDER BY slot'):
+                busy_slots.append(row.slot)
+        assert busy_slots == [2, 3]
+
+    @unittest_run_loop
+    async def test_job_chunks_of_a_database_are_batched(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+        await self.scheduler.stop()
+        self.scheduler.batch_size = 3
+
+        job_ids = [self.job_id]
+        async with self.app['engine'].acquire() as connection:
+            for index in range(1, 4):
+                job_id = str(uuid.uuid4())
+                await connection.execute(
+                    Job.insert().values(
+                        id=job_id,
+                        query='AACAGCAUGAGUGCGCUGGAUGCUG',
+                        submitted=datetime.datetime.now() + datetime.timedelta(seconds=index),
+                        status=JOB_STATUS_CHOICES.started
+                    )
+                )
+                job_ids.append(job_id)
+
+            for job_id in job_ids:
+                await connection.execute(
+                    JobChunk.insert().values(
+                        job_id=job_id,
+                        database='mirbase',
+                        submitted=datetime.datetime.now(),
+                        status=JOB_CHUNK_STATUS_CHOICES.pending
+                    )
+                )
+            await connection.execute(
+                JobChunk.insert().values(
+                    job_id=self.job_id,
+                    database='pombase',
+                    submitted=datetime.datetime.now(),
+                    status=JOB_CHUNK_STATUS_CHOICES.pending
+                )
+            )
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, job_chunk_id=NULL, slots=2 WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        engine = self.app['engine']
+        self.app['engine'] = CountingEngine(engine)
+        try:
+            await self.scheduler.dispatch()
+            assert self.app['engine'].checkouts == 1
+        finally:
+            self.app['engine'] = engine
+
+        # the earliest jobs are searched in a single slot, the last one waits for a free slot
+        assert sorted(self.app['consumer_client'].submitted, key=str) == sorted([
+            ('192.168.0.2', tuple(job_ids[:3]), 'mirbase'),
+            ('192.168.0.2', self.job_id, 'pombase'),
+        ], key=str)
+        assert self.scheduler.metrics['dispatched'] == 4
+        assert self.scheduler.metrics['batched'] == 2
+
+        async with self.app['engine'].acquire() as connection:
+            status = await connection.scalar(
+                sa.text('SELECT status FROM job_chunks WHERE job_id=:job_id'), job_id=job_ids[3]
+            )
+            assert status == JOB_CHUNK_STATUS_CHOICES.pending
+
+            # a batch that the consumer doesn't accept is released as a whole
+            await connection.execute(sa.text('UPDATE job_chunks SET status=:status'),
+                                     status=JOB_CHUNK_STATUS_CHOICES.pending)
+        self.app['consumer_client'].status = 500
+        await self.scheduler.dispatch()
+        assert self.scheduler.metrics['released'] == 4
+
+        async with self.app['engine'].acquire() as connection:
+            count = await connection.scalar(
+                sa.text('SELECT count(*) FROM job_chunks WHERE status=:status'),
+                status=JOB_CHUNK_STATUS_CHOICES.pending
+            )
+            assert count == 5
+
+    @unittest_run_loop
+    async def test_infernal_jobs_are_batched(self):
+        assert await self.wait_for(lambda: self.scheduler.metrics['dispatches'] >= 1)
+        await self.scheduler.stop()
+        self.scheduler.infernal_batch_size = 3
+
+        job_ids = []
+        async with self.app['engine'].acquire() as connection:
+            for index in range(4):
+                job_id = str(uuid.uuid4())
+                submitted = datetime.datetime.now() + datetime.timedelta(seconds=index)
+                await connection.execute(
+                    Job.insert().values(id=job_id, query='AACAGCAUGAGUGCGCUGGAUGCUG', submitted=submitted,
+                                        status=JOB_STATUS_CHOICES.started)
+                )
+                await connection.execute(
+                    InfernalJob.insert().values(job_id=job_id, submitted=submitted,
+                                                status=JOB_CHUNK_STATUS_CHOICES.pending)
+                )
+                job_ids.append(job_id)
+
+            await connection.execute(
+                sa.text('UPDATE consumer SET status=:status, job_chunk_id=NULL, slots=1 WHERE ip=:ip'),
+                status=CONSUMER_STATUS_CHOICES.available,
+                ip='192.168.0.2'
+            )
+
+        await self.scheduler.dispatch()
+
+        # the earliest jobs are searched in a single slot, the last one waits for a free slot
+        assert self.app['consumer_client'].submitted == [('192.168.0.2', tuple(job_ids[:3]), None)]
+        assert self.scheduler.metrics['dispatched'] == 3
+        assert self.scheduler.metrics['batched'] == 2
+
+        async with self.app['engine'].acquire() as connection:
+            status = await connection.scalar(
+                sa.text('SELECT status FROM infernal_job WHERE job_id=:job_id'), job_id=job_ids[3]
+            )
+            assert status == JOB_CHUNK_STATUS_CHOICES.pending
+
@@ -11,15 +11,31 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
+import importlib
 import json
 import logging
 import random
+from unittest import mock
 
+import sqlalchemy as sa
+from aiohttp import web
 from aiohttp.test_utils import unittest_run_loop
 from aiohttp.test_utils import AioHTTPTestCase
+from aiojobs.aiohttp import setup as setup_aiojobs
 
-from sequence_search.producer.__main__ import create_app
+from sequence_search.consumer.rnacentral_databases import databases_release
+from sequence_search.db.models import init_pg, close_pg, Consumer, CONSUMER_STATUS_CHOICES
+from sequence_search.db.settings import get_postgres_credentials
+from sequence_search.producer import settings
+from sequence_search.producer.__main__ import create_app, refresh_databases_release
+from sequence_search.producer.scheduler import Scheduler
 from sequence_search.producer.settings import MIN_QUERY_LENGTH, MAX_QUERY_LENGTH
+from sequence_search.producer.tests.test_scheduler import FakeConsumerClient
+from sequence_search.producer.views import submit_job
+
+# the module, not the submit_job view exported by the views package
+submit_job_module = importlib.import_module('sequence_search.producer.views.submit_job')
 
 """
 Run these tests with:
@@ -68,3 +84,118 @@ class SubmitJobTestCase(AioHTTPTestCase):
             assert response.status == 400
             text = await response.text()
             assert text == "The sequence cannot be longer than %s nucleotides.\n" % MAX_QUERY_LENGTH
+
+    @unittest_run_loop
+    async def test_databases_release_is_refreshed(self):
+        # computed once at startup, not on every submitted job
+        assert self.app['databases_release'] == databases_release()
+
+        with mock.patch('sequence_search.producer.__main__.databases_release', return_value='next release'), \
+                mock.patch.object(settings, 'DATABASES_RELEASE_INTERVAL', 0.01):
+            task = asyncio.ensure_future(refresh_databases_release(self.app))
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+        assert self.app['databases_release'] == 'next release'
+
+
+class SubmitJobDispatchTestCase(AioHTTPTestCase):
+    """
+    A submitted job is sent to the free consumer slots right away, while the scheduler dispatches
+    the rest of it. Nothing should be sent twice.
+    """
+    async def get_application(self):
+        logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
+        app = web.Application()
+        app.update(name='test', settings=get_postgres_credentials(ENVIRONMENT='TEST'))
+        app['consumer_client'] = FakeConsumerClient()
+        app['databases_release'] = 'release'
+        app.on_startup.append(init_pg)
+        app.on_cleanup.append(close_pg)
+        app.router.add_post('/api/submit-job', submit_job)
+        setup_aiojobs(app)
+        return app
+
+    async def setUpAsync(self):
+        await super().setUpAsync()
+
+        self.scheduler = Scheduler(self.app, sweep_interval=60)
+        await self.scheduler.start()
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute(
+                Consumer.insert().values(ip='192.168.0.2', status=CONSUMER_STATUS_CHOICES.available, port='8000',
+                                         slots=2)
+            )
+
+        patcher = mock.patch.object(submit_job_module, 'producer_to_consumers_databases',
+                                    return_value=['mirbase-0.fasta', 'pombase-0.fasta'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def tearDownAsync(self):
+        await self.scheduler.stop()
+
+        async with self.app['engine'].acquire() as connection:
+            await connection.execute('DELETE FROM job_chunks')
+            await connection.execute('DELETE FROM infernal_job')
+            await connection.execute('DELETE FROM jobs')
+            await connection.execute('DELETE FROM consumer')
+            await connection.execute('DELETE FROM statistic')
+
+        await super().tearDownAsync()
+
+    async def statuses(self, job_id):
+        async with self.app['engine'].acquire() as connection:
+            query = sa.text('''
+                SELECT database, status FROM job_chunks WHERE job_id=:job_id
+                UNION ALL
+                SELECT 'infernal', status FROM infernal_job WHERE job_id=:job_id
+            ''')
+            return {row[0]: row[1] async for row in await connection.execute(query, job_id=job_id)}
+
+    @unittest_run_loop
+    async def test_job_is_dispatched_once(self):
+        data = json.dumps({"query": "AACAGCAUGAGUGCGCUGGAUGCUG", "databases": ["mirbase"]})
+        async with self.client.post(path='/api/submit-job', data=data) as response:
+            assert response.status == 201
+            job_id = (await response.json())['job_id']
+
+        # the infernal_job and mirbase go to the free slots, pombase is left for the scheduler
+        submitted = self.app['consumer_client'].submitted
+        for _ in range(100):
+            if len(submitted) == 3:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+
+        assert sorted(submitted, key=str) == sorted([
+            ('192.168.0.2', job_id, None),
+            ('192.168.0.2', job_id, 'mirbase-0.fasta'),
+            ('192.168.0.2', job_id, 'pombase-0.fasta'),
+        ], key=str)
+        assert await self.statuses(job_id) == {
+            'infernal': 'dispatching', 'mirbase-0.fasta': 'dispatching', 'pombase-0.fasta': 'dispatching'
+        }
+
+    @unittest_run_loop
+    async def test_rejected_work_is_released(self):
+        # the consumer doesn't accept anything, e.g. all of its slots are taken
+        self.app['consumer_client'].status = 503
+
+        data = json.dumps({"query": "AACAGCAUGAGUGCGCUGGAUGCUG", "databases": ["mirbase"]})
+        async with self.client.post(path='/api/submit-job', data=data) as response:
+            assert response.status == 201
+            job_id = (await response.json())['job_id']
+
+        submitted = self.app['consumer_client'].submitted
+        for _ in range(100):
+            if len(submitted) == 3:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+
+        # nothing is stuck in 'created' or 'dispatching', the sweep of the scheduler sends it again
+        assert await self.statuses(job_id) == {
+            'infernal': 'pending', 'mirbase-0.fasta': 'pending', 'pombase-0.fasta': 'pending'
+        }
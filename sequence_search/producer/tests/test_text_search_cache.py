@@ -0,0 +1,163 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import logging
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+from sequence_search.producer.text_search_cache import TextSearchCache
+
+
+"""
+Run these tests with:
+
+ENVIRONMENT=TEST python3 -m unittest sequence_search.producer.tests.test_text_search_cache
+"""
+
+
+class FakeMemcached(object):
+    """Local memcached server that understands just enough of the text protocol for get and set"""
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                command, key, *args = line.decode().split()
+                self.commands.append((command, key, args))
+
+                if command == 'get':
+                    if key in self.data:
+                        flags, value = self.data[key]
+                        writer.write(b'VALUE %s %s %d\r\n%s\r\n' % (key.encode(), flags, len(value), value))
+                    writer.write(b'END\r\n')
+                elif command == 'set':
+                    flags, expire, length = args[:3]
+                    value = (await reader.readexactly(int(length) + 2))[:-2]
+                    self.data[key] = (flags.encode(), value)
+                    if 'noreply' not in args:
+                        writer.write(b'STORED\r\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class TextSearchCacheTestCase(AioHTTPTestCase):
+    async def get_application(self):
+        logging.basicConfig(level=logging.ERROR)  # subdue messages like 'DEBUG:asyncio:Using selector: KqueueSelector'
+        return web.Application()
+
+    async def setUpAsync(self):
+        await super().setUpAsync()
+        self.memcached = FakeMemcached()
+        self.port = await self.memcached.start()
+        self.cache = TextSearchCache('127.0.0.1', self.port, pool_size=4, ttl=300, lru_size=2)
+        self.calls = 0
+
+    async def tearDownAsync(self):
+        await self.cache.close()
+        await self.memcached.stop()
+        await super().tearDownAsync()
+
+    async def text_search(self):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return {'entries': [], 'facets': [], 'hitCount': self.calls}
+
+    def memcached_commands(self, command):
+        return [(key, args) for (name, key, args) in self.memcached.commands if name == command]
+
+    @unittest_run_loop
+    async def test_concurrent_requests_are_coalesced(self):
+        values = await asyncio.gather(*[self.cache.get_or_create('key', self.text_search) for _ in range(10)])
+
+        assert self.calls == 1
+        assert all(value == {'entries': [], 'facets': [], 'hitCount': 1} for value in values)
+        assert self.cache.metrics['coalesced'] == 9
+
+        # one lookup and one write with ttl
+        assert len(self.memcached_commands('get')) == 1
+        assert [(key, args[1]) for key, args in self.memcached_commands('set')] == [('key', '300')]
+
+    @unittest_run_loop
+    async def test_lru_and_memcached_tiers(self):
+        await self.cache.get_or_create('key', self.text_search)
+
+        # served from the lru, memcached is not asked again
+        assert (await self.cache.get_or_create('key', self.text_search))['hitCount'] == 1
+        assert self.cache.metrics['lru_hits'] == 1
+        assert len(self.memcached_commands('get')) == 1
+
+        # another producer finds the value in memcached
+        cache = TextSearchCache('127.0.0.1', self.port, pool_size=1)
+        try:
+            assert (await cache.get_or_create('key', self.text_search))['hitCount'] == 1
+            assert cache.metrics['memcached_hits'] == 1
+        finally:
+            await cache.close()
+        assert self.calls == 1
+
+        # the least recently used entry is evicted from the lru, but stays in memcached
+        await self.cache.get_or_create('other-key', self.text_search)
+        await self.cache.get_or_create('third-key', self.text_search)
+        assert list(self.cache.lru.keys()) == ['other-key', 'third-key']
+
+        assert (await self.cache.get_or_create('key', self.text_search))['hitCount'] == 1
+        assert self.cache.metrics['memcached_hits'] == 1
+        assert self.calls == 3
+
+    @unittest_run_loop
+    async def test_memcached_is_not_available(self):
+        await self.memcached.stop()
+        cache = TextSearchCache('127.0.0.1', self.port, pool_size=1)
+        try:
+            assert (await cache.get_or_create('key', self.text_search))['hitCount'] == 1
+            assert cache.metrics['errors'] == 2  # get and set
+            assert self.calls == 1
+        finally:
+            await cache.close()
+
+        # restart the server for tearDown
+        self.port = await self.memcached.start()
+
+    @unittest_run_loop
+    async def test_errors_are_not_cached(self):
+        async def failing_text_search():
+            self.calls += 1
+            raise ConnectionError('EBI search is down')
+
+        results = await asyncio.gather(
+            *[self.cache.get_or_create('key', failing_text_search) for _ in range(3)],
+            return_exceptions=True
+        )
+        assert all(isinstance(result, ConnectionError) for result in results)
+        assert self.calls == 1
+        assert self.memcached_commands('set') == []
+
+        assert (await self.cache.get_or_create('key', self.text_search))['hitCount'] == 2
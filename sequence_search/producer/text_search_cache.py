@@ -0,0 +1,127 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pymemcache import serde
+from pymemcache.client.base import PooledClient
+
+
+class TextSearchCache(object):
+    """
+    Cache of EBI text search results, shared by all the requests of the producer.
+
+    Lookups go to an in-process LRU first and then to memcached. Memcached is accessed through
+    a pool of connections in a thread pool of the same size, so that its blocking calls don't block
+    the event loop. Concurrent requests for the same missing key are coalesced: only one of them
+    calls EBI search, the others wait for its result.
+
+    Memcached errors are logged and treated as cache misses, text search works without the cache.
+    """
+    def __init__(self, host, port=11211, pool_size=8, ttl=3600, lru_size=256, timeout=1):
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self.lru = OrderedDict()  # key -> (expires, value)
+        self.inflight = {}  # key -> task, that gets the value from memcached or creates it
+
+        self.client = PooledClient(
+            (host, port),
+            serde=serde.PickleSerde(pickle_version=2),
+            connect_timeout=timeout,
+            timeout=timeout,
+            max_pool_size=pool_size
+        )
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+        self.metrics = {
+            'lru_hits': 0,
+            'memcached_hits': 0,
+            'misses': 0,  # values created by calling the factory, e.g. EBI search
+            'coalesced': 0,  # requests that waited for the value requested by another request
+            'errors': 0,  # failed memcached calls
+        }
+
+    async def close(self):
+        self.client.close()
+        self.executor.shutdown(wait=False)
+
+    async def get_or_create(self, key, factory):
+        """
+        Returns cached value of the key or creates it with `await factory()` and caches it.
+
+        :param key: memcached key, e.g. md5 hexdigest of the request parameters
+        :param factory: coroutine function that creates the value (None values are not cached)
+        :return: value
+        """
+        value = self.lru_get(key)
+        if value is not None:
+            self.metrics['lru_hits'] += 1
+            return value
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load(key, factory))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+            self.inflight[key] = task
+        else:
+            self.metrics['coalesced'] += 1
+
+        # a cancelled request must not cancel the value awaited by other requests
+        return await asyncio.shield(task)
+
+    async def load(self, key, factory):
+        value = await self.memcached('get', key)
+        if value is not None:
+            self.metrics['memcached_hits'] += 1
+        else:
+            self.metrics['misses'] += 1
+            value = await factory()
+            if value is not None:
+                await self.memcached('set', key, value, expire=self.ttl, noreply=True)
+
+        if value is not None:
+            self.lru_set(key, value)
+        return value
+
+    async def memcached(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self.executor, lambda: getattr(self.client, method)(*args, **kwargs))
+        except Exception as e:
+            self.metrics['errors'] += 1
+            logging.warning("Memcached %s failed: %s" % (method, str(e)))
+            return None
+
+    def lru_get(self, key):
+        try:
+            expires, value = self.lru[key]
+        except KeyError:
+            return None
+
+        if expires < time.monotonic():
+            del self.lru[key]
+            return None
+
+        self.lru.move_to_end(key)
+        return value
+
+    def lru_set(self, key, value):
+        self.lru[key] = (time.monotonic() + self.ttl, value)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
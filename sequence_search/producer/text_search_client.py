@@ -12,7 +12,9 @@ limitations under the License.
 """
 import aiohttp
 import socket
+import time
 
+from .metrics import EBI_SEARCH_SECONDS
 from .settings import EBI_SEARCH_PROXY_URL, PROJECT_ROOT
 
 
@@ -72,7 +74,7 @@ facetfields = [
 ]
 
 
-async def get_text_search_results(results, job_id, query, start, size, facetcount, ENVIRONMENT):
+async def get_text_search_results(rnacentral_ids, job_id, query, start, size, facetcount, ENVIRONMENT):
     """
     For local development local server has to POST list of RNAcentral ids
     to the EMBASSY cloud machine and retrieve results from there.
@@ -80,7 +82,7 @@ async def get_text_search_results(results, job_id, query, start, size, facetcoun
     if ENVIRONMENT != "PRODUCTION":
         # send the list of rnacentral_ids to the proxy, fallback to
         # returning the plain results, if text search unavailable
-        rnacentral_ids = "\n".join([result['rnacentral_id'] for result in results])
+        rnacentral_ids = "\n".join(rnacentral_ids)
         url = EBI_SEARCH_PROXY_URL + '/' + job_id
         headers = {'content-type': 'text/plain'}
 
@@ -113,14 +115,20 @@ async def get_text_search_results(results, job_id, query, start, size, facetcoun
         .format(ebi_search_url=ebi_search_url, job_id=job_id, query=query, fields=','.join(fields),
                 facetcount=facetcount, facetfields=','.join(facetfields), start=start, size=size)
 
+    start = time.perf_counter()
+    status = 'error'
     try:
         # using default timeout. It means that the whole operation should finish in 5 minutes.
         # large timeout prevents facet errors
         async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout()) as session:
             async with session.get(url) as response:
                 if response.status < 400:
-                    return await response.json()
+                    results = await response.json()
+                    status = 'success'
+                    return results
                 else:
                     raise EBITextSearchConnectionError()
     except Exception as e:
         raise EBITextSearchConnectionError() from e
+    finally:
+        EBI_SEARCH_SECONDS.labels(status).observe(time.perf_counter() - start)
@@ -15,7 +15,7 @@ import os
 from aiohttp_swagger import setup_swagger
 from .views import index, submit_job, job_status, job_result, rnacentral_databases, job_results_urs_list, \
     facets, facets_search, list_rnacentral_ids, post_rnacentral_ids, consumers_statuses, jobs_statuses, show_searches, \
-    infernal_job_result, infernal_status, r2dt
+    infernal_job_result, infernal_status, r2dt, scheduler_metrics, job_result_alignment, metrics
 from . import settings
 
 
@@ -25,6 +25,8 @@ def setup_routes(app):
     app.router.add_get('/api/job-status/{job_id:[A-Za-z0-9_-]+}', job_status, name='job-status')
     app.router.add_get('/api/jobs-statuses', jobs_statuses, name='jobs-statuses')
     app.router.add_get('/api/job-result/{job_id:[A-Za-z0-9_-]+}', job_result, name='job-result')
+    app.router.add_get('/api/job-result/{job_id:[A-Za-z0-9_-]+}/alignment/{result_id:[0-9]+}', job_result_alignment,
+                       name='job-result-alignment')
     app.router.add_get('/api/rnacentral-databases', rnacentral_databases, name='rnacentral-databases')
     app.router.add_get('/api/job-results-urs-list/{job_id:[A-Za-z0-9_-]+}', job_results_urs_list, name='job-results-urs-list')
     app.router.add_get('/api/facets/{job_id:[A-Za-z0-9_-]+}', facets, name='facets')
@@ -33,6 +35,8 @@ def setup_routes(app):
     app.router.add_post('/api/post-rnacentral-ids/{job_id:[A-Za-z0-9_-]+}', post_rnacentral_ids, name='post-rnacentral-ids')
     app.router.add_get('/api/consumers-statuses', consumers_statuses, name='consumers-statuses')
     app.router.add_get('/api/show-searches', show_searches, name='show-searches')
+    app.router.add_get('/api/scheduler-metrics', scheduler_metrics, name='scheduler-metrics')
+    app.router.add_get('/metrics', metrics, name='metrics')
     app.router.add_get('/api/infernal-status/{job_id:[A-Za-z0-9_-]+}', infernal_status, name='infernal-status')
     app.router.add_get('/api/infernal-result/{job_id:[A-Za-z0-9_-]+}', infernal_job_result, name='infernal-job-result')
     app.router.add_patch('/api/r2dt/{job_id:[A-Za-z0-9_-]+}', r2dt, name='r2dt')
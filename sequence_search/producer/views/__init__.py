@@ -16,6 +16,7 @@ from .job_chunk_heartbeat import job_chunk_heartbeat
 from .job_status import job_status
 from .jobs_statuses import jobs_statuses
 from .job_result import job_result
+from .job_result_alignment import job_result_alignment
 from .submit_job import submit_job
 from .rnacentral_databases import rnacentral_databases
 from .job_results_urs_list import job_results_urs_list
@@ -28,3 +29,5 @@ from .show_searches import show_searches
 from .infernal_job_result import infernal_job_result
 from .infernal_status import infernal_status
 from .r2dt import r2dt
+from .scheduler_metrics import scheduler_metrics
+from .metrics import metrics
@@ -16,10 +16,8 @@ import hashlib
 
 from aiohttp import web
 from aiojobs.aiohttp import atomic
-from pymemcache.client import base
-from pymemcache import serde
 
-from ...db.jobs import get_job_results, get_job, job_exists, set_job_ordering
+from ...db.jobs import get_job_results, get_job_result_ids, get_job, job_exists, set_job_ordering
 from ..text_search_client import get_text_search_results, ProxyConnectionError, EBITextSearchConnectionError, \
     facetfields
 
@@ -95,6 +93,12 @@ async def facets_search(request):
       description: How to order results - by 'e_value', '-e_value', 'identity', '-identity', 'query_coverage', '-query_coverage', 'target_coverage' or '-target_coverage'.
       type: string
       required: false
+    - name: alignment
+      in: query
+      description: If 'true', entries include their alignments. By default, alignments are fetched one by one
+        from the job-result-alignment endpoint, using the id of each entry.
+      type: string
+      required: false
     responses:
       200:
         description: Ok
@@ -114,6 +118,7 @@ async def facets_search(request):
     size = request.query['size'] if 'size' in request.query else 20
     facetcount = request.query['facetcount'] if 'facetcount' in request.query else 100
     ordering = request.query['ordering'] if 'ordering' in request.query else 'e_value'
+    alignment = request.query.get('alignment') == 'true'
 
     # set ordering, so that EBI text search returns entries in correct order
     await set_job_ordering(request.app['engine'], job_id, ordering)
@@ -124,46 +129,38 @@ async def facets_search(request):
     status = job['status']
     hits = job['hits']
 
-    # get sequence search results from the database, sort/aggregate?
-    results = await get_job_results(request.app['engine'], job_id)
-
     # try to get facets from EBI text search, otherwise stub facets
     try:
         ENVIRONMENT = request.app['settings'].ENVIRONMENT
 
-        # we want to cache the EBI Search result
-        ip_address = '192.168.0.8' if ENVIRONMENT == 'PRODUCTION' else 'localhost'
-        client = base.Client((ip_address, 11211),
-                             serializer=serde.get_python_memcache_serializer(pickle_version=2),
-                             deserializer=serde.python_memcache_deserializer)
-
-        # create a hash with query parameters
-        text_search_key = hashlib.md5(
-            (job_id + query + str(start) + str(size) + str(facetcount) + ordering).encode('utf-8')
-        ).hexdigest()
-
-        # check if the result is cached
-        cached_result = client.get(text_search_key)
+        async def text_search():
+            # get rnacentral_ids of sequence search results from the database, ordered by postgres,
+            # only if the text search is not cached
+            rnacentral_ids = await get_job_result_ids(request.app['engine'], job_id, ordering)
 
-        if cached_result:
-            text_search_data = cached_result
-            logging.debug("Using cache. This is the key used: {}".format(text_search_key))
-        else:
             text_search_data = await get_text_search_results(
-                results, job_id, query, start, size, facetcount, ENVIRONMENT
+                rnacentral_ids, job_id, query, start, size, facetcount, ENVIRONMENT
+            )
+
+            # if this worked, inject sequence search results of this page into facets json
+            results = await get_job_results(
+                request.app['engine'],
+                job_id,
+                ordering,
+                alignment=alignment,
+                rnacentral_ids=[entry['id'] for entry in text_search_data['entries']]
             )
+            results = {result['rnacentral_id']: result for result in results}
 
-            # if this worked, inject text search results into facets json
             for entry in text_search_data['entries']:
-                for result in results:
-                    if result['rnacentral_id'] == entry['id']:
-                        try:
-                            result['description'] = entry['fields']['description'][0]
-                        except (KeyError, IndexError) as e:
-                            result['description'] = result['rnacentral_id']
-                            logging.debug("Error - description not found for rnacentral_id {}".format(result['rnacentral_id']))
-                        entry.update(result)
-                        break
+                result = results.get(entry['id'])
+                if result is not None:
+                    try:
+                        result['description'] = entry['fields']['description'][0]
+                    except (KeyError, IndexError) as e:
+                        result['description'] = result['rnacentral_id']
+                        logging.debug("Error - description not found for rnacentral_id {}".format(result['rnacentral_id']))
+                    entry.update(result)
 
             # sort facets in the same order as in text_search_client
             text_search_data['facets'].sort(key=lambda el: facetfields.index(el['id']))
@@ -183,8 +180,15 @@ async def facets_search(request):
             # text search worked successfully, unset text search error flag
             text_search_data['textSearchError'] = False
 
-            # cache the result
-            client.set(text_search_key, text_search_data)
+            return text_search_data
+
+        # create a hash with query parameters
+        text_search_key = hashlib.md5(
+            (job_id + query + str(start) + str(size) + str(facetcount) + ordering + str(alignment)).encode('utf-8')
+        ).hexdigest()
+
+        # we want to cache the EBI Search result, concurrent requests for the same key run only one text search
+        text_search_data = await request.app['text_search_cache'].get_or_create(text_search_key, text_search)
 
     except (ProxyConnectionError, EBITextSearchConnectionError) as e:
         # text search is not available, pad output with facets stub, indicate that we have a text search error
@@ -193,16 +197,15 @@ async def facets_search(request):
         text_search_data = {
             'entries': [],
             'facets': [],
-            'hitCount': len(results),
+            'hitCount': len(await get_job_result_ids(request.app['engine'], job_id, ordering)),
             'sequence': sequence,
             'sequenceSearchStatus': status,
             'textSearchError': True
         }
 
-        # populate text search entries with sequence search results, paginate
-        start = int(start)
-        size = int(size)
-        for result in results[start:start+size]:
-            text_search_data['entries'].append(result)
+        # populate text search entries with a page of sequence search results
+        text_search_data['entries'] = await get_job_results(
+            request.app['engine'], job_id, ordering, start=int(start), size=int(size), alignment=alignment
+        )
 
     return web.json_response(text_search_data)
@@ -14,8 +14,9 @@ limitations under the License.
 from aiohttp import web
 from aiojobs.aiohttp import atomic
 
-from ...db.jobs import get_infernal_job_results
+from ...db.jobs import get_infernal_job_results, stream_infernal_job_results
 from ...db import DatabaseConnectionError
+from ..streaming import stream_format, stream_json
 
 
 @atomic
@@ -35,6 +36,12 @@ async def infernal_job_result(request):
       description: Unique job identification
       type: string
       required: true
+    - name: stream
+      in: query
+      description: Results are streamed as they are read from the database, either as a JSON array ('json',
+        the same as the default response) or as NDJSON, one result per line ('ndjson').
+      type: string
+      required: false
     responses:
       200:
         description: Ok
@@ -45,6 +52,10 @@ async def infernal_job_result(request):
     engine = request.app['engine']
 
     try:
+        content_type = stream_format(request)
+        if content_type:
+            return await stream_json(request, stream_infernal_job_results(engine, job_id), content_type)
+
         results = await get_infernal_job_results(engine, job_id)
     except DatabaseConnectionError as e:
         raise web.HTTPNotFound() from e
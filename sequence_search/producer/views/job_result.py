@@ -14,8 +14,9 @@ limitations under the License.
 from aiohttp import web
 from aiojobs.aiohttp import atomic
 
-from ...db.jobs import get_job_results
+from ...db.jobs import get_job_results, stream_job_results
 from ...db import DatabaseConnectionError
+from ..streaming import stream_format, stream_json
 
 
 @atomic
@@ -35,6 +36,18 @@ async def job_result(request):
       description: Unique job identification
       type: string
       required: true
+    - name: alignment
+      in: query
+      description: If 'true', results include their alignments. By default, results are summaries and
+        alignments are fetched one by one from the job-result-alignment endpoint.
+      type: string
+      required: false
+    - name: stream
+      in: query
+      description: Results are streamed as they are read from the database, either as a JSON array ('json',
+        the same as the default response) or as NDJSON, one result per line ('ndjson').
+      type: string
+      required: false
     responses:
       200:
         description: Ok
@@ -43,9 +56,14 @@ async def job_result(request):
     """
     job_id = request.match_info['job_id']
     engine = request.app['engine']
+    alignment = request.query.get('alignment') == 'true'
 
     try:
-        results = await get_job_results(engine, job_id)
+        content_type = stream_format(request)
+        if content_type:
+            return await stream_json(request, stream_job_results(engine, job_id, alignment=alignment), content_type)
+
+        results = await get_job_results(engine, job_id, alignment=alignment)
     except DatabaseConnectionError as e:
         raise web.HTTPNotFound() from e
 
@@ -0,0 +1,60 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from aiohttp import web
+from aiojobs.aiohttp import atomic
+
+from ...db.jobs import get_job_result_alignment
+from ...db import DatabaseConnectionError, SQLError, DoesNotExist
+
+
+@atomic
+async def job_result_alignment(request):
+    """
+    Function that returns the alignment of a single result of a job
+    :param request: used to get job_id, result_id and params to connect to the db
+    :return: json object
+
+    ---
+    tags:
+    - Jobs
+    summary: Shows the alignment of a single result of a job
+    parameters:
+    - name: job_id
+      in: path
+      description: Unique job identification
+      type: string
+      required: true
+    - name: result_id
+      in: path
+      description: Id of the result, as returned by job-result and facets-search
+      type: integer
+      required: true
+    responses:
+      200:
+        description: Ok
+      404:
+        description: Not found (probably, job with this job_id doesn't have a result with this result_id)
+    """
+    job_id = request.match_info['job_id']
+    result_id = int(request.match_info['result_id'])
+    engine = request.app['engine']
+
+    try:
+        alignment = await get_job_result_alignment(engine, job_id, result_id)
+    except DoesNotExist as e:
+        raise web.HTTPNotFound(text=str(e)) from e
+    except (DatabaseConnectionError, SQLError) as e:
+        raise web.HTTPNotFound() from e
+
+    return web.json_response(alignment)
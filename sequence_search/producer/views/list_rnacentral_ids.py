@@ -14,7 +14,7 @@ limitations under the License.
 from aiohttp import web
 from aiojobs.aiohttp import atomic
 
-from ...db.jobs import get_job_results
+from ...db.jobs import get_job_result_ids
 from ..text_search_client import rnacentral_ids_file_path
 
 
@@ -42,8 +42,7 @@ async def list_rnacentral_ids(request):
 
     # try getting sequence search results from the database, return as plaintext list
     try:
-        results = await get_job_results(request.app['engine'], job_id)
-        ids = [result['rnacentral_id'] for result in results]
+        ids = await get_job_result_ids(request.app['engine'], job_id)
         if not ids:
             return web.HTTPNotFound()
         data = "\n".join(ids)
@@ -0,0 +1,35 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+
+async def metrics(request):
+    """
+    Metrics of the producer in prometheus format, see metrics.py.
+    :param request: used to get the registry of the app
+    :return: text
+
+    ---
+    tags:
+    - Dashboard
+    summary: Prometheus metrics of the producer
+    parameters: []
+    responses:
+      200:
+        description: Ok
+    """
+    body = generate_latest(REGISTRY) + generate_latest(request.app['metrics'])
+    return web.Response(body=body, headers={'Content-Type': CONTENT_TYPE_LATEST})
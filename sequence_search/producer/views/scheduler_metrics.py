@@ -0,0 +1,38 @@
+"""
+Copyright [2009-present] EMBL-European Bioinformatics Institute
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from aiohttp import web
+
+
+async def scheduler_metrics(request):
+    """
+    Queue depth and dispatch latency of the scheduler.
+    :param request: used to get the scheduler
+    :return: json object
+
+    ---
+    tags:
+    - Dashboard
+    summary: Shows the metrics of the scheduler
+    parameters: []
+    responses:
+      200:
+        description: Ok
+      404:
+        description: Not Found
+    """
+    scheduler = request.app.get('scheduler')
+    if scheduler is None:
+        raise web.HTTPNotFound(text="Scheduler is not running")
+
+    return web.json_response(scheduler.metrics)
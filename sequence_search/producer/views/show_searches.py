@@ -13,46 +13,31 @@ limitations under the License.
 import datetime
 from aiohttp import web
 
+from ...db.statistic import get_searches_summary
 
-def convert_average_time(records):
-    result = []
-    for row in records:
-        item = dict(row.items())
-        item['avg_time'] = str(datetime.timedelta(seconds=int(item['avg_time'].seconds))) if item['avg_time'] else 0
-        result.append(item)
-    return result
+
+def convert_average_time(summary):
+    return {
+        'count': summary['count'],
+        'avg_time': str(datetime.timedelta(seconds=int(summary['avg_time'].seconds))) if summary['avg_time'] else 0
+    }
 
 
 async def show_searches(request):
     async with request.app['engine'].acquire() as conn:
-        query = "SELECT count(*), avg(finished - submitted) as avg_time FROM jobs " \
-                "WHERE (description !='sequence-search-test' OR description IS NULL) "
-
-        # number of searches and average time in the last 24 hours
-        last_24_hours = await conn.execute(
-            query + "AND submitted > %s", datetime.datetime.now() - datetime.timedelta(days=1)
-        )
-        last_24_hours_records = await last_24_hours.fetchall()
-        last_24_hours_result = convert_average_time(last_24_hours_records)
-
-        high_priority_24_hours = await conn.execute(
-            query + "AND priority != 'low' AND submitted > %s", datetime.datetime.now() - datetime.timedelta(days=1)
-        )
-        high_priority_24_hours_records = await high_priority_24_hours.fetchall()
-        high_priority_24_hours_result = convert_average_time(high_priority_24_hours_records)
-
-        # number of searches and average time in the last 7 days
-        last_week = await conn.execute(
-            query + "AND submitted > %s", datetime.datetime.now() - datetime.timedelta(days=7)
+        # number of searches and average time in the last 24 hours and in the last 7 days,
+        # read from the hourly rollups of the searches (see db/statistic.py)
+        last_24_hours = datetime.datetime.now() - datetime.timedelta(days=1)
+        last_24_hours_result = convert_average_time(await get_searches_summary(conn, last_24_hours))
+        high_priority_24_hours_result = convert_average_time(
+            await get_searches_summary(conn, last_24_hours, high_priority=True)
         )
-        last_week_records = await last_week.fetchall()
-        last_week_result = convert_average_time(last_week_records)
 
-        high_priority_last_week = await conn.execute(
-            query + "AND priority != 'low' AND submitted > %s", datetime.datetime.now() - datetime.timedelta(days=7)
+        last_week = datetime.datetime.now() - datetime.timedelta(days=7)
+        last_week_result = convert_average_time(await get_searches_summary(conn, last_week))
+        high_priority_last_week_result = convert_average_time(
+            await get_searches_summary(conn, last_week, high_priority=True)
         )
-        high_priority_last_week_records = await high_priority_last_week.fetchall()
-        high_priority_last_week_result = convert_average_time(high_priority_last_week_records)
 
         # get data from statistic table
         searches_per_month_query = await conn.execute("SELECT period,source,total FROM statistic ORDER BY period")
@@ -97,10 +82,10 @@ async def show_searches(request):
                         value.append({period: total})
 
         response = {
-            "last_24_hours_result": last_24_hours_result[0],
-            "last_week_result": last_week_result[0],
-            "high_priority_24_hours_result": high_priority_24_hours_result[0],
-            "high_priority_last_week_result": high_priority_last_week_result[0],
+            "last_24_hours_result": last_24_hours_result,
+            "last_week_result": last_week_result,
+            "high_priority_24_hours_result": high_priority_24_hours_result,
+            "high_priority_last_week_result": high_priority_last_week_result,
             "searches_per_month": searches_per_month,
             "expert_db_results": expert_db_results
         }
@@ -20,11 +20,15 @@ from urllib.parse import urlparse
 
 from sequence_search.db.models import JOB_CHUNK_STATUS_CHOICES
 from sequence_search.producer.settings import MIN_QUERY_LENGTH, MAX_QUERY_LENGTH
-from ...db.consumers import delegate_job_chunk_to_consumer, find_available_consumers, delegate_infernal_job_to_consumer
-from ...db.jobs import find_highest_priority_jobs, save_job, sequence_exists, database_used_in_search
-from ...db.job_chunks import save_job_chunk, set_job_chunk_status
-from ...db.infernal_job import save_infernal_job
-from ...db.statistic import create_statistic, get_statistic, update_statistic
+from ...db import unit_of_work
+from ...db.consumers import delegate_job_chunk_to_consumer, find_available_consumer_slots, \
+    delegate_infernal_job_to_consumer
+from ...db.jobs import find_highest_priority_jobs, save_job, search_key, find_cached_job
+from ...db.job_chunks import save_job_chunk, set_job_chunk_status, claim_created_job_chunks, release_job_chunks
+from ...db.infernal_job import save_infernal_job, set_infernal_job_status, claim_created_infernal_job, \
+    release_infernal_jobs
+from ...db.statistic import count_search
+from ..metrics import JOBS_SUBMITTED, CACHED_SEARCHES
 from ...consumer.rnacentral_databases import producer_validator, producer_to_consumers_databases
 
 
@@ -124,22 +128,19 @@ async def submit_job(request):
     # database that the user wants to use to perform the search
     databases = producer_to_consumers_databases(data['databases'])
 
-    # check if this query has already been searched
-    job_list = await sequence_exists(request.app['engine'], data['query'])
+    # check if this query has already been searched against the same databases release (see on_startup)
+    key = search_key(data['query'], databases, request.app['databases_release'])
 
-    job_id = None
-    if job_list:
-        # check the database used in each job_id.
-        # set job_id if the database used is the same as in "databases"
-        for job in job_list:
-            if await database_used_in_search(request.app['engine'], job, databases):
-                job_id = job
-                break
+    # the request checks out a single connection, that is released before the consumers are called
+    consumers = []
+    async with unit_of_work(request.app['engine'], transaction=False) as connection:
+        job_id = await find_cached_job(connection, key)
+        if job_id:
+            CACHED_SEARCHES.inc()
+            return web.json_response({"job_id": job_id}, status=201)
 
-    # do the search if the data is not in the database
-    if not job_id:
-        # check for unfinished jobs
-        unfinished_job = await find_highest_priority_jobs(request.app['engine'])
+        # do the search if the data is not in the database, check for unfinished jobs
+        unfinished_job = await find_highest_priority_jobs(connection)
 
         # get URL - for statistical purposes
         try:
@@ -186,88 +187,75 @@ async def submit_job(request):
         if data["description"] == "sequence-search-test":
             priority = "db-seq-test"
         else:
-            period = datetime.today().strftime('%Y-%m')
-            statistic = await get_statistic(request.app['engine'], source, period)
+            await count_search(connection, source, datetime.today().strftime('%Y-%m'))
 
-            if statistic:
-                await update_statistic(
-                    request.app['engine'], statistic['statistic_id'], statistic['statistic_total'] + 1
-                )
-            else:
-                await create_statistic(request.app['engine'], source, period)
-
-        # save metadata about this job to the database
-        job_id = await save_job(request.app['engine'], data['query'], data['description'], url, priority)
+        # save metadata about this job, its job_chunks and infernal_job to the database, all or nothing
+        async with connection.begin():
+            job_id = await save_job(connection, data['query'], data['description'], url, priority, key)
 
-        # save metadata about job_chunks to the database
-        # TODO: what if Job was saved and JobChunk was not? Need transactions?
-        for database in databases:
-            # save job_chunk with "created" status. This prevents the check_chunks_and_consumers function,
-            # which runs every 5 seconds, from executing the same job_chunk again.
-            await save_job_chunk(request.app['engine'], job_id, database)
+            for database in databases:
+                # save job_chunk with "created" status. This prevents the scheduler, which runs whenever a job_chunk
+                # becomes pending or a consumer becomes available, from executing the same job_chunk again.
+                await save_job_chunk(connection, job_id, database)
 
-        # save metadata about infernal_job to the database
-        # TODO: what if Job was saved and InfernalJob was not? Need transactions?
-        await save_infernal_job(request.app['engine'], job_id, priority)
+            await save_infernal_job(connection, job_id, priority)
+        JOBS_SUBMITTED.labels(priority).inc()
 
         # if there are unfinished jobs, change the status of each new job_chunk to pending;
-        # otherwise try starting the job
-        if unfinished_job:
-            for database in databases:
-                try:
-                    await set_job_chunk_status(
-                        request.app['engine'],
-                        job_id,
-                        database,
-                        status=JOB_CHUNK_STATUS_CHOICES.pending
-                    )
-                except Exception as e:
-                    return web.HTTPBadGateway(text=str(e))
-        else:
-            # check for available consumers
-            consumers = await find_available_consumers(request.app['engine'])
-
-            # if consumers are available, delegate to infernal_job first
-            if consumers:
-                consumer = consumers.pop(0)
-
-                try:
-                    await delegate_infernal_job_to_consumer(
-                        engine=request.app['engine'],
-                        consumer_ip=consumer.ip,
-                        consumer_port=consumer.port,
-                        job_id=job_id,
-                        query=data['query'],
-                        consumer_client=request.app['consumer_client']
-                    )
-                except Exception as e:
-                    return web.HTTPBadGateway(text=str(e))
-
-            # after infernal_job, delegate consumers to job_chunks
-            for index in range(min(len(consumers), len(databases))):
-                try:
-                    await delegate_job_chunk_to_consumer(
-                        engine=request.app['engine'],
-                        consumer_ip=consumers[index].ip,
-                        consumer_port=consumers[index].port,
-                        job_id=job_id,
-                        database=databases[index],
-                        query=data['query'],
-                        consumer_client=request.app['consumer_client']
-                    )
-                except Exception as e:
-                    return web.HTTPBadGateway(text=str(e))
-
-            # if no consumer is available, change the status of the remaining job_chunks to pending
-            for index in range(len(consumers), len(databases)):
-                try:
-                    await set_job_chunk_status(
-                        request.app['engine'],
-                        job_id,
-                        databases[index],
-                        status=JOB_CHUNK_STATUS_CHOICES.pending
-                    )
-                except Exception as e:
-                    return web.HTTPBadGateway(text=str(e))
+        # otherwise try starting the job on the free slots of available consumers
+        if not unfinished_job:
+            consumers = await find_available_consumer_slots(connection)
+
+        # the work sent to consumers below is claimed first ('dispatching'), the rest waits for the scheduler
+        # (the first consumer, if any, runs the infernal_job)
+        try:
+            async with connection.begin():
+                if consumers:
+                    infernal_job_id = await claim_created_infernal_job(connection, job_id)
+                    claimed = await claim_created_job_chunks(connection, job_id, databases[:len(consumers) - 1])
+                    job_chunk_ids = {job_chunk.database: job_chunk.id for job_chunk in claimed}
+                else:
+                    await set_infernal_job_status(connection, job_id, status=JOB_CHUNK_STATUS_CHOICES.pending)
+
+                for database in databases[max(len(consumers) - 1, 0):]:
+                    await set_job_chunk_status(connection, job_id, database, status=JOB_CHUNK_STATUS_CHOICES.pending)
+        except Exception as e:
+            return web.HTTPBadGateway(text=str(e))
+
+    # if consumers are available, delegate to infernal_job first;
+    # whatever a consumer doesn't accept is released to 'pending' and sent again by the scheduler
+    if consumers:
+        consumer = consumers.pop(0)
+
+        try:
+            delegated = await delegate_infernal_job_to_consumer(
+                engine=request.app['engine'],
+                consumer_ip=consumer.ip,
+                consumer_port=consumer.port,
+                job_id=job_id,
+                query=data['query'],
+                consumer_client=request.app['consumer_client']
+            )
+            if not delegated:
+                await release_infernal_jobs(request.app['engine'], [infernal_job_id])
+        except Exception as e:
+            return web.HTTPBadGateway(text=str(e))
+
+    # after infernal_job, delegate consumers to job_chunks
+    for index in range(min(len(consumers), len(databases))):
+        try:
+            delegated = await delegate_job_chunk_to_consumer(
+                engine=request.app['engine'],
+                consumer_ip=consumers[index].ip,
+                consumer_port=consumers[index].port,
+                job_id=job_id,
+                database=databases[index],
+                query=data['query'],
+                consumer_client=request.app['consumer_client']
+            )
+            if not delegated:
+                await release_job_chunks(request.app['engine'], [job_chunk_ids[databases[index]]])
+        except Exception as e:
+            return web.HTTPBadGateway(text=str(e))
 
     return web.json_response({"job_id": job_id}, status=201)